@@ -42,6 +42,30 @@ class Settings(BaseSettings):
     # RPA Search Delays (antibot protection)
     rpa_search_delay_sec: float = Field(default=1.0, env="RPA_SEARCH_DELAY_SEC")
     
+    # Distributed search job queue (Celery over REDIS_URL, shared/utils/search_jobs.py)
+    rpa_job_queue_enabled: bool = Field(default=False, env="RPA_JOB_QUEUE_ENABLED")
+    rpa_job_batch_size: int = Field(default=0, env="RPA_JOB_BATCH_SIZE")  # 0 - все товары ЛСД одним заданием
+    rpa_job_lease_sec: int = Field(default=60, env="RPA_JOB_LEASE_SEC")
+    rpa_job_queue_timeout_sec: int = Field(default=900, env="RPA_JOB_QUEUE_TIMEOUT_SEC")  # ожидание свободного воркера
+    rpa_worker_browsers: int = Field(default=0, env="RPA_WORKER_BROWSERS")  # 0 - MAX_CONCURRENT_BROWSERS
+    
+    # Optimizer process pool (order-service)
+    optimizer_max_workers: int = Field(default=0, env="OPTIMIZER_MAX_WORKERS")  # 0 - min(2, число ядер)
+    optimizer_max_queue: int = Field(default=20, env="OPTIMIZER_MAX_QUEUE")
+    optimizer_batch_size: int = Field(default=0, env="OPTIMIZER_BATCH_SIZE")  # 0/1 - по одному заказу
+    anytime_optimization_lsd_fraction: float = Field(default=0.5, env="ANYTIME_OPTIMIZATION_LSD_FRACTION")  # 0 - выключено
+    
+    # Pooled HTTP clients for inter-service calls (shared/utils/http_client.py)
+    http_pool_max_connections: int = Field(default=100, env="HTTP_POOL_MAX_CONNECTIONS")
+    http_pool_max_keepalive: int = Field(default=20, env="HTTP_POOL_MAX_KEEPALIVE")
+    http_pool_keepalive_expiry: float = Field(default=30.0, env="HTTP_POOL_KEEPALIVE_EXPIRY")
+    telegram_api_pool_size: int = Field(default=64, env="TELEGRAM_API_POOL_SIZE")
+    telegram_api_http2: bool = Field(default=False, env="TELEGRAM_API_HTTP2")  # нужен пакет h2
+    
+    # Order status events (LISTEN/NOTIFY) and reconciliation sweep (order-service)
+    order_events_enabled: bool = Field(default=True, env="ORDER_EVENTS_ENABLED")
+    order_reconcile_interval_sec: int = Field(default=60, env="ORDER_RECONCILE_INTERVAL_SEC")
+    
     # Weight Product Auto-Detection
     weight_unit_price_threshold: int = Field(default=300, env="WEIGHT_UNIT_PRICE_THRESHOLD")
     weight_keywords: str = Field(default="вес,весовой,весовая", env="WEIGHT_KEYWORDS")
@@ -0,0 +1,174 @@
+"""add_fprice_snapshot
+
+Revision ID: c3d4e5f6g7h8
+Revises: b2c3d4e5f6g7
+Create Date: 2026-10-17
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c3d4e5f6g7h8'
+down_revision: Union[str, None] = 'b2c3d4e5f6g7'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Снимок fprice_optimizer по заказу (см. services/optimizer/fprice_snapshot.sql)
+    op.create_table(
+        'fprice_snapshot',
+        sa.Column('id', sa.BigInteger(), nullable=False),
+        sa.Column('order_id', sa.BigInteger(), nullable=False),
+        sa.Column('lsd_config_id', sa.BigInteger(), nullable=False),
+        sa.Column('lsd_name', sa.String(), nullable=True),
+        sa.Column('order_item_id', sa.BigInteger(), nullable=False),
+        sa.Column('product_name', sa.String(), nullable=True),
+        sa.Column('price', sa.Numeric(), nullable=True),
+        sa.Column('fprice', sa.Numeric(), nullable=True),
+        sa.Column('base_unit', sa.String(), nullable=True),
+        sa.Column('base_quantity', sa.Numeric(), nullable=True),
+        sa.Column('requested_unit', sa.String(), nullable=True),
+        sa.Column('requested_quantity', sa.Numeric(), nullable=True),
+        sa.Column('order_item_ids_quantity', sa.Integer(), nullable=True),
+        sa.Column('order_item_ids_cost', sa.Numeric(), nullable=True),
+        sa.Column('fprice_min', sa.Numeric(), nullable=True),
+        sa.Column('fprice_diff', sa.Numeric(), nullable=True),
+        sa.Column('loss', sa.Numeric(), nullable=True),
+        sa.Column('min_order_amount', sa.Numeric(), nullable=True),
+        sa.Column('delivery_cost_model', postgresql.JSON(astext_type=sa.Text()), nullable=True),
+        sa.Column('delivery_fixed_fee', sa.Numeric(), nullable=True),
+        sa.Column('over_requested_quantity', sa.Numeric(), nullable=True),
+        sa.Column('items_in_order', sa.BigInteger(), nullable=True),
+        sa.Column('variants_limit', sa.Integer(), nullable=True),
+        sa.Column('refreshed_at', sa.DateTime(timezone=True), server_default=sa.func.now(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        comment='Строки fprice_optimizer по заказу; обновляются refresh_fprice_snapshot после поиска в ЛСД.'
+    )
+    op.create_index('ix_fprice_snapshot_order_item', 'fprice_snapshot', ['order_id', 'order_item_id', 'id'])
+
+    # Пересчёт снимка заказа (всех товаров или только p_order_item_ids) по логике VIEW fprice_optimizer
+    op.execute("""
+        CREATE OR REPLACE FUNCTION public.refresh_fprice_snapshot(
+            p_order_id bigint,
+            p_order_item_ids bigint[] DEFAULT NULL
+        )
+        RETURNS integer
+        LANGUAGE plpgsql
+        AS $$
+        DECLARE
+            v_rows integer;
+        BEGIN
+            -- Поиск по ЛСД идёт параллельно: обновления одного заказа выполняются по очереди
+            PERFORM pg_advisory_xact_lock(hashtext('fprice_snapshot'), hashtext(p_order_id::text));
+
+            DELETE FROM fprice_snapshot fs
+            WHERE fs.order_id = p_order_id
+              AND (p_order_item_ids IS NULL OR fs.order_item_id = ANY(p_order_item_ids));
+
+            INSERT INTO fprice_snapshot (
+                id, order_id, lsd_config_id, lsd_name, order_item_id, product_name,
+                price, fprice, base_unit, base_quantity, requested_unit, requested_quantity,
+                order_item_ids_quantity, order_item_ids_cost, fprice_min, fprice_diff,
+                loss, min_order_amount, delivery_cost_model, delivery_fixed_fee,
+                over_requested_quantity, items_in_order, variants_limit
+            )
+            WITH params AS (
+                SELECT 0.75 AS match_score_threshold
+            ),
+            order_item_counts AS (
+                SELECT count(*) AS item_count
+                FROM order_items oi
+                WHERE oi.order_id = p_order_id
+            ),
+            stocks_filtered AS (
+                SELECT
+                    s.*,
+                    COALESCE(s.fprice::numeric,
+                        CASE
+                            WHEN s.base_quantity IS DISTINCT FROM 0::numeric THEN s.price / NULLIF(s.base_quantity, 0::numeric)
+                            ELSE NULL::numeric
+                        END) AS eff_fprice
+                FROM lsd_stocks s
+                CROSS JOIN params p
+                WHERE s.order_id = p_order_id
+                  AND (p_order_item_ids IS NULL OR s.order_item_id = ANY(p_order_item_ids))
+                  AND s.match_score > p.match_score_threshold
+                  AND s.order_item_ids_quantity > 0
+            ),
+            base AS (
+                SELECT
+                    sf.id,
+                    oi.order_id,
+                    sf.lsd_config_id,
+                    c.name AS lsd_name,
+                    oi.id AS order_item_id,
+                    oi.product_name,
+                    sf.price,
+                    sf.fprice,
+                    sf.base_unit,
+                    sf.base_quantity,
+                    sf.eff_fprice,
+                    oi.requested_unit,
+                    oi.requested_quantity,
+                    oi.requested_quantity * 1.5 AS over_requested_quantity,
+                    sf.order_item_ids_quantity,
+                    sf.order_item_ids_cost,
+                    min(sf.eff_fprice) OVER (PARTITION BY sf.order_item_id) AS fprice_min,
+                    sf.eff_fprice - min(sf.eff_fprice) OVER (PARTITION BY sf.order_item_id) AS fprice_diff,
+                    (sf.eff_fprice - min(sf.eff_fprice) OVER (PARTITION BY sf.order_item_id)) * sf.base_quantity AS loss,
+                    COALESCE(c.min_order_amount, sf.min_order_amount) AS min_order_amount,
+                    sf.delivery_cost_model,
+                    c.delivery_fixed_fee,
+                    row_number() OVER (PARTITION BY oi.id, sf.lsd_config_id ORDER BY sf.eff_fprice, sf.price, sf.id) AS rownum_by_lsd,
+                    oic.item_count,
+                    CASE
+                        WHEN oic.item_count = 1 THEN 100
+                        WHEN oic.item_count = 2 THEN 50
+                        WHEN oic.item_count = 3 THEN 50
+                        WHEN oic.item_count = 4 THEN 30
+                        WHEN oic.item_count = 5 THEN 15
+                        WHEN oic.item_count = 6 THEN 10
+                        WHEN oic.item_count = 7 THEN 7
+                        WHEN oic.item_count = 8 THEN 5
+                        WHEN oic.item_count = 9 THEN 4
+                        WHEN oic.item_count = 10 THEN 4
+                        ELSE LEAST(5, floor(power(5000000::numeric / oic.item_count::numeric, 1.0 / oic.item_count::numeric))::integer)
+                    END AS max_variants_per_item
+                FROM stocks_filtered sf
+                JOIN lsd_configs c ON c.id = sf.lsd_config_id
+                JOIN order_items oi ON oi.id = sf.order_item_id AND oi.order_id = p_order_id
+                CROSS JOIN order_item_counts oic
+            ),
+            shop_best_ranked AS (
+                SELECT
+                    b.*,
+                    row_number() OVER (PARTITION BY b.order_item_id ORDER BY b.eff_fprice, b.price, b.id) AS shop_rank
+                FROM base b
+                WHERE b.rownum_by_lsd = 1
+            )
+            SELECT
+                r.id, r.order_id, r.lsd_config_id, r.lsd_name, r.order_item_id, r.product_name,
+                r.price, r.fprice, r.base_unit, r.base_quantity, r.requested_unit, r.requested_quantity,
+                r.order_item_ids_quantity, r.order_item_ids_cost, r.fprice_min, r.fprice_diff,
+                r.loss, r.min_order_amount, r.delivery_cost_model, r.delivery_fixed_fee,
+                r.over_requested_quantity, r.item_count, r.max_variants_per_item
+            FROM shop_best_ranked r
+            WHERE r.shop_rank <= r.max_variants_per_item;
+
+            GET DIAGNOSTICS v_rows = ROW_COUNT;
+            RETURN v_rows;
+        END;
+        $$;
+    """)
+
+
+def downgrade() -> None:
+    op.execute("DROP FUNCTION IF EXISTS refresh_fprice_snapshot(bigint, bigint[])")
+    op.drop_index('ix_fprice_snapshot_order_item', table_name='fprice_snapshot')
+    op.drop_table('fprice_snapshot')
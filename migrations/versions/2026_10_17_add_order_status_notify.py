@@ -0,0 +1,59 @@
+"""add_order_status_notify
+
+Revision ID: d4e5f6g7h8i9
+Revises: c3d4e5f6g7h8
+Create Date: 2026-10-17
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd4e5f6g7h8i9'
+down_revision: Union[str, None] = 'c3d4e5f6g7h8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # NOTIFY order_status при смене статуса заказа (слушатель - services/order-service/order_events.py).
+    # Уведомление уходит при COMMIT транзакции, откаченные переходы не видны
+    op.execute("""
+        CREATE OR REPLACE FUNCTION public.notify_order_status_change()
+        RETURNS trigger
+        LANGUAGE plpgsql
+        AS $$
+        BEGIN
+            PERFORM pg_notify(
+                'order_status',
+                json_build_object(
+                    'order_id', NEW.id,
+                    'status', NEW.status::text,
+                    'old_status', CASE WHEN TG_OP = 'UPDATE' THEN OLD.status::text END
+                )::text
+            );
+            RETURN NULL;
+        END;
+        $$;
+    """)
+    op.execute("""
+        CREATE TRIGGER orders_status_notify_update
+        AFTER UPDATE OF status ON orders
+        FOR EACH ROW
+        WHEN (OLD.status IS DISTINCT FROM NEW.status)
+        EXECUTE FUNCTION notify_order_status_change();
+    """)
+    op.execute("""
+        CREATE TRIGGER orders_status_notify_insert
+        AFTER INSERT ON orders
+        FOR EACH ROW
+        EXECUTE FUNCTION notify_order_status_change();
+    """)
+
+
+def downgrade() -> None:
+    op.execute("DROP TRIGGER IF EXISTS orders_status_notify_insert ON orders")
+    op.execute("DROP TRIGGER IF EXISTS orders_status_notify_update ON orders")
+    op.execute("DROP FUNCTION IF EXISTS notify_order_status_change()")
@@ -8,10 +8,10 @@ from typing import List, Dict, Any, Tuple
 import psycopg2
 from psycopg2.extras import execute_values
 import time
-import csv
-import tempfile
 import json
 
+from utils.result_writer import copy_rows
+
 logger = logging.getLogger(__name__)
 
 
@@ -211,7 +211,7 @@ class BasketAnalyzer:
     
     def save_to_db_via_csv(self, rows: List[Tuple], order_id: int):
         """
-        Записывает результаты анализа в basket_analyses через CSV и COPY FROM.
+        Записывает результаты анализа в basket_analyses через COPY FROM STDIN.
         
         Args:
             rows: Список кортежей для вставки
@@ -221,7 +221,7 @@ class BasketAnalyzer:
             logger.warning("Нет данных для записи")
             return
         
-        logger.info(f"Начинаем запись {len(rows):,} строк через CSV...")
+        logger.info(f"Начинаем запись {len(rows):,} строк через COPY...")
         start_time = time.time()
         
         # Удаляем старые данные для этого заказа
@@ -231,43 +231,17 @@ class BasketAnalyzer:
             if deleted > 0:
                 logger.info(f"Удалено {deleted:,} старых строк")
         
-        # Создаем временный CSV файл
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.csv', delete=False, newline='') as csvfile:
-            temp_filename = csvfile.name
-            logger.info(f"Создан временный файл: {temp_filename}")
-            
-            csv_writer = csv.writer(csvfile)
-            csv_start = time.time()
-            
-            for row in rows:
-                csv_writer.writerow(row)
-            
-            csv_elapsed = time.time() - csv_start
-            logger.info(f"CSV файл записан за {csv_elapsed:.2f} сек")
-        
-        # Загружаем через COPY FROM
+        # Загружаем через COPY FROM STDIN из буфера в памяти (utils/result_writer.py)
         copy_start = time.time()
-        with open(temp_filename, 'r') as f:
-            with self.conn.cursor() as cur:
-                cur.copy_expert(
-                    """
-                    COPY basket_analyses (
-                        order_id, basket_id, total_loss, total_goods_cost,
-                        delivery_cost, delivery_topup, total_delivery_cost,
-                        total_cost, total_loss_and_delivery
-                    ) FROM STDIN WITH (FORMAT CSV)
-                    """,
-                    f
-                )
+        with self.conn.cursor() as cur:
+            copy_rows(cur, 'basket_analyses', (
+                'order_id', 'basket_id', 'total_loss', 'total_goods_cost', 'delivery_cost',
+                'delivery_topup', 'total_delivery_cost', 'total_cost', 'total_loss_and_delivery'
+            ), rows)
         
         self.conn.commit()
         copy_elapsed = time.time() - copy_start
         
-        # Удаляем временный файл
-        import os
-        os.unlink(temp_filename)
-        logger.info(f"Временный файл удален")
-        
         # Обновляем basket_rank для корзин этого заказа
         with self.conn.cursor() as cur:
             cur.execute("""
@@ -290,7 +264,6 @@ class BasketAnalyzer:
         
         elapsed = time.time() - start_time
         logger.info(f"Записано {len(rows):,} строк за {elapsed:.2f} сек ({len(rows)/elapsed:.0f} строк/сек)")
-        logger.info(f"  - CSV запись: {csv_elapsed:.2f} сек")
         logger.info(f"  - COPY FROM: {copy_elapsed:.2f} сек")
         
         # Получаем и выводим лучшую корзину
@@ -334,7 +307,7 @@ class BasketAnalyzer:
         # 3. Анализируем корзины
         rows = self.analyze_baskets(basket_combinations, delivery_data, order_id)
         
-        # 4. Записываем в БД через CSV
+        # 4. Записываем в БД через COPY
         self.save_to_db_via_csv(rows, order_id)
         
         # 5. Получаем информацию о лучшей корзине
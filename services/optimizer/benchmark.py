@@ -0,0 +1,642 @@
+#!/usr/bin/env python3
+"""
+Синтетический бенчмарк движков оптимизации.
+
+Генерирует наборы данных в формате fprice_optimizer (число товаров, вариантов
+на товар, ЛСД и диапазонов доставки задаются сеткой параметров) и прогоняет
+основные этапы каждого движка в памяти, без БД: строки отдаёт
+InMemoryConnection, запись корзин (save_to_db) не выполняется.
+
+Каждый прогон идёт в отдельном процессе, поэтому пиковый RSS (ru_maxrss)
+относится только к этому прогону. Для каждого случая и движка записываются
+время работы (всего и по этапам), пиковый RSS и комбинаций в секунду.
+Результат - JSON; с --baseline результаты сравниваются с сохранённым
+прогоном и замедления сверх порога помечаются как регрессии (код выхода 1).
+
+Примеры:
+    python benchmark.py --output bench.json
+    python benchmark.py --items 6,8 --variants 4 --lsds 3,6 --ranges 1,5 --engines numpy,chunked
+    python benchmark.py --baseline bench.json --threshold 0.2
+"""
+
+import os
+import sys
+import time
+import json
+import random
+import argparse
+import platform
+import itertools
+import logging
+import multiprocessing
+import resource
+from datetime import datetime
+from typing import List, Dict, Any, Optional
+
+# Добавляем текущую директорию в sys.path для импортов
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+if CURRENT_DIR not in sys.path:
+    sys.path.insert(0, CURRENT_DIR)
+
+BENCHMARK_VERSION = 1
+BENCHMARK_ORDER_ID = 1
+
+# order_optimizer_debug (OrderOptimizerDebug) сюда не входит: это подкласс legacy-движка,
+# без debug_mode он выполняет тот же код, что и "legacy", а с debug_mode пишет CSV и
+# временные таблицы в БД, чего прогон в памяти не поддерживает
+ENGINES = ["numpy", "numpy_kopecks", "chunked", "parallel", "bnb", "subsets", "heuristic", "legacy"]
+
+# Сетка по умолчанию: 3 x 2 x 2 x 2 = 24 случая
+DEFAULT_GRID = {
+    'items': [4, 6, 8],
+    'variants': [3, 5],
+    'lsds': [3, 6],
+    'ranges': [1, 4]
+}
+
+# Больше этого числа комбинаций (после отсечения) движок не запускаем - прогон пропускается
+ENGINE_COMBINATION_LIMITS = {
+    'numpy': 20_000_000,
+    'numpy_kopecks': 20_000_000,
+    'legacy': 300_000
+}
+
+# Логгеры движков: уровень INFO выставляется при импорте модулей
+ENGINE_LOGGERS = ('order_optimizer', 'order_optimizer_numpy')
+
+# Колонки fprice_optimizer в порядке запроса оптимизаторов
+FPRICE_COLUMNS = (
+    'id', 'order_id', 'lsd_config_id', 'lsd_name', 'order_item_id', 'product_name',
+    'price', 'fprice', 'base_unit', 'base_quantity', 'requested_unit', 'requested_quantity',
+    'order_item_ids_quantity', 'order_item_ids_cost', 'fprice_min', 'fprice_diff',
+    'loss', 'min_order_amount', 'delivery_cost_model', 'delivery_fixed_fee'
+)
+
+
+# =============================================================================
+# СИНТЕТИЧЕСКИЕ ДАННЫЕ
+# =============================================================================
+
+def make_delivery_model(n_ranges: int, rnd: random.Random) -> Dict[str, Any]:
+    """
+    Модель доставки из n_ranges диапазонов: пороги растут, стоимость падает
+    до нуля на последнем (бесплатная доставка от суммы).
+    """
+    if n_ranges <= 1:
+        return {'delivery_cost': [{'min': 0, 'max': None, 'fee': rnd.choice([0, 99, 149])}]}
+
+    bounds = sorted(rnd.sample(range(300, 300 * (n_ranges + 3), 50), n_ranges - 1))
+    fees = sorted(rnd.sample(range(29, 29 + 40 * n_ranges, 10), n_ranges - 1), reverse=True) + [0]
+    edges = [0] + bounds + [None]
+    return {
+        'delivery_cost': [
+            {'min': edges[i], 'max': edges[i + 1], 'fee': fees[i]}
+            for i in range(n_ranges)
+        ]
+    }
+
+
+def generate_fprice_rows(n_items: int, n_variants: int, n_lsds: int, n_ranges: int,
+                         seed: int = 0) -> List[Dict[str, Any]]:
+    """
+    Строки fprice_optimizer одного синтетического заказа.
+
+    Args:
+        n_items: Количество товаров (order_item_id)
+        n_variants: Вариантов на товар
+        n_lsds: Количество ЛСД
+        n_ranges: Диапазонов доставки у каждого ЛСД
+        seed: Зерно генератора (одинаковые параметры - одинаковые строки)
+    """
+    rnd = random.Random(f"{seed}:{n_items}:{n_variants}:{n_lsds}:{n_ranges}")
+
+    lsds = [
+        {
+            'lsd_config_id': 1000 + i,
+            'lsd_name': f"bench_lsd_{i}",
+            'min_order_amount': rnd.choice([0, 0, 500, 1000, 1500]),
+            'delivery_fixed_fee': rnd.choice([0, 0, 29, 49]),
+            'delivery_cost_model': make_delivery_model(n_ranges, rnd)
+        }
+        for i in range(n_lsds)
+    ]
+
+    rows = []
+    row_id = 1
+    for item in range(n_items):
+        order_item_id = 100 + item
+        quantity = rnd.choice([1, 1, 2, 3])
+        base_price = rnd.uniform(60, 600)
+        variants = []
+        for _ in range(n_variants):
+            lsd = rnd.choice(lsds)
+            price = round(base_price * rnd.uniform(0.8, 1.4), 2)
+            variants.append((lsd, price))
+        fprice_min = min(price for _, price in variants)
+
+        for variant, (lsd, price) in enumerate(variants):
+            fprice_diff = round(price - fprice_min, 2)
+            rows.append({
+                'id': row_id,
+                'order_id': BENCHMARK_ORDER_ID,
+                'lsd_config_id': lsd['lsd_config_id'],
+                'lsd_name': lsd['lsd_name'],
+                'order_item_id': order_item_id,
+                'product_name': f"Товар {item + 1} вариант {variant + 1}",
+                'price': price,
+                'fprice': price,
+                'base_unit': 'шт',
+                'base_quantity': 1,
+                'requested_unit': 'шт',
+                'requested_quantity': quantity,
+                'order_item_ids_quantity': quantity,
+                'order_item_ids_cost': round(price * quantity, 2),
+                'fprice_min': fprice_min,
+                'fprice_diff': fprice_diff,
+                'loss': round(fprice_diff * quantity, 2),
+                'min_order_amount': lsd['min_order_amount'],
+                'delivery_cost_model': lsd['delivery_cost_model'],
+                'delivery_fixed_fee': lsd['delivery_fixed_fee']
+            })
+            row_id += 1
+
+    return rows
+
+
+class _InMemoryCursor:
+    """Курсор, отдающий строки fprice_optimizer на SELECT и COPY колоночной загрузки"""
+
+    def __init__(self, rows: List[Dict[str, Any]]):
+        self._rows = rows
+        self._result = []
+        self.description = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+    def _select(self, columns, rows):
+        self.description = [(column,) for column in columns]
+        self._result = [tuple(row[column] for column in columns) for row in rows]
+
+    def execute(self, query, params=None):
+        from utils import columnar_loader
+        from utils.fprice_snapshot import FPRICE_SOURCE
+
+        if FPRICE_SOURCE not in query:
+            raise RuntimeError(f"Бенчмарк выполняется без БД: поддерживается только чтение {FPRICE_SOURCE}")
+        if query == columnar_loader.LSD_QUERY:
+            first_rows = {}
+            for row in self._rows:
+                first_rows.setdefault(row['lsd_config_id'], row)
+            self._select(('lsd_config_id', 'lsd_name', 'delivery_cost_model'),
+                         [first_rows[lsd_id] for lsd_id in sorted(first_rows)])
+        elif query == columnar_loader.PRODUCT_NAMES_QUERY:
+            self._select(('product_name',), self._rows)
+        elif query == columnar_loader.VARIANT_ROWS_QUERY:
+            ids = set(params[1])
+            self._select(FPRICE_COLUMNS, [row for row in self._rows if row['id'] in ids])
+        else:
+            self._select(FPRICE_COLUMNS, self._rows)
+
+    def mogrify(self, query, params=None):
+        return (query % params).encode()
+
+    def copy_expert(self, sql, file):
+        from utils.columnar_loader import COLUMNS_DTYPE
+
+        for row in self._rows:
+            file.write(','.join(str(row[column] or 0) for column in COLUMNS_DTYPE.names) + '\n')
+
+    def fetchall(self):
+        return self._result
+
+
+class InMemoryConnection:
+    """Заменяет psycopg2-соединение оптимизатора: строки снимка fprice читаются из памяти"""
+
+    def __init__(self, rows: List[Dict[str, Any]]):
+        self.rows = rows
+
+    def cursor(self, *args, **kwargs):
+        return _InMemoryCursor(self.rows)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+# =============================================================================
+# ОСНОВНЫЕ ЭТАПЫ ДВИЖКОВ (без записи в БД)
+# =============================================================================
+
+class _StageTimer:
+    """Замер времени этапов движка"""
+
+    def __init__(self):
+        self.stages = {}
+        self._started = time.perf_counter()
+
+    def mark(self, stage: str):
+        now = time.perf_counter()
+        self.stages[stage] = round(now - self._started, 6)
+        self._started = now
+
+
+def _too_many(engine: str, n_combinations: int) -> bool:
+    limit = ENGINE_COMBINATION_LIMITS.get(engine)
+    return limit is not None and n_combinations > limit
+
+
+def _run_numpy_family(engine: str, rows: List[Dict[str, Any]], top_n: int,
+                      block_size: int, workers: Optional[int]) -> Dict[str, Any]:
+    """numpy / numpy_kopecks / chunked / parallel / bnb / subsets / heuristic: загрузка в NumPy и отбор корзин"""
+    from order_optimizer_numpy import OrderOptimizerNumPy
+    from order_optimizer_chunked import OrderOptimizerChunked
+    from order_optimizer_parallel import OrderOptimizerParallel
+    from order_optimizer_bnb import OrderOptimizerBnB
+    from order_optimizer_subsets import OrderOptimizerLsdSubsets
+    from order_optimizer_heuristic import OrderOptimizerHeuristic
+
+    if engine in ("numpy", "numpy_kopecks"):
+        optimizer = OrderOptimizerNumPy(None)
+    elif engine == "chunked":
+        optimizer = OrderOptimizerChunked(None, block_size=block_size)
+    elif engine == "parallel":
+        optimizer = OrderOptimizerParallel(None, n_workers=workers, block_size=block_size)
+    elif engine == "bnb":
+        optimizer = OrderOptimizerBnB(None)
+    elif engine == "heuristic":
+        optimizer = OrderOptimizerHeuristic(None)
+    else:
+        optimizer = OrderOptimizerLsdSubsets(None)
+    optimizer.conn = InMemoryConnection(rows)
+
+    timer = _StageTimer()
+    data = optimizer.load_fprice_data_to_numpy(BENCHMARK_ORDER_ID)
+    if engine == "numpy_kopecks":
+        data = optimizer.to_kopecks(data)
+    timer.mark('load')
+    n_combinations = data['n_combinations']
+
+    if _too_many(engine, n_combinations):
+        return {'status': 'skipped', 'combinations': n_combinations, 'stages': timer.stages}
+
+    extra = {}
+    if engine in ("numpy", "numpy_kopecks"):
+        total_losses, total_costs = optimizer.calculate_basic_metrics_broadcast(data)
+        timer.mark('metrics')
+        total_delivery, total_topup = optimizer.calculate_delivery_broadcast(data)
+        timer.mark('delivery')
+        baskets = optimizer.select_top_baskets(None, total_losses, total_costs,
+                                               total_delivery, total_topup, data, top_n)
+        timer.mark('select')
+    elif engine in ("chunked", "parallel"):
+        if engine == "chunked":
+            streamed = optimizer.stream_top_combinations(data, top_n)
+        else:
+            streamed = optimizer.stream_top_parallel(data, top_n)
+            extra['n_shards'] = streamed['n_shards']
+        timer.mark('stream')
+        baskets = optimizer.build_top_baskets(streamed['top'], streamed['mono'], data, top_n)
+        timer.mark('select')
+    elif engine == "bnb":
+        baskets = optimizer.select_top_baskets_bnb(data, top_n)
+        timer.mark('search')
+        extra['nodes_explored'] = optimizer.nodes_explored
+    elif engine == "heuristic":
+        baskets = optimizer.select_top_baskets_heuristic(data, top_n)
+        timer.mark('search')
+        extra['kicks'] = optimizer.kicks
+    else:
+        baskets = optimizer.select_top_baskets_subsets(data, top_n)
+        timer.mark('search')
+        extra['subsets_explored'] = optimizer.subsets_explored
+        extra['states_explored'] = optimizer.states_explored
+
+    return {
+        'status': 'success',
+        'combinations': n_combinations,
+        'stages': timer.stages,
+        'baskets': baskets,
+        **extra
+    }
+
+
+def _run_legacy(rows: List[Dict[str, Any]], top_n: int) -> Dict[str, Any]:
+    """legacy: генерация комбинаций, анализ и отбор на Python"""
+    from order_optimizer import OrderOptimizer
+
+    optimizer = OrderOptimizer(None)
+    optimizer.conn = InMemoryConnection(rows)
+
+    timer = _StageTimer()
+    grouped = optimizer.fetch_fprice_data(BENCHMARK_ORDER_ID)
+    timer.mark('load')
+
+    n_combinations = 1
+    for variants in grouped.values():
+        n_combinations *= len(variants)
+    if _too_many('legacy', n_combinations):
+        return {'status': 'skipped', 'combinations': n_combinations, 'stages': timer.stages}
+
+    combinations = optimizer.generate_combinations_in_memory(grouped)
+    timer.mark('generate')
+    analyzed = optimizer.analyze_all_baskets(combinations, BENCHMARK_ORDER_ID)
+    timer.mark('analyze')
+    baskets, _ = optimizer._select_optimal_baskets(analyzed)
+    timer.mark('select')
+
+    return {
+        'status': 'success',
+        'combinations': n_combinations,
+        'stages': timer.stages,
+        'baskets': baskets
+    }
+
+
+def run_case(engine: str, case: Dict[str, int], top_n: int = 10, block_size: int = 200_000,
+             workers: Optional[int] = None, seed: int = 0) -> Dict[str, Any]:
+    """
+    Один прогон движка на синтетическом заказе (в текущем процессе).
+
+    Returns:
+        Dict: status, combinations, wall_time_sec, stages, comb_per_sec,
+        peak_rss_mb, best_basket_id, best_loss_and_delivery
+    """
+    rows = generate_fprice_rows(case['items'], case['variants'], case['lsds'], case['ranges'], seed=seed)
+
+    start = time.perf_counter()
+    if engine == "legacy":
+        outcome = _run_legacy(rows, top_n)
+    else:
+        outcome = _run_numpy_family(engine, rows, top_n, block_size, workers)
+    wall_time = time.perf_counter() - start
+
+    baskets = outcome.pop('baskets', None)
+    result = {
+        **outcome,
+        'wall_time_sec': round(wall_time, 6),
+        'comb_per_sec': int(outcome['combinations'] / wall_time) if outcome['status'] == 'success' and wall_time > 0 else None,
+        # ru_maxrss в Linux - КБ, в macOS - байты
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss /
+                             (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+    }
+    if baskets:
+        best = baskets[0]
+        result['best_basket_id'] = int(best['basket_id'])
+        result['best_loss_and_delivery'] = round(float(best['total_loss_and_delivery']), 2)
+    return result
+
+
+def _run_case_worker(queue, engine: str, case: Dict[str, int], options: Dict[str, Any], verbose: bool):
+    """Точка входа процесса прогона: результат (или ошибка) уходит в очередь."""
+    try:
+        if not verbose:
+            import order_optimizer, order_optimizer_numpy  # noqa: F401 - настраивают свои логгеры
+            for name in ENGINE_LOGGERS:
+                logging.getLogger(name).setLevel(logging.WARNING)
+        queue.put(run_case(engine, case, **options))
+    except Exception as e:
+        queue.put({'status': 'error', 'error': f"{type(e).__name__}: {e}"})
+
+
+def run_case_isolated(engine: str, case: Dict[str, int], options: Dict[str, Any],
+                      timeout: Optional[float] = None, verbose: bool = False) -> Dict[str, Any]:
+    """
+    Прогон в отдельном процессе: пиковый RSS не смешивается с предыдущими
+    прогонами. Обычный (не daemon) процесс - движок parallel может запускать свой пул.
+    """
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process(
+        target=_run_case_worker,
+        args=(queue, engine, case, options, verbose)
+    )
+    process.start()
+    try:
+        result = queue.get(timeout=timeout)
+    except Exception:
+        process.kill()
+        result = {'status': 'timeout', 'error': f"Прогон не завершился за {timeout} сек"}
+    process.join()
+    if process.exitcode not in (0, None) and result.get('status') == 'success':
+        result = {'status': 'error', 'error': f"Процесс завершился с кодом {process.exitcode}"}
+    return result
+
+
+# =============================================================================
+# ПРОГОН СЕТКИ И СРАВНЕНИЕ С BASELINE
+# =============================================================================
+
+def case_key(case: Dict[str, int]) -> str:
+    """Идентификатор случая: i{items}_v{variants}_l{lsds}_r{ranges}"""
+    return f"i{case['items']}_v{case['variants']}_l{case['lsds']}_r{case['ranges']}"
+
+
+def build_cases(grid: Dict[str, List[int]]) -> List[Dict[str, int]]:
+    """Декартово произведение параметров сетки."""
+    keys = ('items', 'variants', 'lsds', 'ranges')
+    return [dict(zip(keys, values)) for values in itertools.product(*(grid[key] for key in keys))]
+
+
+def run_benchmark(cases: List[Dict[str, int]], engines: List[str], repeat: int = 1,
+                  top_n: int = 10, block_size: int = 200_000, workers: Optional[int] = None,
+                  seed: int = 0, timeout: Optional[float] = None, verbose: bool = False) -> Dict[str, Any]:
+    """
+    Прогоняет движки на всех случаях сетки.
+
+    При repeat > 1 время берётся лучшее из повторов, RSS - максимальный.
+    """
+    options = {'top_n': top_n, 'block_size': block_size, 'workers': workers, 'seed': seed}
+    results = []
+
+    for case in cases:
+        for engine in engines:
+            runs = [run_case_isolated(engine, case, options, timeout=timeout, verbose=verbose) for _ in range(repeat)]
+            successful = [run for run in runs if run['status'] == 'success']
+            if successful:
+                result = min(successful, key=lambda run: run['wall_time_sec'])
+                result['peak_rss_mb'] = max(run['peak_rss_mb'] for run in successful)
+            else:
+                result = runs[-1]
+
+            result = {'case': case_key(case), **case, 'engine': engine, **result}
+            results.append(result)
+
+            if result['status'] == 'success':
+                print(f"  {result['case']:<18} {engine:<13} {result['combinations']:>12,} комб  "
+                      f"{result['wall_time_sec']:>9.3f} сек  {result['peak_rss_mb']:>8.1f} MB  "
+                      f"{result['comb_per_sec']:>14,} комб/сек")
+            else:
+                print(f"  {result['case']:<18} {engine:<13} {result['status']}"
+                      f"{': ' + result['error'] if result.get('error') else ''}")
+
+    return {
+        'version': BENCHMARK_VERSION,
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'environment': _environment(),
+        'options': {**options, 'repeat': repeat, 'engines': engines},
+        'results': results
+    }
+
+
+def _environment() -> Dict[str, Any]:
+    import numpy
+    return {
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count()
+    }
+
+
+def compare_with_baseline(report: Dict[str, Any], baseline: Dict[str, Any],
+                          threshold: float = 0.2, min_time: float = 0.05) -> List[Dict[str, Any]]:
+    """
+    Сравнивает прогон с baseline по (случай, движок).
+
+    Регрессия - время работы выросло больше чем на threshold (доля), либо
+    прогон, успешный в baseline, теперь не успешен. Прогоны быстрее min_time
+    секунд в обоих отчётах не сравниваются - там шум больше порога.
+
+    Returns:
+        Список регрессий
+    """
+    previous = {(row['case'], row['engine']): row for row in baseline.get('results', [])}
+    regressions = []
+
+    for row in report['results']:
+        old = previous.get((row['case'], row['engine']))
+        if old is None or old.get('status') != 'success':
+            continue
+
+        if row['status'] != 'success':
+            regressions.append({'case': row['case'], 'engine': row['engine'],
+                                'reason': f"status {row['status']} (в baseline success)"})
+            continue
+
+        old_time, new_time = old['wall_time_sec'], row['wall_time_sec']
+        if max(old_time, new_time) < min_time:
+            continue
+
+        ratio = new_time / old_time if old_time > 0 else float('inf')
+        row['baseline_wall_time_sec'] = old_time
+        row['slowdown'] = round(ratio - 1, 3)
+        if ratio > 1 + threshold:
+            regressions.append({
+                'case': row['case'],
+                'engine': row['engine'],
+                'reason': f"{old_time:.3f} → {new_time:.3f} сек (+{(ratio - 1) * 100:.0f}%)",
+                'baseline_wall_time_sec': old_time,
+                'wall_time_sec': new_time,
+                'slowdown': round(ratio - 1, 3)
+            })
+
+    return regressions
+
+
+def _parse_int_list(value: str) -> List[int]:
+    try:
+        return [int(part) for part in value.split(',') if part.strip()]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Ожидается список чисел через запятую: {value}")
+
+
+def _parse_engines(value: str) -> List[str]:
+    engines = [part.strip() for part in value.split(',') if part.strip()]
+    unknown = [engine for engine in engines if engine not in ENGINES]
+    if unknown:
+        raise argparse.ArgumentTypeError(f"Неизвестные движки: {', '.join(unknown)}. Доступны: {', '.join(ENGINES)}")
+    return engines
+
+
+def main():
+    """CLI интерфейс бенчмарка."""
+
+    parser = argparse.ArgumentParser(
+        description="Синтетический бенчмарк движков оптимизации (в памяти, без БД)"
+    )
+
+    parser.add_argument("--engines", type=_parse_engines, default=list(ENGINES),
+                        help=f"Движки через запятую (по умолчанию: {','.join(ENGINES)})")
+    parser.add_argument("--items", type=_parse_int_list, default=DEFAULT_GRID['items'],
+                        help="Количество товаров, список через запятую")
+    parser.add_argument("--variants", type=_parse_int_list, default=DEFAULT_GRID['variants'],
+                        help="Вариантов на товар, список через запятую")
+    parser.add_argument("--lsds", type=_parse_int_list, default=DEFAULT_GRID['lsds'],
+                        help="Количество ЛСД, список через запятую")
+    parser.add_argument("--ranges", type=_parse_int_list, default=DEFAULT_GRID['ranges'],
+                        help="Диапазонов доставки у ЛСД, список через запятую")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="Повторов каждого прогона, берётся лучшее время (по умолчанию: 1)")
+    parser.add_argument("--top-n", type=int, default=10,
+                        help="Количество лучших корзин (по умолчанию: 10)")
+    parser.add_argument("--block-size", type=int, default=200_000,
+                        help="Размер блока для движков chunked и parallel (по умолчанию: 200000)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Количество процессов для движка parallel (по умолчанию: число ядер)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Зерно генератора данных (по умолчанию: 0)")
+    parser.add_argument("--timeout", type=float, default=None,
+                        help="Ограничение времени одного прогона, сек")
+    parser.add_argument("--output", type=str, default=None,
+                        help="Файл для JSON-отчёта (по умолчанию: вывод в stdout)")
+    parser.add_argument("--baseline", type=str, default=None,
+                        help="JSON-отчёт предыдущего прогона для поиска регрессий")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="Допустимое замедление относительно baseline, доля (по умолчанию: 0.2)")
+    parser.add_argument("--verbose", action="store_true",
+                        help="Показывать логи движков")
+
+    args = parser.parse_args()
+
+    grid = {'items': args.items, 'variants': args.variants, 'lsds': args.lsds, 'ranges': args.ranges}
+    cases = build_cases(grid)
+
+    print("=" * 80)
+    print(f"БЕНЧМАРК ОПТИМИЗАТОРА: {len(cases)} случаев x {len(args.engines)} движков")
+    print("=" * 80)
+
+    report = run_benchmark(
+        cases, args.engines, repeat=max(1, args.repeat), top_n=args.top_n,
+        block_size=args.block_size, workers=args.workers, seed=args.seed, timeout=args.timeout,
+        verbose=args.verbose
+    )
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare_with_baseline(report, baseline, threshold=args.threshold)
+        report['baseline'] = {'file': args.baseline, 'threshold': args.threshold, 'regressions': regressions}
+
+        print("-" * 80)
+        if regressions:
+            print(f"❌ Регрессии относительно {args.baseline} (порог +{args.threshold * 100:.0f}%):")
+            for regression in regressions:
+                print(f"  {regression['case']:<18} {regression['engine']:<13} {regression['reason']}")
+            exit_code = 1
+        else:
+            print(f"✅ Регрессий относительно {args.baseline} нет")
+
+    encoded = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(encoded + "\n")
+        print(f"Отчёт сохранён: {args.output}")
+    else:
+        print(encoded)
+
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -9,9 +9,9 @@ from itertools import product
 import psycopg2
 from psycopg2.extras import execute_values, Json
 import time
-import csv
-import tempfile
-import json
+
+from utils.fprice_snapshot import FPRICE_SOURCE
+from utils.result_writer import copy_rows
 
 logger = logging.getLogger(__name__)
 
@@ -45,13 +45,13 @@ class CombinationGenerator:
         Returns:
             Dict где ключ = order_item_id, значение = список вариантов товара
         """
-        query = """
+        query = f"""
             SELECT 
                 id, order_id, lsd_config_id, lsd_name, order_item_id, product_name,
                 price, fprice, base_unit, base_quantity, requested_unit, requested_quantity,
                 order_item_ids_quantity, order_item_ids_cost, fprice_min, fprice_diff, 
                 loss, min_order_amount, delivery_cost_model
-            FROM fprice_optimizer
+            FROM {FPRICE_SOURCE}
             WHERE order_id = %s
             ORDER BY order_item_id, id
         """
@@ -172,7 +172,7 @@ class CombinationGenerator:
     
     def save_to_db_via_csv(self, rows: List[Tuple], order_id: int):
         """
-        Записывает строки в таблицу basket_combinations через CSV и COPY FROM.
+        Записывает строки в таблицу basket_combinations через COPY FROM STDIN.
         
         Args:
             rows: Список кортежей для вставки
@@ -182,7 +182,7 @@ class CombinationGenerator:
             logger.warning("Нет данных для записи")
             return
         
-        logger.info(f"Начинаем запись {len(rows):,} строк через CSV...")
+        logger.info(f"Начинаем запись {len(rows):,} строк через COPY...")
         start_time = time.time()
         
         # Удаляем старые данные
@@ -192,55 +192,21 @@ class CombinationGenerator:
             if deleted > 0:
                 logger.info(f"Удалено {deleted:,} старых строк")
         
-        # Создаем временный CSV файл
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.csv', delete=False, newline='') as csvfile:
-            temp_filename = csvfile.name
-            logger.info(f"Создан временный файл: {temp_filename}")
-            
-            csv_writer = csv.writer(csvfile)
-            
-            # Конвертируем строки для CSV
-            csv_start = time.time()
-            for row in rows:
-                # Преобразуем Json объект обратно в строку
-                csv_row = list(row)
-                # delivery_cost_model находится на позиции 16 (0-based)
-                if isinstance(csv_row[16], Json):
-                    csv_row[16] = json.dumps(csv_row[16].adapted)
-                elif isinstance(csv_row[16], dict):
-                    csv_row[16] = json.dumps(csv_row[16])
-                csv_writer.writerow(csv_row)
-            
-            csv_elapsed = time.time() - csv_start
-            logger.info(f"CSV файл записан за {csv_elapsed:.2f} сек")
-        
-        # Загружаем через COPY FROM
+        # Загружаем через COPY FROM STDIN из буфера в памяти (utils/result_writer.py)
         copy_start = time.time()
-        with open(temp_filename, 'r') as f:
-            with self.conn.cursor() as cur:
-                cur.copy_expert(
-                    """
-                    COPY basket_combinations (
-                        basket_id, id, order_id, order_item_id, product_name, lsd_name,
-                        base_unit, base_quantity, price, fprice, fprice_min, fprice_diff,
-                        loss, order_item_ids_quantity, min_order_amount, lsd_config_id,
-                        delivery_cost_model, order_item_ids_cost
-                    ) FROM STDIN WITH (FORMAT CSV)
-                    """,
-                    f
-                )
+        with self.conn.cursor() as cur:
+            copy_rows(cur, 'basket_combinations', (
+                'basket_id', 'id', 'order_id', 'order_item_id', 'product_name', 'lsd_name',
+                'base_unit', 'base_quantity', 'price', 'fprice', 'fprice_min', 'fprice_diff',
+                'loss', 'order_item_ids_quantity', 'min_order_amount', 'lsd_config_id', 'delivery_cost_model',
+                'order_item_ids_cost'
+            ), rows)
         
         self.conn.commit()
         copy_elapsed = time.time() - copy_start
         
-        # Удаляем временный файл
-        import os
-        os.unlink(temp_filename)
-        logger.info(f"Временный файл удален")
-        
         elapsed = time.time() - start_time
         logger.info(f"Записано {len(rows):,} строк за {elapsed:.2f} сек ({len(rows)/elapsed:.0f} строк/сек)")
-        logger.info(f"  - CSV запись: {csv_elapsed:.2f} сек")
         logger.info(f"  - COPY FROM: {copy_elapsed:.2f} сек")
         
         # Проверяем результат
@@ -287,7 +253,7 @@ class CombinationGenerator:
         # 3. Подготавливаем строки для вставки
         rows = self.prepare_basket_rows(combinations, order_id)
         
-        # 4. Записываем в БД через CSV
+        # 4. Записываем в БД через COPY
         self.save_to_db_via_csv(rows, order_id)
         
         total_elapsed = time.time() - total_start
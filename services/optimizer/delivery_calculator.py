@@ -8,10 +8,10 @@ from typing import List, Dict, Any, Tuple
 import psycopg2
 from psycopg2.extras import execute_values
 import time
-import csv
-import tempfile
 import json
 
+from utils.result_writer import copy_rows
+
 logger = logging.getLogger(__name__)
 
 
@@ -162,7 +162,7 @@ class DeliveryCalculator:
     
     def save_to_db_via_csv(self, rows: List[Tuple], order_id: int):
         """
-        Записывает результаты в basket_delivery_costs через CSV и COPY FROM.
+        Записывает результаты в basket_delivery_costs через COPY FROM STDIN.
         
         Args:
             rows: Список кортежей для вставки
@@ -172,7 +172,7 @@ class DeliveryCalculator:
             logger.warning("Нет данных для записи")
             return
         
-        logger.info(f"Начинаем запись {len(rows):,} строк через CSV...")
+        logger.info(f"Начинаем запись {len(rows):,} строк через COPY...")
         start_time = time.time()
         
         # Удаляем старые данные для корзин этого заказа
@@ -189,45 +189,19 @@ class DeliveryCalculator:
             if deleted > 0:
                 logger.info(f"Удалено {deleted:,} старых строк")
         
-        # Создаем временный CSV файл
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.csv', delete=False, newline='') as csvfile:
-            temp_filename = csvfile.name
-            logger.info(f"Создан временный файл: {temp_filename}")
-            
-            csv_writer = csv.writer(csvfile)
-            csv_start = time.time()
-            
-            for row in rows:
-                csv_writer.writerow(row)
-            
-            csv_elapsed = time.time() - csv_start
-            logger.info(f"CSV файл записан за {csv_elapsed:.2f} сек")
-        
-        # Загружаем через COPY FROM
+        # Загружаем через COPY FROM STDIN из буфера в памяти (utils/result_writer.py)
         copy_start = time.time()
-        with open(temp_filename, 'r') as f:
-            with self.conn.cursor() as cur:
-                cur.copy_expert(
-                    """
-                    COPY basket_delivery_costs (
-                        basket_id, lsd_config_id, delivery_cost, topup,
-                        lsd_total_basket_cost, min_order_amount
-                    ) FROM STDIN WITH (FORMAT CSV)
-                    """,
-                    f
-                )
+        with self.conn.cursor() as cur:
+            copy_rows(cur, 'basket_delivery_costs', (
+                'basket_id', 'lsd_config_id', 'delivery_cost', 'topup', 'lsd_total_basket_cost',
+                'min_order_amount'
+            ), rows)
         
         self.conn.commit()
         copy_elapsed = time.time() - copy_start
         
-        # Удаляем временный файл
-        import os
-        os.unlink(temp_filename)
-        logger.info(f"Временный файл удален")
-        
         elapsed = time.time() - start_time
         logger.info(f"Записано {len(rows):,} строк за {elapsed:.2f} сек ({len(rows)/elapsed:.0f} строк/сек)")
-        logger.info(f"  - CSV запись: {csv_elapsed:.2f} сек")
         logger.info(f"  - COPY FROM: {copy_elapsed:.2f} сек")
         
         # Проверяем результат
@@ -272,7 +246,7 @@ class DeliveryCalculator:
         # 2. Рассчитываем стоимость доставки
         rows = self.calculate_delivery_costs(basket_data)
         
-        # 3. Записываем в БД через CSV
+        # 3. Записываем в БД через COPY
         self.save_to_db_via_csv(rows, order_id)
         
         total_elapsed = time.time() - total_start
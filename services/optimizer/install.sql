@@ -9,22 +9,27 @@
 \echo ''
 
 -- 1. Создание таблиц
-\echo '[1/4] Создание таблиц...'
+\echo '[1/5] Создание таблиц...'
 \i optimizer_tables.sql
 \echo ''
 
--- 2. Функция расчета доставки
-\echo '[2/4] Установка функции расчета доставки...'
+-- 2. Снимок fprice_optimizer по заказу (читают оптимизаторы)
+\echo '[2/5] Установка снимка fprice_snapshot...'
+\i fprice_snapshot.sql
+\echo ''
+
+-- 3. Функция расчета доставки
+\echo '[3/5] Установка функции расчета доставки...'
 \i delivery_calculator.sql
 \echo ''
 
--- 3. Процедуры генерации комбинаций и корзин
-\echo '[3/4] Установка процедур генерации...'
+-- 4. Процедуры генерации комбинаций и корзин
+\echo '[4/5] Установка процедур генерации...'
 \i optimizer_procedures.sql
 \echo ''
 
--- 4. Процедура оптимизации с доставкой
-\echo '[4/4] Установка процедуры оптимизации...'
+-- 5. Процедура оптимизации с доставкой
+\echo '[5/5] Установка процедуры оптимизации...'
 \i calculate_optimized_baskets.sql
 \echo ''
 
@@ -1,11 +1,12 @@
 #!/usr/bin/env python3
 """
 Unified Optimizer - единая точка входа для оптимизации заказов.
-Автоматически выбирает между NumPy (быстрый) и Legacy (старый) оптимизаторами.
+Автоматически выбирает движок по оценке памяти и времени заказа (Legacy - если NumPy недоступен).
 """
 
 import os
 import sys
+import time
 import argparse
 from dotenv import load_dotenv
 import logging
@@ -26,6 +27,7 @@ logger = logging.getLogger(__name__)
 def optimize_order_unified(order_id: int, db_connection_string: str,
                            engine: str = "auto",
                            exclusions: dict = None,
+                           use_cache: bool = True,
                            **kwargs) -> dict:
     """
     Универсальная функция оптимизации заказа.
@@ -33,14 +35,21 @@ def optimize_order_unified(order_id: int, db_connection_string: str,
     Args:
         order_id: ID заказа
         db_connection_string: PostgreSQL connection string
-        engine: Движок оптимизации - "numpy", "legacy", или "auto" (по умолчанию)
+        engine: Движок оптимизации - "numpy", "chunked", "parallel", "bnb", "subsets", "heuristic", "legacy",
+                или "auto" (по умолчанию): выбор по оценке памяти и времени в пределах
+                memory_budget_mb / time_budget_sec (kwargs или OPTIMIZER_MEMORY_BUDGET_MB /
+                OPTIMIZER_TIME_BUDGET_SEC)
         exclusions: Словарь с исключениями пользователя:
             - keywords: список ключевых слов категорий для исключения
             - products: список названий продуктов из чёрного списка
+        use_cache: Использовать кэш результатов (utils/result_cache.py): при тех же
+            строках fprice_snapshot, исключениях, top_n и движке корзины
+            записываются из кэша без запуска движка
         **kwargs: Дополнительные параметры для оптимизатора
 
     Returns:
-        Dict с результатами оптимизации
+        Dict с результатами оптимизации ('cache': 'hit' / 'miss' / 'off'; для "auto" -
+        'engine_selection': стратегия, движок, причина и оценки)
     """
 
     # Логируем исключения если они есть
@@ -49,15 +58,195 @@ def optimize_order_unified(order_id: int, db_connection_string: str,
         prod_count = len(exclusions.get('products', []))
         logger.info(f"🚫 Исключения: {kw_count} ключевых слов, {prod_count} продуктов")
 
-    # Автоматический выбор движка
-    if engine == "auto":
+    # Одно соединение на подготовку и кэш (снимок, выбор движка, хэш, запись из кэша);
+    # движок открывает своё
+    conn = _connect(db_connection_string)
+    try:
+        # Движки читают снимок fprice_snapshot - для старых заказов строим его здесь
+        _ensure_fprice_snapshot(conn, order_id)
+
+        # Автоматический выбор движка
+        selection = None
+        if engine == "auto":
+            try:
+                import numpy
+                selection = _select_engine_by_budget(conn, order_id, **kwargs)
+                engine = selection['engine']
+                # Параметры, явно переданные вызывающим, важнее подобранных
+                kwargs = {**kwargs, **{k: v for k, v in selection['params'].items() if not kwargs.get(k)}}
+                logger.info(f"✓ NumPy доступен, выбран движок {engine} ({selection['strategy']}): {selection['reason']}")
+            except ImportError:
+                engine = "legacy"
+                logger.info("⚠ NumPy недоступен, используем Legacy оптимизатор")
+
+        if not use_cache:
+            result = _run_engine(order_id, db_connection_string, engine, exclusions, **kwargs)
+            result['cache'] = 'off'
+        else:
+            result = _optimize_with_cache(conn, order_id, db_connection_string, engine, exclusions, **kwargs)
+    finally:
+        if conn is not None:
+            conn.close()
+
+    if selection is not None:
+        result['engine_selection'] = selection
+    return result
+
+
+def _connect(db_connection_string: str):
+    """Соединение для подготовки оптимизации; None, если БД недоступна (движок сообщит ошибку сам)."""
+    import psycopg2
+
+    try:
+        return psycopg2.connect(db_connection_string)
+    except Exception as e:
+        logger.warning(f"⚠️ Не удалось подключиться к БД для подготовки оптимизации: {e}")
+        return None
+
+
+def _ensure_fprice_snapshot(conn, order_id: int):
+    """
+    Строит снимок fprice заказа, если его ещё нет (utils/fprice_snapshot.py).
+    Ошибка не останавливает оптимизацию - движок увидит пустой снимок как "нет данных".
+    """
+    from utils.fprice_snapshot import ensure_snapshot
+
+    if conn is None:
+        return
+    try:
         try:
-            import numpy
-            engine = "numpy"
-            logger.info("✓ NumPy доступен, используем NumPy оптимизатор")
-        except ImportError:
-            engine = "legacy"
-            logger.info("⚠ NumPy недоступен, используем Legacy оптимизатор")
+            ensure_snapshot(conn, order_id)
+        except Exception:
+            conn.rollback()
+            raise
+    except Exception as e:
+        logger.warning(f"⚠️ Не удалось подготовить снимок fprice заказа {order_id}: {e}")
+
+
+def _select_engine_by_budget(conn, order_id: int, **kwargs) -> dict:
+    """
+    Выбор движка по оценке памяти и времени (utils/engine_selector.py).
+    Если оценку получить не удалось - NumPy, как раньше.
+    """
+    from utils.engine_selector import fetch_order_shape, select_engine
+
+    try:
+        if conn is None:
+            raise RuntimeError("нет соединения с БД")
+        try:
+            shape = fetch_order_shape(conn, order_id)
+        finally:
+            # Соединение не держит открытую транзакцию, пока работает движок
+            conn.rollback()
+    except Exception as e:
+        logger.warning(f"⚠️ Не удалось оценить размер заказа: {e}")
+        return {'strategy': 'exhaustive', 'engine': 'numpy', 'params': {},
+                'reason': f"оценка недоступна ({e})"}
+
+    return select_engine(
+        shape['n_variants'], shape['n_lsd'],
+        memory_budget_mb=kwargs.get('memory_budget_mb'),
+        time_budget_sec=kwargs.get('time_budget_sec'),
+        block_size=kwargs.get('block_size'),
+        workers=kwargs.get('workers')
+    )
+
+
+def _engine_cache_key(engine: str, **kwargs) -> str:
+    """
+    Движок и все его параметры, от которых зависит результат, - часть ключа кэша.
+
+    Значения по умолчанию раскрываются так же, как в _run_engine и конструкторах
+    движков, поэтому явный параметр и его значение по умолчанию дают один ключ.
+    Параметры, подобранные автовыбором, к этому моменту уже в kwargs.
+    """
+    params = {}
+    if engine == "numpy":
+        # Метрики в копейках ранжируют ничьи иначе, чем float32
+        from order_optimizer_numpy import KOPECK_METRICS
+        kopeck_metrics = kwargs.get('kopeck_metrics')
+        if kopeck_metrics or (kopeck_metrics is None and KOPECK_METRICS):
+            return "numpy:kopecks"
+    elif engine in ("chunked", "parallel"):
+        from order_optimizer_chunked import DEFAULT_BLOCK_SIZE
+        params['block_size'] = kwargs.get('block_size') or DEFAULT_BLOCK_SIZE
+        if engine == "parallel":
+            params['workers'] = kwargs.get('workers') or os.cpu_count() or 1
+    elif engine == "heuristic":
+        from order_optimizer_heuristic import HEURISTIC_TIME_BUDGET_SEC, HEURISTIC_EXHAUSTIVE_MAX_COMBINATIONS
+        params['time_budget_sec'] = float(kwargs.get('time_budget_sec') or HEURISTIC_TIME_BUDGET_SEC)
+        params['exhaustive_max'] = HEURISTIC_EXHAUSTIVE_MAX_COMBINATIONS
+
+    if not params:
+        return engine
+    return f"{engine}:" + ",".join(f"{key}={value}" for key, value in sorted(params.items()))
+
+
+def _optimize_with_cache(conn, order_id: int, db_connection_string: str, engine: str,
+                         exclusions: dict = None, **kwargs) -> dict:
+    """
+    Запуск движка через кэш результатов. Хэш, запись из кэша и снимок корзин
+    для кэша идут через соединение conn. Ошибки кэша не мешают оптимизации.
+    """
+    from utils.result_cache import result_cache, compute_input_hash, snapshot_baskets, restore_baskets
+
+    top_n = kwargs.get('top_n_final', kwargs.get('top_n', 10))
+    start_time = time.time()
+    cache_key = None
+
+    engine_key = _engine_cache_key(engine, **kwargs)
+
+    try:
+        if conn is None:
+            raise RuntimeError("нет соединения с БД")
+        try:
+            cache_key = compute_input_hash(conn, order_id, exclusions, top_n, engine_key)
+        finally:
+            conn.rollback()
+        cached = result_cache.get(cache_key) if cache_key else None
+
+        if cached is not None:
+            restore_baskets(conn, order_id, cached['snapshot'])
+            result = dict(cached['result'])
+            result['elapsed_time'] = time.time() - start_time
+            result['optimization_elapsed_time'] = cached['result'].get('elapsed_time')
+            result['cache'] = 'hit'
+            result['cache_key'] = cache_key
+            result['cache_stats'] = result_cache.stats()
+            logger.info(f"♻️  Кэш: результат заказа #{order_id} записан из кэша "
+                        f"({result['elapsed_time']:.2f} сек, ключ {cache_key[:12]})")
+            return result
+    except Exception as e:
+        logger.warning(f"⚠️ Кэш результатов недоступен: {e}")
+        cache_key = None
+
+    result = _run_engine(order_id, db_connection_string, engine, exclusions, **kwargs)
+    result['cache'] = 'miss'
+    result['cache_key'] = cache_key
+
+    # Результат отката на Legacy под ключом другого движка не кэшируем
+    if cache_key and result.get('status') == 'success' and result.get('engine') == engine:
+        try:
+            try:
+                snapshot = snapshot_baskets(conn, order_id)
+            finally:
+                conn.rollback()
+            result_cache.put(cache_key, {
+                'result': {k: v for k, v in result.items() if k not in ('cache', 'cache_key')},
+                'snapshot': snapshot
+            })
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось сохранить результат в кэш: {e}")
+
+    result['cache_stats'] = result_cache.stats()
+    logger.info(f"Кэш: промах для заказа #{order_id} (попаданий {result['cache_stats']['hits']}, "
+                f"промахов {result['cache_stats']['misses']})")
+    return result
+
+
+def _run_engine(order_id: int, db_connection_string: str, engine: str,
+                exclusions: dict = None, **kwargs) -> dict:
+    """Запускает выбранный движок (с откатом на Legacy при ошибке)."""
 
     # Запускаем соответствующий оптимизатор
     if engine == "numpy":
@@ -74,7 +263,8 @@ def optimize_order_unified(order_id: int, db_connection_string: str,
                 order_id=order_id,
                 db_connection_string=db_connection_string,
                 top_n_final=top_n_final,
-                exclusions=exclusions
+                exclusions=exclusions,
+                kopeck_metrics=kwargs.get('kopeck_metrics')
             )
 
             result['engine'] = 'numpy'
@@ -85,6 +275,130 @@ def optimize_order_unified(order_id: int, db_connection_string: str,
             logger.info("⤷ Переключаемся на Legacy оптимизатор...")
             engine = "legacy"
 
+    if engine == "chunked":
+        try:
+            from order_optimizer_chunked import optimize_order_chunked, DEFAULT_BLOCK_SIZE
+
+            logger.info(f"🚀 Запуск потокового NumPy оптимизатора для заказа #{order_id}")
+
+            top_n_final = kwargs.get('top_n_final', kwargs.get('top_n', 10))
+            block_size = kwargs.get('block_size') or DEFAULT_BLOCK_SIZE
+
+            result = optimize_order_chunked(
+                order_id=order_id,
+                db_connection_string=db_connection_string,
+                top_n_final=top_n_final,
+                exclusions=exclusions,
+                block_size=block_size
+            )
+
+            result['engine'] = 'chunked'
+            return result
+
+        except Exception as e:
+            logger.error(f"❌ Потоковый NumPy оптимизатор завершился с ошибкой: {e}")
+            logger.info("⤷ Переключаемся на Legacy оптимизатор...")
+            engine = "legacy"
+
+    if engine == "parallel":
+        try:
+            from order_optimizer_parallel import optimize_order_parallel
+            from order_optimizer_chunked import DEFAULT_BLOCK_SIZE
+
+            top_n_final = kwargs.get('top_n_final', kwargs.get('top_n', 10))
+            n_workers = kwargs.get('workers')
+            block_size = kwargs.get('block_size') or DEFAULT_BLOCK_SIZE
+
+            logger.info(f"🚀 Запуск многопроцессного NumPy оптимизатора для заказа #{order_id} "
+                        f"(процессов: {n_workers or os.cpu_count()})")
+
+            result = optimize_order_parallel(
+                order_id=order_id,
+                db_connection_string=db_connection_string,
+                top_n_final=top_n_final,
+                exclusions=exclusions,
+                n_workers=n_workers,
+                block_size=block_size
+            )
+
+            result['engine'] = 'parallel'
+            return result
+
+        except Exception as e:
+            logger.error(f"❌ Многопроцессный NumPy оптимизатор завершился с ошибкой: {e}")
+            logger.info("⤷ Переключаемся на Legacy оптимизатор...")
+            engine = "legacy"
+
+    if engine == "bnb":
+        try:
+            from order_optimizer_bnb import optimize_order_bnb
+
+            logger.info(f"🚀 Запуск оптимизатора ветвей и границ для заказа #{order_id}")
+
+            top_n_final = kwargs.get('top_n_final', kwargs.get('top_n', 10))
+
+            result = optimize_order_bnb(
+                order_id=order_id,
+                db_connection_string=db_connection_string,
+                top_n_final=top_n_final,
+                exclusions=exclusions
+            )
+
+            result['engine'] = 'bnb'
+            return result
+
+        except Exception as e:
+            logger.error(f"❌ Оптимизатор ветвей и границ завершился с ошибкой: {e}")
+            logger.info("⤷ Переключаемся на Legacy оптимизатор...")
+            engine = "legacy"
+
+    if engine == "subsets":
+        try:
+            from order_optimizer_subsets import optimize_order_subsets
+
+            logger.info(f"🚀 Запуск оптимизатора по подмножествам ЛСД для заказа #{order_id}")
+
+            top_n_final = kwargs.get('top_n_final', kwargs.get('top_n', 10))
+
+            result = optimize_order_subsets(
+                order_id=order_id,
+                db_connection_string=db_connection_string,
+                top_n_final=top_n_final,
+                exclusions=exclusions
+            )
+
+            result['engine'] = 'subsets'
+            return result
+
+        except Exception as e:
+            logger.error(f"❌ Оптимизатор по подмножествам ЛСД завершился с ошибкой: {e}")
+            logger.info("⤷ Переключаемся на Legacy оптимизатор...")
+            engine = "legacy"
+
+    if engine == "heuristic":
+        try:
+            from order_optimizer_heuristic import optimize_order_heuristic
+
+            logger.info(f"🚀 Запуск эвристического оптимизатора (локальный поиск) для заказа #{order_id}")
+
+            top_n_final = kwargs.get('top_n_final', kwargs.get('top_n', 10))
+
+            result = optimize_order_heuristic(
+                order_id=order_id,
+                db_connection_string=db_connection_string,
+                top_n_final=top_n_final,
+                exclusions=exclusions,
+                time_budget_sec=kwargs.get('time_budget_sec')
+            )
+
+            result['engine'] = 'heuristic'
+            return result
+
+        except Exception as e:
+            logger.error(f"❌ Эвристический оптимизатор завершился с ошибкой: {e}")
+            logger.info("⤷ Переключаемся на Legacy оптимизатор...")
+            engine = "legacy"
+
     if engine == "legacy":
         # Импортируем из той же директории
         from order_optimizer import optimize_order
@@ -104,7 +418,7 @@ def optimize_order_unified(order_id: int, db_connection_string: str,
         result['engine'] = 'legacy'
         return result
 
-    raise ValueError(f"Неизвестный движок: {engine}. Доступны: numpy, legacy, auto")
+    raise ValueError(f"Неизвестный движок: {engine}. Доступны: numpy, chunked, parallel, bnb, subsets, heuristic, legacy, auto")
 
 
 def main():
@@ -123,7 +437,7 @@ def main():
     parser.add_argument(
         "--engine",
         type=str,
-        choices=["numpy", "legacy", "auto"],
+        choices=["numpy", "chunked", "parallel", "bnb", "subsets", "heuristic", "legacy", "auto"],
         default="auto",
         help="Движок оптимизации (по умолчанию: auto)"
     )
@@ -142,6 +456,48 @@ def main():
         help="Количество комбинаций для предфильтрации в NumPy (по умолчанию: 100000)"
     )
     
+    parser.add_argument(
+        "--block-size",
+        type=int,
+        default=None,
+        help="Размер блока комбинаций для движков chunked и parallel (по умолчанию: 200000)"
+    )
+    
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Количество процессов для движка parallel (по умолчанию: число ядер)"
+    )
+    
+    parser.add_argument(
+        "--memory-budget-mb",
+        type=float,
+        default=None,
+        help="Бюджет памяти для выбора движка в режиме auto, МБ (по умолчанию: OPTIMIZER_MEMORY_BUDGET_MB или 1024)"
+    )
+    
+    parser.add_argument(
+        "--time-budget",
+        type=float,
+        default=None,
+        help="Бюджет времени для выбора движка в режиме auto и для поиска движка heuristic, сек "
+             "(по умолчанию: OPTIMIZER_TIME_BUDGET_SEC или 60 / OPTIMIZER_HEURISTIC_TIME_BUDGET_SEC или 10)"
+    )
+    
+    parser.add_argument(
+        "--kopeck-metrics",
+        action="store_true",
+        default=None,
+        help="Метрики движка numpy в копейках int32 (по умолчанию: OPTIMIZER_KOPECK_METRICS)"
+    )
+    
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Не использовать кэш результатов оптимизации"
+    )
+    
     parser.add_argument(
         "--db-url",
         type=str,
@@ -174,8 +530,14 @@ def main():
             order_id=args.order_id,
             db_connection_string=db_url,
             engine=args.engine,
+            use_cache=not args.no_cache,
             top_n=args.top_n,
-            top_k_prefilter=args.top_k_prefilter
+            top_k_prefilter=args.top_k_prefilter,
+            block_size=args.block_size,
+            workers=args.workers,
+            memory_budget_mb=args.memory_budget_mb,
+            time_budget_sec=args.time_budget,
+            kopeck_metrics=args.kopeck_metrics
         )
         
         if result['status'] == 'success':
@@ -183,7 +545,15 @@ def main():
             print("✅ ОПТИМИЗАЦИЯ ЗАВЕРШЕНА")
             print("=" * 80)
             print(f"Движок: {result['engine'].upper()}")
+            if 'engine_selection' in result:
+                print(f"Выбор движка: {result['engine_selection']['strategy']} - {result['engine_selection']['reason']}")
             print(f"Всего комбинаций: {result.get('total_combinations', 'N/A'):,}")
+            if 'nodes_explored' in result:
+                print(f"Узлов дерева поиска: {result['nodes_explored']:,}")
+            if 'subsets_explored' in result:
+                print(f"Подмножеств ЛСД решено: {result['subsets_explored']:,}")
+            if 'kicks' in result:
+                print(f"Возмущений локального поиска: {result['kicks']:,}")
             if 'prefiltered' in result:
                 print(f"Предфильтровано: {result['prefiltered']:,}")
             print(f"Сохранено корзин: {result.get('saved_baskets', 'N/A')}")
@@ -191,6 +561,8 @@ def main():
             print(f"  Стоимость: {result.get('best_total_cost', 0):.2f}₽")
             print(f"  Потери+доставка: {result.get('best_loss_and_delivery', 0):.2f}₽")
             print(f"\nВремя выполнения: {result.get('elapsed_time', 0):.2f} сек")
+            if result.get('cache') == 'hit':
+                print("Результат взят из кэша")
             
             if 'performance_comb_per_sec' in result:
                 print(f"Производительность: {result['performance_comb_per_sec']:,} комб/сек")
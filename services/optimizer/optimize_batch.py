@@ -0,0 +1,191 @@
+"""
+Пакетная оптимизация нескольких заказов в одном процессе.
+
+optimize_order_unified на каждый заказ открывает соединения, читает заказ
+отдельными запросами и строит lookup-таблицы доставки ЛСД, хотя модели
+доставки у заказов одни и те же. В вечерний пик order-service забирает
+готовые заказы пачкой (FOR UPDATE SKIP LOCKED) и отдаёт части пачки
+процессам optimizer_pool; здесь каждая часть:
+
+- читает входные данные всех заказов одним COPY (load_fprice_columns_batch)
+- строит lookup-таблицу доставки один раз на модель ЛСД для всех заказов
+  (delivery_lookup_cache движка)
+- выбирает движок каждого заказа по оценке памяти и времени (engine_selector)
+  и запускает его на уже загруженных данных
+- записывает корзины всех заказов одной транзакцией (BatchResultWriter)
+
+Кэш результатов (utils/result_cache.py) в пакетном режиме не используется.
+Движки, которые сами читают и пишут БД (legacy) или запускают свой пул
+процессов (parallel), выполняются по одному заказу через optimize_order_unified.
+"""
+
+import logging
+import os
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+import psycopg2
+
+# Добавляем текущую директорию в sys.path для импортов
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+if CURRENT_DIR not in sys.path:
+    sys.path.insert(0, CURRENT_DIR)
+
+from utils.columnar_loader import load_fprice_columns_batch, use_consistent_snapshot
+from utils.engine_selector import select_engine
+from utils.fprice_snapshot import ensure_snapshot
+from utils.result_writer import BatchResultWriter
+
+logger = logging.getLogger(__name__)
+
+# Движки, которые умеют работать на загруженных пакетом данных
+BATCH_ENGINES = ("numpy", "chunked", "bnb", "subsets", "heuristic")
+
+
+def _create_optimizer(engine: str, **kwargs):
+    """Движок без собственного соединения (соединение пакета подставляется снаружи)."""
+    if engine == "numpy":
+        from order_optimizer_numpy import OrderOptimizerNumPy
+        optimizer = OrderOptimizerNumPy(None)
+        if kwargs.get('kopeck_metrics') is not None:
+            optimizer.kopeck_metrics = kwargs['kopeck_metrics']
+        return optimizer
+    if engine == "chunked":
+        from order_optimizer_chunked import OrderOptimizerChunked, DEFAULT_BLOCK_SIZE
+        return OrderOptimizerChunked(None, block_size=kwargs.get('block_size') or DEFAULT_BLOCK_SIZE)
+    if engine == "bnb":
+        from order_optimizer_bnb import OrderOptimizerBnB
+        return OrderOptimizerBnB(None)
+    if engine == "subsets":
+        from order_optimizer_subsets import OrderOptimizerLsdSubsets
+        return OrderOptimizerLsdSubsets(None)
+    if engine == "heuristic":
+        from order_optimizer_heuristic import OrderOptimizerHeuristic
+        return OrderOptimizerHeuristic(None, time_budget_sec=kwargs.get('time_budget_sec'))
+    raise ValueError(f"Движок {engine} не поддерживает пакетный режим. Доступны: {', '.join(BATCH_ENGINES)}")
+
+
+def _select_batch_engine(data: Dict[str, Any], engine: str, **kwargs) -> Dict[str, Any]:
+    """
+    Движок заказа пакета. Для "auto" - оценка по загруженным данным (после
+    исключений и отсечения вариантов) в одном процессе: вместо parallel - chunked.
+    """
+    if engine != "auto":
+        return {'engine': engine, 'params': {}}
+    selection = select_engine(
+        data['n_variants'], len(set(data['lsd_config_ids'].tolist())),
+        memory_budget_mb=kwargs.get('memory_budget_mb'),
+        time_budget_sec=kwargs.get('time_budget_sec'),
+        block_size=kwargs.get('block_size'),
+        workers=1
+    )
+    selection['params'].pop('workers', None)
+    return selection
+
+
+def optimize_orders_batch(order_ids: List[int], db_connection_string: str,
+                          exclusions_by_order: Optional[Dict[int, dict]] = None,
+                          engine: str = "auto", **kwargs) -> Dict[int, Dict[str, Any]]:
+    """
+    Оптимизирует несколько заказов с общей загрузкой и общей записью.
+
+    Args:
+        order_ids: ID заказов пакета
+        db_connection_string: PostgreSQL connection string
+        exclusions_by_order: Исключения пользователя по заказам (как в optimize_order_unified)
+        engine: "auto" или один из BATCH_ENGINES для всех заказов; остальные
+            движки - по одному заказу через optimize_order_unified
+        **kwargs: top_n / top_n_final, бюджеты и параметры движков
+
+    Returns:
+        {order_id: результат как у optimize_order_unified}; если заказ не удалось
+        оптимизировать - {'status': 'error', 'error': ...}
+    """
+    exclusions_by_order = exclusions_by_order or {}
+    top_n = kwargs.get('top_n_final', kwargs.get('top_n', 10))
+    results: Dict[int, Dict[str, Any]] = {}
+
+    if engine != "auto" and engine not in BATCH_ENGINES:
+        from optimize import optimize_order_unified
+        for order_id in order_ids:
+            results[order_id] = optimize_order_unified(
+                order_id, db_connection_string, engine=engine,
+                exclusions=exclusions_by_order.get(order_id), **kwargs
+            )
+        return results
+
+    start_time = time.time()
+    logger.info(f"📦 Пакетная оптимизация {len(order_ids)} заказов: {order_ids}")
+
+    delivery_lookup_cache: Dict[str, Dict[str, Any]] = {}
+    fallback_order_ids = []
+
+    conn = psycopg2.connect(db_connection_string)
+    use_consistent_snapshot(conn)
+    try:
+        for order_id in order_ids:
+            try:
+                ensure_snapshot(conn, order_id)
+            except Exception as e:
+                conn.rollback()
+                logger.warning(f"⚠️ Не удалось подготовить снимок fprice заказа {order_id}: {e}")
+
+        loaded = load_fprice_columns_batch(conn, order_ids, exclusions_by_order)
+
+        batch_writer = BatchResultWriter(conn)
+
+        for order_id in order_ids:
+            data = loaded.get(order_id)
+            if data is None:
+                results[order_id] = {"status": "no_data", "elapsed_time": 0}
+                continue
+
+            selection = _select_batch_engine(data, engine, **kwargs)
+            order_engine = selection['engine']
+            try:
+                optimizer = _create_optimizer(order_engine, **{**kwargs, **selection['params']})
+                optimizer.conn = conn
+                optimizer.preloaded_data = {order_id: data}
+                optimizer.delivery_lookup_cache = delivery_lookup_cache
+                optimizer.result_batch = batch_writer
+
+                result = optimizer.optimize_order(order_id, top_n, exclusions=exclusions_by_order.get(order_id))
+                result['engine'] = order_engine
+                if 'strategy' in selection:
+                    result['engine_selection'] = selection
+                results[order_id] = result
+            except Exception as e:
+                logger.error(f"❌ Заказ #{order_id}: движок {order_engine} завершился с ошибкой в пакете: {e}")
+                batch_writer.discard(order_id)
+                conn.rollback()
+                fallback_order_ids.append(order_id)
+
+        # Корзины всех заказов - одной транзакцией
+        try:
+            batch_writer.write()
+        except Exception as e:
+            logger.error(f"❌ Не удалось записать корзины пакета: {e}")
+            for order_id in batch_writer.order_ids:
+                results[order_id] = {"status": "error", "error": f"Запись корзин пакета: {e}"}
+    finally:
+        conn.close()
+
+    # Заказы, на которых движок упал, - по одному, с откатом на Legacy, как в optimize_order_unified
+    if fallback_order_ids:
+        from optimize import _run_engine
+        for order_id in fallback_order_ids:
+            try:
+                results[order_id] = _run_engine(order_id, db_connection_string, "legacy",
+                                                exclusions_by_order.get(order_id), **kwargs)
+            except Exception as e:
+                results[order_id] = {"status": "error", "error": str(e)}
+
+    for result in results.values():
+        result['batch_size'] = len(order_ids)
+
+    elapsed = time.time() - start_time
+    succeeded = sum(1 for result in results.values() if result.get('status') == 'success')
+    logger.info(f"📦 Пакет из {len(order_ids)} заказов за {elapsed:.2f} сек: успешно {succeeded}, "
+                f"lookup-таблиц доставки {len(delivery_lookup_cache)}")
+    return results
@@ -60,7 +60,7 @@ BEGIN
             fp.delivery_cost_model,
             fp.over_requested_quantity,
             generate_series(1, CEIL(fp.over_requested_quantity / NULLIF(fp.base_quantity, 0))::INTEGER) as pieces
-        FROM fprice_optimizer fp
+        FROM fprice_snapshot fp
         WHERE fp.order_id = p_order_id
     )
     SELECT 
@@ -7,12 +7,14 @@ import logging
 from typing import List, Dict, Any, Tuple
 from itertools import product
 import psycopg2
-from psycopg2.extras import execute_values
 import time
-import json
 import sys
 import os
 
+from utils.exclusion_matcher import filter_grouped_variants
+from utils.fprice_snapshot import FPRICE_SOURCE
+from utils.result_writer import BasketResultWriter
+
 # Настраиваем логирование для оптимизатора
 logger = logging.getLogger('order_optimizer')
 logger.setLevel(logging.INFO)
@@ -82,13 +84,13 @@ class OrderOptimizer:
                 - keywords: список ключевых слов категорий для исключения
                 - products: список названий продуктов из чёрного списка
         """
-        query = """
+        query = f"""
             SELECT
                 id, order_id, lsd_config_id, lsd_name, order_item_id, product_name,
                 price, fprice, base_unit, base_quantity, requested_unit, requested_quantity,
                 order_item_ids_quantity, order_item_ids_cost, fprice_min, fprice_diff,
                 loss, min_order_amount, delivery_cost_model, delivery_fixed_fee
-            FROM fprice_optimizer
+            FROM {FPRICE_SOURCE}
             WHERE order_id = %s
             ORDER BY order_item_id, id
         """
@@ -114,7 +116,7 @@ class OrderOptimizer:
 
         # Применяем фильтрацию исключений если они переданы
         if exclusions:
-            grouped = self._apply_exclusions_filter(grouped, exclusions)
+            grouped = filter_grouped_variants(grouped, exclusions)
 
         # Логируем статистику
         for order_item_id, variants in sorted(grouped.items()):
@@ -122,65 +124,6 @@ class OrderOptimizer:
 
         return grouped
 
-    def _apply_exclusions_filter(self, grouped: Dict[int, List[Dict[str, Any]]],
-                                  exclusions: Dict[str, Any]) -> Dict[int, List[Dict[str, Any]]]:
-        """Применяет фильтрацию исключений к товарам.
-
-        Args:
-            grouped: Данные товаров, сгруппированные по order_item_id
-            exclusions: Словарь с исключениями:
-                - keywords: список ключевых слов категорий
-                - products: список названий продуктов из чёрного списка
-
-        Returns:
-            Отфильтрованные данные. Если все варианты товара исключены,
-            оставляем первый вариант с предупреждением.
-        """
-        keywords = [kw.lower() for kw in exclusions.get('keywords', [])]
-        products = [p.lower() for p in exclusions.get('products', [])]
-
-        if not keywords and not products:
-            return grouped
-
-        logger.info(f"🚫 Применяем фильтр исключений: {len(keywords)} ключевых слов, {len(products)} продуктов")
-
-        filtered_grouped = {}
-        excluded_count = 0
-        warnings = []
-
-        for order_item_id, variants in grouped.items():
-            filtered_variants = []
-
-            for variant in variants:
-                product_name = variant['product_name'].lower()
-
-                # Проверяем черный список продуктов
-                is_blacklisted = any(p in product_name for p in products)
-
-                # Проверяем ключевые слова категорий
-                matches_keyword = any(kw in product_name for kw in keywords)
-
-                if is_blacklisted or matches_keyword:
-                    excluded_count += 1
-                    logger.debug(f"  ❌ Исключён: {variant['product_name']} (ЛСД: {variant['lsd_name']})")
-                else:
-                    filtered_variants.append(variant)
-
-            if filtered_variants:
-                filtered_grouped[order_item_id] = filtered_variants
-            else:
-                # ВСЕ варианты исключены - оставляем первый с предупреждением
-                filtered_grouped[order_item_id] = variants[:1]
-                warning_msg = f"⚠️ Все варианты товара order_item_id={order_item_id} ({variants[0]['product_name']}) исключены, оставлен первый"
-                warnings.append(warning_msg)
-                logger.warning(warning_msg)
-
-        logger.info(f"🚫 Фильтрация завершена: исключено {excluded_count} вариантов")
-        if warnings:
-            logger.warning(f"🚫 Предупреждения: {len(warnings)} товаров с полным исключением")
-
-        return filtered_grouped
-    
     def generate_combinations_in_memory(self, grouped_data: Dict[int, List[Dict[str, Any]]]) -> List[List[Dict[str, Any]]]:
         """Генерирует все возможные комбинации товаров в памяти."""
         if not grouped_data:
@@ -474,88 +417,43 @@ class OrderOptimizer:
     # =========================================================================
     
     def save_top_baskets_to_db(self, top_baskets: List[Dict[str, Any]], order_id: int):
-        """Записывает топ-N корзин в БД."""
+        """Записывает топ-N корзин в БД (COPY через BasketResultWriter, одна транзакция)."""
         logger.info(f"Запись топ-{len(top_baskets)} корзин в БД...")
         start_time = time.time()
         
-        # Удаляем старые данные
-        with self.conn.cursor() as cur:
-            # ВАЖНО: Сначала basket_delivery_costs
-            cur.execute("""
-                DELETE FROM basket_delivery_costs 
-                WHERE order_id = %s
-            """, (order_id,))
-            deleted_bdc = cur.rowcount
-            
-            # Затем basket_combinations
-            cur.execute("DELETE FROM basket_combinations WHERE order_id = %s", (order_id,))
-            deleted_bc = cur.rowcount
-            
-            # И basket_analyses
-            cur.execute("DELETE FROM basket_analyses WHERE order_id = %s", (order_id,))
-            deleted_ba = cur.rowcount
-            
-            logger.info(f"Удалено старых записей: basket_delivery_costs={deleted_bdc}, "
-                       f"basket_combinations={deleted_bc}, basket_analyses={deleted_ba}")
-        
-        # Подготавливаем данные для вставки
-        bc_rows = []
-        bdc_rows = []
-        ba_rows = []
+        writer = BasketResultWriter(self.conn, order_id)
         
         for basket in top_baskets:
             basket_id = basket['basket_id']
             
             # basket_combinations - разворачиваем все товары
-            for item in basket['basket_items']:
-                lsd_stock_id = item['id']  # id из fprice_optimizer = lsd_stocks.id
-                fprice_optimizer_id = item['id']
-                
-                # Логируем для первой корзины
-                if basket_id == basket['basket_id'] and len(bc_rows) < 3:
-                    logger.info(f"  Товар: {item['product_name']}, lsd_stock_id={lsd_stock_id}, fprice_opt_id={fprice_optimizer_id}")
-                
-                bc_rows.append((
-                    basket_id, item['id'], order_id, item['order_item_id'],
-                    item['product_name'], item['lsd_name'], item['base_unit'],
-                    item['base_quantity'], item['price'], item['fprice'],
-                    item['fprice_min'], item['fprice_diff'], item['loss'],
-                    item['order_item_ids_quantity'], item['min_order_amount'],
-                    item['lsd_config_id'], json.dumps(item['delivery_cost_model']),
-                    item['order_item_ids_cost'], fprice_optimizer_id, lsd_stock_id
-                ))
+            # (fprice_optimizer_id и lsd_stock_id = id из fprice_optimizer)
+            writer.add_basket_items(basket_id, basket['basket_items'])
             
             # basket_delivery_costs - по ЛСД
             for lsd_id, info in basket['delivery_info'].items():
-                bdc_rows.append((
-                    order_id, basket_id, lsd_id, info['delivery_cost'], info['topup'],
+                writer.add_delivery_cost(
+                    basket_id, lsd_id, info['delivery_cost'], info['topup'],
                     info['lsd_total_basket_cost'], info['min_order_amount']
-                ))
+                )
             
             # basket_analyses - одна строка на корзину
-            ba_rows.append((
-                order_id, basket_id, basket['total_loss'], basket['total_goods_cost'],
-                json.dumps(basket['delivery_cost_json']),
-                json.dumps(basket['delivery_topup_json']),
+            writer.add_analysis(
+                basket_id, basket['total_loss'], basket['total_goods_cost'],
+                basket['delivery_cost_json'], basket['delivery_topup_json'],
                 basket['total_delivery_cost'], basket['total_cost'],
                 basket['total_loss_and_delivery'],
-                basket['rank']  # НОВОЕ: добавляем ранг корзины
-            ))
+                basket['rank'],
+                basket.get('is_mono_basket', False)
+            )
         
-        # Вставляем данные
+        counts = writer.write()
+        logger.info(f"  Записано {counts['basket_combinations']} строк в basket_combinations")
+        logger.info(f"  Записано {counts['basket_delivery_costs']} строк в basket_delivery_costs")
+        logger.info(f"  Записано {counts['basket_analyses']} строк в basket_analyses")
+        
+        # Проверяем что записалось
         with self.conn.cursor() as cur:
-            # basket_combinations
-            execute_values(cur, """
-                INSERT INTO basket_combinations (
-                    basket_id, id, order_id, order_item_id, product_name, lsd_name,
-                    base_unit, base_quantity, price, fprice, fprice_min, fprice_diff,
-                    loss, order_item_ids_quantity, min_order_amount, lsd_config_id,
-                    delivery_cost_model, order_item_ids_cost, fprice_optimizer_id, lsd_stock_id
-                ) VALUES %s
-            """, bc_rows)
-            logger.info(f"  Записано {len(bc_rows)} строк в basket_combinations")
-            
-            # Проверяем что записалось
             cur.execute("""
                 SELECT basket_id, product_name, fprice_optimizer_id, lsd_stock_id 
                 FROM basket_combinations 
@@ -563,36 +461,9 @@ class OrderOptimizer:
                 LIMIT 3
             """, (order_id,))
             sample_rows = cur.fetchall()
-            logger.info(f"  Примеры записанных строк:")
-            for row in sample_rows:
-                logger.info(f"    basket_id={row[0]}, product={row[1]}, fprice_opt={row[2]}, lsd_stock={row[3]}")
-            
-            # basket_delivery_costs
-            execute_values(cur, """
-                INSERT INTO basket_delivery_costs (
-                    order_id, basket_id, lsd_config_id, delivery_cost, topup,
-                    lsd_total_basket_cost, min_order_amount
-                ) VALUES %s
-                ON CONFLICT (order_id, basket_id, lsd_config_id) 
-                DO UPDATE SET
-                    delivery_cost = EXCLUDED.delivery_cost,
-                    topup = EXCLUDED.topup,
-                    lsd_total_basket_cost = EXCLUDED.lsd_total_basket_cost,
-                    min_order_amount = EXCLUDED.min_order_amount
-            """, bdc_rows)
-            logger.info(f"  Записано {len(bdc_rows)} строк в basket_delivery_costs")
-            
-            # basket_analyses
-            execute_values(cur, """
-                INSERT INTO basket_analyses (
-                    order_id, basket_id, total_loss, total_goods_cost,
-                    delivery_cost, delivery_topup, total_delivery_cost,
-                    total_cost, total_loss_and_delivery, basket_rank
-                ) VALUES %s
-            """, ba_rows)
-            logger.info(f"  Записано {len(ba_rows)} строк в basket_analyses")
-        
-        self.conn.commit()
+        logger.info(f"  Примеры записанных строк:")
+        for row in sample_rows:
+            logger.info(f"    basket_id={row[0]}, product={row[1]}, fprice_opt={row[2]}, lsd_stock={row[3]}")
         
         elapsed = time.time() - start_time
         logger.info(f"Запись в БД завершена за {elapsed:.2f} сек")
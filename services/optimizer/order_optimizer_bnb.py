@@ -0,0 +1,620 @@
+"""
+Точный оптимизатор заказов методом ветвей и границ (branch-and-bound).
+
+Находит те же топ-N корзин и лучшие моно-корзины по ЛСД, что и
+OrderOptimizerNumPy, но не перебирает все prod(n_variants) комбинаций:
+поддерево отсекается, если допустимая нижняя оценка
+    сумма потерь выбранных вариантов
+    + сумма минимальных потерь по оставшимся товарам
+    + минимально достижимые доставка и топап по уже задействованным ЛСД
+    + минимальная доставка ЛСД, без которого не обойтись оставшимся товарам
+хуже текущего N-го результата.
+
+Поиск ведётся в float64, а доставка - с допуском на границах диапазонов,
+поэтому в кандидаты попадают все корзины в окне EPS от N-го результата.
+Финальный отбор пересчитывает кандидатов тем же float32-ядром, что и
+NumPy движок, - значения, порядок и basket_id совпадают.
+
+Порог отсечения основного поиска сразу задают N корзин короткого локального
+поиска (warm_start_threshold): без него первые листья обхода (варианты с
+наименьшими потерями из многих ЛСД) дают слабый порог, и на заказах из
+десятков товаров в десятке ЛСД обход не укладывается в минуты.
+Если и с ним обход превышает OPTIMIZER_BNB_MAX_NODES узлов, отбор
+переходит на локальный поиск OrderOptimizerHeuristic (без гарантии
+оптимума, в результате exact=False).
+
+Номера комбинаций - целые Python (combination_id_dtype): у заказов из
+десятков товаров prod(n_variants) > 2^63. basket_id хранится в BIGINT,
+поэтому корзина с номером больше BIGINT_MAX получает basket_id = ранг
+(_fit_basket_ids).
+"""
+
+import logging
+import os
+import random
+import time
+import gc
+from typing import List, Dict, Any, Tuple, Optional, Set
+import numpy as np
+
+from order_optimizer_numpy import OrderOptimizerNumPy, combination_id_dtype
+
+# Пишем в тот же лог, что и NumPy оптимизатор (logs/optimizer_numpy.log)
+logger = logging.getLogger('order_optimizer_numpy')
+
+# Допуск на расхождение float64-поиска и float32-расчёта (₽)
+SEARCH_EPS = 0.05
+# Допуск на попадание суммы ЛСД на границу диапазона доставки (₽)
+RANGE_EPS = 0.01
+# basket_id хранится в BIGINT
+BIGINT_MAX = 2 ** 63 - 1
+# Бюджет локального поиска, задающего начальный порог отсечения (сек)
+WARM_START_SEC = 0.5
+# Больше стольких узлов дерева (~25 мкс на узел) - переход на локальный поиск
+BNB_MAX_NODES = int(os.getenv('OPTIMIZER_BNB_MAX_NODES', '50000'))
+
+
+class SearchBudgetExceeded(Exception):
+    """Обход дерева превысил бюджет узлов"""
+
+
+class _LsdDelivery:
+    """Модель доставки одного ЛСД в скалярном виде (семантика calculate_delivery_vectorized_v2)"""
+
+    def __init__(self, lookup: Dict[str, np.ndarray], min_order: float, fixed_fee: float):
+        self.mins = [float(v) for v in lookup['mins']]
+        self.maxs = [float(v) for v in lookup['maxs']]
+        self.fees = [float(v) for v in lookup['fees']]
+        self.min_order = min_order
+        self.fixed_fee = fixed_fee
+        # Точки, в которых меняется стоимость доставки
+        self.breakpoints = sorted(set(v for v in self.mins + self.maxs if v != float('inf')))
+        self.min_fee = min(self.fees)
+
+    def fee_at(self, total: float) -> float:
+        """Базовая стоимость доставки для суммы ПОСЛЕ топапа (как np.searchsorted в v2)"""
+        n = len(self.fees)
+        idx = -1
+        for i, v in enumerate(self.mins):
+            if v <= total:
+                idx = i
+        idx = min(max(idx, 0), n - 1)
+        if not total < self.maxs[idx] and idx < n - 1:
+            idx += 1
+        return self.fees[idx]
+
+    def fee_bounds(self, low: float, high: float) -> Tuple[float, float]:
+        """(min, max) базовой стоимости доставки для сумм из [low, high]"""
+        values = [self.fee_at(low)]
+        for point in self.breakpoints:
+            if low < point <= high:
+                values.append(self.fee_at(point))
+        return min(values), max(values)
+
+    def topup(self, total: float) -> float:
+        if self.min_order > 0 and total < self.min_order:
+            return self.min_order - total
+        return 0.0
+
+    def lower_bound(self, spent: float, spent_max: float) -> float:
+        """
+        Нижняя оценка доставки + топапа, если итоговая сумма ЛСД лежит в [spent, spent_max].
+        Сумма после топапа лежит в [max(spent, min_order), max(spent_max, min_order)].
+        """
+        low = max(spent, self.min_order)
+        high = max(spent_max, self.min_order)
+        fee_low, _ = self.fee_bounds(low - RANGE_EPS, high + RANGE_EPS)
+        return self.fixed_fee + self.topup(spent_max) + fee_low
+
+    # Векторные версии для движков, которые оценивают сразу много состояний
+
+    def fee_at_array(self, totals: np.ndarray) -> np.ndarray:
+        """fee_at для массива сумм"""
+        mins = np.array(self.mins)
+        maxs = np.array(self.maxs)
+        fees = np.array(self.fees)
+        idx = np.clip(np.searchsorted(mins, totals, side='right') - 1, 0, len(fees) - 1)
+        idx = np.where((totals >= maxs[idx]) & (idx < len(fees) - 1), idx + 1, idx)
+        return fees[idx]
+
+    def lower_bound_array(self, spent: np.ndarray, spent_max: np.ndarray) -> np.ndarray:
+        """lower_bound для массивов сумм"""
+        low = np.maximum(spent, self.min_order) - RANGE_EPS
+        high = np.maximum(spent_max, self.min_order) + RANGE_EPS
+        fee_low = self.fee_at_array(low)
+        for point in self.breakpoints:
+            inside = (low < point) & (point <= high)
+            fee_low = np.where(inside, np.minimum(fee_low, self.fee_at(point)), fee_low)
+        topup = np.maximum(self.min_order - spent_max, 0.0) if self.min_order > 0 else 0.0
+        return self.fixed_fee + topup + fee_low
+
+    @property
+    def saturation(self) -> float:
+        """Сумма, начиная с которой доставка и топап ЛСД больше не меняются"""
+        return max(self.breakpoints + [self.min_order]) + 1.0
+
+    @property
+    def is_monotone(self) -> bool:
+        """Доставка + топап не растут с ростом суммы ЛСД"""
+        fees = [self.fee_at(0.0)] + [self.fee_at(point) for point in self.breakpoints]
+        return all(b <= a for a, b in zip(fees, fees[1:]))
+
+
+class OrderOptimizerBnB(OrderOptimizerNumPy):
+    """Точный оптимизатор методом ветвей и границ"""
+
+    def __init__(self, db_connection_string: str):
+        super().__init__(db_connection_string)
+        self.nodes_explored = 0
+        # False, если обход превысил бюджет и корзины найдены локальным поиском
+        self.exact = True
+
+    # =========================================================================
+    # ПОДГОТОВКА
+    # =========================================================================
+
+    def _prepare_search_context(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """Переводит NumPy массивы в структуры для скалярного поиска."""
+        lsd_config_ids = data['lsd_config_ids']
+        delivery_lookups = self._prepare_delivery_lookups(data)
+
+        lsd_models = {}
+        for lsd_id, lookup in delivery_lookups.items():
+            # min_order_amount и fixed_fee одинаковые для всех вариантов ЛСД - берём первый
+            idx = int(np.where(lsd_config_ids == lsd_id)[0][0])
+            lsd_models[lsd_id] = _LsdDelivery(
+                lookup,
+                float(data['min_order_amounts'][idx]),
+                float(data['delivery_fixed_fees'][idx])
+            )
+
+        items = []
+        item_offsets = data['item_offsets']
+        for item_idx in range(data['n_items']):
+            variants = []
+            for local_idx in range(data['n_variants'][item_idx]):
+                global_idx = item_offsets[item_idx] + local_idx
+                variants.append((
+                    local_idx,
+                    float(data['losses'][global_idx]),
+                    float(data['costs'][global_idx]),
+                    int(lsd_config_ids[global_idx])
+                ))
+            items.append(variants)
+
+        return {
+            'items': items,
+            'lsd_models': lsd_models,
+            'strides': [int(s) for s in self._combination_strides(data['n_variants'])]
+        }
+
+    # =========================================================================
+    # ПОИСК
+    # =========================================================================
+
+    def warm_start_threshold(self, ctx: Dict[str, Any], k: int) -> float:
+        """
+        Начальный порог для branch_and_bound по k корзинам локального поиска.
+
+        Корзины считаются той же пессимистичной оценкой, что и листья обхода,
+        поэтому порог не ниже k-й лучшей корзины и точность поиска не меняется.
+
+        Returns:
+            Порог (inf, если локальный поиск нашёл меньше k корзин)
+        """
+        # order_optimizer_heuristic импортирует этот модуль
+        from order_optimizer_heuristic import _LocalSearch, MONO_STALE_KICKS
+
+        # Короткий поиск: после нескольких возмущений без улучшения остаток бюджета
+        # уходит на соседей лучших корзин - нужны k разных корзин
+        search = _LocalSearch(ctx, max_stale_kicks=MONO_STALE_KICKS)
+        if not search.feasible or k <= 0:
+            return float('inf')
+        search.search(k, time.monotonic() + WARM_START_SEC, random.Random(0))
+
+        pessimistic = []
+        for choice in search.pool:
+            loss = 0.0
+            spent: Dict[int, float] = {}
+            for variants, pos in zip(search.items, choice):
+                _, v_loss, v_cost, lsd_id = variants[pos]
+                loss += v_loss
+                spent[lsd_id] = spent.get(lsd_id, 0.0) + v_cost
+            for lsd_id, total in spent.items():
+                if total <= 0:
+                    continue
+                model = ctx['lsd_models'][lsd_id]
+                topup = model.topup(total)
+                loss += topup + model.fixed_fee + model.fee_bounds(total + topup - RANGE_EPS,
+                                                                   total + topup + RANGE_EPS)[1]
+            pessimistic.append(loss)
+        if len(pessimistic) < k:
+            return float('inf')
+
+        kth = sorted(pessimistic)[k - 1]
+        return kth + SEARCH_EPS + abs(kth) * 1e-5
+
+    def branch_and_bound(self, ctx: Dict[str, Any], k: int,
+                         only_lsds: Optional[Set[int]] = None,
+                         threshold: float = float('inf'),
+                         max_nodes: Optional[int] = None) -> List[int]:
+        """
+        Ищет k лучших комбинаций (с запасом EPS) методом ветвей и границ.
+
+        Args:
+            ctx: Контекст из _prepare_search_context
+            k: Сколько лучших комбинаций нужно
+            only_lsds: Если задан - берём варианты только этих ЛСД
+                (один ЛСД - поиск моно-корзин)
+            threshold: Известная верхняя оценка k-й корзины (корзины хуже не нужны)
+            max_nodes: Бюджет узлов дерева (None - без ограничения)
+
+        Returns:
+            Номера комбинаций-кандидатов (0-based), их может быть больше k
+
+        Raises:
+            SearchBudgetExceeded: Обход превысил max_nodes узлов
+        """
+        lsd_models = ctx['lsd_models']
+        strides = ctx['strides']
+
+        item_variants = []
+        for variants in ctx['items']:
+            if only_lsds is not None:
+                variants = [v for v in variants if v[3] in only_lsds]
+                if not variants:
+                    return []  # Какого-то товара нет в этих ЛСД - корзина невозможна
+            # Сначала варианты с меньшими потерями - хорошие решения находятся раньше
+            item_variants.append(sorted(variants, key=lambda v: (v[1], v[0])))
+
+        # Порядок товаров: сначала с наибольшим разбросом потерь - раньше отсечения
+        order = sorted(range(len(item_variants)),
+                       key=lambda i: -(item_variants[i][-1][1] - item_variants[i][0][1]))
+        levels = [item_variants[i] for i in order]
+        n_levels = len(levels)
+        lsd_ids = sorted(lsd_models.keys())
+
+        # Суффиксные суммы: минимальные потери и максимальная добавка к сумме каждого ЛСД
+        suffix_min_loss = [0.0] * (n_levels + 1)
+        suffix_max_spend = [dict.fromkeys(lsd_ids, 0.0) for _ in range(n_levels + 1)]
+        for depth in range(n_levels - 1, -1, -1):
+            suffix_min_loss[depth] = suffix_min_loss[depth + 1] + levels[depth][0][1]
+            for lsd_id in lsd_ids:
+                costs = [v[2] for v in levels[depth] if v[3] == lsd_id]
+                suffix_max_spend[depth][lsd_id] = suffix_max_spend[depth + 1][lsd_id] + (max(costs) if costs else 0.0)
+
+        # Минимальные доставка + топап при открытии ЛСД на уровне depth
+        # (0, если в ЛСД есть бесплатные варианты - сумма 0 не считается)
+        entry_cost = [dict.fromkeys(lsd_ids, 0.0) for _ in range(n_levels + 1)]
+        for lsd_id, model in lsd_models.items():
+            lsd_costs = [v[2] for level in levels for v in level if v[3] == lsd_id]
+            if not lsd_costs or min(lsd_costs) <= 0:
+                continue
+            for depth in range(n_levels + 1):
+                entry_cost[depth][lsd_id] = model.lower_bound(min(lsd_costs), suffix_max_spend[depth][lsd_id])
+        entry_share = [dict.fromkeys(lsd_ids, 0.0) for _ in range(n_levels + 1)]
+        for depth in range(n_levels):
+            for lsd_id in lsd_ids:
+                n_levels_with_lsd = sum(1 for level in levels[depth:] if any(v[3] == lsd_id for v in level))
+                if n_levels_with_lsd:
+                    entry_share[depth][lsd_id] = entry_cost[depth][lsd_id] / n_levels_with_lsd
+        # Варианты каждого уровня: (превышение над минимальными потерями, ЛСД)
+        level_excess = [[(v[1] - level[0][1], v[3]) for v in level] for level in levels]
+
+        spent = dict.fromkeys(lsd_ids, 0.0)
+        choice = [0] * n_levels
+        candidates = []          # (оптимистичная оценка, пессимистичная оценка, номер комбинации)
+        best_pessimistic = []    # k лучших пессимистичных оценок, по возрастанию
+        state = {'threshold': threshold, 'nodes': 0}
+
+        def lower_bound(depth: int, loss_acc: float) -> float:
+            bound = loss_acc + suffix_min_loss[depth]
+            used = set()
+            for lsd_id in lsd_ids:
+                if spent[lsd_id] > 0:
+                    used.add(lsd_id)
+                    bound += lsd_models[lsd_id].lower_bound(
+                        spent[lsd_id], spent[lsd_id] + suffix_max_spend[depth][lsd_id]
+                    )
+            # Каждый оставшийся товар либо берёт вариант с большими потерями, либо открывает
+            # новый ЛСД. Штраф худшего товара не пересекается с остальной оценкой; кроме того,
+            # доставку нового ЛСД можно разделить поровну между всеми товарами, которые его могут взять
+            entry = entry_cost[depth]
+            share = entry_share[depth]
+            penalty = 0.0
+            shared_penalty = 0.0
+            for level in range(depth, n_levels):
+                best = best_shared = float('inf')
+                for excess, lsd_id in level_excess[level]:
+                    if excess >= best:
+                        break
+                    if lsd_id in used:
+                        best = min(best, excess)
+                        best_shared = min(best_shared, excess)
+                    else:
+                        best = min(best, excess + entry[lsd_id])
+                        best_shared = min(best_shared, excess + share[lsd_id])
+                penalty = max(penalty, best)
+                shared_penalty += best_shared
+            return bound + max(penalty, shared_penalty)
+
+        def evaluate_leaf(loss_acc: float) -> Tuple[float, float]:
+            optimistic = pessimistic = loss_acc
+            for lsd_id in lsd_ids:
+                total = spent[lsd_id]
+                if total <= 0:
+                    continue
+                model = lsd_models[lsd_id]
+                topup = model.topup(total)
+                fee_low, fee_high = model.fee_bounds(total + topup - RANGE_EPS, total + topup + RANGE_EPS)
+                optimistic += topup + model.fixed_fee + fee_low
+                pessimistic += topup + model.fixed_fee + fee_high
+            return optimistic, pessimistic
+
+        def add_candidate(optimistic: float, pessimistic: float):
+            combo_id = sum(choice[level] * strides[order[level]] for level in range(n_levels))
+            candidates.append((optimistic, pessimistic, combo_id))
+
+            best_pessimistic.append(pessimistic)
+            best_pessimistic.sort()
+            del best_pessimistic[k:]
+            if len(best_pessimistic) == k:
+                kth = best_pessimistic[-1]
+                new_threshold = kth + SEARCH_EPS + abs(kth) * 1e-5
+                if new_threshold < state['threshold']:
+                    state['threshold'] = new_threshold
+                    # Выбрасываем кандидатов, которые уже точно не попадут в топ
+                    candidates[:] = [c for c in candidates if c[0] <= new_threshold]
+
+        def dfs(depth: int, loss_acc: float):
+            state['nodes'] += 1
+            if max_nodes is not None and state['nodes'] > max_nodes:
+                raise SearchBudgetExceeded()
+            if depth == n_levels:
+                optimistic, pessimistic = evaluate_leaf(loss_acc)
+                if optimistic <= state['threshold']:
+                    add_candidate(optimistic, pessimistic)
+                return
+
+            if lower_bound(depth, loss_acc) > state['threshold']:
+                return
+
+            for local_idx, loss, cost, lsd_id in levels[depth]:
+                # Варианты отсортированы по потерям: дальше только хуже
+                if loss_acc + loss + suffix_min_loss[depth + 1] > state['threshold']:
+                    break
+                choice[depth] = local_idx
+                spent[lsd_id] += cost
+                dfs(depth + 1, loss_acc + loss)
+                spent[lsd_id] -= cost
+
+        try:
+            if k > 0:
+                dfs(0, 0.0)
+        finally:
+            self.nodes_explored += state['nodes']
+
+        return [c[2] for c in candidates]
+
+    def rank_combinations(self, combo_ids: List[int], data: Dict[str, Any],
+                          delivery_lookups: Dict[int, Dict[str, np.ndarray]]) -> Tuple[np.ndarray, ...]:
+        """
+        Точно (float32-ядром NumPy движка) пересчитывает и сортирует комбинации.
+
+        Returns:
+            (combo_ids, combo_indices, total_losses, total_costs, total_delivery, total_topup)
+            в порядке np.lexsort((total_cost, total_loss_and_delivery))
+        """
+        combo_ids = np.array(sorted(set(combo_ids)), dtype=combination_id_dtype(data['n_variants']))
+        combo_indices = self.decode_combination_ids(combo_ids, data['n_variants'])
+        total_losses, total_costs = self._basic_metrics_for_indices(combo_indices, data)
+        total_delivery, total_topup = self._delivery_for_indices(combo_indices, data, delivery_lookups)
+
+        total_loss_and_delivery = total_losses + total_topup + total_delivery
+        total_costs_corrected = total_costs + total_topup + total_delivery
+        order = np.lexsort((total_costs_corrected, total_loss_and_delivery))
+
+        return (combo_ids[order], combo_indices[order], total_losses[order],
+                total_costs[order], total_delivery[order], total_topup[order])
+
+    def build_ranked_baskets(self, top_ranked: Tuple[np.ndarray, ...],
+                             mono_ranked: Dict[int, Tuple[np.ndarray, ...]],
+                             data: Dict[str, Any], top_n: int) -> List[Dict[str, Any]]:
+        """
+        Собирает топ-N корзин и лучшие моно-корзины, не попавшие в топ-N
+        (семантика select_top_baskets), из результатов rank_combinations.
+
+        Args:
+            top_ranked: Кандидаты в топ-N
+            mono_ranked: Dict[lsd_id] -> кандидаты в моно-корзины ЛСД (не меньше top_n + 1)
+        """
+        top_baskets = []
+        top_basket_ids = set()
+        for pos in range(min(top_n, len(top_ranked[0]))):
+            basket = self._build_basket(
+                top_ranked[1][pos], int(top_ranked[0][pos]), pos + 1, data,
+                top_ranked[2][pos], top_ranked[3][pos], top_ranked[5][pos], top_ranked[4][pos]
+            )
+            top_baskets.append(basket)
+            top_basket_ids.add(int(top_ranked[0][pos]))
+
+            if pos < 3:
+                mono_label = "[МОНО]" if basket['is_mono_basket'] else "[МУЛЬТИ]"
+                logger.info(f"  #{pos + 1} {mono_label}: basket_id={basket['basket_id']}, "
+                            f"loss+delivery={basket['total_loss_and_delivery']:.2f}₽, "
+                            f"итого={basket['total_cost']:.2f}₽")
+
+        next_rank = len(top_baskets) + 1
+        mono_baskets_added = 0
+        for lsd_id in sorted(mono_ranked):
+            ranked = mono_ranked[lsd_id]
+            for pos, combo_id in enumerate(ranked[0]):
+                if int(combo_id) in top_basket_ids:
+                    continue
+                basket = self._build_basket(
+                    ranked[1][pos], int(combo_id), next_rank, data,
+                    ranked[2][pos], ranked[3][pos], ranked[5][pos], ranked[4][pos]
+                )
+                top_baskets.append(basket)
+                top_basket_ids.add(int(combo_id))
+                mono_baskets_added += 1
+                next_rank += 1
+
+                logger.info(f"  ✓ Добавлена моно-корзина {basket['basket_items'][0]['lsd_name']}: "
+                            f"loss+delivery={basket['total_loss_and_delivery']:.2f}₽, "
+                            f"итого={basket['total_cost']:.2f}₽")
+                break
+
+        logger.info(f"Добавлено дополнительных моно-корзин: {mono_baskets_added}")
+        return self._fit_basket_ids(top_baskets)
+
+    def _fit_basket_ids(self, top_baskets: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        basket_id хранится в BIGINT: корзина, у которой номер комбинации + 1
+        больше BIGINT_MAX, получает basket_id = ранг. Остальные корзины
+        сохраняют номер комбинации и сравнимы с другими движками. Если ранг
+        совпал с basket_id другой корзины заказа, ранг получают все корзины.
+        """
+        oversized = [basket for basket in top_baskets if basket['basket_id'] > BIGINT_MAX]
+        if not oversized:
+            return top_baskets
+
+        kept_ids = {basket['basket_id'] for basket in top_baskets if basket['basket_id'] <= BIGINT_MAX}
+        if any(basket['rank'] in kept_ids for basket in oversized):
+            oversized = top_baskets
+        logger.info(f"  Номера комбинаций {len(oversized)} корзин не помещаются в BIGINT - basket_id = ранг")
+        for basket in oversized:
+            basket['basket_id'] = basket['rank']
+        return top_baskets
+
+    def select_top_baskets_bnb(self, data: Dict[str, Any], top_n: int = 10) -> List[Dict[str, Any]]:
+        """
+        Отбирает топ-N корзин + лучшие моно-корзины для каждого LSD
+        (семантика select_top_baskets) без полного перебора.
+        """
+        logger.info(f"Поиск топ-{top_n} корзин методом ветвей и границ...")
+        start_time = time.time()
+
+        ctx = self._prepare_search_context(data)
+        delivery_lookups = self._prepare_delivery_lookups(data)
+        nodes_before = self.nodes_explored
+
+        def budget() -> int:
+            return BNB_MAX_NODES - (self.nodes_explored - nodes_before)
+
+        try:
+            # Шаг 1: топ-N
+            threshold = self.warm_start_threshold(ctx, top_n)
+            top_ranked = self.rank_combinations(
+                self.branch_and_bound(ctx, top_n, threshold=threshold, max_nodes=budget()),
+                data, delivery_lookups
+            )
+            logger.info(f"  Узлов дерева поиска (топ-{top_n}): {self.nodes_explored:,}")
+
+            # Шаг 2: кандидаты в моно-корзины каждого ЛСД
+            mono_ranked = {}
+            for lsd_id in np.unique(data['lsd_config_ids']):
+                candidates = self.branch_and_bound(ctx, top_n + 1, only_lsds={int(lsd_id)},
+                                                   max_nodes=budget())
+                if candidates:
+                    mono_ranked[int(lsd_id)] = self.rank_combinations(candidates, data, delivery_lookups)
+        except SearchBudgetExceeded:
+            # order_optimizer_heuristic импортирует этот модуль
+            from order_optimizer_heuristic import OrderOptimizerHeuristic
+
+            logger.warning(f"  Обход превысил {BNB_MAX_NODES:,} узлов - переходим на локальный поиск "
+                           f"(без гарантии оптимума)")
+            self.exact = False
+            return OrderOptimizerHeuristic(self.db_connection_string).select_top_baskets_heuristic(data, top_n)
+
+        top_baskets = self.build_ranked_baskets(top_ranked, mono_ranked, data, top_n)
+
+        elapsed = time.time() - start_time
+        logger.info(f"Всего узлов дерева поиска: {self.nodes_explored:,} "
+                    f"(полный перебор: {data['n_combinations']:,} комбинаций)")
+        logger.info(f"Отбор завершён за {elapsed:.2f} сек")
+
+        return top_baskets
+
+    # =========================================================================
+    # ГЛАВНАЯ ФУНКЦИЯ
+    # =========================================================================
+
+    def optimize_order(self, order_id: int, top_n_final: int = 10, exclusions: dict = None) -> Dict[str, Any]:
+        """
+        Полная оптимизация заказа методом ветвей и границ.
+
+        Args:
+            order_id: ID заказа
+            top_n_final: Количество финальных корзин для записи
+            exclusions: Словарь с исключениями пользователя (keywords, products)
+
+        Returns:
+            Dict с результатами (включая nodes_explored)
+        """
+        total_start = time.time()
+        self.nodes_explored = 0
+        self.exact = True
+
+        logger.info("=" * 80)
+        logger.info(f"ОПТИМИЗАЦИЯ ЗАКАЗА #{order_id} (branch-and-bound)")
+        logger.info("=" * 80)
+
+        gc.disable()
+        try:
+            logger.info("\n[1/3] Загрузка данных в NumPy...")
+            data = self.load_fprice_data_to_numpy(order_id, exclusions=exclusions)
+            if data is None:
+                return {"status": "no_data", "elapsed_time": 0}
+
+            logger.info("\n[2/3] Поиск лучших корзин...")
+            top_baskets = self.select_top_baskets_bnb(data, top_n_final)
+
+            logger.info(f"\n[3/3] Запись {len(top_baskets)} корзин в БД...")
+            self.save_to_db(top_baskets, order_id)
+
+        finally:
+            gc.enable()
+            gc.collect()
+
+        total_elapsed = time.time() - total_start
+
+        best = top_baskets[0]
+        logger.info("\n" + "=" * 80)
+        logger.info("ОПТИМИЗАЦИЯ ЗАВЕРШЕНА")
+        logger.info("=" * 80)
+        logger.info(f"Всего комбинаций: {data['n_combinations']:,}")
+        logger.info(f"Узлов дерева поиска: {self.nodes_explored:,}")
+        logger.info(f"Лучшая корзина: #{best['basket_id']}")
+        logger.info(f"  - Потери + доставка: {best['total_loss_and_delivery']:.2f}₽")
+        logger.info(f"  - Итого: {best['total_cost']:.2f}₽")
+        logger.info(f"Время выполнения: {total_elapsed:.2f} сек")
+        logger.info("=" * 80)
+
+        return {
+            "status": "success",
+            "order_id": order_id,
+            "total_combinations": data['n_combinations'],
+            "nodes_explored": self.nodes_explored,
+            "exact": self.exact,
+            "saved_baskets": len(top_baskets),
+            "best_basket_id": best['basket_id'],
+            "best_total_cost": best['total_cost'],
+            "best_loss_and_delivery": best['total_loss_and_delivery'],
+            "elapsed_time": total_elapsed
+        }
+
+
+def optimize_order_bnb(order_id: int, db_connection_string: str,
+                       top_n_final: int = 10, exclusions: dict = None) -> Dict[str, Any]:
+    """
+    Функция-обёртка для оптимизации методом ветвей и границ.
+
+    Args:
+        order_id: ID заказа
+        db_connection_string: Строка подключения к PostgreSQL
+        top_n_final: Количество финальных корзин для записи
+        exclusions: Словарь с исключениями пользователя (keywords, products)
+    """
+    with OrderOptimizerBnB(db_connection_string) as optimizer:
+        return optimizer.optimize_order(order_id, top_n_final, exclusions=exclusions)
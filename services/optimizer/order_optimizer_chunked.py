@@ -0,0 +1,341 @@
+"""
+Потоковый (блочный) режим NumPy оптимизатора.
+
+Обходит пространство комбинаций в смешанной системе счисления блоками
+фиксированного размера: для каждого блока считает потери, стоимость товаров,
+доставку и топап, после чего сливает блок в бегущий топ-N и в бегущие
+лучшие моно-корзины по каждому ЛСД. Пиковая память определяется размером
+блока (block_size), а не количеством комбинаций заказа.
+
+Результат совпадает с OrderOptimizerNumPy.select_top_baskets: те же метрики
+(float32, тот же порядок вычислений), тот же порядок сортировки
+(total_loss_and_delivery, total_cost, номер комбинации) и те же basket_id.
+"""
+
+import logging
+import time
+import gc
+from typing import List, Dict, Any, Tuple, Iterator
+import numpy as np
+
+from order_optimizer_numpy import OrderOptimizerNumPy
+from utils.stage_metrics import StageMetrics
+
+# Пишем в тот же лог, что и NumPy оптимизатор (logs/optimizer_numpy.log)
+logger = logging.getLogger('order_optimizer_numpy')
+
+# Размер блока по умолчанию: ~40 байт временных массивов на ячейку (комбинация × товар),
+# для 12 товаров это ~90 MB на блок
+DEFAULT_BLOCK_SIZE = 200_000
+
+
+class OrderOptimizerChunked(OrderOptimizerNumPy):
+    """NumPy оптимизатор с потоковой обработкой комбинаций блоками"""
+
+    def __init__(self, db_connection_string: str, block_size: int = DEFAULT_BLOCK_SIZE):
+        """
+        Args:
+            db_connection_string: PostgreSQL connection string
+            block_size: Количество комбинаций в одном блоке
+        """
+        super().__init__(db_connection_string)
+        if block_size < 1:
+            raise ValueError(f"block_size должен быть положительным, получено {block_size}")
+        self.block_size = block_size
+
+    # =========================================================================
+    # ОБХОД ПРОСТРАНСТВА КОМБИНАЦИЙ БЛОКАМИ
+    # =========================================================================
+
+    def iter_combination_blocks(self, n_variants: List[int], start: int = 0,
+                                stop: int = None) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Генерирует блоки индексной матрицы для диапазона номеров комбинаций.
+
+        Args:
+            n_variants: Список количества вариантов для каждого товара
+            start: Первый номер комбинации (включительно)
+            stop: Последний номер комбинации (не включительно), по умолчанию - все
+
+        Yields:
+            (combo_ids, combo_indices) - номера комбинаций shape (block,)
+            и локальные индексы вариантов shape (block, n_items)
+        """
+        if stop is None:
+            stop = int(np.prod(n_variants, dtype=np.int64))
+
+        for block_start in range(start, stop, self.block_size):
+            block_stop = min(block_start + self.block_size, stop)
+            combo_ids = np.arange(block_start, block_stop, dtype=np.int64)
+            yield combo_ids, self.decode_combination_ids(combo_ids, n_variants)
+
+    def evaluate_block(self, combo_indices: np.ndarray, data: Dict[str, Any],
+                       delivery_lookups: Dict[int, Dict[str, np.ndarray]]) -> Tuple[np.ndarray, ...]:
+        """
+        Считает метрики для блока комбинаций.
+
+        Returns:
+            (total_losses, total_costs, total_delivery, total_topup) - массивы shape (block,)
+        """
+        total_losses, total_costs = self._basic_metrics_for_indices(combo_indices, data)
+        total_delivery, total_topup = self._delivery_for_indices(combo_indices, data, delivery_lookups)
+        return total_losses, total_costs, total_delivery, total_topup
+
+    # =========================================================================
+    # БЕГУЩИЙ ТОП-N
+    # =========================================================================
+
+    def _merge_top(self, running: Dict[str, np.ndarray], combo_ids: np.ndarray,
+                   loss_and_delivery: np.ndarray, total_cost: np.ndarray, k: int) -> Dict[str, np.ndarray]:
+        """
+        Сливает кандидатов в бегущий топ-k.
+
+        Порядок - как у np.lexsort((total_cost, loss_and_delivery)) по всем
+        комбинациям: при полном равенстве ключей выигрывает меньший номер комбинации.
+        """
+        if k <= 0:
+            return running
+
+        if len(combo_ids) > k:
+            # Отсекаем заведомо лишних: всё, что хуже k-го значения основного ключа.
+            # Равные k-му значению оставляем - их судьбу решат вторичные ключи.
+            threshold = np.partition(loss_and_delivery, k - 1)[k - 1]
+            keep = loss_and_delivery <= threshold
+            combo_ids = combo_ids[keep]
+            loss_and_delivery = loss_and_delivery[keep]
+            total_cost = total_cost[keep]
+
+        ids = np.concatenate([running['ids'], combo_ids])
+        keys = np.concatenate([running['loss_and_delivery'], loss_and_delivery])
+        costs = np.concatenate([running['total_cost'], total_cost])
+
+        order = np.lexsort((ids, costs, keys))[:k]
+        return {
+            'ids': ids[order],
+            'loss_and_delivery': keys[order],
+            'total_cost': costs[order]
+        }
+
+    def _empty_top(self) -> Dict[str, np.ndarray]:
+        return {
+            'ids': np.empty(0, dtype=np.int64),
+            'loss_and_delivery': np.empty(0, dtype=np.float32),
+            'total_cost': np.empty(0, dtype=np.float32)
+        }
+
+    def stream_top_combinations(self, data: Dict[str, Any], top_n: int = 10,
+                                start: int = 0, stop: int = None,
+                                delivery_lookups: Dict[int, Dict[str, np.ndarray]] = None) -> Dict[str, Any]:
+        """
+        Потоково обходит диапазон комбинаций и возвращает бегущие топы.
+
+        Моно-кандидатов по каждому ЛСД храним top_n + 1: select_top_baskets
+        берёт лучшую моно-корзину, которая НЕ попала в общий топ-N, а в топ-N
+        может попасть не более top_n моно-корзин одного ЛСД.
+
+        Args:
+            data: Словарь с NumPy массивами данных
+            top_n: Размер общего топа
+            start, stop: Диапазон номеров комбинаций (по умолчанию - все)
+            delivery_lookups: Готовые lookup-таблицы доставки (по умолчанию строятся из data)
+
+        Returns:
+            Dict: 'top' - бегущий топ-N, 'mono' - {lsd_id: топ моно-корзин},
+            'n_blocks', 'n_processed'
+        """
+        lsd_config_ids = data['lsd_config_ids']
+        if delivery_lookups is None:
+            delivery_lookups = self._prepare_delivery_lookups(data)
+        mono_k = top_n + 1
+
+        top = self._empty_top()
+        mono = {}
+        n_blocks = 0
+        n_processed = 0
+
+        for combo_ids, combo_indices in self.iter_combination_blocks(data['n_variants'], start, stop):
+            total_losses, total_costs, total_delivery, total_topup = self.evaluate_block(
+                combo_indices, data, delivery_lookups
+            )
+
+            # Те же выражения и порядок операций, что и в select_top_baskets
+            total_loss_and_delivery = total_losses + total_topup + total_delivery
+            total_costs_corrected = total_costs + total_topup + total_delivery
+
+            top = self._merge_top(top, combo_ids, total_loss_and_delivery, total_costs_corrected, top_n)
+
+            # Моно-корзины блока: все товары из одного ЛСД
+            combo_lsd_ids = lsd_config_ids[self._global_indices(combo_indices, data)]
+            mono_rows = np.nonzero((combo_lsd_ids == combo_lsd_ids[:, :1]).all(axis=1))[0]
+            if len(mono_rows):
+                mono_lsds = combo_lsd_ids[mono_rows, 0]
+                for lsd_id in np.unique(mono_lsds):
+                    rows = mono_rows[mono_lsds == lsd_id]
+                    mono[int(lsd_id)] = self._merge_top(
+                        mono.get(int(lsd_id), self._empty_top()), combo_ids[rows],
+                        total_loss_and_delivery[rows], total_costs_corrected[rows], mono_k
+                    )
+
+            n_blocks += 1
+            n_processed += len(combo_ids)
+
+        return {'top': top, 'mono': mono, 'n_blocks': n_blocks, 'n_processed': n_processed}
+
+    def build_top_baskets(self, top: Dict[str, np.ndarray], mono: Dict[int, Dict[str, np.ndarray]],
+                          data: Dict[str, Any], top_n: int = 10) -> List[Dict[str, Any]]:
+        """
+        Формирует итоговый список корзин (топ-N + лучшие моно-корзины по ЛСД)
+        в формате select_top_baskets.
+        """
+        top_ids = [int(i) for i in top['ids'][:top_n]]
+        top_id_set = set(top_ids)
+
+        # Лучшая моно-корзина каждого ЛСД, не попавшая в топ-N (ЛСД по возрастанию id)
+        mono_ids = []
+        for lsd_id in np.unique(data['lsd_config_ids']):
+            candidates = mono.get(int(lsd_id))
+            if candidates is None:
+                continue
+            for combo_id in candidates['ids']:
+                if int(combo_id) not in top_id_set:
+                    mono_ids.append(int(combo_id))
+                    break
+
+        # Пересчитываем метрики только для победителей - результат для строки
+        # не зависит от блока, поэтому значения совпадают побитово
+        selected_ids = np.array(top_ids + mono_ids, dtype=np.int64)
+        combo_indices = self.decode_combination_ids(selected_ids, data['n_variants'])
+        total_losses, total_costs, total_delivery, total_topup = self.evaluate_block(
+            combo_indices, data, self._prepare_delivery_lookups(data)
+        )
+
+        top_baskets = []
+        for pos, combo_id in enumerate(selected_ids):
+            basket = self._build_basket(
+                combo_indices[pos], int(combo_id), pos + 1, data,
+                total_losses[pos], total_costs[pos], total_topup[pos], total_delivery[pos]
+            )
+            top_baskets.append(basket)
+
+            if pos < len(top_ids) and pos < 3:
+                mono_label = "[МОНО]" if basket['is_mono_basket'] else "[МУЛЬТИ]"
+                logger.info(f"  #{pos + 1} {mono_label}: basket_id={basket['basket_id']}, "
+                            f"loss+delivery={basket['total_loss_and_delivery']:.2f}₽, "
+                            f"итого={basket['total_cost']:.2f}₽")
+            elif pos >= len(top_ids):
+                logger.info(f"  ✓ Добавлена моно-корзина {basket['basket_items'][0]['lsd_name']}: "
+                            f"loss+delivery={basket['total_loss_and_delivery']:.2f}₽, "
+                            f"итого={basket['total_cost']:.2f}₽")
+
+        mono_count_in_top = sum(1 for b in top_baskets[:len(top_ids)] if b['is_mono_basket'])
+        logger.info(f"Моно-корзин в топ-{top_n}: {mono_count_in_top}")
+        logger.info(f"Добавлено дополнительных моно-корзин: {len(mono_ids)}")
+        logger.info(f"Всего корзин для сохранения: {len(top_baskets)}")
+
+        return top_baskets
+
+    # =========================================================================
+    # ГЛАВНАЯ ФУНКЦИЯ
+    # =========================================================================
+
+    def optimize_order(self, order_id: int, top_n_final: int = 10, exclusions: dict = None) -> Dict[str, Any]:
+        """
+        Полная оптимизация заказа в потоковом режиме.
+        Анализирует ВСЕ комбинации, но держит в памяти только один блок.
+
+        Args:
+            order_id: ID заказа
+            top_n_final: Количество финальных корзин для записи
+            exclusions: Словарь с исключениями пользователя (keywords, products)
+
+        Returns:
+            Dict с результатами
+        """
+        total_start = time.time()
+
+        logger.info("=" * 80)
+        logger.info(f"ОПТИМИЗАЦИЯ ЗАКАЗА #{order_id} (NumPy, потоковый режим)")
+        logger.info("=" * 80)
+
+        gc.disable()
+        # Длительность, пик памяти и объём каждого этапа (utils/stage_metrics.py)
+        stage_metrics = StageMetrics('chunked')
+        try:
+            # Этап 1: Загрузка данных
+            logger.info("\n[1/3] Загрузка данных в NumPy...")
+            with stage_metrics.stage('load') as stage:
+                data = self.load_fprice_data_to_numpy(order_id, exclusions=exclusions)
+                if data is not None:
+                    stage['combinations'] = data['n_combinations']
+            if data is None:
+                return {"status": "no_data", "elapsed_time": 0}
+            stage_metrics.set_order(data)
+
+            n_combinations = data['n_combinations']
+            block_mb = (min(self.block_size, n_combinations) * data['n_items'] * 40) / (1024 * 1024)
+            logger.info(f"  Размер блока: {self.block_size:,} комбинаций (~{block_mb:.1f} MB временных массивов)")
+
+            # Этап 2: Потоковый расчёт метрик и отбор (метрики, доставка и топ-N в одном проходе)
+            logger.info(f"\n[2/3] Потоковый расчёт {n_combinations:,} комбинаций...")
+            with stage_metrics.stage('scan', n_combinations) as stage:
+                streamed = self.stream_top_combinations(data, top_n_final)
+                top_baskets = self.build_top_baskets(streamed['top'], streamed['mono'], data, top_n_final)
+                stage['blocks'] = streamed['n_blocks']
+            logger.info(f"Обработано {streamed['n_processed']:,} комбинаций в {streamed['n_blocks']} блоках "
+                        f"за {stage_metrics.stages['scan']['duration_sec']:.2f} сек")
+
+            # Этап 3: Запись в БД
+            logger.info(f"\n[3/3] Запись {len(top_baskets)} корзин в БД...")
+            with stage_metrics.stage('save') as stage:
+                stage['baskets'] = len(top_baskets)
+                self.save_to_db(top_baskets, order_id)
+
+        finally:
+            stage_metrics.close()
+            gc.enable()
+            gc.collect()
+
+        total_elapsed = time.time() - total_start
+
+        best = top_baskets[0]
+        logger.info("\n" + "=" * 80)
+        logger.info("ОПТИМИЗАЦИЯ ЗАВЕРШЕНА")
+        logger.info("=" * 80)
+        logger.info(f"Всего комбинаций: {n_combinations:,}")
+        logger.info(f"Лучшая корзина: #{best['basket_id']}")
+        logger.info(f"  - Потери + доставка: {best['total_loss_and_delivery']:.2f}₽")
+        logger.info(f"  - Итого: {best['total_cost']:.2f}₽")
+        logger.info(f"Время выполнения: {total_elapsed:.2f} сек")
+        logger.info(f"Этапы: {stage_metrics.log_line()}")
+        logger.info("=" * 80)
+
+        return {
+            "status": "success",
+            "order_id": order_id,
+            "total_combinations": n_combinations,
+            "saved_baskets": len(top_baskets),
+            "best_basket_id": best['basket_id'],
+            "best_total_cost": best['total_cost'],
+            "best_loss_and_delivery": best['total_loss_and_delivery'],
+            "elapsed_time": total_elapsed,
+            "performance_comb_per_sec": int(n_combinations / total_elapsed),
+            "block_size": self.block_size,
+            "n_blocks": streamed['n_blocks'],
+            "stage_metrics": stage_metrics.summary()
+        }
+
+
+def optimize_order_chunked(order_id: int, db_connection_string: str, top_n_final: int = 10,
+                           exclusions: dict = None, block_size: int = DEFAULT_BLOCK_SIZE) -> Dict[str, Any]:
+    """
+    Функция-обёртка для потоковой оптимизации с NumPy.
+
+    Args:
+        order_id: ID заказа
+        db_connection_string: Строка подключения к PostgreSQL
+        top_n_final: Количество финальных корзин для записи
+        exclusions: Словарь с исключениями пользователя (keywords, products)
+        block_size: Количество комбинаций в одном блоке
+    """
+    with OrderOptimizerChunked(db_connection_string, block_size=block_size) as optimizer:
+        return optimizer.optimize_order(order_id, top_n_final, exclusions=exclusions)
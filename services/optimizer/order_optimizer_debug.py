@@ -17,6 +17,7 @@ from order_optimizer import OrderOptimizer as BaseOptimizer
 
 # Импортируем CSV exporter
 from utils.csv_exporter import CSVExporter
+from utils.result_writer import copy_rows
 
 logger = logging.getLogger('order_optimizer_debug')
 
@@ -140,69 +141,29 @@ class OrderOptimizerDebug(BaseOptimizer):
             
             # _basket_combinations через COPY
             if bc_rows:
-                import io
-                buf = io.StringIO()
-                for row in bc_rows:
-                    # Преобразуем кортеж в строку для COPY
-                    # Экранируем табуляции и переносы строк в данных
-                    line = '\t'.join(
-                        str(val).replace('\t', ' ').replace('\n', ' ').replace('\r', ' ') if val is not None else '\\N'
-                        for val in row
-                    )
-                    buf.write(line + '\n')
-                
-                buf.seek(0)
-                cur.copy_from(
-                    buf,
-                    '_basket_combinations',
-                    columns=(
-                        'basket_id', 'id', 'order_id', 'order_item_id', 
-                        'product_name', 'lsd_name', 'base_unit', 'base_quantity', 'price', 
-                        'fprice', 'fprice_min', 'fprice_diff', 'loss', 'order_item_ids_quantity', 
-                        'min_order_amount', 'lsd_config_id', 'delivery_cost_model', 'order_item_ids_cost',
-                        'fprice_optimizer_id'
-                    )
-                )
+                copy_rows(cur, '_basket_combinations', (
+                    'basket_id', 'id', 'order_id', 'order_item_id', 
+                    'product_name', 'lsd_name', 'base_unit', 'base_quantity', 'price', 
+                    'fprice', 'fprice_min', 'fprice_diff', 'loss', 'order_item_ids_quantity', 
+                    'min_order_amount', 'lsd_config_id', 'delivery_cost_model', 'order_item_ids_cost',
+                    'fprice_optimizer_id'
+                ), bc_rows)
                 logger.info(f"  ✓ _basket_combinations: {len(bc_rows):,} строк")
             
             # _basket_delivery_costs через COPY
             if bdc_rows:
-                buf = io.StringIO()
-                for row in bdc_rows:
-                    line = '\t'.join(
-                        str(val) if val is not None else '\\N'
-                        for val in row
-                    )
-                    buf.write(line + '\n')
-                
-                buf.seek(0)
-                cur.copy_from(
-                    buf,
-                    '_basket_delivery_costs',
-                    columns=('basket_id', 'lsd_config_id', 'delivery_cost', 'topup', 'lsd_total_basket_cost', 'min_order_amount')
-                )
+                copy_rows(cur, '_basket_delivery_costs', (
+                    'basket_id', 'lsd_config_id', 'delivery_cost', 'topup', 'lsd_total_basket_cost', 'min_order_amount'
+                ), bdc_rows)
                 logger.info(f"  ✓ _basket_delivery_costs: {len(bdc_rows):,} строк")
             
             # _basket_analyses через COPY
             if ba_rows:
-                buf = io.StringIO()
-                for row in ba_rows:
-                    line = '\t'.join(
-                        str(val).replace('\t', ' ').replace('\n', ' ').replace('\r', ' ') if val is not None else '\\N'
-                        for val in row
-                    )
-                    buf.write(line + '\n')
-                
-                buf.seek(0)
-                cur.copy_from(
-                    buf,
-                    '_basket_analyses',
-                    columns=(
-                        'order_id', 'basket_id', 'total_loss', 'total_goods_cost',
-                        'delivery_cost', 'delivery_topup', 'total_delivery_cost',
-                        'total_cost', 'total_loss_and_delivery', 'basket_rank'
-                    )
-                )
+                copy_rows(cur, '_basket_analyses', (
+                    'order_id', 'basket_id', 'total_loss', 'total_goods_cost',
+                    'delivery_cost', 'delivery_topup', 'total_delivery_cost',
+                    'total_cost', 'total_loss_and_delivery', 'basket_rank'
+                ), ba_rows)
                 logger.info(f"  ✓ _basket_analyses: {len(ba_rows):,} строк")
         
         self.conn.commit()
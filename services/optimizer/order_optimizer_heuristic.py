@@ -0,0 +1,450 @@
+"""
+Эвристический оптимизатор заказов: локальный поиск от жадного решения.
+
+Для заказов, которые не укладываются в бюджет ни полным перебором, ни
+ветвями и границами (десятки товаров), ищет хорошие корзины без гарантии
+оптимума:
+
+1. Жадное решение - вариант с наименьшими потерями для каждого товара
+   (как BasketOptimizer._greedy_optimization в order-service).
+2. Спуск с чередованием окрестностей по точной цели
+   потери + доставка + топап (диапазоны доставки и минимальный заказ ЛСД):
+   - перенос товара: другой вариант одного товара;
+   - консолидация ЛСД: все товары одного ЛСД переходят в остальные ЛСД
+     корзины или целиком в другой ЛСД - экономия фиксированной доставки;
+   - обмен: два товара разных ЛСД меняются магазинами - суммы ЛСД
+     сдвигаются к порогам диапазонов без смены набора ЛСД.
+3. Возмущения: несколько случайных товаров лучшей корзины получают другие
+   варианты, и спуск повторяется - пока не кончится бюджет времени или
+   MAX_STALE_KICKS возмущений подряд не улучшат лучшую корзину.
+
+Кандидаты (локальные оптимумы и их соседи по переносу товара) и моно-корзины
+(тот же поиск в пределах одного ЛСД) пересчитываются float32-ядром NumPy
+движка, поэтому метрики и записи корзин те же, что у остальных движков.
+Топ-N ранжируется по объединению кандидатов и моно-корзин. Заказ до
+OPTIMIZER_HEURISTIC_EXHAUSTIVE_MAX комбинаций считается полным перебором.
+basket_id = номер комбинации + 1; корзины, чей номер не помещается в BIGINT,
+получают basket_id = ранг (OrderOptimizerBnB._fit_basket_ids).
+"""
+
+import logging
+import math
+import os
+import random
+import time
+import gc
+from typing import List, Dict, Any, Tuple, Optional, Iterator
+import numpy as np
+
+from order_optimizer_numpy import combination_index_dtype
+from order_optimizer_bnb import OrderOptimizerBnB, SEARCH_EPS
+
+# Пишем в тот же лог, что и NumPy оптимизатор (logs/optimizer_numpy.log)
+logger = logging.getLogger('order_optimizer_numpy')
+
+# Бюджет времени на поиск по умолчанию (сек)
+HEURISTIC_TIME_BUDGET_SEC = float(os.getenv('OPTIMIZER_HEURISTIC_TIME_BUDGET_SEC', '10'))
+# Доля бюджета на основной поиск, остаток - на моно-корзины
+MAIN_SEARCH_SHARE = 0.8
+# Возмущений подряд без улучшения, после которых поиск останавливается
+MAX_STALE_KICKS = 200
+MONO_STALE_KICKS = 20
+# Сколько товаров меняет одно возмущение
+KICK_SIZE = 3
+# Минимальное улучшение цели, которое считается улучшением (₽)
+IMPROVE_EPS = 1e-6
+# Сумма ЛСД меньше этой считается нулевой (остаток вычитаний в float64)
+SPEND_EPS = 1e-6
+# До стольких комбинаций - полный перебор NumPy вместо локального поиска
+HEURISTIC_EXHAUSTIVE_MAX_COMBINATIONS = int(os.getenv('OPTIMIZER_HEURISTIC_EXHAUSTIVE_MAX', '200000'))
+
+
+class _LocalSearch:
+    """Локальный поиск по вариантам товаров (цель в float64)"""
+
+    def __init__(self, ctx: Dict[str, Any], only_lsd: Optional[int] = None,
+                 max_stale_kicks: int = MAX_STALE_KICKS):
+        """
+        Args:
+            ctx: Контекст из _prepare_search_context
+            only_lsd: Если задан - только варианты этого ЛСД (поиск моно-корзин)
+            max_stale_kicks: Возмущений подряд без улучшения до остановки
+        """
+        self.lsd_models = ctx['lsd_models']
+        self.max_stale_kicks = max_stale_kicks
+        self.items = []
+        for variants in ctx['items']:
+            if only_lsd is not None:
+                variants = [v for v in variants if v[3] == only_lsd]
+            # Позиция 0 - вариант с наименьшими потерями
+            self.items.append(sorted(variants, key=lambda v: (v[1], v[0])))
+        self.n_items = len(self.items)
+        self.feasible = all(self.items)
+        self.lsd_ids = sorted({v[3] for variants in self.items for v in variants})
+        # Лучший по потерям вариант каждого товара в каждом ЛСД
+        self.best_in_lsd = []
+        for variants in self.items:
+            best = {}
+            for pos, v in enumerate(variants):
+                best.setdefault(v[3], pos)
+            self.best_in_lsd.append(best)
+        # Найденные корзины: позиции вариантов -> цель
+        self.pool: Dict[Tuple[int, ...], float] = {}
+        self.kicks = 0
+
+    # Цель
+
+    def lsd_cost(self, lsd_id: int, total: float) -> float:
+        """Доставка + топап ЛСД с суммой товаров total (семантика _lsd_delivery_from_totals)"""
+        if total <= SPEND_EPS:
+            return 0.0
+        model = self.lsd_models[lsd_id]
+        topup = model.topup(total)
+        return topup + model.fixed_fee + model.fee_at(total + topup)
+
+    def evaluate(self, choice: List[int]) -> Tuple[float, Dict[int, float]]:
+        """(цель, суммы ЛСД) корзины"""
+        loss = 0.0
+        spend: Dict[int, float] = {}
+        for variants, pos in zip(self.items, choice):
+            _, v_loss, v_cost, lsd_id = variants[pos]
+            loss += v_loss
+            spend[lsd_id] = spend.get(lsd_id, 0.0) + v_cost
+        return loss + sum(self.lsd_cost(lsd_id, total) for lsd_id, total in spend.items()), spend
+
+    def move_delta(self, choice: List[int], spend: Dict[int, float], changes: Dict[int, int]) -> float:
+        """Изменение цели при смене вариантов {товар: новая позиция}"""
+        delta = 0.0
+        shifts: Dict[int, float] = {}
+        for item, pos in changes.items():
+            _, old_loss, old_cost, old_lsd = self.items[item][choice[item]]
+            _, new_loss, new_cost, new_lsd = self.items[item][pos]
+            delta += new_loss - old_loss
+            shifts[old_lsd] = shifts.get(old_lsd, 0.0) - old_cost
+            shifts[new_lsd] = shifts.get(new_lsd, 0.0) + new_cost
+        for lsd_id, shift in shifts.items():
+            total = spend.get(lsd_id, 0.0)
+            delta += self.lsd_cost(lsd_id, total + shift) - self.lsd_cost(lsd_id, total)
+        return delta
+
+    # Окрестности
+
+    def item_moves(self, choice: List[int], spend: Dict[int, float]) -> Iterator[Dict[int, int]]:
+        """Перенос товара: другой вариант одного товара"""
+        for item, variants in enumerate(self.items):
+            for pos in range(len(variants)):
+                if pos != choice[item]:
+                    yield {item: pos}
+
+    def consolidation_moves(self, choice: List[int], spend: Dict[int, float]) -> Iterator[Dict[int, int]]:
+        """Консолидация: все товары ЛСД уходят в остальные ЛСД корзины или в один другой ЛСД"""
+        used = {lsd_id for lsd_id, total in spend.items() if total > SPEND_EPS}
+        for source in sorted(used):
+            members = [item for item in range(self.n_items) if self.items[item][choice[item]][3] == source]
+            targets = [used - {source}] if len(used) > 2 else []
+            targets += [{lsd_id} for lsd_id in self.lsd_ids if lsd_id != source]
+            for target in targets:
+                changes = {}
+                for item in members:
+                    positions = [self.best_in_lsd[item][lsd_id] for lsd_id in target
+                                 if lsd_id in self.best_in_lsd[item]]
+                    if not positions:
+                        break
+                    changes[item] = min(positions)
+                else:
+                    if changes:
+                        yield changes
+
+    def swap_moves(self, choice: List[int], spend: Dict[int, float]) -> Iterator[Dict[int, int]]:
+        """Обмен: два товара разных ЛСД меняются магазинами"""
+        item_lsds = [self.items[item][choice[item]][3] for item in range(self.n_items)]
+        for i in range(self.n_items):
+            for j in range(i + 1, self.n_items):
+                lsd_i, lsd_j = item_lsds[i], item_lsds[j]
+                if lsd_i == lsd_j:
+                    continue
+                pos_i = self.best_in_lsd[i].get(lsd_j)
+                pos_j = self.best_in_lsd[j].get(lsd_i)
+                if pos_i is not None and pos_j is not None:
+                    yield {i: pos_i, j: pos_j}
+
+    # Поиск
+
+    def descend(self, choice: List[int], deadline: float) -> float:
+        """
+        Спуск с чередованием окрестностей: лучший улучшающий ход текущей
+        окрестности, после улучшения - снова с переноса товара.
+        Меняет choice на месте.
+
+        Returns:
+            Цель найденного локального оптимума (или корзины на момент дедлайна)
+        """
+        neighborhoods = (self.item_moves, self.consolidation_moves, self.swap_moves)
+        objective, spend = self.evaluate(choice)
+        level = 0
+        while level < len(neighborhoods) and time.monotonic() < deadline:
+            best_delta, best_changes = -IMPROVE_EPS, None
+            for changes in neighborhoods[level](choice, spend):
+                delta = self.move_delta(choice, spend, changes)
+                if delta < best_delta:
+                    best_delta, best_changes = delta, changes
+            if best_changes is None:
+                level += 1
+                continue
+            for item, pos in best_changes.items():
+                choice[item] = pos
+            # Суммы ЛСД пересчитываем заново, чтобы не копить ошибку вычитаний
+            objective, spend = self.evaluate(choice)
+            level = 0
+        self.pool[tuple(choice)] = objective
+        return objective
+
+    def search(self, k: int, deadline: float, rng: random.Random) -> List[Tuple[int, ...]]:
+        """
+        Жадное решение, спуск и возмущения до дедлайна.
+
+        Returns:
+            Позиции вариантов корзин-кандидатов в окне SEARCH_EPS от k-й лучшей
+        """
+        choice = [0] * self.n_items
+        best = self.descend(choice, deadline)
+        best_choice = tuple(choice)
+
+        stale = 0
+        while stale < self.max_stale_kicks and time.monotonic() < deadline:
+            trial = list(best_choice)
+            for item in rng.sample(range(self.n_items), min(KICK_SIZE, self.n_items)):
+                trial[item] = rng.randrange(len(self.items[item]))
+            objective = self.descend(trial, deadline)
+            self.kicks += 1
+            if objective < best - IMPROVE_EPS:
+                best, best_choice = objective, tuple(trial)
+                stale = 0
+            else:
+                stale += 1
+
+        # Соседи лучших корзин по переносу товара - почти такие же корзины для топ-N.
+        # Повторяем, пока в k лучших есть нераскрытые корзины
+        expanded = set()
+        while time.monotonic() < deadline:
+            top = [choice for choice, _ in sorted(self.pool.items(), key=lambda entry: entry[1])[:k]]
+            pending = [choice for choice in top if choice not in expanded]
+            if not pending:
+                break
+            for choice in pending:
+                expanded.add(choice)
+                choice = list(choice)
+                objective, spend = self.evaluate(choice)
+                for changes in self.item_moves(choice, spend):
+                    neighbour = list(choice)
+                    for item, pos in changes.items():
+                        neighbour[item] = pos
+                    neighbour = tuple(neighbour)
+                    if neighbour not in self.pool:
+                        self.pool[neighbour] = objective + self.move_delta(choice, spend, changes)
+
+        ranked = sorted(self.pool.items(), key=lambda entry: entry[1])
+        if not ranked:
+            return []
+        kth = ranked[min(k, len(ranked)) - 1][1]
+        threshold = kth + SEARCH_EPS + abs(kth) * 1e-5
+        return [choice for choice, objective in ranked if objective <= threshold]
+
+    def local_indices(self, choice: Tuple[int, ...]) -> Tuple[int, ...]:
+        """Позиции вариантов -> локальные индексы вариантов товаров"""
+        return tuple(self.items[item][pos][0] for item, pos in enumerate(choice))
+
+
+class OrderOptimizerHeuristic(OrderOptimizerBnB):
+    """Эвристический оптимизатор: локальный поиск от жадного решения"""
+
+    def __init__(self, db_connection_string: str, time_budget_sec: float = None, seed: int = 0):
+        """
+        Args:
+            db_connection_string: Строка подключения к PostgreSQL
+            time_budget_sec: Бюджет времени на поиск (по умолчанию OPTIMIZER_HEURISTIC_TIME_BUDGET_SEC)
+            seed: Зерно генератора возмущений (одинаковые данные - одинаковый поиск)
+        """
+        super().__init__(db_connection_string)
+        self.time_budget_sec = time_budget_sec or HEURISTIC_TIME_BUDGET_SEC
+        self.seed = seed
+        self.kicks = 0
+
+    # =========================================================================
+    # РАНЖИРОВАНИЕ
+    # =========================================================================
+
+    def _combination_numbers(self, combos: List[Tuple[int, ...]], n_variants: List[int]) -> List[int]:
+        """Номера комбинаций в целых Python (при десятках товаров не помещаются в int64)"""
+        strides = [int(stride) for stride in self._combination_strides(n_variants)]
+        return [sum(local_idx * stride for local_idx, stride in zip(combo, strides)) for combo in combos]
+
+    def rank_local_indices(self, combos: List[Tuple[int, ...]], data: Dict[str, Any],
+                           delivery_lookups: Dict[int, Dict[str, np.ndarray]]) -> Tuple[np.ndarray, ...]:
+        """
+        rank_combinations для корзин, заданных локальными индексами вариантов.
+
+        Returns:
+            (combo_ids, combo_indices, total_losses, total_costs, total_delivery, total_topup);
+            combo_ids - массив целых Python (dtype=object)
+        """
+        combos = sorted(set(combos))
+        combo_ids = self._combination_numbers(combos, data['n_variants'])
+        # Ничьи решаются по номеру комбинации, как в np.lexsort по всем комбинациям
+        by_number = sorted(range(len(combos)), key=lambda pos: combo_ids[pos])
+        combo_ids = np.array([combo_ids[pos] for pos in by_number], dtype=object)
+        combo_indices = np.array([combos[pos] for pos in by_number],
+                                 dtype=combination_index_dtype(data['n_variants']))
+
+        total_losses, total_costs = self._basic_metrics_for_indices(combo_indices, data)
+        total_delivery, total_topup = self._delivery_for_indices(combo_indices, data, delivery_lookups)
+
+        total_loss_and_delivery = total_losses + total_topup + total_delivery
+        total_costs_corrected = total_costs + total_topup + total_delivery
+        order = np.lexsort((total_costs_corrected, total_loss_and_delivery))
+
+        return (combo_ids[order], combo_indices[order], total_losses[order],
+                total_costs[order], total_delivery[order], total_topup[order])
+
+    def select_top_baskets_heuristic(self, data: Dict[str, Any], top_n: int = 10) -> List[Dict[str, Any]]:
+        """
+        Отбирает топ-N корзин + лучшие моно-корзины для каждого LSD
+        (семантика select_top_baskets) локальным поиском в пределах бюджета времени.
+        """
+        n_combinations = math.prod(int(n) for n in data['n_variants'])
+        if n_combinations <= HEURISTIC_EXHAUSTIVE_MAX_COMBINATIONS:
+            # Полный перебор дешевле поиска и точен
+            logger.info(f"Всего {n_combinations:,} комбинаций - полный перебор вместо локального поиска")
+            total_losses, total_costs = self.calculate_basic_metrics_broadcast(data)
+            total_delivery, total_topup = self.calculate_delivery_broadcast(data)
+            return self.select_top_baskets(None, total_losses, total_costs,
+                                           total_delivery, total_topup, data, top_n)
+
+        logger.info(f"Поиск топ-{top_n} корзин локальным поиском (бюджет {self.time_budget_sec:.1f} сек)...")
+        start_time = time.time()
+        start = time.monotonic()
+        rng = random.Random(self.seed)
+
+        ctx = self._prepare_search_context(data)
+        delivery_lookups = self._prepare_delivery_lookups(data)
+
+        # Шаг 1: топ-N
+        search = _LocalSearch(ctx)
+        greedy = search.evaluate([0] * search.n_items)[0]
+        candidates = search.search(top_n, start + self.time_budget_sec * MAIN_SEARCH_SHARE, rng)
+        self.kicks = search.kicks
+        logger.info(f"  Жадное решение: {greedy:.2f}₽, после поиска: {search.pool[candidates[0]]:.2f}₽ "
+                    f"(возмущений: {search.kicks:,}, корзин просмотрено: {len(search.pool):,})")
+
+        # Шаг 2: моно-корзины каждого ЛСД - тот же поиск в пределах ЛСД
+        mono_ranked = {}
+        mono_candidates = []
+        deadline = start + self.time_budget_sec
+        for lsd_id in np.unique(data['lsd_config_ids']):
+            mono_search = _LocalSearch(ctx, only_lsd=int(lsd_id), max_stale_kicks=MONO_STALE_KICKS)
+            if not mono_search.feasible:
+                logger.info(f"  ✗ ЛСД {int(lsd_id)}: моно-корзина невозможна (не у всех товаров есть варианты)")
+                continue
+            lsd_candidates = [mono_search.local_indices(c)
+                              for c in mono_search.search(top_n + 1, deadline, rng)]
+            self.kicks += mono_search.kicks
+            mono_candidates.extend(lsd_candidates)
+            mono_ranked[int(lsd_id)] = self.rank_local_indices(lsd_candidates, data, delivery_lookups)
+
+        # Топ-N ранжируется по всем найденным корзинам: моно-корзина лучше
+        # кандидатов основного поиска займёт своё место в топе, а не встанет за ним
+        top_ranked = self.rank_local_indices(
+            [search.local_indices(c) for c in candidates] + mono_candidates, data, delivery_lookups
+        )
+
+        top_baskets = self.build_ranked_baskets(top_ranked, mono_ranked, data, top_n)
+
+        elapsed = time.time() - start_time
+        logger.info(f"Отбор завершён за {elapsed:.2f} сек")
+
+        return top_baskets
+
+    # =========================================================================
+    # ГЛАВНАЯ ФУНКЦИЯ
+    # =========================================================================
+
+    def optimize_order(self, order_id: int, top_n_final: int = 10, exclusions: dict = None) -> Dict[str, Any]:
+        """
+        Полная оптимизация заказа локальным поиском.
+
+        Args:
+            order_id: ID заказа
+            top_n_final: Количество финальных корзин для записи
+            exclusions: Словарь с исключениями пользователя (keywords, products)
+
+        Returns:
+            Dict с результатами (включая kicks и time_budget_sec)
+        """
+        total_start = time.time()
+        self.kicks = 0
+
+        logger.info("=" * 80)
+        logger.info(f"ОПТИМИЗАЦИЯ ЗАКАЗА #{order_id} (локальный поиск)")
+        logger.info("=" * 80)
+
+        gc.disable()
+        try:
+            logger.info("\n[1/3] Загрузка данных в NumPy...")
+            data = self.load_fprice_data_to_numpy(order_id, exclusions=exclusions)
+            if data is None:
+                return {"status": "no_data", "elapsed_time": 0}
+
+            logger.info("\n[2/3] Поиск лучших корзин...")
+            top_baskets = self.select_top_baskets_heuristic(data, top_n_final)
+
+            logger.info(f"\n[3/3] Запись {len(top_baskets)} корзин в БД...")
+            self.save_to_db(top_baskets, order_id)
+
+        finally:
+            gc.enable()
+            gc.collect()
+
+        total_elapsed = time.time() - total_start
+        n_combinations = math.prod(int(n) for n in data['n_variants'])
+
+        best = top_baskets[0]
+        logger.info("\n" + "=" * 80)
+        logger.info("ОПТИМИЗАЦИЯ ЗАВЕРШЕНА")
+        logger.info("=" * 80)
+        logger.info(f"Всего комбинаций: {n_combinations:,}")
+        logger.info(f"Возмущений: {self.kicks:,}")
+        logger.info(f"Лучшая корзина: #{best['basket_id']}")
+        logger.info(f"  - Потери + доставка: {best['total_loss_and_delivery']:.2f}₽")
+        logger.info(f"  - Итого: {best['total_cost']:.2f}₽")
+        logger.info(f"Время выполнения: {total_elapsed:.2f} сек")
+        logger.info("=" * 80)
+
+        return {
+            "status": "success",
+            "order_id": order_id,
+            "total_combinations": n_combinations,
+            "kicks": self.kicks,
+            "time_budget_sec": self.time_budget_sec,
+            "saved_baskets": len(top_baskets),
+            "best_basket_id": best['basket_id'],
+            "best_total_cost": best['total_cost'],
+            "best_loss_and_delivery": best['total_loss_and_delivery'],
+            "elapsed_time": total_elapsed
+        }
+
+
+def optimize_order_heuristic(order_id: int, db_connection_string: str,
+                             top_n_final: int = 10, exclusions: dict = None,
+                             time_budget_sec: float = None) -> Dict[str, Any]:
+    """
+    Функция-обёртка для оптимизации локальным поиском.
+
+    Args:
+        order_id: ID заказа
+        db_connection_string: Строка подключения к PostgreSQL
+        top_n_final: Количество финальных корзин для записи
+        exclusions: Словарь с исключениями пользователя (keywords, products)
+        time_budget_sec: Бюджет времени на поиск (по умолчанию OPTIMIZER_HEURISTIC_TIME_BUDGET_SEC)
+    """
+    with OrderOptimizerHeuristic(db_connection_string, time_budget_sec=time_budget_sec) as optimizer:
+        return optimizer.optimize_order(order_id, top_n_final, exclusions=exclusions)
@@ -3,17 +3,23 @@
 Все вычисления происходят через векторные операции NumPy для максимальной производительности.
 """
 
+import json
 import logging
+import math
 import sys
 import os
 import time
-import json
 import gc
-from typing import List, Dict, Any, Tuple
+from typing import List, Dict, Any, Tuple, Optional, Callable
 import psycopg2
-from psycopg2.extras import execute_values
 import numpy as np
 
+from utils.exclusion_matcher import filter_grouped_variants
+from utils.columnar_loader import load_fprice_columns, use_consistent_snapshot
+from utils.fprice_snapshot import FPRICE_SOURCE
+from utils.result_writer import BasketResultWriter
+from utils.stage_metrics import StageMetrics
+
 # Настраиваем логирование
 logger = logging.getLogger('order_optimizer_numpy')
 logger.setLevel(logging.INFO)
@@ -47,9 +53,59 @@ logger.propagate = False
 
 logger.info("✅ NumPy Optimizer logging configured")
 
+# Размер блока при переборе пространства моно-корзин одного ЛСД
+MONO_BLOCK_SIZE = 200_000
+
+# Единицы метрик: рубли float32 (по умолчанию) или целые копейки int32
+METRIC_RUBLES = 'rub'
+METRIC_KOPECKS = 'kop'
+KOPECKS_PER_RUBLE = 100
+
+# Массивы вариантов, которые переводятся в копейки
+KOPECK_ARRAYS = ('losses', 'costs', 'min_order_amounts', 'delivery_fixed_fees')
+
+# Режим копеек для движка numpy по умолчанию
+KOPECK_METRICS = os.getenv('OPTIMIZER_KOPECK_METRICS', '0') == '1'
+
+
+def combination_index_dtype(n_variants: List[int]) -> np.dtype:
+    """
+    Самый узкий тип локальных индексов вариантов: uint8 до 256 вариантов
+    товара, uint16 до 65536, иначе int32.
+    """
+    max_index = max(n_variants, default=1) - 1
+    for dtype in (np.uint8, np.uint16):
+        if max_index <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.int32)
+
+
+def combination_id_dtype(n_variants: List[int]) -> np.dtype:
+    """
+    Тип номеров комбинаций: int64, пока все номера в него помещаются, иначе
+    object (целые Python) - у заказов из десятков товаров prod(n_variants) > 2^63.
+    """
+    n_combinations = math.prod(int(n) for n in n_variants)
+    return np.dtype(np.int64 if n_combinations - 1 <= np.iinfo(np.int64).max else object)
+
 
 class OrderOptimizerNumPy:
     """Оптимизатор заказов с полной векторизацией через NumPy"""
+
+    # Колоночная загрузка (COPY числовых колонок, ленивые метаданные);
+    # False - построчная загрузка всех колонок
+    columnar_load = True
+
+    # Метрики в целых копейках int32 (to_kopecks): точные суммы и ничьи
+    # в np.lexsort без шума float32; только для optimize_order этого класса
+    kopeck_metrics = KOPECK_METRICS
+
+    # Пакетная оптимизация (optimize_batch.py): данные заказов, загруженные пакетом
+    # (order_id -> словарь load_fprice_data_to_numpy), общий кэш lookup-таблиц
+    # доставки и общая запись корзин (BatchResultWriter)
+    preloaded_data: Optional[Dict[int, Dict[str, Any]]] = None
+    delivery_lookup_cache: Optional[Dict[str, Dict[str, np.ndarray]]] = None
+    result_batch = None
     
     def __init__(self, db_connection_string: str):
         self.db_connection_string = db_connection_string
@@ -57,6 +113,8 @@ class OrderOptimizerNumPy:
         
     def __enter__(self):
         self.conn = psycopg2.connect(self.db_connection_string)
+        # Загрузка заказа и запись корзин видят один снимок fprice_snapshot
+        use_consistent_snapshot(self.conn)
         return self
         
     def __exit__(self, exc_type, exc_val, exc_tb):
@@ -80,16 +138,22 @@ class OrderOptimizerNumPy:
         Returns:
             Dict с NumPy массивами и метаданными
         """
+        if self.preloaded_data and order_id in self.preloaded_data:
+            return self.preloaded_data.pop(order_id)
+
         logger.info("Загрузка данных из fprice_optimizer...")
+        if self.columnar_load:
+            return load_fprice_columns(self.conn, order_id, exclusions=exclusions)
+
         start_time = time.time()
         
-        query = """
+        query = f"""
             SELECT 
                 id, order_id, lsd_config_id, lsd_name, order_item_id, product_name,
                 price, fprice, base_unit, base_quantity, requested_unit, requested_quantity,
                 order_item_ids_quantity, order_item_ids_cost, fprice_min, fprice_diff, 
                 loss, min_order_amount, delivery_cost_model, delivery_fixed_fee
-            FROM fprice_optimizer
+            FROM {FPRICE_SOURCE}
             WHERE order_id = %s
             ORDER BY order_item_id, id
         """
@@ -115,7 +179,7 @@ class OrderOptimizerNumPy:
 
         # Применяем фильтрацию по исключениям пользователя
         if exclusions:
-            grouped = self._apply_exclusions_filter(grouped, exclusions)
+            grouped = filter_grouped_variants(grouped, exclusions)
 
         # Сортируем order_item_ids для детерминированного порядка
         sorted_items = sorted(grouped.keys())
@@ -145,7 +209,8 @@ class OrderOptimizerNumPy:
             item_offsets.append(item_offsets[-1] + count)
         
         # Считаем количество комбинаций
-        n_combinations = np.prod(n_variants, dtype=np.int64)
+        # Целое Python: при десятках товаров произведение не помещается в int64
+        n_combinations = math.prod(int(n) for n in n_variants)
         
         elapsed = time.time() - start_time
         logger.info(f"Данные загружены за {elapsed:.2f} сек")
@@ -170,66 +235,57 @@ class OrderOptimizerNumPy:
             'variant_metadata': all_variants  # Полные данные для финальной записи
         }
 
-    def _apply_exclusions_filter(self, grouped: dict, exclusions: dict) -> dict:
+    def to_kopecks(self, data: Dict[str, Any]) -> Dict[str, Any]:
         """
-        Фильтрует варианты товаров по исключениям пользователя.
+        Переводит метрики вариантов в целые копейки (int32).
 
-        Args:
-            grouped: Словарь {order_item_id: [варианты]}
-            exclusions: Словарь с исключениями:
-                - keywords: список ключевых слов категорий
-                - products: список названий продуктов из чёрного списка
+        Суммы целых точные и не зависят от порядка сложения, поэтому ничьи в
+        np.lexsort решаются по номеру комбинации, а не по шуму округления
+        float32. Диапазоны доставки переводятся в копейки в
+        _prepare_delivery_lookups, итоги корзин - обратно в рубли в _build_basket.
 
         Returns:
-            Отфильтрованный словарь grouped
+            Копия data с int32 массивами и metric_units = 'kop'; data без
+            изменений, если верхняя оценка суммы корзины не помещается в int32
         """
-        keywords = [kw.lower() for kw in exclusions.get('keywords', [])]
-        products = [p.lower() for p in exclusions.get('products', [])]
-
-        if not keywords and not products:
-            return grouped
-
-        logger.info(f"🚫 Применение исключений: {len(keywords)} ключевых слов, {len(products)} продуктов")
-
-        filtered_grouped = {}
-        excluded_count = 0
-
-        for order_item_id, variants in grouped.items():
-            filtered_variants = []
-
-            for variant in variants:
-                product_name = variant.get('product_name', '').lower()
-                is_excluded = False
-
-                # Проверка по ключевым словам категорий
-                for keyword in keywords:
-                    if keyword in product_name:
-                        is_excluded = True
-                        break
-
-                # Проверка по черному списку продуктов
-                if not is_excluded:
-                    for product in products:
-                        if product in product_name:
-                            is_excluded = True
-                            break
+        if data.get('metric_units') == METRIC_KOPECKS:
+            return data
 
-                if not is_excluded:
-                    filtered_variants.append(variant)
-                else:
-                    excluded_count += 1
-
-            if filtered_variants:
-                filtered_grouped[order_item_id] = filtered_variants
-            else:
-                # Если все варианты исключены — оставляем первый с предупреждением
-                logger.warning(f"⚠️ Все варианты товара {order_item_id} исключены! "
-                             f"Оставляем первый вариант: {variants[0].get('product_name', 'N/A')}")
-                filtered_grouped[order_item_id] = [variants[0]]
+        kopecks = {
+            key: np.rint(data[key].astype(np.float64) * KOPECKS_PER_RUBLE)
+            for key in KOPECK_ARRAYS
+        }
 
-        logger.info(f"🚫 Исключено вариантов: {excluded_count}")
+        # Верхняя оценка: самые дорогие варианты всех товаров плюс минимальный
+        # заказ, фиксированный сбор и самый дорогой диапазон доставки каждого ЛСД
+        item_starts = data['item_offsets'][:-1]
+        lsd_ids = np.unique(data['lsd_config_ids'])
+        max_fee = max((
+            float(range_item.get('fee', 0) or 0)
+            for lsd_id in lsd_ids
+            for range_item in (self._lsd_delivery_model(data, lsd_id) or {}).get('delivery_cost') or []
+        ), default=0.0)
+        bound = (np.maximum.reduceat(np.abs(kopecks['costs']), item_starts).sum()
+                 + np.maximum.reduceat(np.abs(kopecks['losses']), item_starts).sum()
+                 + len(lsd_ids) * (np.abs(kopecks['min_order_amounts']).max()
+                                   + np.abs(kopecks['delivery_fixed_fees']).max()
+                                   + abs(max_fee) * KOPECKS_PER_RUBLE))
+        if bound > np.iinfo(np.int32).max:
+            logger.warning(f"Суммы корзин до {bound / KOPECKS_PER_RUBLE:,.0f}₽ не помещаются в int32 копеек - "
+                           f"метрики остаются в рублях float32")
+            return data
+
+        logger.info(f"Метрики в копейках int32 (оценка суммы корзины до {bound / KOPECKS_PER_RUBLE:,.2f}₽)")
+        return {
+            **data,
+            **{key: values.astype(np.int32) for key, values in kopecks.items()},
+            'metric_units': METRIC_KOPECKS
+        }
 
-        return filtered_grouped
+    @staticmethod
+    def _metric_dtype(data: Dict[str, Any]) -> np.dtype:
+        """Тип массивов метрик: int32 для копеек, иначе float32."""
+        return np.dtype(np.int32 if data.get('metric_units') == METRIC_KOPECKS else np.float32)
 
     # =========================================================================
     # ЭТАП 2: ГЕНЕРАЦИЯ ИНДЕКСНОЙ МАТРИЦЫ КОМБИНАЦИЙ
@@ -243,26 +299,26 @@ class OrderOptimizerNumPy:
             n_variants: Список количества вариантов для каждого товара
             
         Returns:
-            np.ndarray shape (n_combinations, n_items) dtype=int32
+            np.ndarray shape (n_combinations, n_items), dtype - combination_index_dtype
         """
         logger.info("Генерация индексной матрицы комбинаций...")
         start_time = time.time()
         
         n_items = len(n_variants)
         n_combinations = np.prod(n_variants, dtype=np.int64)
+        index_dtype = combination_index_dtype(n_variants)
         
         # Оценка памяти
-        memory_mb = (n_combinations * n_items * 4) / (1024 * 1024)
-        logger.info(f"  Ожидаемый размер матрицы: {memory_mb:.1f} MB")
+        memory_mb = (n_combinations * n_items * index_dtype.itemsize) / (1024 * 1024)
+        int32_mb = (n_combinations * n_items * 4) / (1024 * 1024)
+        logger.info(f"  Ожидаемый размер матрицы: {memory_mb:.1f} MB ({index_dtype}, int32 - {int32_mb:.1f} MB)")
         
         # Генерируем индексы через meshgrid подход
         # Для каждого товара создаём массив индексов, который повторяется нужное кол-во раз
-        indices = np.zeros((int(n_combinations), n_items), dtype=np.int32)
+        indices = np.zeros((int(n_combinations), n_items), dtype=index_dtype)
         
         # Количество повторений для каждого товара
-        repeat_counts = np.ones(n_items, dtype=np.int64)
-        for i in range(n_items - 1, 0, -1):
-            repeat_counts[i - 1] = repeat_counts[i] * n_variants[i]
+        repeat_counts = self._combination_strides(n_variants)
         
         # Tile counts (сколько раз повторить весь блок)
         tile_counts = np.ones(n_items, dtype=np.int64)
@@ -276,7 +332,7 @@ class OrderOptimizerNumPy:
             tile_count = int(tile_counts[item_idx])
             
             # Создаём базовый паттерн [0, 0, ..., 1, 1, ..., 2, 2, ...]
-            pattern = np.repeat(np.arange(n_var, dtype=np.int32), repeat_count)
+            pattern = np.repeat(np.arange(n_var, dtype=index_dtype), repeat_count)
             
             # Тайлим его tile_count раз
             indices[:, item_idx] = np.tile(pattern, tile_count)
@@ -285,9 +341,42 @@ class OrderOptimizerNumPy:
         actual_memory_mb = indices.nbytes / (1024 * 1024)
         logger.info(f"Матрица сгенерирована за {elapsed:.2f} сек")
         logger.info(f"  Размер: {indices.shape}")
-        logger.info(f"  Память: {actual_memory_mb:.1f} MB")
+        logger.info(f"  Память: {actual_memory_mb:.1f} MB ({indices.dtype}, "
+                    f"экономия {int32_mb - actual_memory_mb:.1f} MB против int32)")
         
         return indices
+
+    def _combination_strides(self, n_variants: List[int]) -> np.ndarray:
+        """
+        Веса разрядов смешанной системы счисления для номеров комбинаций.
+
+        Номер комбинации (basket_id - 1) = sum(local_idx[i] * strides[i]),
+        последний товар меняется быстрее всех - как в generate_combination_indices.
+        Шаги считаются в целых Python, тип массива - combination_id_dtype.
+        """
+        strides = [1] * len(n_variants)
+        for i in range(len(n_variants) - 1, 0, -1):
+            strides[i - 1] = strides[i] * int(n_variants[i])
+        return np.array(strides, dtype=combination_id_dtype(n_variants))
+
+    def decode_combination_ids(self, combo_ids: np.ndarray, n_variants: List[int]) -> np.ndarray:
+        """
+        Восстанавливает строки индексной матрицы по номерам комбинаций.
+
+        Args:
+            combo_ids: Номера комбинаций (0-based) в порядке generate_combination_indices
+                (int64 или целые Python - см. combination_id_dtype)
+            n_variants: Список количества вариантов для каждого товара
+
+        Returns:
+            np.ndarray shape (len(combo_ids), n_items), dtype - combination_index_dtype
+        """
+        strides = self._combination_strides(n_variants)
+        combo_ids = np.asarray(combo_ids, dtype=strides.dtype)
+        indices = np.empty((len(combo_ids), len(n_variants)), dtype=combination_index_dtype(n_variants))
+        for item_idx, n_var in enumerate(n_variants):
+            indices[:, item_idx] = (combo_ids // strides[item_idx]) % n_var
+        return indices
     
     # =========================================================================
     # ЭТАП 3: ВЕКТОРИЗОВАННЫЙ РАСЧЁТ БАЗОВЫХ МЕТРИК
@@ -308,33 +397,275 @@ class OrderOptimizerNumPy:
         start_time = time.time()
         
         n_combinations = combo_indices.shape[0]
-        n_items = combo_indices.shape[1]
-        item_offsets = data['item_offsets']
-        losses = data['losses']
-        costs = data['costs']
+        total_losses, total_costs = self._basic_metrics_for_indices(combo_indices, data)
+        
+        elapsed = time.time() - start_time
+        logger.info(f"Базовые метрики рассчитаны за {elapsed:.2f} сек ({n_combinations/elapsed:,.0f} корзин/сек)")
+        logger.info(f"  total_losses: min={total_losses.min():.2f}, max={total_losses.max():.2f}")
+        logger.info(f"  total_costs: min={total_costs.min():.2f}, max={total_costs.max():.2f}")
         
-        # Преобразуем локальные индексы в глобальные
+        return total_losses, total_costs
+
+    def _global_indices(self, combo_indices: np.ndarray, data: Dict[str, Any]) -> np.ndarray:
+        """Преобразует локальные индексы вариантов в глобальные (с учётом item_offsets)."""
         # combo_indices содержит локальные индексы (0, 1, 2, ... для каждого товара)
         # Нужно добавить item_offsets для получения глобальных индексов
-        global_indices = combo_indices.copy()
-        for item_idx in range(n_items):
+        item_offsets = data['item_offsets']
+        global_indices = combo_indices.astype(np.int32, copy=True)
+        for item_idx in range(combo_indices.shape[1]):
             global_indices[:, item_idx] += item_offsets[item_idx]
+        return global_indices
+
+    def _basic_metrics_for_indices(self, combo_indices: np.ndarray,
+                                   data: Dict[str, Any]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Ядро calculate_basic_metrics без логирования.
+        Результат для каждой строки не зависит от остальных строк, поэтому
+        функцию можно вызывать как для всей матрицы, так и для её блоков.
+        """
+        global_indices = self._global_indices(combo_indices, data)
         
         # Извлекаем данные для всех комбинаций
-        combo_losses = losses[global_indices]  # shape: (n_combinations, n_items)
-        combo_costs = costs[global_indices]
+        combo_losses = data['losses'][global_indices]  # shape: (n_combinations, n_items)
+        combo_costs = data['costs'][global_indices]
         
         # Суммируем по товарам (axis=1)
         total_losses = combo_losses.sum(axis=1)  # shape: (n_combinations,)
         total_costs = combo_costs.sum(axis=1)
         
+        return total_losses, total_costs
+    
+    # =========================================================================
+    # ЭТАП 3 БЕЗ ИНДЕКСНОЙ МАТРИЦЫ: СУММЫ ЧЕРЕЗ BROADCASTING
+    # =========================================================================
+    #
+    # В порядке номеров комбинаций массив метрик - это тензор формы
+    # (n_variants[0], ..., n_variants[-1]) в C-порядке, а вклад товара i - вектор
+    # его вариантов, растянутый по оси i. Сумма таких векторов через
+    # broadcasting даёт метрики без матрицы (n_combinations, n_items).
+    #
+    # float32 не ассоциативен, поэтому слагаемые складываются в том же порядке,
+    # что и sum(axis=1) по строке матрицы (попарное суммирование NumPy), и
+    # результат совпадает с матричным расчётом побитово.
+
+    def _broadcast_shape(self, data: Dict[str, Any]) -> Tuple[Tuple[int, ...], List[Optional[int]]]:
+        """
+        Форма тензора комбинаций и ось каждого товара.
+
+        Товары с одним вариантом оси не получают (их вклад - скаляр), иначе
+        заказ из десятков товаров упёрся бы в ограничение NumPy на число осей.
+
+        Returns:
+            (shape, item_axes) - item_axes[i] = ось товара i или None
+        """
+        shape = []
+        item_axes = []
+        for n_var in data['n_variants']:
+            if n_var > 1:
+                item_axes.append(len(shape))
+                shape.append(n_var)
+            else:
+                item_axes.append(None)
+        return tuple(shape), item_axes
+
+    def _item_terms(self, values: np.ndarray, data: Dict[str, Any], item_axes: List[Optional[int]],
+                    mask: np.ndarray = None) -> List[Optional[np.ndarray]]:
+        """
+        Вклад каждого товара в виде массива, готового к broadcasting.
+
+        Args:
+            values: Массив по всем вариантам (losses, costs)
+            mask: Маска вариантов (для сумм по ЛСД) - как combo_costs * lsd_mask
+
+        Returns:
+            Список слагаемых; None - нулевой вклад (ни один вариант товара не в маске)
+        """
+        n_dims = sum(1 for axis in item_axes if axis is not None)
+        terms = []
+        for item_idx, n_var in enumerate(data['n_variants']):
+            offset = data['item_offsets'][item_idx]
+            item_values = values[offset:offset + n_var]
+            if mask is not None:
+                item_mask = mask[offset:offset + n_var]
+                if not item_mask.any():
+                    terms.append(None)
+                    continue
+                item_values = item_values * item_mask
+
+            axis = item_axes[item_idx]
+            if axis is None:
+                terms.append(item_values[0])
+            else:
+                term_shape = [1] * n_dims
+                term_shape[axis] = n_var
+                terms.append(item_values.reshape(term_shape))
+        return terms
+
+    @staticmethod
+    def _add_terms(left, right):
+        """Сложение с учётом нулевых слагаемых (x + 0.0 == x для неотрицательных x)."""
+        if left is None:
+            return right
+        if right is None:
+            return left
+        return left + right
+
+    def _pairwise_sum_terms(self, terms: List[Optional[np.ndarray]]):
+        """
+        Сумма слагаемых в порядке попарного суммирования NumPy (pairwise_sum):
+        до 8 слагаемых - подряд, до 128 - 8 накопителей с шагом 8 и хвост подряд,
+        больше - рекурсивно пополам (граница кратна 8).
+        """
+        n = len(terms)
+        if n < 8:
+            result = None
+            for term in terms:
+                result = self._add_terms(result, term)
+            return result
+
+        if n <= 128:
+            acc = list(terms[:8])
+            i = 8
+            while i < n - (n % 8):
+                for j in range(8):
+                    acc[j] = self._add_terms(acc[j], terms[i + j])
+                i += 8
+            result = self._add_terms(
+                self._add_terms(self._add_terms(acc[0], acc[1]), self._add_terms(acc[2], acc[3])),
+                self._add_terms(self._add_terms(acc[4], acc[5]), self._add_terms(acc[6], acc[7]))
+            )
+            for term in terms[i:]:
+                result = self._add_terms(result, term)
+            return result
+
+        half = n // 2
+        half -= half % 8
+        return self._add_terms(self._pairwise_sum_terms(terms[:half]),
+                               self._pairwise_sum_terms(terms[half:]))
+
+    def _pairwise_sum_lazy(self, n: int, make_term: Callable[[int], Optional[np.ndarray]], start: int = 0):
+        """
+        _pairwise_sum_terms для слагаемых make_term(start), ..., make_term(start + n - 1),
+        которые создаются по одному и складываются на месте (make_term возвращает
+        новый массив). Порядок сложений тот же, что у _pairwise_sum_terms, -
+        результат побитово равен, но одновременно живут несколько слагаемых, а не все.
+        """
+        def add(left, right):
+            if left is None:
+                return right
+            if right is None:
+                return left
+            left += right
+            return left
+
+        if n < 8:
+            result = None
+            for i in range(n):
+                result = add(result, make_term(start + i))
+            return result
+
+        if n <= 128:
+            stop = n - n % 8
+
+            def accumulator(j):
+                acc = make_term(start + j)
+                for i in range(8 + j, stop, 8):
+                    acc = add(acc, make_term(start + i))
+                return acc
+
+            # Накопители считаются по очереди и сразу сворачиваются деревом, как в pairwise_sum
+            result = add(
+                add(add(accumulator(0), accumulator(1)), add(accumulator(2), accumulator(3))),
+                add(add(accumulator(4), accumulator(5)), add(accumulator(6), accumulator(7)))
+            )
+            for i in range(stop, n):
+                result = add(result, make_term(start + i))
+            return result
+
+        half = n // 2
+        half -= half % 8
+        return add(self._pairwise_sum_lazy(half, make_term, start),
+                   self._pairwise_sum_lazy(n - half, make_term, start + half))
+
+    def _flatten_broadcast(self, tensor, shape: Tuple[int, ...], dtype: np.dtype = np.float32) -> np.ndarray:
+        """Разворачивает сумму в плоский массив в порядке номеров комбинаций."""
+        return np.ascontiguousarray(np.broadcast_to(tensor, shape), dtype=dtype).reshape(-1)
+
+    def calculate_basic_metrics_broadcast(self, data: Dict[str, Any]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        total_loss и total_goods_cost для всех комбинаций без индексной матрицы.
+
+        Returns:
+            (total_losses, total_costs) - массивы shape (n_combinations,),
+            побитово равные calculate_basic_metrics
+        """
+        logger.info("Расчёт базовых метрик без индексной матрицы...")
+        start_time = time.time()
+
+        shape, item_axes = self._broadcast_shape(data)
+        metric_dtype = self._metric_dtype(data)
+        total_losses = self._flatten_broadcast(
+            self._pairwise_sum_terms(self._item_terms(data['losses'], data, item_axes)), shape, metric_dtype
+        )
+        total_costs = self._flatten_broadcast(
+            self._pairwise_sum_terms(self._item_terms(data['costs'], data, item_axes)), shape, metric_dtype
+        )
+
+        n_combinations = len(total_losses)
         elapsed = time.time() - start_time
-        logger.info(f"Базовые метрики рассчитаны за {elapsed:.2f} сек ({n_combinations/elapsed:,.0f} корзин/сек)")
+        logger.info(f"Базовые метрики рассчитаны за {elapsed:.2f} сек "
+                    f"({n_combinations / max(elapsed, 1e-9):,.0f} корзин/сек)")
         logger.info(f"  total_losses: min={total_losses.min():.2f}, max={total_losses.max():.2f}")
         logger.info(f"  total_costs: min={total_costs.min():.2f}, max={total_costs.max():.2f}")
-        
+
         return total_losses, total_costs
-    
+
+    def calculate_delivery_broadcast(self, data: Dict[str, Any]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Доставка и топап для всех комбинаций без индексной матрицы.
+
+        Сумма по ЛСД и её доставка считаются на тензоре только по осям товаров,
+        у которых есть варианты этого ЛСД, и растягиваются на все комбинации
+        лишь при накоплении в итоговые массивы.
+
+        Returns:
+            (total_delivery_costs, total_topups) - массивы shape (n_combinations,),
+            побитово равные calculate_delivery_vectorized_v2
+        """
+        logger.info("Расчёт доставки без индексной матрицы...")
+        start_time = time.time()
+
+        lsd_config_ids = data['lsd_config_ids']
+        delivery_lookups = self._prepare_delivery_lookups(data)
+        shape, item_axes = self._broadcast_shape(data)
+
+        total_delivery_costs = np.zeros(shape, dtype=self._metric_dtype(data))
+        total_topups = np.zeros(shape, dtype=self._metric_dtype(data))
+
+        lsd_table = self._lsd_delivery_table(data)
+
+        for lsd_pos, lsd_id in enumerate(lsd_table['lsd_ids']):
+            lsd_mask = lsd_config_ids == lsd_id
+            lsd_totals = self._pairwise_sum_terms(self._item_terms(data['costs'], data, item_axes, lsd_mask))
+
+            delivery_cost, topup = self._lsd_delivery_from_totals(
+                np.asarray(lsd_totals), lsd_table['min_orders'][lsd_pos], lsd_table['fixed_fees'][lsd_pos],
+                delivery_lookups[int(lsd_id)]
+            )
+
+            total_delivery_costs += delivery_cost
+            total_topups += topup
+
+        total_delivery_costs = total_delivery_costs.reshape(-1)
+        total_topups = total_topups.reshape(-1)
+
+        elapsed = time.time() - start_time
+        logger.info(f"Доставка рассчитана за {elapsed:.2f} сек")
+        logger.info(f"  Доставка: min={total_delivery_costs.min():.2f}, max={total_delivery_costs.max():.2f}")
+        logger.info(f"  Топап: min={total_topups.min():.2f}, max={total_topups.max():.2f}")
+
+        return total_delivery_costs, total_topups
+
     # =========================================================================
     # ЭТАП 4: ПРЕДВАРИТЕЛЬНАЯ ФИЛЬТРАЦИЯ
     # =========================================================================
@@ -379,6 +710,53 @@ class OrderOptimizerNumPy:
     # ЭТАП 5: РАСЧЁТ ДОСТАВКИ (ПОЛНАЯ ВЕКТОРИЗАЦИЯ)
     # =========================================================================
 
+    def _lsd_delivery_model(self, data: Dict[str, Any], lsd_id: int) -> Dict[str, Any]:
+        """Модель доставки ЛСД: из колоночной загрузки или из первого варианта ЛСД."""
+        if 'lsd_delivery_models' in data:
+            return data['lsd_delivery_models'].get(int(lsd_id), {})
+        idx = np.where(data['lsd_config_ids'] == lsd_id)[0][0]
+        return data['variant_metadata'][idx].get('delivery_cost_model', {})
+
+    def _delivery_lookup(self, delivery_model: Dict[str, Any]) -> Dict[str, np.ndarray]:
+        """lookup-таблица одной модели доставки (float32, рубли)."""
+        if not delivery_model or 'delivery_cost' not in delivery_model:
+            # Пустая модель - бесплатная доставка
+            return {
+                'mins': np.array([0.0], dtype=np.float32),
+                'maxs': np.array([np.inf], dtype=np.float32),
+                'fees': np.array([0.0], dtype=np.float32)
+            }
+
+        delivery_ranges = delivery_model.get('delivery_cost', [])
+        if not delivery_ranges:
+            return {
+                'mins': np.array([0.0], dtype=np.float32),
+                'maxs': np.array([np.inf], dtype=np.float32),
+                'fees': np.array([0.0], dtype=np.float32)
+            }
+
+        # Сортируем диапазоны по min
+        sorted_ranges = sorted(delivery_ranges, key=lambda x: x.get('min', 0))
+
+        mins = []
+        maxs = []
+        fees = []
+
+        for range_item in sorted_ranges:
+            min_val = float(range_item.get('min', 0) or 0)
+            max_val = range_item.get('max')
+            fee = float(range_item.get('fee', 0))
+
+            mins.append(min_val)
+            maxs.append(float(max_val) if max_val is not None else np.inf)
+            fees.append(fee)
+
+        return {
+            'mins': np.array(mins, dtype=np.float32),
+            'maxs': np.array(maxs, dtype=np.float32),
+            'fees': np.array(fees, dtype=np.float32)
+        }
+
     def _prepare_delivery_lookups(self, data: Dict[str, Any]) -> Dict[int, Dict[str, np.ndarray]]:
         """
         Предрассчитывает lookup-таблицы для диапазонов доставки каждого ЛСД.
@@ -393,54 +771,31 @@ class OrderOptimizerNumPy:
         logger.info("  Подготовка lookup-таблиц для диапазонов доставки...")
 
         lsd_config_ids = data['lsd_config_ids']
-        variant_metadata = data['variant_metadata']
 
         unique_lsd_ids = np.unique(lsd_config_ids)
         delivery_lookups = {}
 
         for lsd_id in unique_lsd_ids:
-            # Находим первый вариант с этим lsd_id
-            idx = np.where(lsd_config_ids == lsd_id)[0][0]
-            delivery_model = variant_metadata[idx].get('delivery_cost_model', {})
-
-            if not delivery_model or 'delivery_cost' not in delivery_model:
-                # Пустая модель - бесплатная доставка
-                delivery_lookups[int(lsd_id)] = {
-                    'mins': np.array([0.0], dtype=np.float32),
-                    'maxs': np.array([np.inf], dtype=np.float32),
-                    'fees': np.array([0.0], dtype=np.float32)
-                }
+            delivery_model = self._lsd_delivery_model(data, lsd_id)
+            if self.delivery_lookup_cache is None:
+                delivery_lookups[int(lsd_id)] = self._delivery_lookup(delivery_model)
                 continue
 
-            delivery_ranges = delivery_model.get('delivery_cost', [])
-            if not delivery_ranges:
-                delivery_lookups[int(lsd_id)] = {
-                    'mins': np.array([0.0], dtype=np.float32),
-                    'maxs': np.array([np.inf], dtype=np.float32),
-                    'fees': np.array([0.0], dtype=np.float32)
+            # Пакетный режим: модели ЛСД одинаковые у заказов пакета - таблица строится один раз
+            cache_key = json.dumps(delivery_model, sort_keys=True, default=str)
+            if cache_key not in self.delivery_lookup_cache:
+                self.delivery_lookup_cache[cache_key] = self._delivery_lookup(delivery_model)
+            delivery_lookups[int(lsd_id)] = self.delivery_lookup_cache[cache_key]
+
+        if data.get('metric_units') == METRIC_KOPECKS:
+            # Границы и сборы в копейках: mins - целые для searchsorted, maxs - float64 (inf)
+            delivery_lookups = {
+                lsd_id: {
+                    'mins': np.rint(lookup['mins'].astype(np.float64) * KOPECKS_PER_RUBLE).astype(np.int64),
+                    'maxs': np.rint(lookup['maxs'].astype(np.float64) * KOPECKS_PER_RUBLE),
+                    'fees': np.rint(lookup['fees'].astype(np.float64) * KOPECKS_PER_RUBLE).astype(np.int32)
                 }
-                continue
-
-            # Сортируем диапазоны по min
-            sorted_ranges = sorted(delivery_ranges, key=lambda x: x.get('min', 0))
-
-            mins = []
-            maxs = []
-            fees = []
-
-            for range_item in sorted_ranges:
-                min_val = float(range_item.get('min', 0) or 0)
-                max_val = range_item.get('max')
-                fee = float(range_item.get('fee', 0))
-
-                mins.append(min_val)
-                maxs.append(float(max_val) if max_val is not None else np.inf)
-                fees.append(fee)
-
-            delivery_lookups[int(lsd_id)] = {
-                'mins': np.array(mins, dtype=np.float32),
-                'maxs': np.array(maxs, dtype=np.float32),
-                'fees': np.array(fees, dtype=np.float32)
+                for lsd_id, lookup in delivery_lookups.items()
             }
 
         logger.info(f"  Подготовлено {len(delivery_lookups)} lookup-таблиц")
@@ -462,37 +817,114 @@ class OrderOptimizerNumPy:
         start_time = time.time()
 
         n_combinations = combo_indices.shape[0]
-        n_items = combo_indices.shape[1]
-        item_offsets = data['item_offsets']
+
+        # Подготавливаем lookup-таблицы
+        delivery_lookups = self._prepare_delivery_lookups(data)
+
+        logger.info(f"  Обработка {len(delivery_lookups)} уникальных ЛСД...")
+        total_delivery_costs, total_topups = self._delivery_for_indices_masked(combo_indices, data, delivery_lookups)
+
+        elapsed = time.time() - start_time
+        logger.info(f"Доставка рассчитана за {elapsed:.2f} сек ({n_combinations/elapsed:,.0f} корзин/сек)")
+        logger.info(f"  min delivery: {total_delivery_costs.min():.2f}₽")
+        logger.info(f"  max delivery: {total_delivery_costs.max():.2f}₽")
+        logger.info(f"  min topup: {total_topups.min():.2f}₽")
+        logger.info(f"  max topup: {total_topups.max():.2f}₽")
+
+        return total_delivery_costs, total_topups
+
+    def _lsd_delivery_table(self, data: Dict[str, Any]) -> Dict[str, np.ndarray]:
+        """
+        Таблица ЛСД для расчёта доставки.
+
+        Returns:
+            Dict:
+            - 'lsd_ids': id ЛСД по возрастанию, shape (n_lsd,)
+            - 'min_orders', 'fixed_fees': min_order_amount и fixed_fee ЛСД
+              (одинаковые для всех вариантов ЛСД), shape (n_lsd,)
+            - 'lsd_costs': вклад варианта в сумму каждого ЛСД (cost в строке
+              своего ЛСД, 0 в остальных), shape (n_lsd, n_total_variants)
+        """
+        lsd_config_ids = data['lsd_config_ids']
+        lsd_ids, first_idx = np.unique(lsd_config_ids, return_index=True)
+        lsd_masks = lsd_config_ids[None, :] == lsd_ids[:, None]
+        return {
+            'lsd_ids': lsd_ids,
+            'min_orders': data['min_order_amounts'][first_idx],
+            'fixed_fees': data['delivery_fixed_fees'][first_idx],
+            'lsd_costs': data['costs'][None, :] * lsd_masks
+        }
+
+    def _delivery_for_indices(self, combo_indices: np.ndarray, data: Dict[str, Any],
+                              delivery_lookups: Dict[int, Dict[str, np.ndarray]]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Доставка и топап для строк индексной матрицы без масок (n_combinations, n_items).
+
+        Суммы всех ЛСД (n_lsd, n_combinations) накапливаются за один проход по
+        товарам из столбцов таблицы lsd_costs, min_order_amount и fixed_fee
+        берутся из таблицы ЛСД. Слагаемые товаров создаются по мере сложения
+        (_pairwise_sum_lazy): в памяти несколько массивов (n_lsd, n_combinations),
+        а не по одному на товар. Слагаемые складываются в порядке попарного
+        суммирования NumPy, поэтому результат побитово равен
+        _delivery_for_indices_masked (calculate_delivery_vectorized_v2).
+        lookup-таблицы передаются снаружи, чтобы не пересчитывать их для каждого блока.
+
+        Returns:
+            (total_delivery_costs, total_topups) - два массива shape (len(combo_indices),)
+        """
+        n_combinations = combo_indices.shape[0]
+        lsd_table = self._lsd_delivery_table(data)
+        global_indices = self._global_indices(combo_indices, data)
+
+        # (n_lsd, n_combinations): сумма товаров каждого ЛСД в каждой корзине;
+        # слагаемые товаров создаются по мере сложения
+        lsd_spend = self._pairwise_sum_lazy(
+            combo_indices.shape[1], lambda item_idx: lsd_table['lsd_costs'][:, global_indices[:, item_idx]]
+        )
+        metric_dtype = self._metric_dtype(data)
+        if lsd_spend is None:
+            lsd_spend = np.zeros((len(lsd_table['lsd_ids']), n_combinations), dtype=metric_dtype)
+
+        total_delivery_costs = np.zeros(n_combinations, dtype=metric_dtype)
+        total_topups = np.zeros(n_combinations, dtype=metric_dtype)
+
+        for lsd_pos, lsd_id in enumerate(lsd_table['lsd_ids']):
+            delivery_cost, topup = self._lsd_delivery_from_totals(
+                lsd_spend[lsd_pos], lsd_table['min_orders'][lsd_pos], lsd_table['fixed_fees'][lsd_pos],
+                delivery_lookups[int(lsd_id)]
+            )
+            total_delivery_costs += delivery_cost
+            total_topups += topup
+
+        return total_delivery_costs, total_topups
+
+    def _delivery_for_indices_masked(self, combo_indices: np.ndarray, data: Dict[str, Any],
+                                     delivery_lookups: Dict[int, Dict[str, np.ndarray]]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Ядро calculate_delivery_vectorized_v2 без логирования (маски по каждой ячейке).
+        Эталон для _delivery_for_indices.
+
+        Returns:
+            (total_delivery_costs, total_topups) - два массива shape (len(combo_indices),)
+        """
+        n_combinations = combo_indices.shape[0]
         lsd_config_ids = data['lsd_config_ids']
-        costs = data['costs']
-        min_order_amounts = data['min_order_amounts']
-        delivery_fixed_fees = data['delivery_fixed_fees']
 
         # Преобразуем в глобальные индексы
-        global_indices = combo_indices.copy()
-        for item_idx in range(n_items):
-            global_indices[:, item_idx] += item_offsets[item_idx]
+        global_indices = self._global_indices(combo_indices, data)
 
         # Извлекаем данные для всех комбинаций
         combo_lsd_ids = lsd_config_ids[global_indices]  # shape: (n_combinations, n_items)
-        combo_costs = costs[global_indices]
-        combo_min_orders = min_order_amounts[global_indices]
-        combo_fixed_fees = delivery_fixed_fees[global_indices]
-
-        # Подготавливаем lookup-таблицы
-        delivery_lookups = self._prepare_delivery_lookups(data)
+        combo_costs = data['costs'][global_indices]
+        combo_min_orders = data['min_order_amounts'][global_indices]
+        combo_fixed_fees = data['delivery_fixed_fees'][global_indices]
 
         # Результирующие массивы
-        total_delivery_costs = np.zeros(n_combinations, dtype=np.float32)
-        total_topups = np.zeros(n_combinations, dtype=np.float32)
-
-        # Получаем уникальные ЛСД
-        unique_lsd_ids = np.unique(lsd_config_ids)
-        logger.info(f"  Обработка {len(unique_lsd_ids)} уникальных ЛСД...")
+        total_delivery_costs = np.zeros(n_combinations, dtype=self._metric_dtype(data))
+        total_topups = np.zeros(n_combinations, dtype=self._metric_dtype(data))
 
         # Для каждого ЛСД векторно рассчитываем доставку
-        for lsd_id in unique_lsd_ids:
+        for lsd_id in np.unique(lsd_config_ids):
             # Создаём маску: где в комбинации есть товары из этого ЛСД
             lsd_mask = (combo_lsd_ids == lsd_id)  # shape: (n_combinations, n_items)
 
@@ -505,54 +937,65 @@ class OrderOptimizerNumPy:
             min_order = combo_min_orders[np.arange(n_combinations), lsd_item_indices]
             fixed_fee = combo_fixed_fees[np.arange(n_combinations), lsd_item_indices]
 
-            # Маска: где этот ЛСД действительно присутствует (lsd_totals > 0)
-            has_lsd = lsd_totals > 0
-
-            # Рассчитываем топап (векторно)
-            topup = np.where(
-                has_lsd & (min_order > 0) & (lsd_totals < min_order),
-                min_order - lsd_totals,
-                0.0
+            delivery_cost, topup = self._lsd_delivery_from_totals(
+                lsd_totals, min_order, fixed_fee, delivery_lookups[int(lsd_id)]
             )
 
-            # Корректируем сумму ПОСЛЕ топапа
-            lsd_totals_with_topup = lsd_totals + topup
+            # Аккумулируем результаты
+            total_delivery_costs += delivery_cost
+            total_topups += topup
 
-            # Векторно находим диапазон через np.searchsorted
-            lookup = delivery_lookups[int(lsd_id)]
+        return total_delivery_costs, total_topups
 
-            # searchsorted возвращает индекс первого элемента >= искомого
-            # Нам нужен индекс диапазона, в который попадает значение
-            # Используем side='right' чтобы получить индекс > значения, потом вычитаем 1
-            range_indices = np.searchsorted(lookup['mins'], lsd_totals_with_topup, side='right') - 1
-            range_indices = np.clip(range_indices, 0, len(lookup['fees']) - 1)
+    def _lsd_delivery_from_totals(self, lsd_totals: np.ndarray, min_order, fixed_fee,
+                                  lookup: Dict[str, np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Доставка и топап одного ЛСД по сумме товаров этого ЛСД в каждой корзине.
 
-            # Проверяем, что значение не превышает max диапазона
-            # Если превышает - ищем следующий диапазон
-            in_range = lsd_totals_with_topup < lookup['maxs'][range_indices]
+        Общая часть матричного и безматричного расчёта: операции поэлементные,
+        поэтому результат не зависит от формы массивов (min_order и fixed_fee -
+        массивы той же формы или скаляры).
 
-            # Если не в диапазоне и есть следующий диапазон - берём его
-            next_range_available = range_indices < (len(lookup['fees']) - 1)
-            range_indices = np.where(~in_range & next_range_available, range_indices + 1, range_indices)
+        Returns:
+            (delivery_cost, topup) - массивы той же формы, что lsd_totals
+        """
+        # Маска: где этот ЛСД действительно присутствует (lsd_totals > 0)
+        has_lsd = lsd_totals > 0
 
-            # Извлекаем fee (векторно)
-            base_fees = lookup['fees'][range_indices]
+        # Ноль в типе метрик (float32 или копейки int32), чтобы np.where не повышал тип
+        zero = lsd_totals.dtype.type(0)
 
-            # Применяем только к тем комбинациям, где есть этот ЛСД
-            delivery_cost = np.where(has_lsd, base_fees + fixed_fee, 0.0)
+        # Рассчитываем топап (векторно)
+        topup = np.where(
+            has_lsd & (min_order > 0) & (lsd_totals < min_order),
+            min_order - lsd_totals,
+            zero
+        )
 
-            # Аккумулируем результаты
-            total_delivery_costs += delivery_cost
-            total_topups += topup
+        # Корректируем сумму ПОСЛЕ топапа
+        lsd_totals_with_topup = lsd_totals + topup
 
-        elapsed = time.time() - start_time
-        logger.info(f"Доставка рассчитана за {elapsed:.2f} сек ({n_combinations/elapsed:,.0f} корзин/сек)")
-        logger.info(f"  min delivery: {total_delivery_costs.min():.2f}₽")
-        logger.info(f"  max delivery: {total_delivery_costs.max():.2f}₽")
-        logger.info(f"  min topup: {total_topups.min():.2f}₽")
-        logger.info(f"  max topup: {total_topups.max():.2f}₽")
+        # searchsorted возвращает индекс первого элемента >= искомого
+        # Нам нужен индекс диапазона, в который попадает значение
+        # Используем side='right' чтобы получить индекс > значения, потом вычитаем 1
+        range_indices = np.searchsorted(lookup['mins'], lsd_totals_with_topup, side='right') - 1
+        range_indices = np.clip(range_indices, 0, len(lookup['fees']) - 1)
 
-        return total_delivery_costs, total_topups
+        # Проверяем, что значение не превышает max диапазона
+        # Если превышает - ищем следующий диапазон
+        in_range = lsd_totals_with_topup < lookup['maxs'][range_indices]
+
+        # Если не в диапазоне и есть следующий диапазон - берём его
+        next_range_available = range_indices < (len(lookup['fees']) - 1)
+        range_indices = np.where(~in_range & next_range_available, range_indices + 1, range_indices)
+
+        # Извлекаем fee (векторно)
+        base_fees = lookup['fees'][range_indices]
+
+        # Применяем только к тем комбинациям, где есть этот ЛСД
+        delivery_cost = np.where(has_lsd, base_fees + fixed_fee, zero)
+
+        return delivery_cost, topup
 
     # =========================================================================
     # СТАРАЯ ВЕРСИЯ (ОСТАВЛЕНА ДЛЯ СОВМЕСТИМОСТИ)
@@ -580,7 +1023,6 @@ class OrderOptimizerNumPy:
         costs = data['costs']
         min_order_amounts = data['min_order_amounts']
         delivery_fixed_fees = data['delivery_fixed_fees']
-        variant_metadata = data['variant_metadata']
         
         # Преобразуем в глобальные индексы
         global_indices = combo_indices.copy()
@@ -606,9 +1048,7 @@ class OrderOptimizerNumPy:
         # Создаём lookup для моделей доставки
         delivery_models = {}
         for lsd_id in unique_lsd_ids:
-            # Находим первый вариант с этим lsd_id
-            idx = np.where(lsd_config_ids == lsd_id)[0][0]
-            delivery_models[lsd_id] = variant_metadata[idx].get('delivery_cost_model', {})
+            delivery_models[lsd_id] = self._lsd_delivery_model(data, lsd_id)
         
         # Обрабатываем батчами для экономии памяти
         batch_size = 10000
@@ -710,12 +1150,16 @@ class OrderOptimizerNumPy:
     # ЭТАП 6: ФИНАЛЬНАЯ СОРТИРОВКА И ОТБОР
     # =========================================================================
     
-    def select_top_baskets(self, combo_indices: np.ndarray, total_losses: np.ndarray,
+    def select_top_baskets(self, combo_indices: Optional[np.ndarray], total_losses: np.ndarray,
                           total_costs: np.ndarray, total_delivery: np.ndarray, total_topup: np.ndarray,
                           data: Dict[str, Any], top_n: int = 10) -> List[Dict[str, Any]]:
         """
         Отбирает топ-N корзин + лучшие моно-корзины для каждого LSD.
         
+        Args:
+            combo_indices: Индексная матрица или None - тогда строки победителей
+                восстанавливаются по номерам комбинаций (decode_combination_ids)
+        
         Returns:
             Список словарей с полными данными о корзинах
         """
@@ -731,118 +1175,52 @@ class OrderOptimizerNumPy:
         # Сортируем по total_loss_and_delivery, затем по total_cost
         sort_keys = np.lexsort((total_costs_corrected, total_loss_and_delivery))
         
-        n_items = data['n_items']
-        item_offsets = data['item_offsets']
-        variant_metadata = data['variant_metadata']
-        lsd_config_ids = data['lsd_config_ids']
-        
         # Шаг 1: Отбираем топ-N
         top_indices = sort_keys[:top_n]
         top_baskets = []
         top_basket_ids = set()
         
         for rank, idx in enumerate(top_indices, start=1):
-            combo_idx = combo_indices[idx]
-            
-            # Преобразуем в глобальные индексы и извлекаем полные данные
-            basket_items = []
-            lsd_ids_in_basket = set()
-            
-            for item_idx in range(n_items):
-                global_idx = combo_idx[item_idx] + item_offsets[item_idx]
-                item_data = variant_metadata[global_idx]
-                basket_items.append(item_data)
-                lsd_ids_in_basket.add(item_data['lsd_config_id'])
-            
-            is_mono_basket = len(lsd_ids_in_basket) == 1
-            
-            basket = {
-                'basket_id': int(idx) + 1,
-                'rank': rank,
-                'basket_items': basket_items,
-                'total_loss': float(total_losses[idx]),
-                'total_goods_cost': float(total_costs[idx]),
-                'total_topup': float(total_topup[idx]),
-                'total_delivery_cost': float(total_delivery[idx]),
-                'total_cost': float(total_costs[idx] + total_topup[idx] + total_delivery[idx]),
-                'total_loss_and_delivery': float(total_loss_and_delivery[idx]),
-                'is_mono_basket': is_mono_basket,
-                'lsd_ids': lsd_ids_in_basket
-            }
+            basket = self._build_basket(
+                self._combination_row(combo_indices, int(idx), data), int(idx), rank, data,
+                total_losses[idx], total_costs[idx], total_topup[idx], total_delivery[idx]
+            )
             
             top_baskets.append(basket)
             top_basket_ids.add(int(idx))
             
             if rank <= 3:
-                mono_label = "[МОНО]" if is_mono_basket else "[МУЛЬТИ]"
+                mono_label = "[МОНО]" if basket['is_mono_basket'] else "[МУЛЬТИ]"
                 logger.info(f"  #{rank} {mono_label}: basket_id={basket['basket_id']}, "
                            f"loss+delivery={basket['total_loss_and_delivery']:.2f}₽, "
                            f"итого={basket['total_cost']:.2f}₽")
         
         # Шаг 2: Добавляем лучшие моно-корзины для каждого LSD
+        # Моно-корзины ищем в их собственном (маленьком) пространстве, а не
+        # проходом по sort_keys: метрики строки не зависят от остальных строк,
+        # поэтому ключи совпадают с total_* побитово
         logger.info(f"\nПоиск лучших моно-корзин для каждого LSD...")
+        mono_candidates = self.find_mono_candidates(data, top_n + 1)
+        logger.info(f"Найдено {len(mono_candidates)} уникальных LSD")
         
-        # Находим все уникальные LSD в данных
-        unique_lsd_ids = np.unique(lsd_config_ids)
-        logger.info(f"Найдено {len(unique_lsd_ids)} уникальных LSD")
-        
-        # Для каждого LSD ищем лучшую моно-корзину
         mono_baskets_added = []
         next_rank = top_n + 1
         
-        for lsd_id in unique_lsd_ids:
-            # Ищем лучшую моно-корзину для этого LSD
-            # Идём по отсортированным индексам
-            best_mono_idx = None
-            
-            for idx in sort_keys:
-                # Пропускаем корзины, которые уже в топ-N
-                if int(idx) in top_basket_ids:
-                    continue
-                
-                combo_idx = combo_indices[idx]
-                
-                # Проверяем, является ли эта корзина моно-корзиной для lsd_id
-                lsd_ids_in_basket = set()
-                for item_idx in range(n_items):
-                    global_idx = combo_idx[item_idx] + item_offsets[item_idx]
-                    lsd_ids_in_basket.add(lsd_config_ids[global_idx])
-                
-                # Если это моно-корзина с нужным LSD - берём её
-                if len(lsd_ids_in_basket) == 1 and lsd_id in lsd_ids_in_basket:
-                    best_mono_idx = idx
-                    break
+        for lsd_id, candidate_ids in mono_candidates.items():
+            # Лучшая моно-корзина, которая ещё не в топ-N
+            best_mono_idx = next((int(idx) for idx in candidate_ids if int(idx) not in top_basket_ids), None)
             
             # Если нашли моно-корзину - добавляем
             if best_mono_idx is not None:
-                combo_idx = combo_indices[best_mono_idx]
-                basket_items = []
-                lsd_ids_in_basket = set()
-                
-                for item_idx in range(n_items):
-                    global_idx = combo_idx[item_idx] + item_offsets[item_idx]
-                    item_data = variant_metadata[global_idx]
-                    basket_items.append(item_data)
-                    lsd_ids_in_basket.add(item_data['lsd_config_id'])
-                
-                lsd_name = basket_items[0]['lsd_name']
-                
-                basket = {
-                    'basket_id': int(best_mono_idx) + 1,
-                    'rank': next_rank,
-                    'basket_items': basket_items,
-                    'total_loss': float(total_losses[best_mono_idx]),
-                    'total_goods_cost': float(total_costs[best_mono_idx]),
-                    'total_topup': float(total_topup[best_mono_idx]),
-                    'total_delivery_cost': float(total_delivery[best_mono_idx]),
-                    'total_cost': float(total_costs[best_mono_idx] + total_topup[best_mono_idx] + total_delivery[best_mono_idx]),
-                    'total_loss_and_delivery': float(total_loss_and_delivery[best_mono_idx]),
-                    'is_mono_basket': True,
-                    'lsd_ids': lsd_ids_in_basket
-                }
+                basket = self._build_basket(
+                    self._combination_row(combo_indices, best_mono_idx, data), best_mono_idx, next_rank, data,
+                    total_losses[best_mono_idx], total_costs[best_mono_idx],
+                    total_topup[best_mono_idx], total_delivery[best_mono_idx]
+                )
+                lsd_name = basket['basket_items'][0]['lsd_name']
                 
                 top_baskets.append(basket)
-                top_basket_ids.add(int(best_mono_idx))
+                top_basket_ids.add(best_mono_idx)
                 mono_baskets_added.append(lsd_name)
                 next_rank += 1
                 
@@ -863,32 +1241,157 @@ class OrderOptimizerNumPy:
         
         return top_baskets
     
+    def _combination_row(self, combo_indices: Optional[np.ndarray], combo_number: int,
+                         data: Dict[str, Any]) -> np.ndarray:
+        """Строка индексной матрицы: из матрицы, если она есть, иначе декодированием номера."""
+        if combo_indices is not None:
+            return combo_indices[combo_number]
+        return self.decode_combination_ids(np.array([combo_number]), data['n_variants'])[0]
+
+    def _mono_variant_choices(self, data: Dict[str, Any], lsd_id: int) -> Optional[List[np.ndarray]]:
+        """
+        Локальные индексы вариантов ЛСД для каждого товара.
+
+        Returns:
+            Список массивов (по возрастанию индекса) или None, если у какого-то
+            товара нет ни одного варианта этого ЛСД - моно-корзина невозможна
+        """
+        lsd_config_ids = data['lsd_config_ids']
+        item_offsets = data['item_offsets']
+        choices = []
+        for item_idx, n_var in enumerate(data['n_variants']):
+            offset = item_offsets[item_idx]
+            local = np.nonzero(lsd_config_ids[offset:offset + n_var] == lsd_id)[0]
+            if len(local) == 0:
+                return None
+            choices.append(local.astype(np.int32))
+        return choices
+
+    def find_mono_candidates(self, data: Dict[str, Any], k: int,
+                             delivery_lookups: Dict[int, Dict[str, np.ndarray]] = None) -> Dict[int, np.ndarray]:
+        """
+        Лучшие k моно-корзин каждого ЛСД без прохода по всем комбинациям.
+
+        Моно-корзина ЛСД X состоит только из вариантов X, поэтому её пространство -
+        произведение числа вариантов X по товарам. Оно перебирается блоками
+        MONO_BLOCK_SIZE в той же смешанной системе счисления (варианты внутри
+        товара по возрастанию), поэтому порядок перебора совпадает с порядком
+        номеров комбинаций, а ничьи решаются как в np.lexsort по всем комбинациям.
+
+        Args:
+            data: Словарь с NumPy массивами данных
+            k: Сколько кандидатов хранить на ЛСД (обычно top_n + 1)
+            delivery_lookups: Готовые lookup-таблицы доставки (по умолчанию строятся из data)
+
+        Returns:
+            Dict[lsd_id] -> номера комбинаций (0-based) в порядке ранжирования;
+            ЛСД по возрастанию id, для невозможных моно-корзин - пустой массив
+        """
+        if delivery_lookups is None:
+            delivery_lookups = self._prepare_delivery_lookups(data)
+        strides = self._combination_strides(data['n_variants'])
+        variant_metadata = data.get('variant_metadata')
+
+        mono_candidates = {}
+        for lsd_id in np.unique(data['lsd_config_ids']):
+            lsd_id = int(lsd_id)
+            choices = self._mono_variant_choices(data, lsd_id)
+            if choices is None:
+                if variant_metadata is not None:
+                    lsd_idx = int(np.nonzero(data['lsd_config_ids'] == lsd_id)[0][0])
+                    lsd_name = variant_metadata[lsd_idx]['lsd_name']
+                else:
+                    lsd_name = lsd_id
+                logger.info(f"  ✗ {lsd_name}: моно-корзина невозможна (не у всех товаров есть варианты)")
+                mono_candidates[lsd_id] = np.empty(0, dtype=np.int64)
+                continue
+
+            n_choices = [len(c) for c in choices]
+            mono_strides = self._combination_strides(n_choices)
+            n_mono = int(np.prod(n_choices, dtype=np.int64))
+
+            best_ids = np.empty(0, dtype=strides.dtype)
+            best_keys = np.empty(0, dtype=self._metric_dtype(data))
+            best_costs = np.empty(0, dtype=self._metric_dtype(data))
+
+            for block_start in range(0, n_mono, MONO_BLOCK_SIZE):
+                mono_ids = np.arange(block_start, min(block_start + MONO_BLOCK_SIZE, n_mono), dtype=np.int64)
+                combo_indices = np.empty((len(mono_ids), len(choices)), dtype=np.int32)
+                for item_idx, item_choices in enumerate(choices):
+                    positions = (mono_ids // mono_strides[item_idx]) % n_choices[item_idx]
+                    combo_indices[:, item_idx] = item_choices[positions]
+
+                total_losses, total_costs = self._basic_metrics_for_indices(combo_indices, data)
+                total_delivery, total_topup = self._delivery_for_indices(combo_indices, data, delivery_lookups)
+
+                # Те же выражения и порядок операций, что и в select_top_baskets
+                total_loss_and_delivery = total_losses + total_topup + total_delivery
+                total_costs_corrected = total_costs + total_topup + total_delivery
+
+                ids = np.concatenate([best_ids, combo_indices.astype(strides.dtype) @ strides])
+                keys = np.concatenate([best_keys, total_loss_and_delivery])
+                costs = np.concatenate([best_costs, total_costs_corrected])
+                order = np.lexsort((ids, costs, keys))[:k]
+                best_ids, best_keys, best_costs = ids[order], keys[order], costs[order]
+
+            mono_candidates[lsd_id] = best_ids
+
+        return mono_candidates
+
+    def _build_basket(self, combo_idx: np.ndarray, combo_number: int, rank: int, data: Dict[str, Any],
+                      total_loss: np.float32, total_goods_cost: np.float32,
+                      total_topup: np.float32, total_delivery: np.float32) -> Dict[str, Any]:
+        """
+        Собирает словарь корзины для save_to_db по строке индексной матрицы.
+
+        Args:
+            combo_idx: Локальные индексы вариантов (строка индексной матрицы)
+            combo_number: Номер комбинации (0-based), basket_id = combo_number + 1
+            rank: Ранг корзины
+            data: Словарь с данными
+            total_*: Метрики комбинации (float32 или копейки int32, как в векторных расчётах)
+        """
+        item_offsets = data['item_offsets']
+        scale = KOPECKS_PER_RUBLE if data.get('metric_units') == METRIC_KOPECKS else 1
+        variant_metadata = data['variant_metadata']
+        
+        # Преобразуем в глобальные индексы и извлекаем полные данные
+        basket_items = []
+        lsd_ids_in_basket = set()
+        
+        for item_idx in range(data['n_items']):
+            global_idx = int(combo_idx[item_idx]) + item_offsets[item_idx]
+            item_data = variant_metadata[global_idx]
+            basket_items.append(item_data)
+            lsd_ids_in_basket.add(item_data['lsd_config_id'])
+        
+        return {
+            'basket_id': combo_number + 1,
+            'rank': rank,
+            'basket_items': basket_items,
+            'total_loss': float(total_loss) / scale,
+            'total_goods_cost': float(total_goods_cost) / scale,
+            'total_topup': float(total_topup) / scale,
+            'total_delivery_cost': float(total_delivery) / scale,
+            'total_cost': float(total_goods_cost + total_topup + total_delivery) / scale,
+            'total_loss_and_delivery': float(total_loss + total_topup + total_delivery) / scale,
+            'is_mono_basket': len(lsd_ids_in_basket) == 1,
+            'lsd_ids': lsd_ids_in_basket
+        }
+    
     # =========================================================================
     # ЭТАП 7: ЗАПИСЬ В БД
     # =========================================================================
     
     def save_to_db(self, top_baskets: List[Dict[str, Any]], order_id: int):
-        """Записывает топ-корзины в БД."""
+        """Записывает топ-корзины в БД (COPY через BasketResultWriter, одна транзакция)."""
         logger.info(f"Запись {len(top_baskets)} корзин в БД...")
         start_time = time.time()
         
-        # Удаляем старые данные
-        with self.conn.cursor() as cur:
-            cur.execute("DELETE FROM basket_delivery_costs WHERE order_id = %s", (order_id,))
-            deleted_bdc = cur.rowcount
-            
-            cur.execute("DELETE FROM basket_combinations WHERE order_id = %s", (order_id,))
-            deleted_bc = cur.rowcount
-            
-            cur.execute("DELETE FROM basket_analyses WHERE order_id = %s", (order_id,))
-            deleted_ba = cur.rowcount
-            
-            logger.info(f"Удалено старых записей: bdc={deleted_bdc}, bc={deleted_bc}, ba={deleted_ba}")
-        
-        # Подготавливаем данные
-        bc_rows = []
-        bdc_rows = []
-        ba_rows = []
+        if self.result_batch is not None:
+            writer = self.result_batch.writer(order_id)
+        else:
+            writer = BasketResultWriter(self.conn, order_id)
         
         for basket in top_baskets:
             basket_id = basket['basket_id']
@@ -910,16 +1413,7 @@ class OrderOptimizerNumPy:
                 lsd_groups[lsd_id]['total_cost'] += float(item['order_item_ids_cost'] or 0)
             
             # basket_combinations
-            for item in basket['basket_items']:
-                bc_rows.append((
-                    basket_id, item['id'], order_id, item['order_item_id'],
-                    item['product_name'], item['lsd_name'], item['base_unit'],
-                    item['base_quantity'], item['price'], item['fprice'],
-                    item['fprice_min'], item['fprice_diff'], item['loss'],
-                    item['order_item_ids_quantity'], item['min_order_amount'],
-                    item['lsd_config_id'], json.dumps(item['delivery_cost_model']),
-                    item['order_item_ids_cost'], item['id'], item['id']
-                ))
+            writer.add_basket_items(basket_id, basket['basket_items'])
             
             # basket_delivery_costs
             delivery_cost_json = {}
@@ -928,14 +1422,11 @@ class OrderOptimizerNumPy:
             
             for lsd_id, group in lsd_groups.items():
                 lsd_total = group['total_cost']
-                original_lsd_total = lsd_total  # Сохраняем оригинал
                 topup = 0.0
-                has_topup = False
                 
                 if group['min_order'] > 0 and lsd_total < group['min_order']:
                     topup = group['min_order'] - lsd_total
                     lsd_total = group['min_order']
-                    has_topup = True
                 
                 # Расчёт доставки от суммы ПОСЛЕ топапа
                 base_fee = self._calculate_delivery_by_model(group['model'], lsd_total)
@@ -943,10 +1434,8 @@ class OrderOptimizerNumPy:
                 # Стоимость доставки (base_fee рассчитан от суммы ПОСЛЕ топапа)
                 delivery_cost = base_fee + group['fixed_fee']
                 
-                bdc_rows.append((
-                    order_id, basket_id, lsd_id, delivery_cost, topup,
-                    group['total_cost'], group['min_order']
-                ))
+                writer.add_delivery_cost(basket_id, lsd_id, delivery_cost, topup,
+                                         group['total_cost'], group['min_order'])
                 
                 delivery_cost_json[group['lsd_name']] = delivery_cost
                 delivery_topup_json[group['lsd_name']] = topup
@@ -958,49 +1447,28 @@ class OrderOptimizerNumPy:
             corrected_total_cost = basket['total_goods_cost'] + total_topup + total_delivery
             corrected_total_loss_and_delivery = basket['total_loss'] + total_topup + total_delivery
             
-            ba_rows.append((
-                order_id, basket_id, basket['total_loss'], basket['total_goods_cost'],
-                json.dumps(delivery_cost_json), json.dumps(delivery_topup_json),
+            writer.add_analysis(
+                basket_id, basket['total_loss'], basket['total_goods_cost'],
+                delivery_cost_json, delivery_topup_json,
                 total_delivery,  # БЕЗ топапа
                 corrected_total_cost,  # total_goods_cost + topup + delivery
                 corrected_total_loss_and_delivery,  # loss + topup + delivery
                 basket['rank'],
-                basket.get('is_mono_basket', False)  # Добавляем флаг моно-корзины
-            ))
+                basket.get('is_mono_basket', False)  # Флаг моно-корзины
+            )
         
-        # Вставляем данные
-        with self.conn.cursor() as cur:
-            execute_values(cur, """
-                INSERT INTO basket_combinations (
-                    basket_id, id, order_id, order_item_id, product_name, lsd_name,
-                    base_unit, base_quantity, price, fprice, fprice_min, fprice_diff,
-                    loss, order_item_ids_quantity, min_order_amount, lsd_config_id,
-                    delivery_cost_model, order_item_ids_cost, fprice_optimizer_id, lsd_stock_id
-                ) VALUES %s
-            """, bc_rows)
-            
-            execute_values(cur, """
-                INSERT INTO basket_delivery_costs (
-                    order_id, basket_id, lsd_config_id, delivery_cost, topup,
-                    lsd_total_basket_cost, min_order_amount
-                ) VALUES %s
-            """, bdc_rows)
-            
-            execute_values(cur, """
-                INSERT INTO basket_analyses (
-                    order_id, basket_id, total_loss, total_goods_cost,
-                    delivery_cost, delivery_topup, total_delivery_cost,
-                    total_cost, total_loss_and_delivery, basket_rank, is_mono_basket
-                ) VALUES %s
-            """, ba_rows)
+        if self.result_batch is not None:
+            # Пакетный режим: строки запишет result_batch.write() вместе с остальными заказами
+            logger.info(f"Корзины заказа #{order_id} добавлены в пакетную запись")
+            return
         
-        self.conn.commit()
+        counts = writer.write()
         
         elapsed = time.time() - start_time
         logger.info(f"Запись завершена за {elapsed:.2f} сек")
-        logger.info(f"  basket_combinations: {len(bc_rows)} строк")
-        logger.info(f"  basket_delivery_costs: {len(bdc_rows)} строк")
-        logger.info(f"  basket_analyses: {len(ba_rows)} строк")
+        logger.info(f"  basket_combinations: {counts['basket_combinations']} строк")
+        logger.info(f"  basket_delivery_costs: {counts['basket_delivery_costs']} строк")
+        logger.info(f"  basket_analyses: {counts['basket_analyses']} строк")
     
     # =========================================================================
     # ГЛАВНАЯ ФУНКЦИЯ
@@ -1031,36 +1499,49 @@ class OrderOptimizerNumPy:
         gc.disable()
         logger.info("GC отключен для ускорения вычислений")
         
+        # Длительность, пик памяти и объём каждого этапа (utils/stage_metrics.py)
+        stage_metrics = StageMetrics('numpy')
+        
         try:
             # Этап 1: Загрузка данных
-            logger.info("\n[1/5] Загрузка данных в NumPy...")
-            data = self.load_fprice_data_to_numpy(order_id, exclusions=exclusions)
+            logger.info("\n[1/4] Загрузка данных в NumPy...")
+            with stage_metrics.stage('load') as stage:
+                data = self.load_fprice_data_to_numpy(order_id, exclusions=exclusions)
+                if data is not None and self.kopeck_metrics:
+                    data = self.to_kopecks(data)
+                if data is not None:
+                    stage['combinations'] = data['n_combinations']
             if data is None:
                 return {"status": "no_data", "elapsed_time": 0}
+            stage_metrics.set_order(data)
+            n_combinations = data['n_combinations']
             
-            # Этап 2: Генерация индексной матрицы
-            logger.info("\n[2/5] Генерация индексной матрицы комбинаций...")
-            combo_indices = self.generate_combination_indices(data['n_variants'])
+            # Этап 2: Расчёт базовых метрик (без индексной матрицы; строки
+            # индексной матрицы декодируются только для победителей на этапе select)
+            logger.info("\n[2/4] Векторный расчёт базовых метрик...")
+            with stage_metrics.stage('metrics', n_combinations):
+                total_losses, total_costs = self.calculate_basic_metrics_broadcast(data)
             
-            # Этап 3: Расчёт базовых метрик
-            logger.info("\n[3/5] Векторный расчёт базовых метрик...")
-            total_losses, total_costs = self.calculate_basic_metrics(combo_indices, data)
+            # Этап 3: Расчёт доставки ДЛЯ ВСЕХ комбинаций (ПОЛНАЯ ВЕКТОРИЗАЦИЯ)
+            logger.info("\n[3/4] Расчёт доставки для всех комбинаций...")
+            with stage_metrics.stage('delivery', n_combinations):
+                total_delivery, total_topup = self.calculate_delivery_broadcast(data)
             
-            # Этап 4: Расчёт доставки ДЛЯ ВСЕХ комбинаций (ПОЛНАЯ ВЕКТОРИЗАЦИЯ)
-            logger.info("\n[4/5] Расчёт доставки для всех комбинаций...")
-            total_delivery, total_topup = self.calculate_delivery_vectorized_v2(combo_indices, data)
-            
-            # Этап 5: Финальный отбор
-            logger.info(f"\n[5/5] Финальный отбор топ-{top_n_final} и запись в БД...")
-            top_baskets = self.select_top_baskets(
-                combo_indices, total_losses, total_costs, 
-                total_delivery, total_topup, data, top_n_final
-            )
+            # Этап 4: Финальный отбор - строки индексной матрицы декодируются только для победителей
+            logger.info(f"\n[4/4] Финальный отбор топ-{top_n_final} и запись в БД...")
+            with stage_metrics.stage('select', n_combinations):
+                top_baskets = self.select_top_baskets(
+                    None, total_losses, total_costs, 
+                    total_delivery, total_topup, data, top_n_final
+                )
             
             # Запись в БД
-            self.save_to_db(top_baskets, order_id)
+            with stage_metrics.stage('save') as stage:
+                stage['baskets'] = len(top_baskets)
+                self.save_to_db(top_baskets, order_id)
             
         finally:
+            stage_metrics.close()
             # Включаем GC обратно
             gc.enable()
             gc.collect()
@@ -1081,6 +1562,7 @@ class OrderOptimizerNumPy:
         logger.info(f"  - Итого: {best['total_cost']:.2f}₽")
         logger.info(f"Время выполнения: {total_elapsed:.2f} сек")
         logger.info(f"Производительность: {data['n_combinations']/total_elapsed:,.0f} комбинаций/сек")
+        logger.info(f"Этапы: {stage_metrics.log_line()}")
         logger.info("=" * 80)
         
         return {
@@ -1092,12 +1574,15 @@ class OrderOptimizerNumPy:
             "best_total_cost": best['total_cost'],
             "best_loss_and_delivery": best['total_loss_and_delivery'],
             "elapsed_time": total_elapsed,
-            "performance_comb_per_sec": int(data['n_combinations']/total_elapsed)
+            "performance_comb_per_sec": int(data['n_combinations']/total_elapsed),
+            "metric_units": data.get('metric_units', METRIC_RUBLES),
+            "stage_metrics": stage_metrics.summary()
         }
 
 
 def optimize_order_numpy(order_id: int, db_connection_string: str,
-                        top_n_final: int = 10, exclusions: dict = None) -> Dict[str, Any]:
+                        top_n_final: int = 10, exclusions: dict = None,
+                        kopeck_metrics: bool = None) -> Dict[str, Any]:
     """
     Удобная функция-обёртка для оптимизации с NumPy.
     Анализирует ВСЕ комбинации без предфильтрации.
@@ -1109,8 +1594,11 @@ def optimize_order_numpy(order_id: int, db_connection_string: str,
         exclusions: Словарь с исключениями пользователя:
             - keywords: список ключевых слов для исключения
             - products: список названий продуктов из чёрного списка
+        kopeck_metrics: Метрики в копейках int32 (None - OPTIMIZER_KOPECK_METRICS)
     """
     with OrderOptimizerNumPy(db_connection_string) as optimizer:
+        if kopeck_metrics is not None:
+            optimizer.kopeck_metrics = kopeck_metrics
         return optimizer.optimize_order(order_id, top_n_final, exclusions=exclusions)
 
 
@@ -0,0 +1,249 @@
+"""
+Многопроцессный режим NumPy оптимизатора.
+
+Пространство комбинаций делится на непрерывные диапазоны номеров
+(смешанная система счисления, как в потоковом режиме), которые считают
+процессы пула. Массивы вариантов (losses, costs, lsd_config_ids,
+min_order_amounts, delivery_fixed_fees) лежат в multiprocessing.shared_memory
+и не копируются в каждый процесс. Каждый процесс потоково обходит свои
+диапазоны и возвращает локальный топ-N и моно-кандидатов по ЛСД, родитель
+сливает их тем же _merge_top, что и потоковый режим.
+
+Порядок слияния не влияет на результат: ключ сортировки
+(total_loss_and_delivery, total_cost, номер комбинации) полный, а метрики
+строки не зависят от диапазона - результат совпадает с OrderOptimizerNumPy.
+"""
+
+import logging
+import os
+import time
+import gc
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+from typing import List, Dict, Any, Tuple
+import numpy as np
+
+from order_optimizer_chunked import OrderOptimizerChunked, DEFAULT_BLOCK_SIZE
+
+# Пишем в тот же лог, что и NumPy оптимизатор (logs/optimizer_numpy.log)
+logger = logging.getLogger('order_optimizer_numpy')
+
+# Массивы вариантов, которые кладём в shared memory
+SHARED_ARRAYS = ('losses', 'costs', 'lsd_config_ids', 'min_order_amounts', 'delivery_fixed_fees')
+# Диапазонов на процесс: больше 1, чтобы быстрые процессы добирали работу за медленными
+SHARDS_PER_WORKER = 4
+# Меньше этого числа комбинаций пул не запускаем - накладные расходы больше выигрыша
+MIN_PARALLEL_COMBINATIONS = 2 * DEFAULT_BLOCK_SIZE
+
+# Состояние процесса пула (заполняется в _init_worker)
+_worker_state = {}
+
+
+def _init_worker(shared_specs: Dict[str, Tuple[str, Tuple[int, ...], str]], meta: Dict[str, Any],
+                 delivery_lookups: Dict[int, Dict[str, np.ndarray]], block_size: int):
+    """Подключает процесс пула к shared memory родителя."""
+    data = dict(meta)
+    handles = []
+    for key, (name, shape, dtype) in shared_specs.items():
+        # resource_tracker у процессов пула общий с родителем: повторная регистрация
+        # сегмента ничего не меняет, удаляет его только родитель (unlink)
+        shm = shared_memory.SharedMemory(name=name)
+        handles.append(shm)
+        data[key] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+    _worker_state['data'] = data
+    _worker_state['handles'] = handles
+    _worker_state['delivery_lookups'] = delivery_lookups
+    _worker_state['optimizer'] = OrderOptimizerChunked(None, block_size=block_size)
+
+
+def _process_shard(start: int, stop: int, top_n: int) -> Dict[str, Any]:
+    """Потоково обходит диапазон [start, stop) в процессе пула."""
+    optimizer = _worker_state['optimizer']
+    return optimizer.stream_top_combinations(
+        _worker_state['data'], top_n, start, stop,
+        delivery_lookups=_worker_state['delivery_lookups']
+    )
+
+
+class OrderOptimizerParallel(OrderOptimizerChunked):
+    """NumPy оптимизатор, распределяющий комбинации по процессам"""
+
+    def __init__(self, db_connection_string: str, n_workers: int = None,
+                 block_size: int = DEFAULT_BLOCK_SIZE):
+        """
+        Args:
+            db_connection_string: PostgreSQL connection string
+            n_workers: Количество процессов (по умолчанию - число ядер)
+            block_size: Количество комбинаций в одном блоке процесса
+        """
+        super().__init__(db_connection_string, block_size=block_size)
+        self.n_workers = n_workers or os.cpu_count() or 1
+        if self.n_workers < 1:
+            raise ValueError(f"n_workers должен быть положительным, получено {self.n_workers}")
+
+    def split_ranges(self, n_combinations: int, n_shards: int) -> List[Tuple[int, int]]:
+        """Делит [0, n_combinations) на n_shards непрерывных диапазонов почти равного размера."""
+        n_shards = max(1, min(n_shards, n_combinations))
+        bounds = [n_combinations * i // n_shards for i in range(n_shards + 1)]
+        return [(bounds[i], bounds[i + 1]) for i in range(n_shards) if bounds[i] < bounds[i + 1]]
+
+    def _merge_streamed(self, merged: Dict[str, Any], part: Dict[str, Any], top_n: int) -> Dict[str, Any]:
+        """Сливает результат диапазона в общий результат."""
+        top = part['top']
+        merged['top'] = self._merge_top(merged['top'], top['ids'], top['loss_and_delivery'],
+                                        top['total_cost'], top_n)
+        for lsd_id, candidates in part['mono'].items():
+            merged['mono'][lsd_id] = self._merge_top(
+                merged['mono'].get(lsd_id, self._empty_top()), candidates['ids'],
+                candidates['loss_and_delivery'], candidates['total_cost'], top_n + 1
+            )
+        merged['n_blocks'] += part['n_blocks']
+        merged['n_processed'] += part['n_processed']
+        return merged
+
+    def stream_top_parallel(self, data: Dict[str, Any], top_n: int = 10) -> Dict[str, Any]:
+        """
+        Обходит все комбинации в пуле процессов.
+
+        Returns:
+            Dict в формате stream_top_combinations + 'n_shards'
+        """
+        n_combinations = data['n_combinations']
+        delivery_lookups = self._prepare_delivery_lookups(data)
+
+        if self.n_workers == 1 or n_combinations < MIN_PARALLEL_COMBINATIONS:
+            logger.info(f"  {n_combinations:,} комбинаций - считаем в текущем процессе")
+            streamed = self.stream_top_combinations(data, top_n, delivery_lookups=delivery_lookups)
+            streamed['n_shards'] = 1
+            return streamed
+
+        ranges = self.split_ranges(n_combinations, self.n_workers * SHARDS_PER_WORKER)
+        meta = {
+            'n_items': data['n_items'],
+            'n_variants': data['n_variants'],
+            'item_offsets': data['item_offsets']
+        }
+
+        segments = []
+        try:
+            shared_specs = {}
+            for key in SHARED_ARRAYS:
+                array = np.ascontiguousarray(data[key])
+                shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+                segments.append(shm)
+                np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+                shared_specs[key] = (shm.name, array.shape, array.dtype.str)
+
+            logger.info(f"  Процессов: {self.n_workers}, диапазонов: {len(ranges)} "
+                        f"(~{ranges[0][1] - ranges[0][0]:,} комбинаций в каждом)")
+
+            merged = {'top': self._empty_top(), 'mono': {}, 'n_blocks': 0, 'n_processed': 0}
+            with ProcessPoolExecutor(
+                max_workers=self.n_workers,
+                initializer=_init_worker,
+                initargs=(shared_specs, meta, delivery_lookups, self.block_size)
+            ) as pool:
+                futures = [pool.submit(_process_shard, start, stop, top_n) for start, stop in ranges]
+                for future in as_completed(futures):
+                    merged = self._merge_streamed(merged, future.result(), top_n)
+
+        finally:
+            for shm in segments:
+                shm.close()
+                shm.unlink()
+
+        merged['n_shards'] = len(ranges)
+        return merged
+
+    # =========================================================================
+    # ГЛАВНАЯ ФУНКЦИЯ
+    # =========================================================================
+
+    def optimize_order(self, order_id: int, top_n_final: int = 10, exclusions: dict = None) -> Dict[str, Any]:
+        """
+        Полная оптимизация заказа в пуле процессов.
+
+        Args:
+            order_id: ID заказа
+            top_n_final: Количество финальных корзин для записи
+            exclusions: Словарь с исключениями пользователя (keywords, products)
+
+        Returns:
+            Dict с результатами
+        """
+        total_start = time.time()
+
+        logger.info("=" * 80)
+        logger.info(f"ОПТИМИЗАЦИЯ ЗАКАЗА #{order_id} (NumPy, {self.n_workers} процессов)")
+        logger.info("=" * 80)
+
+        gc.disable()
+        try:
+            logger.info("\n[1/3] Загрузка данных в NumPy...")
+            data = self.load_fprice_data_to_numpy(order_id, exclusions=exclusions)
+            if data is None:
+                return {"status": "no_data", "elapsed_time": 0}
+
+            n_combinations = data['n_combinations']
+
+            logger.info(f"\n[2/3] Параллельный расчёт {n_combinations:,} комбинаций...")
+            stream_start = time.time()
+            streamed = self.stream_top_parallel(data, top_n_final)
+            stream_elapsed = time.time() - stream_start
+            logger.info(f"Обработано {streamed['n_processed']:,} комбинаций в {streamed['n_shards']} "
+                        f"диапазонах за {stream_elapsed:.2f} сек")
+
+            top_baskets = self.build_top_baskets(streamed['top'], streamed['mono'], data, top_n_final)
+
+            logger.info(f"\n[3/3] Запись {len(top_baskets)} корзин в БД...")
+            self.save_to_db(top_baskets, order_id)
+
+        finally:
+            gc.enable()
+            gc.collect()
+
+        total_elapsed = time.time() - total_start
+
+        best = top_baskets[0]
+        logger.info("\n" + "=" * 80)
+        logger.info("ОПТИМИЗАЦИЯ ЗАВЕРШЕНА")
+        logger.info("=" * 80)
+        logger.info(f"Всего комбинаций: {n_combinations:,}")
+        logger.info(f"Лучшая корзина: #{best['basket_id']}")
+        logger.info(f"  - Потери + доставка: {best['total_loss_and_delivery']:.2f}₽")
+        logger.info(f"  - Итого: {best['total_cost']:.2f}₽")
+        logger.info(f"Время выполнения: {total_elapsed:.2f} сек")
+        logger.info("=" * 80)
+
+        return {
+            "status": "success",
+            "order_id": order_id,
+            "total_combinations": n_combinations,
+            "saved_baskets": len(top_baskets),
+            "best_basket_id": best['basket_id'],
+            "best_total_cost": best['total_cost'],
+            "best_loss_and_delivery": best['total_loss_and_delivery'],
+            "elapsed_time": total_elapsed,
+            "performance_comb_per_sec": int(n_combinations / total_elapsed),
+            "n_workers": self.n_workers,
+            "n_shards": streamed['n_shards']
+        }
+
+
+def optimize_order_parallel(order_id: int, db_connection_string: str, top_n_final: int = 10,
+                            exclusions: dict = None, n_workers: int = None,
+                            block_size: int = DEFAULT_BLOCK_SIZE) -> Dict[str, Any]:
+    """
+    Функция-обёртка для многопроцессной оптимизации с NumPy.
+
+    Args:
+        order_id: ID заказа
+        db_connection_string: Строка подключения к PostgreSQL
+        top_n_final: Количество финальных корзин для записи
+        exclusions: Словарь с исключениями пользователя (keywords, products)
+        n_workers: Количество процессов (по умолчанию - число ядер)
+        block_size: Количество комбинаций в одном блоке процесса
+    """
+    with OrderOptimizerParallel(db_connection_string, n_workers=n_workers, block_size=block_size) as optimizer:
+        return optimizer.optimize_order(order_id, top_n_final, exclusions=exclusions)
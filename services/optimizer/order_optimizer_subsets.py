@@ -0,0 +1,413 @@
+"""
+Оптимизатор заказов через перебор подмножеств ЛСД.
+
+Каждая корзина относится ровно к одному подмножеству ЛСД - набору магазинов
+её вариантов. Подмножества перебираются по возрастанию нижней оценки
+    сумма минимальных потерь товаров в ЛСД подмножества
+    + минимальная доставка и топап каждого ЛСД подмножества
+и перебор останавливается, когда оценка хуже текущей N-й корзины.
+
+Внутри подмножества задача назначения товаров решается динамикой по товарам:
+состояние - суммы по ЛСД (обрезанные по порогу, после которого доставка и топап
+не меняются) и маска задействованных ЛСД. Состояние отбрасывается, если его
+строго доминируют (потери меньше, суммы не меньше) хотя бы k других состояний
+с той же маской, или если его нижняя оценка хуже текущей N-й корзины. Число
+состояний определяется диапазонами доставки и min_order_amount, а не
+произведением числа вариантов.
+
+Моно-корзины получаются бесплатно - это подмножества из одного ЛСД.
+Кандидаты пересчитываются float32-ядром NumPy движка, поэтому значения,
+порядок и basket_id совпадают с остальными движками.
+"""
+
+import logging
+import time
+import gc
+from typing import List, Dict, Any, Tuple, Optional
+import numpy as np
+
+from order_optimizer_numpy import combination_id_dtype
+from order_optimizer_bnb import OrderOptimizerBnB, SEARCH_EPS
+
+# Пишем в тот же лог, что и NumPy оптимизатор (logs/optimizer_numpy.log)
+logger = logging.getLogger('order_optimizer_numpy')
+
+# Минимальный выигрыш по потерям, при котором одно состояние строго лучше другого (₽)
+DOMINANCE_EPS = 0.005
+# Допуск на равенство сумм ЛСД (₽)
+SPEND_EPS = 1e-6
+# Сколько состояний проверяется на доминирование за один шаг
+DOMINANCE_CHUNK = 512
+# Ширина луча приближённого прохода (на одну корзину топа), который уточняет
+# порог перед точным решением подмножества
+SEED_BEAM_PER_BASKET = 4
+# Предел числа состояний динамики на одном товаре. Если суммы многих ЛСД
+# почти не доминируют друг друга, подмножество решается ветвями и границами
+MAX_SUBSET_STATES = 20_000
+
+
+class OrderOptimizerLsdSubsets(OrderOptimizerBnB):
+    """Точный оптимизатор через перебор подмножеств ЛСД"""
+
+    def __init__(self, db_connection_string: str):
+        super().__init__(db_connection_string)
+        self.subsets_explored = 0
+        self.states_explored = 0
+
+    # =========================================================================
+    # ОЦЕНКИ
+    # =========================================================================
+
+    def _subset_lower_bound(self, ctx: Dict[str, Any], lsd_subset: Tuple[int, ...]) -> Optional[float]:
+        """
+        Нижняя оценка лучшей корзины, использующей ровно ЛСД из lsd_subset.
+
+        Returns:
+            Оценку или None, если какой-то товар нельзя взять в ЛСД подмножества
+        """
+        bound = 0.0
+        lsd_costs = {lsd_id: [] for lsd_id in lsd_subset}
+        for variants in ctx['items']:
+            allowed = [v for v in variants if v[3] in lsd_costs]
+            if not allowed:
+                return None
+            bound += min(v[1] for v in allowed)
+            for v in allowed:
+                lsd_costs[v[3]].append(v[2])
+
+        for lsd_id, costs in lsd_costs.items():
+            if not costs:
+                return None  # ЛСД подмножества нечего предложить
+            if min(costs) > 0:
+                bound += ctx['lsd_models'][lsd_id].lower_bound(min(costs), sum(costs))
+        return bound
+
+    def _kth_threshold(self, ranked: Tuple[np.ndarray, ...], k: int) -> float:
+        """Порог отсечения: k-е значение loss+topup+delivery с допуском SEARCH_EPS"""
+        if k <= 0 or len(ranked[0]) < k:
+            return float('inf')
+        kth = float(ranked[2][k - 1] + ranked[5][k - 1] + ranked[4][k - 1])
+        return kth + SEARCH_EPS + abs(kth) * 1e-5
+
+    # =========================================================================
+    # ДИНАМИКА ВНУТРИ ПОДМНОЖЕСТВА
+    # =========================================================================
+
+    def _prune_dominated_states(self, loss: np.ndarray, spend: np.ndarray, mask: np.ndarray,
+                                monotone: np.ndarray, k: int) -> np.ndarray:
+        """
+        Возвращает маску состояний, которые доминируют меньше k других.
+
+        Состояние A доминирует B (та же маска ЛСД), если loss_A < loss_B и сумма
+        каждого ЛСД у A не меньше (для ЛСД с немонотонной доставкой - равна).
+        Доминирование транзитивно, поэтому достаточно сравнивать с уже
+        оставленными состояниями: у отброшенного доминатора есть k своих, и они
+        доминируют то же состояние.
+        """
+        keep = np.ones(len(loss), dtype=bool)
+        for group_mask in np.unique(mask):
+            group = np.where(mask == group_mask)[0]
+            if len(group) <= k:
+                continue
+            group = group[np.argsort(loss[group], kind='stable')]
+            group_loss = loss[group]
+            group_spend = spend[group]
+
+            kept = np.zeros(0, dtype=np.int64)
+            for start in range(0, len(group), DOMINANCE_CHUNK):
+                chunk = np.arange(start, min(start + DOMINANCE_CHUNK, len(group)))
+                # Доминировать могут только состояния с меньшими потерями - они левее
+                reference = np.concatenate([kept, chunk])
+                better = group_loss[None, reference] + DOMINANCE_EPS < group_loss[chunk, None]
+                diff = group_spend[None, reference, :] - group_spend[chunk, None, :]
+                spend_ok = np.where(monotone, diff >= -SPEND_EPS, np.abs(diff) <= SPEND_EPS).all(axis=2)
+                n_dominating = (better & spend_ok).sum(axis=1)
+                kept = np.concatenate([kept, chunk[n_dominating < k]])
+
+            keep[group] = False
+            keep[group[kept]] = True
+        return keep
+
+    def solve_subset(self, ctx: Dict[str, Any], lsd_subset: Tuple[int, ...], k: int,
+                     threshold: float = float('inf'), beam: Optional[int] = None) -> Optional[List[int]]:
+        """
+        Находит кандидатов в k лучших корзин, использующих ровно ЛСД из lsd_subset.
+
+        Args:
+            ctx: Контекст из _prepare_search_context
+            lsd_subset: ЛСД подмножества
+            k: Сколько лучших корзин подмножества нужно
+            threshold: Корзины с оценкой хуже порога не нужны
+            beam: Если задан - на каждом товаре оставляем только beam состояний
+                с лучшей оценкой (быстрый приближённый поиск стартовых корзин)
+
+        Returns:
+            Номера комбинаций-кандидатов (0-based) или None, если число
+            состояний превысило MAX_SUBSET_STATES
+        """
+        m = len(lsd_subset)
+        position = {lsd_id: j for j, lsd_id in enumerate(lsd_subset)}
+        models = [ctx['lsd_models'][lsd_id] for lsd_id in lsd_subset]
+        caps = np.array([model.saturation for model in models])
+        monotone = np.array([model.is_monotone for model in models])
+        full_mask = (1 << m) - 1
+        # Номера комбинаций больших заказов не помещаются в int64 - целые Python
+        id_dtype = combination_id_dtype([len(variants) for variants in ctx['items']])
+
+        levels = []
+        for item_idx, variants in enumerate(ctx['items']):
+            allowed = [v for v in variants if v[3] in position]
+            levels.append((
+                np.array([v[0] for v in allowed], dtype=id_dtype) * ctx['strides'][item_idx],
+                np.array([v[1] for v in allowed]),
+                np.array([v[2] for v in allowed]),
+                np.array([position[v[3]] for v in allowed], dtype=np.int64)
+            ))
+        n_levels = len(levels)
+
+        # Суффиксы: минимальные потери, максимальная добавка к сумме ЛСД,
+        # минимальная положительная стоимость варианта и наличие бесплатных вариантов
+        suffix_min_loss = np.zeros(n_levels + 1)
+        suffix_max_spend = np.zeros((n_levels + 1, m))
+        suffix_min_cost = np.full((n_levels + 1, m), np.inf)
+        suffix_has_free = np.zeros((n_levels + 1, m), dtype=bool)
+        for depth in range(n_levels - 1, -1, -1):
+            _, losses, costs, positions = levels[depth]
+            suffix_min_loss[depth] = suffix_min_loss[depth + 1] + losses.min()
+            suffix_max_spend[depth] = suffix_max_spend[depth + 1]
+            suffix_min_cost[depth] = suffix_min_cost[depth + 1]
+            suffix_has_free[depth] = suffix_has_free[depth + 1]
+            for j in range(m):
+                lsd_costs = costs[positions == j]
+                if len(lsd_costs):
+                    suffix_max_spend[depth, j] += lsd_costs.max()
+                    positive = lsd_costs[lsd_costs > 0]
+                    if len(positive):
+                        suffix_min_cost[depth, j] = min(suffix_min_cost[depth, j], positive.min())
+                    suffix_has_free[depth, j] |= bool((lsd_costs <= 0).any())
+
+        # Минимальные доставка + топап ЛСД, который ещё не задействован
+        entry_cost = np.zeros((n_levels + 1, m))
+        for depth in range(n_levels + 1):
+            for j, model in enumerate(models):
+                if suffix_has_free[depth, j]:
+                    continue
+                if np.isinf(suffix_min_cost[depth, j]):
+                    entry_cost[depth, j] = np.inf  # ЛСД уже не задействовать
+                else:
+                    entry_cost[depth, j] = model.lower_bound(suffix_min_cost[depth, j], suffix_max_spend[depth, j])
+
+        def lower_bounds(depth, loss, spend, mask):
+            bound = loss + suffix_min_loss[depth]
+            for j, model in enumerate(models):
+                used = (mask >> j) & 1 == 1
+                spent = spend[:, j]
+                lsd_bound = np.where(
+                    spent > 0,
+                    model.lower_bound_array(spent, spent + suffix_max_spend[depth, j]),
+                    np.where(used, 0.0, entry_cost[depth, j])
+                )
+                bound = bound + lsd_bound
+            return bound
+
+        loss = np.zeros(1)
+        spend = np.zeros((1, m))
+        mask = np.zeros(1, dtype=np.int64)
+        combo_ids = np.zeros(1, dtype=id_dtype)
+
+        for depth, (id_offsets, losses, costs, positions) in enumerate(levels):
+            n_states, n_options = len(loss), len(losses)
+            rows = np.arange(n_states * n_options)
+
+            loss = (loss[:, None] + losses[None, :]).ravel()
+            spend = np.repeat(spend, n_options, axis=0)
+            spend[rows, np.tile(positions, n_states)] += np.tile(costs, n_states)
+            spend = np.minimum(spend, caps)
+            mask = np.repeat(mask, n_options) | np.tile(1 << positions, n_states)
+            combo_ids = np.repeat(combo_ids, n_options) + np.tile(id_offsets, n_states)
+            self.states_explored += len(loss)
+
+            keep = lower_bounds(depth + 1, loss, spend, mask) <= threshold
+            if beam is None and keep.sum() > MAX_SUBSET_STATES:
+                return None
+            keep[keep] = self._prune_dominated_states(loss[keep], spend[keep], mask[keep], monotone, k)
+            if beam is not None and keep.sum() > beam:
+                bounds = np.where(keep, lower_bounds(depth + 1, loss, spend, mask), np.inf)
+                keep = np.zeros(len(loss), dtype=bool)
+                keep[np.argsort(bounds, kind='stable')[:beam]] = True
+            loss, spend, mask, combo_ids = loss[keep], spend[keep], mask[keep], combo_ids[keep]
+
+            if len(loss) == 0:
+                return []
+
+        full = mask == full_mask
+        values = lower_bounds(n_levels, loss[full], spend[full], mask[full])
+        return [int(c) for c in combo_ids[full][values <= threshold]]
+
+    # =========================================================================
+    # ОТБОР КОРЗИН
+    # =========================================================================
+
+    def select_top_baskets_subsets(self, data: Dict[str, Any], top_n: int = 10) -> List[Dict[str, Any]]:
+        """
+        Отбирает топ-N корзин + лучшие моно-корзины для каждого LSD
+        (семантика select_top_baskets) перебором подмножеств ЛСД.
+        """
+        logger.info(f"Поиск топ-{top_n} корзин перебором подмножеств ЛСД...")
+        start_time = time.time()
+
+        ctx = self._prepare_search_context(data)
+        delivery_lookups = self._prepare_delivery_lookups(data)
+        lsd_ids = sorted(ctx['lsd_models'])
+
+        subsets = []
+        for bits in range(1, 1 << len(lsd_ids)):
+            lsd_subset = tuple(lsd_id for j, lsd_id in enumerate(lsd_ids) if bits >> j & 1)
+            bound = self._subset_lower_bound(ctx, lsd_subset)
+            if bound is not None:
+                subsets.append((bound, lsd_subset))
+        subsets.sort(key=lambda s: (s[0], len(s[1]), s[1]))
+        logger.info(f"  ЛСД: {len(lsd_ids)}, допустимых подмножеств: {len(subsets)}")
+
+        # Шаг 1: подмножества из одного ЛСД - кандидаты в моно-корзины
+        mono_ranked = {}
+        pool = []
+        for _, lsd_subset in subsets:
+            if len(lsd_subset) != 1:
+                continue
+            self.subsets_explored += 1
+            candidates = self.solve_subset(ctx, lsd_subset, top_n + 1)
+            if candidates is None:
+                candidates = self.branch_and_bound(ctx, top_n + 1, only_lsds=set(lsd_subset))
+            if candidates:
+                mono_ranked[lsd_subset[0]] = self.rank_combinations(candidates, data, delivery_lookups)
+                pool.extend(candidates)
+
+        ranked = self.rank_combinations(pool, data, delivery_lookups)
+        threshold = self._kth_threshold(ranked, top_n)
+
+        def merge(candidates):
+            nonlocal pool, threshold
+            ranked = self.rank_combinations(pool + candidates, data, delivery_lookups)
+            threshold = self._kth_threshold(ranked, top_n)
+            values = ranked[2] + ranked[5] + ranked[4]
+            pool = [int(c) for c in ranked[0][values <= threshold]]
+
+        # Шаг 2: остальные подмножества по возрастанию нижней оценки. Перед точным решением
+        # подмножества быстрый проход лучом находит реальные корзины и уточняет порог
+        for bound, lsd_subset in subsets:
+            if bound > threshold:
+                break
+            if len(lsd_subset) == 1:
+                continue  # Точное решение уже есть с шага 1
+            self.subsets_explored += 1
+
+            for beam in (top_n * SEED_BEAM_PER_BASKET, None):
+                candidates = self.solve_subset(ctx, lsd_subset, top_n, threshold, beam=beam)
+                if candidates is None:
+                    # Корзины из части ЛСД подмножества тоже валидны - пул их просто отсеет
+                    logger.info(f"  Подмножество {lsd_subset}: слишком много состояний, "
+                                f"решаем ветвями и границами")
+                    candidates = self.branch_and_bound(ctx, top_n, only_lsds=set(lsd_subset),
+                                                       threshold=threshold)
+                if not candidates:
+                    continue
+
+                ranked = self.rank_combinations(pool + candidates, data, delivery_lookups)
+                threshold = self._kth_threshold(ranked, top_n)
+                values = ranked[2] + ranked[5] + ranked[4]
+                pool = [int(c) for c in ranked[0][values <= threshold]]
+
+        top_ranked = self.rank_combinations(pool, data, delivery_lookups)
+        top_baskets = self.build_ranked_baskets(top_ranked, mono_ranked, data, top_n)
+
+        elapsed = time.time() - start_time
+        logger.info(f"Подмножеств ЛСД решено: {self.subsets_explored:,} из {len(subsets):,}, "
+                    f"состояний: {self.states_explored:,} "
+                    f"(полный перебор: {data['n_combinations']:,} комбинаций)")
+        logger.info(f"Отбор завершён за {elapsed:.2f} сек")
+
+        return top_baskets
+
+    # =========================================================================
+    # ГЛАВНАЯ ФУНКЦИЯ
+    # =========================================================================
+
+    def optimize_order(self, order_id: int, top_n_final: int = 10, exclusions: dict = None) -> Dict[str, Any]:
+        """
+        Полная оптимизация заказа перебором подмножеств ЛСД.
+
+        Args:
+            order_id: ID заказа
+            top_n_final: Количество финальных корзин для записи
+            exclusions: Словарь с исключениями пользователя (keywords, products)
+
+        Returns:
+            Dict с результатами (включая subsets_explored и states_explored)
+        """
+        total_start = time.time()
+        self.subsets_explored = 0
+        self.states_explored = 0
+
+        logger.info("=" * 80)
+        logger.info(f"ОПТИМИЗАЦИЯ ЗАКАЗА #{order_id} (подмножества ЛСД)")
+        logger.info("=" * 80)
+
+        gc.disable()
+        try:
+            logger.info("\n[1/3] Загрузка данных в NumPy...")
+            data = self.load_fprice_data_to_numpy(order_id, exclusions=exclusions)
+            if data is None:
+                return {"status": "no_data", "elapsed_time": 0}
+
+            logger.info("\n[2/3] Поиск лучших корзин...")
+            top_baskets = self.select_top_baskets_subsets(data, top_n_final)
+
+            logger.info(f"\n[3/3] Запись {len(top_baskets)} корзин в БД...")
+            self.save_to_db(top_baskets, order_id)
+
+        finally:
+            gc.enable()
+            gc.collect()
+
+        total_elapsed = time.time() - total_start
+
+        best = top_baskets[0]
+        logger.info("\n" + "=" * 80)
+        logger.info("ОПТИМИЗАЦИЯ ЗАВЕРШЕНА")
+        logger.info("=" * 80)
+        logger.info(f"Всего комбинаций: {data['n_combinations']:,}")
+        logger.info(f"Подмножеств ЛСД решено: {self.subsets_explored:,}")
+        logger.info(f"Лучшая корзина: #{best['basket_id']}")
+        logger.info(f"  - Потери + доставка: {best['total_loss_and_delivery']:.2f}₽")
+        logger.info(f"  - Итого: {best['total_cost']:.2f}₽")
+        logger.info(f"Время выполнения: {total_elapsed:.2f} сек")
+        logger.info("=" * 80)
+
+        return {
+            "status": "success",
+            "order_id": order_id,
+            "total_combinations": data['n_combinations'],
+            "subsets_explored": self.subsets_explored,
+            "states_explored": self.states_explored,
+            "saved_baskets": len(top_baskets),
+            "best_basket_id": best['basket_id'],
+            "best_total_cost": best['total_cost'],
+            "best_loss_and_delivery": best['total_loss_and_delivery'],
+            "elapsed_time": total_elapsed
+        }
+
+
+def optimize_order_subsets(order_id: int, db_connection_string: str,
+                           top_n_final: int = 10, exclusions: dict = None) -> Dict[str, Any]:
+    """
+    Функция-обёртка для оптимизации перебором подмножеств ЛСД.
+
+    Args:
+        order_id: ID заказа
+        db_connection_string: Строка подключения к PostgreSQL
+        top_n_final: Количество финальных корзин для записи
+        exclusions: Словарь с исключениями пользователя (keywords, products)
+    """
+    with OrderOptimizerLsdSubsets(db_connection_string) as optimizer:
+        return optimizer.optimize_order(order_id, top_n_final, exclusions=exclusions)
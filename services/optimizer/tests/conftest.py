@@ -0,0 +1,33 @@
+"""
+Общие фикстуры тестов оптимизатора: синтетические заказы benchmark.py
+загружаются в NumPy через InMemoryConnection, без БД.
+"""
+
+import os
+import sys
+
+import pytest
+
+OPTIMIZER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if OPTIMIZER_DIR not in sys.path:
+    sys.path.insert(0, OPTIMIZER_DIR)
+
+from benchmark import BENCHMARK_ORDER_ID, InMemoryConnection  # noqa: E402
+from order_optimizer_numpy import OrderOptimizerNumPy  # noqa: E402
+
+
+@pytest.fixture
+def optimizer():
+    return OrderOptimizerNumPy(None)
+
+
+@pytest.fixture
+def load_order(optimizer):
+    """Загрузка строк fprice_optimizer в формат load_fprice_data_to_numpy"""
+
+    def load(rows):
+        optimizer.conn = InMemoryConnection(rows)
+        return optimizer.load_fprice_data_to_numpy(BENCHMARK_ORDER_ID)
+
+    return load
+
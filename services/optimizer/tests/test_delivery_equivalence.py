@@ -0,0 +1,115 @@
+"""
+Безматричный расчёт доставки (_delivery_for_indices) побитово равен эталону
+с масками по ячейкам (_delivery_for_indices_masked, calculate_delivery_vectorized_v2)
+и расчёту без индексной матрицы (calculate_delivery_broadcast) и держит в
+памяти меньше эталона.
+"""
+
+import tracemalloc
+
+import numpy as np
+import pytest
+
+from benchmark import generate_fprice_rows
+
+SEEDS = [0, 1, 2, 3, 4]
+
+
+def _set_lsd_terms(rows, lsd_config_id, **terms):
+    for row in rows:
+        if row['lsd_config_id'] == lsd_config_id:
+            row.update(terms)
+    return rows
+
+
+def _threshold_rows(seed):
+    """
+    Заказ, где суммы ЛСД часто ровно на порогах: стоимости вариантов кратны
+    250₽, у первого ЛСД минимальный заказ 1000₽ и бесплатная доставка от 1500₽,
+    у второго - бесплатная доставка от 500₽ и фиксированный сбор.
+    """
+    rows = generate_fprice_rows(n_items=5, n_variants=4, n_lsds=2, n_ranges=2, seed=seed)
+    costs = [250, 500, 750]
+    for row in rows:
+        row['order_item_ids_cost'] = costs[row['id'] % len(costs)]
+    _set_lsd_terms(rows, 1000, min_order_amount=1000, delivery_fixed_fee=0, delivery_cost_model={
+        'delivery_cost': [{'min': 0, 'max': 1500, 'fee': 199}, {'min': 1500, 'max': None, 'fee': 0}]
+    })
+    _set_lsd_terms(rows, 1001, min_order_amount=0, delivery_fixed_fee=49, delivery_cost_model={
+        'delivery_cost': [{'min': 0, 'max': 500, 'fee': 99}, {'min': 500, 'max': None, 'fee': 0}]
+    })
+    return rows
+
+
+def _assert_bit_identical(optimizer, data):
+    combo_indices = optimizer.generate_combination_indices(data['n_variants'])
+    delivery_lookups = optimizer._prepare_delivery_lookups(data)
+
+    delivery, topup = optimizer._delivery_for_indices(combo_indices, data, delivery_lookups)
+    masked_delivery, masked_topup = optimizer._delivery_for_indices_masked(combo_indices, data, delivery_lookups)
+    v2_delivery, v2_topup = optimizer.calculate_delivery_vectorized_v2(combo_indices, data)
+    broadcast_delivery, broadcast_topup = optimizer.calculate_delivery_broadcast(data)
+
+    for expected_delivery, expected_topup in ((masked_delivery, masked_topup), (v2_delivery, v2_topup),
+                                              (broadcast_delivery, broadcast_topup)):
+        assert delivery.dtype == expected_delivery.dtype
+        assert topup.dtype == expected_topup.dtype
+        assert delivery.tobytes() == expected_delivery.tobytes()
+        assert topup.tobytes() == expected_topup.tobytes()
+
+    return delivery, topup
+
+
+@pytest.mark.parametrize("kopecks", [False, True])
+@pytest.mark.parametrize("seed", SEEDS)
+@pytest.mark.parametrize("n_items,n_variants,n_lsds,n_ranges",
+                         [(4, 3, 3, 1), (5, 4, 3, 4), (6, 3, 5, 3), (10, 2, 4, 2), (17, 2, 3, 2)])
+def test_generated_orders(optimizer, load_order, seed, kopecks, n_items, n_variants, n_lsds, n_ranges):
+    data = load_order(generate_fprice_rows(n_items, n_variants, n_lsds, n_ranges, seed=seed))
+    if kopecks:
+        data = optimizer.to_kopecks(data)
+
+    _assert_bit_identical(optimizer, data)
+
+
+@pytest.mark.parametrize("kopecks", [False, True])
+@pytest.mark.parametrize("seed", SEEDS)
+def test_free_delivery_and_min_order_thresholds(optimizer, load_order, seed, kopecks):
+    data = load_order(_threshold_rows(seed))
+    if kopecks:
+        data = optimizer.to_kopecks(data)
+
+    _, topup = _assert_bit_identical(optimizer, data)
+
+    # Случай действительно проверяет пороги: суммы первого ЛСД бывают ниже
+    # минимального заказа (топап) и ровно на границе бесплатной доставки
+    combo_indices = optimizer.generate_combination_indices(data['n_variants'])
+    global_indices = optimizer._global_indices(combo_indices, data)
+    unit = 100 if kopecks else 1
+    lsd_spend = (data['costs'][global_indices] * (data['lsd_config_ids'][global_indices] == 1000)).sum(axis=1)
+    assert ((lsd_spend > 0) & (lsd_spend < 1000 * unit)).any()
+    assert (lsd_spend == 1500 * unit).any()
+    assert (topup > 0).any()
+
+
+def test_peak_memory_below_masked(optimizer, load_order):
+    # 10 товаров - слагаемые по 8 накопителям pairwise_sum
+    data = load_order(generate_fprice_rows(n_items=10, n_variants=3, n_lsds=6, n_ranges=3, seed=0))
+    combo_indices = optimizer.generate_combination_indices(data['n_variants'])
+    delivery_lookups = optimizer._prepare_delivery_lookups(data)
+
+    peaks = {}
+    for name in ('_delivery_for_indices', '_delivery_for_indices_masked'):
+        tracemalloc.start()
+        try:
+            getattr(optimizer, name)(combo_indices, data, delivery_lookups)
+            peaks[name] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    # Кроме глобальных индексов - несколько массивов сумм ЛСД (n_lsd, n_combinations),
+    # а не по одному на каждый из 10 товаров
+    global_indices_bytes = optimizer._global_indices(combo_indices, data).nbytes
+    lsd_spend_bytes = 6 * len(combo_indices) * data['costs'].itemsize
+    assert peaks['_delivery_for_indices'] < peaks['_delivery_for_indices_masked']
+    assert peaks['_delivery_for_indices'] < global_indices_bytes + 5 * lsd_spend_bytes
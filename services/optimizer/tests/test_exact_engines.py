@@ -0,0 +1,113 @@
+"""
+Точные движки (ветви и границы, подмножества ЛСД) на синтетических заказах
+benchmark.py: на малых заказах - те же корзины, что полный перебор
+OrderOptimizerNumPy, на заказах больше 2^63 комбинаций - тот же оптимум без
+переполнения номеров комбинаций. При превышении бюджета узлов ветви и границы
+переходят на локальный поиск.
+"""
+
+import math
+
+import numpy as np
+import pytest
+
+from benchmark import BENCHMARK_ORDER_ID, InMemoryConnection, generate_fprice_rows
+import order_optimizer_bnb
+from order_optimizer_bnb import BIGINT_MAX, OrderOptimizerBnB
+from order_optimizer_heuristic import OrderOptimizerHeuristic
+from order_optimizer_subsets import OrderOptimizerLsdSubsets
+
+TOP_N = 5
+SMALL_CASES = [(4, 3, 3, 1), (5, 4, 3, 4), (6, 3, 5, 3), (7, 3, 4, 2)]
+
+
+def _load(optimizer, rows):
+    optimizer.conn = InMemoryConnection(rows)
+    return optimizer.load_fprice_data_to_numpy(BENCHMARK_ORDER_ID)
+
+
+def _basket_keys(baskets):
+    return [(basket['basket_id'], basket['rank'], round(basket['total_loss_and_delivery'], 2),
+             round(basket['total_cost'], 2)) for basket in baskets]
+
+
+def _exact_search(engine, data):
+    if isinstance(engine, OrderOptimizerLsdSubsets):
+        return engine.select_top_baskets_subsets(data, TOP_N)
+    return engine.select_top_baskets_bnb(data, TOP_N)
+
+
+@pytest.mark.parametrize("engine_class", [OrderOptimizerBnB, OrderOptimizerLsdSubsets])
+@pytest.mark.parametrize("seed", [0, 1, 2])
+@pytest.mark.parametrize("n_items,n_variants,n_lsds,n_ranges", SMALL_CASES)
+def test_small_orders_match_exhaustive(optimizer, engine_class, seed, n_items, n_variants, n_lsds, n_ranges):
+    rows = generate_fprice_rows(n_items, n_variants, n_lsds, n_ranges, seed=seed)
+    data = _load(optimizer, rows)
+    total_losses, total_costs = optimizer.calculate_basic_metrics_broadcast(data)
+    total_delivery, total_topup = optimizer.calculate_delivery_broadcast(data)
+    expected = optimizer.select_top_baskets(None, total_losses, total_costs, total_delivery, total_topup, data, TOP_N)
+
+    engine = engine_class(None)
+    baskets = _exact_search(engine, _load(engine, rows))
+
+    assert _basket_keys(baskets) == _basket_keys(expected)
+
+
+@pytest.mark.parametrize("n_items,n_variants", [(40, 4), (30, 5)])
+def test_orders_over_int64_combinations(n_items, n_variants):
+    rows = generate_fprice_rows(n_items, n_variants, n_lsds=6, n_ranges=3, seed=0)
+    assert n_variants ** n_items > 2 ** 63
+
+    results = {}
+    for engine_class in (OrderOptimizerBnB, OrderOptimizerLsdSubsets):
+        engine = engine_class(None)
+        data = _load(engine, rows)
+        baskets = _exact_search(engine, data)
+
+        if engine_class is OrderOptimizerBnB:
+            assert engine.exact
+        basket_ids = [basket['basket_id'] for basket in baskets]
+        assert all(0 < basket_id <= BIGINT_MAX for basket_id in basket_ids)
+        assert len(set(basket_ids)) == len(basket_ids)
+        results[engine_class] = baskets
+
+    # Оба движка точные: один и тот же оптимум
+    bnb_best = results[OrderOptimizerBnB][0]['total_loss_and_delivery']
+    assert results[OrderOptimizerLsdSubsets][0]['total_loss_and_delivery'] == pytest.approx(bnb_best, abs=0.01)
+
+    # Локальный поиск не находит корзину лучше точного оптимума
+    heuristic = OrderOptimizerHeuristic(None, time_budget_sec=1)
+    heuristic_baskets = heuristic.select_top_baskets_heuristic(_load(heuristic, rows), TOP_N)
+    assert heuristic_baskets[0]['total_loss_and_delivery'] >= bnb_best - 0.01
+    assert all(0 < basket['basket_id'] <= BIGINT_MAX for basket in heuristic_baskets)
+
+
+def test_bnb_falls_back_to_local_search_over_node_budget(optimizer, monkeypatch):
+    rows = generate_fprice_rows(7, 3, 4, 2, seed=0)
+    data = _load(optimizer, rows)
+    total_losses, total_costs = optimizer.calculate_basic_metrics_broadcast(data)
+    total_delivery, total_topup = optimizer.calculate_delivery_broadcast(data)
+    expected = optimizer.select_top_baskets(None, total_losses, total_costs, total_delivery, total_topup, data, TOP_N)
+
+    monkeypatch.setattr(order_optimizer_bnb, 'BNB_MAX_NODES', 10)
+    engine = OrderOptimizerBnB(None)
+    baskets = engine.select_top_baskets_bnb(_load(engine, rows), TOP_N)
+
+    assert not engine.exact
+    # Маленький заказ локальный поиск считает полным перебором - корзины те же
+    assert _basket_keys(baskets) == _basket_keys(expected)
+
+
+def test_combination_ids_round_trip_over_int64(optimizer):
+    n_variants = [5] * 30
+    strides = optimizer._combination_strides(n_variants)
+    assert strides.dtype == object
+    assert int(strides[0]) * n_variants[0] == math.prod(n_variants)
+
+    rng = np.random.default_rng(0)
+    combos = rng.integers(0, 5, size=(20, len(n_variants)))
+    combo_ids = [sum(int(i) * int(s) for i, s in zip(combo, strides)) for combo in combos]
+    assert max(combo_ids) > 2 ** 63
+
+    decoded = optimizer.decode_combination_ids(np.array(combo_ids, dtype=object), n_variants)
+    assert np.array_equal(decoded.astype(np.int64), combos)
@@ -0,0 +1,108 @@
+"""
+Метрики в целых копейках (to_kopecks) против float32 рублей на синтетических
+заказах benchmark.py: итоги корзин расходятся не больше чем на копейку, лучшая
+корзина без ничьих одна и та же, а суммы по ЛСД в копейках точные.
+"""
+
+import itertools
+from decimal import Decimal
+
+import numpy as np
+import pytest
+
+from benchmark import generate_fprice_rows
+
+SEEDS = [0, 1, 2, 3, 4, 5]
+CASES = [(4, 3, 3, 1), (5, 4, 3, 4), (6, 3, 5, 3)]
+
+
+def _kopecks(value) -> int:
+    return int((Decimal(str(value or 0)) * 100).to_integral_value())
+
+
+def _metrics(optimizer, data):
+    total_losses, total_costs = optimizer.calculate_basic_metrics_broadcast(data)
+    total_delivery, total_topup = optimizer.calculate_delivery_broadcast(data)
+    return total_losses, total_costs, total_delivery, total_topup
+
+
+def _sort_keys(total_losses, total_costs, total_delivery, total_topup):
+    """Ключи ранжирования select_top_baskets: (loss + topup + delivery, goods + topup + delivery)"""
+    return total_losses + total_topup + total_delivery, total_costs + total_topup + total_delivery
+
+
+def _reference_totals(combination):
+    """Итоги корзины целыми копейками по строкам fprice_optimizer (выбранный вариант каждого товара)"""
+    lsd_spend = {}
+    lsd_rows = {}
+    for row in combination:
+        lsd_spend[row['lsd_config_id']] = lsd_spend.get(row['lsd_config_id'], 0) + _kopecks(row['order_item_ids_cost'])
+        lsd_rows[row['lsd_config_id']] = row
+
+    delivery = topup = 0
+    for lsd_id, spend in lsd_spend.items():
+        row = lsd_rows[lsd_id]
+        min_order = _kopecks(row['min_order_amount'])
+        lsd_topup = min_order - spend if 0 < spend < min_order else 0
+        spend += lsd_topup
+        ranges = sorted(row['delivery_cost_model']['delivery_cost'], key=lambda r: r['min'])
+        fee = next(_kopecks(r['fee']) for r in ranges
+                   if _kopecks(r['min']) <= spend and (r['max'] is None or spend < _kopecks(r['max'])))
+        delivery += fee + _kopecks(row['delivery_fixed_fee'])
+        topup += lsd_topup
+
+    return (sum(_kopecks(row['loss']) for row in combination),
+            sum(_kopecks(row['order_item_ids_cost']) for row in combination),
+            delivery, topup)
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+@pytest.mark.parametrize("n_items,n_variants,n_lsds,n_ranges", CASES)
+def test_totals_within_one_kopeck(optimizer, load_order, seed, n_items, n_variants, n_lsds, n_ranges):
+    data = load_order(generate_fprice_rows(n_items, n_variants, n_lsds, n_ranges, seed=seed))
+    kopeck_data = optimizer.to_kopecks(data)
+    assert kopeck_data['metric_units'] == 'kop'
+
+    float_keys = _sort_keys(*_metrics(optimizer, data))
+    kopeck_keys = _sort_keys(*_metrics(optimizer, kopeck_data))
+
+    for float_total, kopeck_total in zip(float_keys, kopeck_keys):
+        assert kopeck_total.dtype == np.int32
+        diff = np.abs(float_total.astype(np.float64) * 100 - kopeck_total.astype(np.float64))
+        assert diff.max() <= 1.0
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+@pytest.mark.parametrize("n_items,n_variants,n_lsds,n_ranges", CASES)
+def test_same_best_basket_without_ties(optimizer, load_order, seed, n_items, n_variants, n_lsds, n_ranges):
+    data = load_order(generate_fprice_rows(n_items, n_variants, n_lsds, n_ranges, seed=seed))
+    kopeck_data = optimizer.to_kopecks(data)
+
+    float_baskets = optimizer.select_top_baskets(None, *_metrics(optimizer, data), data, top_n=2)
+    kopeck_metrics = _metrics(optimizer, kopeck_data)
+    kopeck_baskets = optimizer.select_top_baskets(None, *kopeck_metrics, kopeck_data, top_n=2)
+
+    key, cost = _sort_keys(*kopeck_metrics)
+    first, second = (kopeck_baskets[0]['basket_id'] - 1, kopeck_baskets[1]['basket_id'] - 1)
+    if (key[first], cost[first]) == (key[second], cost[second]):
+        pytest.skip("ничья: порядок лучших корзин определяется номером комбинации")
+
+    assert float_baskets[0]['basket_id'] == kopeck_baskets[0]['basket_id']
+    assert float_baskets[0]['total_loss_and_delivery'] == pytest.approx(
+        kopeck_baskets[0]['total_loss_and_delivery'], abs=0.01)
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+@pytest.mark.parametrize("n_items,n_variants,n_lsds,n_ranges", CASES)
+def test_kopeck_components_are_exact(optimizer, load_order, seed, n_items, n_variants, n_lsds, n_ranges):
+    rows = generate_fprice_rows(n_items, n_variants, n_lsds, n_ranges, seed=seed)
+    kopeck_data = optimizer.to_kopecks(load_order(rows))
+    total_losses, total_costs, total_delivery, total_topup = _metrics(optimizer, kopeck_data)
+
+    rows_by_item = [sorted((row for row in rows if row['order_item_id'] == item_id), key=lambda row: row['id'])
+                    for item_id in sorted({row['order_item_id'] for row in rows})]
+    # Номер комбинации - смешанная система счисления, первый товар старший разряд
+    for combo_number, combination in enumerate(itertools.product(*rows_by_item)):
+        assert (int(total_losses[combo_number]), int(total_costs[combo_number]),
+                int(total_delivery[combo_number]), int(total_topup[combo_number])) == \
+            _reference_totals(combination)
@@ -0,0 +1,443 @@
+"""
+Колоночная загрузка fprice_optimizer в NumPy.
+
+Раньше NumPy движки читали все 20 колонок fprice_optimizer через fetchall,
+строили dict на каждую строку и уже из списков словарей собирали массивы.
+Для перебора нужны только числовые колонки, поэтому здесь:
+
+- id, order_item_id, lsd_config_id, loss, order_item_ids_cost,
+  min_order_amount, delivery_fixed_fee читаются одним COPY ... TO STDOUT
+  (CSV) и разбираются np.loadtxt сразу в типизированные массивы
+- модель доставки и имя ЛСД - один запрос DISTINCT ON (lsd_config_id)
+- product_name читается, только если у пользователя есть исключения
+- полные строки (названия, единицы, цены) загружаются лениво одним запросом
+  и только для вариантов из собранных корзин - при записи в БД
+- пакет заказов (load_fprice_columns_batch) читается теми же запросами
+  с order_id = ANY(...) - по одному запросу на пакет, а не на заказ
+
+Исключения работают на массивах и дают тот же набор вариантов, что и
+построчная загрузка.
+
+Запросы одного заказа идут отдельными SELECT, а rpa-service переписывает
+fprice_snapshot, пока идёт поиск (предварительные оптимизации читают его
+в это время). В READ COMMITTED каждый запрос видит свой снимок: названия
+могли не совпасть с колонками, а пересохранённые строки - получить новые
+id к моменту ленивой загрузки метаданных. Поэтому соединение движка
+работает в REPEATABLE READ (use_consistent_snapshot): загрузка, метаданные
+и запись корзин - одна транзакция с одним снимком.
+"""
+
+import io
+import logging
+import math
+import time
+from collections.abc import Mapping, Sequence
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from utils.exclusion_matcher import exclusion_keep_mask
+from utils.fprice_snapshot import FPRICE_SOURCE
+
+logger = logging.getLogger(__name__)
+
+# Порядок строк во всех запросах одинаковый: позиции массивов совпадают
+COLUMNS_QUERY = f"""
+    SELECT
+        id, order_item_id, lsd_config_id,
+        COALESCE(loss, 0), COALESCE(order_item_ids_cost, 0),
+        COALESCE(min_order_amount, 0), COALESCE(delivery_fixed_fee, 0)
+    FROM {FPRICE_SOURCE}
+    WHERE order_id = %s
+    ORDER BY order_item_id, id
+"""
+
+COLUMNS_DTYPE = np.dtype([
+    ('id', np.int64),
+    ('order_item_id', np.int64),
+    ('lsd_config_id', np.int64),
+    ('loss', np.float64),
+    ('order_item_ids_cost', np.float64),
+    ('min_order_amount', np.float64),
+    ('delivery_fixed_fee', np.float64)
+])
+
+PRODUCT_NAMES_QUERY = f"""
+    SELECT product_name
+    FROM {FPRICE_SOURCE}
+    WHERE order_id = %s
+    ORDER BY order_item_id, id
+"""
+
+# Модель доставки ЛСД - из его первой строки (как у построчной загрузки)
+LSD_QUERY = f"""
+    SELECT DISTINCT ON (lsd_config_id) lsd_config_id, lsd_name, delivery_cost_model
+    FROM {FPRICE_SOURCE}
+    WHERE order_id = %s
+    ORDER BY lsd_config_id, order_item_id, id
+"""
+
+VARIANT_ROWS_QUERY = f"""
+    SELECT
+        id, order_id, lsd_config_id, lsd_name, order_item_id, product_name,
+        price, fprice, base_unit, base_quantity, requested_unit, requested_quantity,
+        order_item_ids_quantity, order_item_ids_cost, fprice_min, fprice_diff,
+        loss, min_order_amount, delivery_cost_model, delivery_fixed_fee
+    FROM {FPRICE_SOURCE}
+    WHERE order_id = %s AND id = ANY(%s)
+"""
+
+
+# Пакетная загрузка: те же запросы для нескольких заказов, порядок - order_id, затем как выше
+BATCH_COLUMNS_QUERY = f"""
+    SELECT
+        order_id, id, order_item_id, lsd_config_id,
+        COALESCE(loss, 0), COALESCE(order_item_ids_cost, 0),
+        COALESCE(min_order_amount, 0), COALESCE(delivery_fixed_fee, 0)
+    FROM {FPRICE_SOURCE}
+    WHERE order_id = ANY(%s)
+    ORDER BY order_id, order_item_id, id
+"""
+
+BATCH_COLUMNS_DTYPE = np.dtype([('order_id', np.int64)] + COLUMNS_DTYPE.descr)
+
+BATCH_PRODUCT_NAMES_QUERY = f"""
+    SELECT order_id, product_name
+    FROM {FPRICE_SOURCE}
+    WHERE order_id = ANY(%s)
+    ORDER BY order_id, order_item_id, id
+"""
+
+BATCH_LSD_QUERY = f"""
+    SELECT DISTINCT ON (order_id, lsd_config_id) order_id, lsd_config_id, lsd_name, delivery_cost_model
+    FROM {FPRICE_SOURCE}
+    WHERE order_id = ANY(%s)
+    ORDER BY order_id, lsd_config_id, order_item_id, id
+"""
+
+
+def use_consistent_snapshot(conn):
+    """
+    Все запросы транзакции соединения видят один снимок БД (REPEATABLE READ).
+    Вызывается сразу после connect - до первой транзакции.
+    """
+    conn.set_session(isolation_level='REPEATABLE READ')
+
+
+def fetch_columns(conn, order_id: int) -> np.ndarray:
+    """
+    Числовые колонки заказа одним COPY TO STDOUT.
+
+    Returns:
+        Структурированный массив COLUMNS_DTYPE (порядок order_item_id, id)
+    """
+    buffer = io.StringIO()
+    with conn.cursor() as cur:
+        select = cur.mogrify(COLUMNS_QUERY, (order_id,))
+        if isinstance(select, bytes):
+            select = select.decode()
+        cur.copy_expert(f"COPY ({select}) TO STDOUT WITH (FORMAT csv)", buffer)
+
+    if buffer.tell() == 0:
+        return np.empty(0, dtype=COLUMNS_DTYPE)
+    buffer.seek(0)
+    return np.loadtxt(buffer, delimiter=',', dtype=COLUMNS_DTYPE, ndmin=1)
+
+
+def fetch_lsd_info(conn, order_id: int) -> Dict[int, Dict[str, Any]]:
+    """Имя и модель доставки каждого ЛСД заказа: {lsd_config_id: {lsd_name, delivery_cost_model}}."""
+    with conn.cursor() as cur:
+        cur.execute(LSD_QUERY, (order_id,))
+        return {
+            int(lsd_id): {'lsd_name': lsd_name, 'delivery_cost_model': delivery_model}
+            for lsd_id, lsd_name, delivery_model in cur.fetchall()
+        }
+
+
+def fetch_product_names(conn, order_id: int) -> List[str]:
+    with conn.cursor() as cur:
+        cur.execute(PRODUCT_NAMES_QUERY, (order_id,))
+        return [name for (name,) in cur.fetchall()]
+
+
+def _item_offsets(order_item_ids: np.ndarray) -> List[int]:
+    """Границы товаров в массиве, упорядоченном по order_item_id."""
+    if len(order_item_ids) == 0:
+        return [0]
+    starts = np.flatnonzero(np.diff(order_item_ids)) + 1
+    return [0] + starts.tolist() + [len(order_item_ids)]
+
+
+class VariantRow(Mapping):
+    """
+    Строка fprice_optimizer варианта.
+
+    id, order_item_id, lsd_config_id и lsd_name берутся из массивов;
+    обращение к любой другой колонке загружает полные строки всех
+    вариантов, выданных LazyVariantMetadata к этому моменту.
+    """
+
+    __slots__ = ('_metadata', '_index')
+
+    def __init__(self, metadata: 'LazyVariantMetadata', index: int):
+        self._metadata = metadata
+        self._index = index
+
+    def __getitem__(self, key: str) -> Any:
+        value = self._metadata._array_value(self._index, key)
+        if value is not None:
+            return value
+        return self._metadata._row(self._index)[key]
+
+    def __iter__(self):
+        return iter(self._metadata._row(self._index))
+
+    def __len__(self) -> int:
+        return len(self._metadata._row(self._index))
+
+
+class LazyVariantMetadata(Sequence):
+    """
+    variant_metadata колоночной загрузки: индекс варианта -> VariantRow.
+
+    Полные строки запрашиваются одним SELECT ... id = ANY(...) на все
+    варианты, к которым было обращение (варианты собранных корзин).
+    """
+
+    def __init__(self, conn, order_id: int, ids: np.ndarray, order_item_ids: np.ndarray,
+                 lsd_config_ids: np.ndarray, lsd_info: Dict[int, Dict[str, Any]]):
+        self.conn = conn
+        self.order_id = order_id
+        self._ids = ids
+        self._order_item_ids = order_item_ids
+        self._lsd_config_ids = lsd_config_ids
+        self._lsd_info = lsd_info
+        self._requested = set()
+        self._rows: Dict[int, Dict[str, Any]] = {}
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __getitem__(self, index: int) -> VariantRow:
+        index = int(index)
+        if index < 0:
+            index += len(self._ids)
+        if not 0 <= index < len(self._ids):
+            raise IndexError(index)
+        self._requested.add(index)
+        return VariantRow(self, index)
+
+    def _array_value(self, index: int, key: str) -> Any:
+        if key == 'id':
+            return int(self._ids[index])
+        if key == 'order_item_id':
+            return int(self._order_item_ids[index])
+        if key == 'lsd_config_id':
+            return int(self._lsd_config_ids[index])
+        if key == 'lsd_name':
+            return self._lsd_info[int(self._lsd_config_ids[index])]['lsd_name']
+        return None
+
+    def _row(self, index: int) -> Dict[str, Any]:
+        if index not in self._rows:
+            self._load()
+        return self._rows[index]
+
+    def _load(self):
+        pending = sorted(self._requested.difference(self._rows))
+        start_time = time.time()
+        id_to_index = {int(self._ids[index]): index for index in pending}
+
+        with self.conn.cursor() as cur:
+            cur.execute(VARIANT_ROWS_QUERY, (self.order_id, list(id_to_index)))
+            columns = [desc[0] for desc in cur.description]
+            for row in cur.fetchall():
+                row_dict = dict(zip(columns, row))
+                self._rows[id_to_index[row_dict['id']]] = row_dict
+
+        missing = [int(self._ids[index]) for index in pending if index not in self._rows]
+        if missing:
+            raise KeyError(f"Строки fprice_optimizer {missing[:5]} заказа {self.order_id} не найдены")
+        logger.info(f"Метаданные {len(pending)} вариантов корзин загружены за {time.time() - start_time:.3f} сек")
+
+
+def load_fprice_columns(conn, order_id: int, exclusions: dict = None) -> Optional[Dict[str, Any]]:
+    """
+    Загружает заказ в формат OrderOptimizerNumPy.load_fprice_data_to_numpy.
+
+    Args:
+        conn: psycopg2-соединение
+        order_id: ID заказа
+        exclusions: Исключения пользователя (keywords, products)
+
+    Returns:
+        Dict с NumPy массивами (variant_metadata - LazyVariantMetadata,
+        lsd_delivery_models - модель доставки по ЛСД) или None, если строк нет
+    """
+    start_time = time.time()
+
+    columns = fetch_columns(conn, order_id)
+    if len(columns) == 0:
+        logger.warning(f"Нет данных в fprice_optimizer для заказа {order_id}")
+        return None
+
+    lsd_info = fetch_lsd_info(conn, order_id)
+    logger.info(f"COPY fprice_optimizer: {len(columns)} строк, {len(lsd_info)} ЛСД "
+                f"за {time.time() - start_time:.3f} сек")
+
+    product_names = fetch_product_names(conn, order_id) if exclusions else None
+    return build_order_data(conn, order_id, columns, lsd_info, product_names,
+                            exclusions=exclusions, start_time=start_time)
+
+
+def build_order_data(conn, order_id: int, columns: np.ndarray, lsd_info: Dict[int, Dict[str, Any]],
+                     product_names: Optional[List[str]], exclusions: dict = None,
+                     start_time: float = None) -> Dict[str, Any]:
+    """
+    Исключения и словарь данных заказа из уже прочитанных колонок
+    (общая часть одиночной и пакетной загрузки).
+
+    Args:
+        columns: Строки заказа (COLUMNS_DTYPE, порядок order_item_id, id)
+        lsd_info: ЛСД заказа (fetch_lsd_info)
+        product_names: Названия вариантов в порядке columns (нужны только при исключениях)
+    """
+    start_time = start_time or time.time()
+
+    keep_mask = np.ones(len(columns), dtype=bool)
+    if exclusions:
+        order_item_ids = columns['order_item_id']
+        item_offsets = _item_offsets(order_item_ids)
+        keep_mask &= exclusion_keep_mask(product_names, item_offsets, exclusions,
+                                         order_item_ids=order_item_ids[item_offsets[:-1]].tolist())
+
+    columns = columns[keep_mask]
+    item_offsets = _item_offsets(columns['order_item_id'])
+    sorted_items = [int(columns['order_item_id'][start]) for start in item_offsets[:-1]]
+    n_variants = [end - start for start, end in zip(item_offsets[:-1], item_offsets[1:])]
+    # Целое Python: при десятках товаров произведение не помещается в int64
+    n_combinations = math.prod(int(n) for n in n_variants)
+
+    logger.info(f"Товаров: {len(sorted_items)}, варианты: {n_variants}")
+
+    lsd_config_ids = columns['lsd_config_id'].astype(np.int32)
+    losses = columns['loss'].astype(np.float32)
+    costs = columns['order_item_ids_cost'].astype(np.float32)
+
+    logger.info(f"Данные загружены за {time.time() - start_time:.2f} сек")
+    logger.info(f"  Всего вариантов: {len(columns)}")
+    logger.info(f"  Ожидается комбинаций: {n_combinations:,}")
+
+    return {
+        'order_id': order_id,
+        'n_items': len(sorted_items),
+        'n_variants': n_variants,
+        'n_combinations': n_combinations,
+        'sorted_items': sorted_items,
+        'losses': losses,
+        'costs': costs,
+        'lsd_config_ids': lsd_config_ids,
+        'fprice_ids': columns['id'].astype(np.int32),
+        'min_order_amounts': columns['min_order_amount'].astype(np.float32),
+        'delivery_fixed_fees': columns['delivery_fixed_fee'].astype(np.float32),
+        'item_offsets': item_offsets,
+        'lsd_delivery_models': {
+            lsd_id: info['delivery_cost_model'] or {} for lsd_id, info in lsd_info.items()
+        },
+        'variant_metadata': LazyVariantMetadata(
+            conn, order_id, columns['id'].copy(), columns['order_item_id'].copy(),
+            columns['lsd_config_id'].copy(), lsd_info
+        )
+    }
+
+
+def fetch_columns_batch(conn, order_ids: Sequence[int]) -> Dict[int, np.ndarray]:
+    """
+    Числовые колонки нескольких заказов одним COPY TO STDOUT.
+
+    Returns:
+        {order_id: массив COLUMNS_DTYPE}; заказов без строк в словаре нет
+    """
+    buffer = io.StringIO()
+    with conn.cursor() as cur:
+        select = cur.mogrify(BATCH_COLUMNS_QUERY, (list(order_ids),))
+        if isinstance(select, bytes):
+            select = select.decode()
+        cur.copy_expert(f"COPY ({select}) TO STDOUT WITH (FORMAT csv)", buffer)
+
+    if buffer.tell() == 0:
+        return {}
+    buffer.seek(0)
+    rows = np.loadtxt(buffer, delimiter=',', dtype=BATCH_COLUMNS_DTYPE, ndmin=1)
+
+    per_order = {}
+    bounds = _item_offsets(rows['order_id'])
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        columns = np.empty(end - start, dtype=COLUMNS_DTYPE)
+        for name in COLUMNS_DTYPE.names:
+            columns[name] = rows[name][start:end]
+        per_order[int(rows['order_id'][start])] = columns
+    return per_order
+
+
+def fetch_lsd_info_batch(conn, order_ids: Sequence[int]) -> Dict[int, Dict[int, Dict[str, Any]]]:
+    """fetch_lsd_info нескольких заказов одним запросом: {order_id: {lsd_config_id: ...}}."""
+    per_order: Dict[int, Dict[int, Dict[str, Any]]] = {}
+    with conn.cursor() as cur:
+        cur.execute(BATCH_LSD_QUERY, (list(order_ids),))
+        for order_id, lsd_id, lsd_name, delivery_model in cur.fetchall():
+            per_order.setdefault(int(order_id), {})[int(lsd_id)] = {
+                'lsd_name': lsd_name, 'delivery_cost_model': delivery_model
+            }
+    return per_order
+
+
+def fetch_product_names_batch(conn, order_ids: Sequence[int]) -> Dict[int, List[str]]:
+    """Названия вариантов нескольких заказов одним запросом: {order_id: [product_name]}."""
+    per_order: Dict[int, List[str]] = {}
+    if not order_ids:
+        return per_order
+    with conn.cursor() as cur:
+        cur.execute(BATCH_PRODUCT_NAMES_QUERY, (list(order_ids),))
+        for order_id, name in cur.fetchall():
+            per_order.setdefault(int(order_id), []).append(name)
+    return per_order
+
+
+def load_fprice_columns_batch(conn, order_ids: Sequence[int],
+                              exclusions_by_order: Optional[Dict[int, dict]] = None) -> Dict[int, Optional[Dict[str, Any]]]:
+    """
+    load_fprice_columns для нескольких заказов: колонки всех заказов - одним
+    COPY, ЛСД - одним запросом, названия - одним запросом для заказов с исключениями.
+
+    Args:
+        order_ids: ID заказов
+        exclusions_by_order: Исключения пользователя по заказам
+
+    Returns:
+        {order_id: словарь данных или None, если строк нет}
+    """
+    start_time = time.time()
+    exclusions_by_order = exclusions_by_order or {}
+
+    columns_by_order = fetch_columns_batch(conn, order_ids)
+    lsd_info_by_order = fetch_lsd_info_batch(conn, list(columns_by_order))
+    names_by_order = fetch_product_names_batch(
+        conn, [order_id for order_id in columns_by_order if exclusions_by_order.get(order_id)]
+    )
+    logger.info(f"COPY fprice_optimizer: {len(order_ids)} заказов, "
+                f"{sum(len(columns) for columns in columns_by_order.values())} строк "
+                f"за {time.time() - start_time:.3f} сек")
+
+    loaded = {}
+    for order_id in order_ids:
+        columns = columns_by_order.get(order_id)
+        if columns is None:
+            logger.warning(f"Нет данных в fprice_optimizer для заказа {order_id}")
+            loaded[order_id] = None
+            continue
+        loaded[order_id] = build_order_data(
+            conn, order_id, columns, lsd_info_by_order.get(order_id, {}), names_by_order.get(order_id),
+            exclusions=exclusions_by_order.get(order_id)
+        )
+    return loaded
@@ -0,0 +1,201 @@
+"""
+Выбор движка оптимизации по бюджету памяти и времени.
+
+engine="auto" раньше означал "numpy, если импортируется", и NumPy движок
+выделял столько памяти, сколько требует prod(n_variants). Здесь до запуска
+движка по дешёвому COUNT(*) GROUP BY order_item_id оценивается число
+комбинаций, память и время каждого этапа, и выбирается стратегия:
+
+- exhaustive (numpy)         - все массивы метрик в памяти, если влезают в оба бюджета
+- chunked (chunked/parallel) - потоковый обход блоками, память ограничена блоком
+- pruned (bnb)               - точный поиск с отсечениями, время не пропорционально числу комбинаций
+- heuristic (heuristic)      - если и отсечения не гарантируют бюджет: локальный
+                               поиск в пределах бюджета времени, без гарантии оптимума.
+                               Сюда же - заказы от 2^63 комбинаций: их номера не
+                               помещаются в BIGINT basket_id
+
+Оценки - верхние: считаются по строкам до исключений пользователя.
+Коэффициенты замерены benchmark.py.
+
+Бюджеты: OPTIMIZER_MEMORY_BUDGET_MB (по умолчанию 1024) и
+OPTIMIZER_TIME_BUDGET_SEC (по умолчанию 60), либо параметры вызова.
+"""
+
+import logging
+import math
+import os
+from typing import Any, Dict, List, Optional
+
+from utils.fprice_snapshot import FPRICE_SOURCE
+
+logger = logging.getLogger(__name__)
+
+ITEM_VARIANT_COUNTS_QUERY = f"""
+    SELECT order_item_id, COUNT(*) AS n_variants
+    FROM {FPRICE_SOURCE}
+    WHERE order_id = %s
+    GROUP BY order_item_id
+    ORDER BY order_item_id
+"""
+
+LSD_COUNT_QUERY = f"""
+    SELECT COUNT(DISTINCT lsd_config_id)
+    FROM {FPRICE_SOURCE}
+    WHERE order_id = %s
+"""
+
+DEFAULT_MEMORY_BUDGET_MB = float(os.getenv('OPTIMIZER_MEMORY_BUDGET_MB', '1024'))
+DEFAULT_TIME_BUDGET_SEC = float(os.getenv('OPTIMIZER_TIME_BUDGET_SEC', '60'))
+
+# Процесс с импортированными numpy/psycopg2 и загруженным заказом
+BASE_PROCESS_MB = 64
+
+# numpy: живые массивы на комбинацию к концу этапа (метрики float32, ключи, lexsort int64)
+NUMPY_STAGE_BYTES = {'metrics': 8, 'delivery': 24, 'select': 32}
+# chunked: временные массивы блока на комбинацию - индексы товаров и суммы по ЛСД
+CHUNKED_BYTES_PER_ITEM = 24
+CHUNKED_BYTES_PER_LSD = 56
+CHUNKED_BYTES_BASE = 32
+# Пропускная способность одного ядра (консервативно, ниже замеров benchmark.py)
+NUMPY_COMBINATIONS_PER_SEC = 2_000_000
+CHUNKED_COMBINATIONS_PER_SEC = 600_000
+# Наименьший блок, при котором потоковый режим ещё не тонет в накладных расходах Python
+MIN_BLOCK_SIZE = 10_000
+
+# Больше стольких товаров время поиска с отсечениями не предсказуемо
+PRUNED_MAX_ITEMS = 40
+# От стольких комбинаций номера не помещаются в BIGINT basket_id - только heuristic
+PRUNED_MAX_COMBINATIONS = 2 ** 63
+
+# Движок каждой стратегии; стратегии без движка откатываются на предыдущую
+STRATEGY_ENGINES = {
+    'exhaustive': 'numpy',
+    'chunked': 'chunked',
+    'pruned': 'bnb',
+    'heuristic': 'heuristic'
+}
+
+
+def fetch_order_shape(conn, order_id: int) -> Dict[str, Any]:
+    """
+    Число вариантов по товарам и число ЛСД заказа (без загрузки строк).
+
+    Returns:
+        Dict: n_variants (список по order_item_id), n_lsd
+    """
+    with conn.cursor() as cur:
+        cur.execute(ITEM_VARIANT_COUNTS_QUERY, (order_id,))
+        n_variants = [int(count) for _, count in cur.fetchall()]
+        cur.execute(LSD_COUNT_QUERY, (order_id,))
+        n_lsd = int(cur.fetchone()[0] or 0)
+
+    return {'n_variants': n_variants, 'n_lsd': n_lsd}
+
+
+def estimate_costs(n_variants: List[int], n_lsd: int, block_size: int, workers: int) -> Dict[str, Any]:
+    """
+    Оценки памяти и времени по этапам для exhaustive и chunked.
+
+    Returns:
+        Dict с n_combinations и оценками в МБ / секундах
+    """
+    n_items = len(n_variants)
+    n_combinations = math.prod(n_variants) if n_variants else 0
+    block = min(block_size, max(n_combinations, 1))
+    chunk_bytes = CHUNKED_BYTES_PER_ITEM * n_items + CHUNKED_BYTES_PER_LSD * n_lsd + CHUNKED_BYTES_BASE
+    stages_mb = {
+        stage: round(n_combinations * stage_bytes / (1024 * 1024), 1)
+        for stage, stage_bytes in NUMPY_STAGE_BYTES.items()
+    }
+
+    return {
+        'n_items': n_items,
+        'n_lsd': n_lsd,
+        'n_combinations': n_combinations,
+        'exhaustive': {
+            'memory_mb': round(BASE_PROCESS_MB + max(stages_mb.values()), 1),
+            'stages_mb': stages_mb,
+            'time_sec': round(n_combinations / NUMPY_COMBINATIONS_PER_SEC, 2)
+        },
+        'chunked': {
+            'memory_mb': round(BASE_PROCESS_MB + workers * block * chunk_bytes / (1024 * 1024), 1),
+            'block_size': block,
+            'bytes_per_combination': chunk_bytes,
+            'workers': workers,
+            'time_sec': round(n_combinations / (CHUNKED_COMBINATIONS_PER_SEC * workers), 2)
+        }
+    }
+
+
+def select_engine(n_variants: List[int], n_lsd: int,
+                  memory_budget_mb: Optional[float] = None,
+                  time_budget_sec: Optional[float] = None,
+                  block_size: Optional[int] = None,
+                  workers: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Выбирает стратегию и движок для заказа.
+
+    Args:
+        n_variants: Вариантов по товарам
+        n_lsd: Количество ЛСД
+        memory_budget_mb: Бюджет памяти (по умолчанию OPTIMIZER_MEMORY_BUDGET_MB)
+        time_budget_sec: Бюджет времени (по умолчанию OPTIMIZER_TIME_BUDGET_SEC)
+        block_size: Размер блока потокового режима (по умолчанию DEFAULT_BLOCK_SIZE движка)
+        workers: Процессов для parallel (по умолчанию число ядер)
+
+    Returns:
+        Dict: strategy, engine, reason, estimates, budgets и параметры движка (params)
+    """
+    from order_optimizer_chunked import DEFAULT_BLOCK_SIZE
+
+    memory_budget_mb = memory_budget_mb or DEFAULT_MEMORY_BUDGET_MB
+    time_budget_sec = time_budget_sec or DEFAULT_TIME_BUDGET_SEC
+    workers = workers or os.cpu_count() or 1
+    estimates = estimate_costs(n_variants, n_lsd, block_size or DEFAULT_BLOCK_SIZE, workers)
+    n_combinations = estimates['n_combinations']
+    exhaustive = estimates['exhaustive']
+    chunked = estimates['chunked']
+
+    def decision(strategy: str, reason: str, params: Dict[str, Any] = None) -> Dict[str, Any]:
+        engine = STRATEGY_ENGINES[strategy]
+        return {
+            'strategy': strategy,
+            'engine': engine,
+            'reason': reason,
+            'params': params or {},
+            'estimates': estimates,
+            'budgets': {'memory_mb': memory_budget_mb, 'time_sec': time_budget_sec}
+        }
+
+    if exhaustive['memory_mb'] <= memory_budget_mb and exhaustive['time_sec'] <= time_budget_sec:
+        return decision('exhaustive', f"{n_combinations:,} комбинаций: ~{exhaustive['memory_mb']:.0f} MB, "
+                                      f"~{exhaustive['time_sec']:.1f} сек - в пределах бюджета")
+
+    if chunked['time_sec'] <= time_budget_sec:
+        # Блок подгоняем под бюджет памяти, если блок по умолчанию не помещается
+        params = {}
+        if chunked['memory_mb'] > memory_budget_mb:
+            available = (memory_budget_mb - BASE_PROCESS_MB) * 1024 * 1024
+            params['block_size'] = int(available / (workers * chunked['bytes_per_combination']))
+
+        if params.get('block_size', MIN_BLOCK_SIZE) >= MIN_BLOCK_SIZE:
+            result = decision('chunked', f"полный перебор ~{exhaustive['memory_mb']:.0f} MB / "
+                                         f"~{exhaustive['time_sec']:.1f} сек вне бюджета, "
+                                         f"потоковый режим ~{chunked['time_sec']:.1f} сек", params)
+            if workers > 1:
+                result['engine'] = 'parallel'
+                result['params']['workers'] = workers
+            return result
+
+    reason = (f"{n_combinations:,} комбинаций: полный перебор ~{exhaustive['time_sec']:.1f} сек / "
+              f"~{exhaustive['memory_mb']:.0f} MB, потоковый ~{chunked['time_sec']:.1f} сек - вне бюджета")
+
+    if estimates['n_items'] > PRUNED_MAX_ITEMS or n_combinations >= PRUNED_MAX_COMBINATIONS:
+        if 'heuristic' in STRATEGY_ENGINES:
+            if estimates['n_items'] > PRUNED_MAX_ITEMS:
+                return decision('heuristic', f"{reason}; {estimates['n_items']} товаров - "
+                                             f"время поиска с отсечениями не предсказуемо")
+            return decision('heuristic', f"{reason}; номера комбинаций не помещаются в BIGINT")
+        reason += "; эвристический движок недоступен"
+
+    return decision('pruned', f"{reason}; поиск с отсечениями")
@@ -0,0 +1,254 @@
+"""
+Исключения пользователя: скомпилированный матчер названий товаров.
+
+Раньше каждый движок приводил название каждого варианта к нижнему регистру
+и искал в нём подстрокой каждое ключевое слово и каждый продукт из чёрного
+списка во вложенных циклах Python; тип диеты разворачивается в сотни
+ключевых слов. Здесь списки пользователя один раз компилируются в одно
+регулярное выражение (альтернативы свёрнуты в префиксное дерево), а
+названия всех вариантов проверяются одним проходом по склеенной строке.
+
+Матчеры кэшируются в процессе (LRU): по (user_id, version), если
+user-service прислал штамп версии исключений, иначе по самим спискам.
+"""
+
+import logging
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+# Сколько скомпилированных матчеров держать в процессе
+MATCHER_CACHE_SIZE = 256
+
+# Разделитель названий при проверке одним проходом (в PostgreSQL text не бывает NUL)
+_SEPARATOR = '\x00'
+
+
+def _lowered_patterns(exclusions: Dict[str, Any], key: str) -> List[str]:
+    """Подстроки списка в нижнем регистре (пробелы внутри ключевых слов значимы)."""
+    return sorted({str(value).lower() for value in exclusions.get(key) or [] if value})
+
+
+def _trie_regex(patterns: Sequence[str]) -> str:
+    """
+    Альтернатива подстрок, свёрнутая в префиксное дерево.
+
+    Нужен только факт совпадения, поэтому слово, продолжающее другое
+    слово списка ("сырок" при "сыр"), не добавляет ветку.
+    """
+    trie: Dict[str, Any] = {}
+    for pattern in patterns:
+        node = trie
+        for char in pattern:
+            if '' in node:
+                break
+            node = node.setdefault(char, {})
+        else:
+            node.clear()
+            node[''] = True
+
+    def build(node: Dict[str, Any]) -> str:
+        if '' in node:
+            return ''
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items())]
+        if len(branches) == 1:
+            return branches[0]
+        single = [branch for branch in branches if len(branch) == 1]
+        if len(single) == len(branches):
+            return '[' + ''.join(single) + ']'
+        return '(?:' + '|'.join(branches) + ')'
+
+    return build(trie)
+
+
+class ExclusionMatcher:
+    """Ключевые слова и продукты пользователя, скомпилированные в одно выражение"""
+
+    def __init__(self, keywords: Sequence[str], products: Sequence[str]):
+        """
+        Args:
+            keywords: Ключевые слова категорий (в нижнем регистре)
+            products: Продукты из чёрного списка (в нижнем регистре)
+        """
+        self.n_keywords = len(keywords)
+        self.n_products = len(products)
+        # Пустая строка совпала бы с любым названием
+        patterns = sorted({p for p in list(keywords) + list(products) if p and _SEPARATOR not in p})
+        self._regex = re.compile(_trie_regex(patterns)) if patterns else None
+
+    def __bool__(self) -> bool:
+        return self._regex is not None
+
+    def excluded_positions(self, product_names: Sequence[Optional[str]]) -> List[int]:
+        """Индексы названий, содержащих хотя бы одно исключение (по возрастанию)."""
+        if self._regex is None or not product_names:
+            return []
+
+        lowered = [(name or '').lower() for name in product_names]
+        text = _SEPARATOR.join(lowered)
+
+        # Конец каждого названия в склеенной строке
+        ends = []
+        position = 0
+        for name in lowered:
+            position += len(name)
+            ends.append(position)
+            position += 1
+
+        positions = []
+        index = 0
+        for match in self._regex.finditer(text):
+            start = match.start()
+            while ends[index] < start:
+                index += 1
+            if not positions or positions[-1] != index:
+                positions.append(index)
+        return positions
+
+    def mask(self, product_names: Sequence[Optional[str]]):
+        """
+        Маска исключённых названий одним вызовом.
+
+        Returns:
+            np.ndarray[bool] длины len(product_names): True - название исключено
+        """
+        import numpy as np
+
+        mask = np.zeros(len(product_names), dtype=bool)
+        mask[self.excluded_positions(product_names)] = True
+        return mask
+
+
+class _MatcherCache:
+    """LRU-кэш скомпилированных матчеров"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries: 'OrderedDict[Hashable, ExclusionMatcher]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, build) -> ExclusionMatcher:
+        with self._lock:
+            matcher = self._entries.get(key)
+            if matcher is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return matcher
+            self.misses += 1
+
+        matcher = build()
+        with self._lock:
+            self._entries[key] = matcher
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return matcher
+
+    def stats(self) -> Dict[str, int]:
+        return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+matcher_cache = _MatcherCache(MATCHER_CACHE_SIZE)
+
+
+def get_matcher(exclusions: Optional[Dict[str, Any]]) -> ExclusionMatcher:
+    """
+    Скомпилированный матчер исключений (из кэша процесса).
+
+    Args:
+        exclusions: keywords, products и, если известны, user_id и version
+            (штамп версии исключений из user-service)
+    """
+    exclusions = exclusions or {}
+    if exclusions.get('user_id') is not None and exclusions.get('version'):
+        key = ('user', exclusions['user_id'], exclusions['version'])
+        keywords = products = None
+    else:
+        keywords = _lowered_patterns(exclusions, 'keywords')
+        products = _lowered_patterns(exclusions, 'products')
+        key = ('lists', tuple(keywords), tuple(products))
+
+    def build() -> ExclusionMatcher:
+        return ExclusionMatcher(
+            keywords if keywords is not None else _lowered_patterns(exclusions, 'keywords'),
+            products if products is not None else _lowered_patterns(exclusions, 'products')
+        )
+
+    return matcher_cache.get(key, build)
+
+
+def exclusion_keep_mask(product_names: Sequence[Optional[str]], item_offsets: Sequence[int],
+                        exclusions: Optional[Dict[str, Any]], order_item_ids: Sequence[int] = None):
+    """
+    Маска вариантов, оставшихся после исключений пользователя.
+
+    Вариант исключается, если название содержит ключевое слово или продукт
+    из чёрного списка; если исключены все варианты товара, остаётся первый.
+
+    Args:
+        product_names: Названия вариантов (варианты товара идут подряд)
+        item_offsets: Границы товаров (len = n_items + 1)
+        exclusions: Исключения пользователя
+        order_item_ids: ID товаров (для предупреждения), по одному на товар
+
+    Returns:
+        np.ndarray[bool]: True - вариант остаётся
+    """
+    import numpy as np
+
+    matcher = get_matcher(exclusions)
+    keep = np.ones(len(product_names), dtype=bool)
+    if not matcher:
+        return keep
+
+    logger.info(f"🚫 Применение исключений: {matcher.n_keywords} ключевых слов, {matcher.n_products} продуктов")
+    keep[matcher.excluded_positions(product_names)] = False
+
+    for item_idx, (start, end) in enumerate(zip(item_offsets[:-1], item_offsets[1:])):
+        if end > start and not keep[start:end].any():
+            item_id = order_item_ids[item_idx] if order_item_ids is not None else item_idx
+            logger.warning(f"⚠️ Все варианты товара {item_id} исключены! "
+                           f"Оставляем первый вариант: {product_names[start] or 'N/A'}")
+            keep[start] = True
+
+    logger.info(f"🚫 Исключено вариантов: {int((~keep).sum())}")
+    return keep
+
+
+def filter_grouped_variants(grouped: Dict[int, List[Dict[str, Any]]],
+                            exclusions: Optional[Dict[str, Any]]) -> Dict[int, List[Dict[str, Any]]]:
+    """
+    Фильтрует варианты {order_item_id: [строки]} по исключениям пользователя
+    (построчная загрузка; правила как у exclusion_keep_mask).
+    """
+    matcher = get_matcher(exclusions)
+    if not matcher:
+        return grouped
+
+    logger.info(f"🚫 Применение исключений: {matcher.n_keywords} ключевых слов, {matcher.n_products} продуктов")
+
+    item_ids = list(grouped)
+    variants = [variant for item_id in item_ids for variant in grouped[item_id]]
+    excluded = set(matcher.excluded_positions([variant.get('product_name') for variant in variants]))
+
+    filtered_grouped = {}
+    position = 0
+    for item_id in item_ids:
+        item_variants = grouped[item_id]
+        kept = [v for offset, v in enumerate(item_variants) if position + offset not in excluded]
+        position += len(item_variants)
+        if kept:
+            filtered_grouped[item_id] = kept
+        else:
+            # Если все варианты исключены — оставляем первый с предупреждением
+            logger.warning(f"⚠️ Все варианты товара {item_id} исключены! "
+                           f"Оставляем первый вариант: {item_variants[0].get('product_name', 'N/A')}")
+            filtered_grouped[item_id] = [item_variants[0]]
+
+    logger.info(f"🚫 Исключено вариантов: {len(excluded)}")
+    return filtered_grouped
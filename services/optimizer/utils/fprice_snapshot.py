@@ -0,0 +1,72 @@
+"""
+Снимок fprice_optimizer по заказу (таблица fprice_snapshot).
+
+VIEW fprice_optimizer считает оконные функции по всем lsd_stocks, и
+WHERE order_id = ... не опускается под окна: каждый запрос оптимизатора
+читал всю таблицу. Оптимизаторы, кэш результатов и выбор движка читают
+таблицу fprice_snapshot с теми же колонками. Её заполняет SQL-функция
+refresh_fprice_snapshot (fprice_snapshot.sql):
+
+- rpa-service после сохранения результатов ЛСД - для товаров этого поиска
+- order-service по завершении поиска по заказу - весь заказ
+- ensure_snapshot перед оптимизацией, если строк заказа ещё нет
+  (заказы, проанализированные до появления снимка)
+"""
+
+import logging
+import time
+from typing import Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+# Источник строк оптимизатора (те же колонки, что у VIEW fprice_optimizer)
+FPRICE_SOURCE = 'fprice_snapshot'
+
+SNAPSHOT_EXISTS_QUERY = f"SELECT EXISTS (SELECT 1 FROM {FPRICE_SOURCE} WHERE order_id = %s)"
+
+
+def refresh_snapshot(conn, order_id: int, order_item_ids: Optional[Iterable[int]] = None) -> int:
+    """
+    Пересчитывает снимок заказа и фиксирует транзакцию.
+
+    Args:
+        conn: psycopg2-соединение
+        order_id: ID заказа
+        order_item_ids: Только эти товары (None - весь заказ)
+
+    Returns:
+        Количество строк снимка, записанных для заказа / товаров
+    """
+    start_time = time.time()
+    item_ids = None if order_item_ids is None else sorted({int(item_id) for item_id in order_item_ids})
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT refresh_fprice_snapshot(%s, %s::bigint[])", (order_id, item_ids))
+            rows = cur.fetchone()[0]
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    scope = "весь заказ" if item_ids is None else f"{len(item_ids)} товаров"
+    logger.info(f"Снимок fprice заказа {order_id} ({scope}): {rows} строк за {time.time() - start_time:.2f} сек")
+    return rows
+
+
+def ensure_snapshot(conn, order_id: int) -> bool:
+    """
+    Заполняет снимок заказа, если в нём ещё нет строк.
+
+    Returns:
+        True, если снимок пришлось построить
+    """
+    with conn.cursor() as cur:
+        cur.execute(SNAPSHOT_EXISTS_QUERY, (order_id,))
+        exists = cur.fetchone()[0]
+    conn.commit()
+
+    if exists:
+        return False
+    logger.info(f"Снимка fprice заказа {order_id} нет - строим")
+    refresh_snapshot(conn, order_id)
+    return True
@@ -0,0 +1,164 @@
+"""
+Кэш результатов оптимизации по хэшу входных данных.
+
+Повторный запуск оптимизации (force-retry, перезапуск анализа, изменение
+исключений) при неизменных строках fprice_optimizer даёт те же корзины.
+Ключ кэша - sha256 от отпечатка строк fprice_optimizer заказа (md5 и число
+строк считает сервер - строки не передаются), нормализованных исключений,
+top_n, движка и его параметров (optimize._engine_cache_key).
+Значение - результат движка и снимок строк basket_analyses /
+basket_combinations / basket_delivery_costs заказа; при попадании снимок
+записывается в basket_* напрямую, без запуска движка.
+
+Кэш живёт в памяти процесса и вытесняет давно не использованные записи,
+когда суммарный размер превышает OPTIMIZER_CACHE_MAX_MB (по умолчанию 64).
+Общего кэша между процессами нет: в order-service оптимизации идут в
+spawn-пуле optimizer_pool, и повтор попадает в кэш, только если выполняется
+тем же процессом пула, что и первый запуск (повторы предварительной
+оптимизации - в том числе).
+"""
+import hashlib
+import json
+import logging
+import os
+import pickle
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from utils.fprice_snapshot import FPRICE_SOURCE
+from utils.result_writer import BASKET_TABLES, JSON_COLUMNS, write_baskets
+
+logger = logging.getLogger(__name__)
+
+# Меняется при изменении формата ключа или снимка - старые записи перестают совпадать
+CACHE_VERSION = 2
+
+# Отпечаток тех же строк, что читают оптимизаторы: число строк и md5 их текста
+FPRICE_INPUT_QUERY = f"""
+    SELECT COUNT(*), md5(string_agg(fprice_rows::text, E'\\n' ORDER BY fprice_rows.order_item_id, fprice_rows.id))
+    FROM (
+        SELECT
+            id, order_id, lsd_config_id, lsd_name, order_item_id, product_name,
+            price, fprice, base_unit, base_quantity, requested_unit, requested_quantity,
+            order_item_ids_quantity, order_item_ids_cost, fprice_min, fprice_diff,
+            loss, min_order_amount, delivery_cost_model, delivery_fixed_fee
+        FROM {FPRICE_SOURCE}
+        WHERE order_id = %s
+    ) AS fprice_rows
+"""
+
+
+def normalize_exclusions(exclusions: Optional[Dict[str, Any]]) -> Dict[str, List[str]]:
+    """Приводит исключения к виду, не зависящему от порядка и регистра."""
+    exclusions = exclusions or {}
+    return {
+        key: sorted({str(value).strip().lower() for value in exclusions.get(key) or [] if str(value).strip()})
+        for key in ('keywords', 'products')
+    }
+
+
+def compute_input_hash(conn, order_id: int, exclusions: Optional[Dict[str, Any]],
+                       top_n: int, engine: str) -> Optional[str]:
+    """
+    Хэш входных данных оптимизатора (один запрос, строки заказа хэширует сервер).
+
+    Returns:
+        sha256 в hex или None, если в fprice_optimizer нет строк заказа
+    """
+    with conn.cursor() as cur:
+        cur.execute(FPRICE_INPUT_QUERY, (order_id,))
+        n_rows, rows_md5 = cur.fetchone()
+
+    if not n_rows:
+        return None
+
+    payload = {
+        'version': CACHE_VERSION,
+        'engine': engine,
+        'top_n': top_n,
+        'exclusions': normalize_exclusions(exclusions),
+        'n_rows': n_rows,
+        'rows_md5': rows_md5
+    }
+    encoded = json.dumps(payload, sort_keys=True, default=str, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+def snapshot_baskets(conn, order_id: int) -> Dict[str, List[Tuple]]:
+    """Читает записанные движком строки basket_* заказа."""
+    snapshot = {}
+    with conn.cursor() as cur:
+        for table, columns in BASKET_TABLES.items():
+            cur.execute(f"SELECT {', '.join(columns)} FROM {table} WHERE order_id = %s", (order_id,))
+            snapshot[table] = [
+                tuple(json.dumps(value) if column in JSON_COLUMNS and value is not None else value
+                      for column, value in zip(columns, row))
+                for row in cur.fetchall()
+            ]
+    return snapshot
+
+
+def restore_baskets(conn, order_id: int, snapshot: Dict[str, List[Tuple]]):
+    """Заменяет строки basket_* заказа снимком из кэша (одна транзакция, COPY)."""
+    write_baskets(conn, order_id, snapshot)
+
+
+class OptimizationResultCache:
+    """LRU-кэш результатов оптимизации с ограничением по суммарному размеру"""
+
+    def __init__(self, max_bytes: int):
+        """
+        Args:
+            max_bytes: Максимальный суммарный размер записей (0 - кэш выключен)
+        """
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, Tuple[int, bytes]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Возвращает запись и делает её самой свежей; считает попадания и промахи."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return pickle.loads(entry[1])
+
+    def put(self, key: str, value: Dict[str, Any]):
+        """Сохраняет запись, вытесняя самые старые при превышении max_bytes."""
+        payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        size = len(payload)
+        if size > self.max_bytes:
+            logger.info(f"Результат не помещается в кэш ({size:,} байт > {self.max_bytes:,})")
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self.total_bytes -= self._entries.pop(key)[0]
+            self._entries[key] = (size, payload)
+            self.total_bytes += size
+
+            while self.total_bytes > self.max_bytes:
+                _, (evicted_size, _) = self._entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self._entries),
+                'bytes': self.total_bytes
+            }
+
+
+# Кэш процесса
+result_cache = OptimizationResultCache(
+    max_bytes=int(float(os.getenv('OPTIMIZER_CACHE_MAX_MB', '64')) * 1024 * 1024)
+)
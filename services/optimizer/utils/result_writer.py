@@ -0,0 +1,264 @@
+"""
+Запись результата оптимизации в basket_* через COPY FROM STDIN.
+
+Раньше каждый движок писал корзины сам: три DELETE, списки кортежей,
+json.dumps(delivery_cost_model) для каждой строки и execute_values; этапы
+legacy (combination_generator, basket_analyzer, delivery_calculator)
+сначала писали CSV во временный файл. Здесь строки сразу форматируются
+в текстовый формат COPY в буферах в памяти, а BasketResultWriter.write()
+в одной транзакции удаляет старые строки заказа и загружает
+basket_combinations, basket_delivery_costs и basket_analyses тремя COPY.
+delivery_cost_model сериализуется один раз на ЛСД. BatchResultWriter
+так же одной транзакцией записывает корзины пакета заказов.
+"""
+
+import io
+import json
+import logging
+import time
+from typing import Any, Dict, Iterable, List, Sequence
+
+logger = logging.getLogger(__name__)
+
+# Таблицы результата и их колонки (в порядке загрузки)
+BASKET_TABLES = {
+    'basket_combinations': (
+        'basket_id', 'id', 'order_id', 'order_item_id', 'product_name', 'lsd_name',
+        'base_unit', 'base_quantity', 'price', 'fprice', 'fprice_min', 'fprice_diff',
+        'loss', 'order_item_ids_quantity', 'min_order_amount', 'lsd_config_id',
+        'delivery_cost_model', 'order_item_ids_cost', 'fprice_optimizer_id', 'lsd_stock_id'
+    ),
+    'basket_delivery_costs': (
+        'order_id', 'basket_id', 'lsd_config_id', 'delivery_cost', 'topup',
+        'lsd_total_basket_cost', 'min_order_amount'
+    ),
+    'basket_analyses': (
+        'order_id', 'basket_id', 'total_loss', 'total_goods_cost',
+        'delivery_cost', 'delivery_topup', 'total_delivery_cost',
+        'total_cost', 'total_loss_and_delivery', 'basket_rank', 'is_mono_basket'
+    ),
+}
+
+# Порядок удаления старых строк заказа
+DELETE_ORDER = ('basket_delivery_costs', 'basket_combinations', 'basket_analyses')
+
+# JSON-колонки: psycopg2 читает их как dict, обратно пишем строкой
+JSON_COLUMNS = {'delivery_cost', 'delivery_topup', 'delivery_cost_model'}
+
+# Экранирование текстового формата COPY
+_COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+def copy_value(value: Any) -> str:
+    """Значение в текстовом формате COPY (NULL - \\N, dict/list и Json - JSON-строка)."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (int, float)):
+        return str(value)
+    if isinstance(value, (dict, list)):
+        value = json.dumps(value)
+    elif hasattr(value, 'adapted'):
+        # psycopg2.extras.Json
+        value = json.dumps(value.adapted)
+    return str(value).translate(_COPY_ESCAPES)
+
+
+def copy_line(row: Iterable[Any]) -> str:
+    return '\t'.join(copy_value(value) for value in row) + '\n'
+
+
+def copy_buffer(cur, table: str, columns: Sequence[str], buffer: io.StringIO):
+    """Загружает подготовленный буфер в таблицу одним COPY FROM STDIN."""
+    buffer.seek(0)
+    cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buffer)
+
+
+def copy_rows(cur, table: str, columns: Sequence[str], rows: Iterable[Sequence[Any]]) -> int:
+    """
+    Загружает строки в таблицу через COPY FROM STDIN из буфера в памяти.
+
+    Returns:
+        Количество загруженных строк
+    """
+    buffer = io.StringIO()
+    count = 0
+    for row in rows:
+        buffer.write(copy_line(row))
+        count += 1
+    if count:
+        copy_buffer(cur, table, columns, buffer)
+    return count
+
+
+class BasketResultWriter:
+    """Буферизует строки basket_* заказа и записывает их одной транзакцией"""
+
+    def __init__(self, conn, order_id: int):
+        """
+        Args:
+            conn: psycopg2-соединение
+            order_id: ID заказа
+        """
+        self.conn = conn
+        self.order_id = order_id
+        self._buffers = {table: io.StringIO() for table in BASKET_TABLES}
+        self._counts = {table: 0 for table in BASKET_TABLES}
+        # lsd_config_id -> delivery_cost_model в формате COPY
+        self._delivery_models: Dict[Any, str] = {}
+
+    def _write(self, table: str, values: Sequence[Any]):
+        self._buffers[table].write(copy_line(values))
+        self._counts[table] += 1
+
+    def _delivery_model(self, item: Dict[str, Any]) -> str:
+        lsd_id = item['lsd_config_id']
+        encoded = self._delivery_models.get(lsd_id)
+        if encoded is None:
+            encoded = json.dumps(item['delivery_cost_model']).translate(_COPY_ESCAPES)
+            self._delivery_models[lsd_id] = encoded
+        return encoded
+
+    def add_basket_items(self, basket_id: int, items: Iterable[Dict[str, Any]]):
+        """Строки basket_combinations корзины (items - строки fprice_optimizer)."""
+        buffer = self._buffers['basket_combinations']
+        order_id = copy_value(self.order_id)
+        basket = copy_value(basket_id)
+        for item in items:
+            item_id = copy_value(item['id'])
+            buffer.write('\t'.join((
+                basket, item_id, order_id, copy_value(item['order_item_id']),
+                copy_value(item['product_name']), copy_value(item['lsd_name']),
+                copy_value(item['base_unit']), copy_value(item['base_quantity']),
+                copy_value(item['price']), copy_value(item['fprice']),
+                copy_value(item['fprice_min']), copy_value(item['fprice_diff']),
+                copy_value(item['loss']), copy_value(item['order_item_ids_quantity']),
+                copy_value(item['min_order_amount']), copy_value(item['lsd_config_id']),
+                self._delivery_model(item), copy_value(item['order_item_ids_cost']),
+                item_id, item_id
+            )) + '\n')
+            self._counts['basket_combinations'] += 1
+
+    def add_delivery_cost(self, basket_id: int, lsd_config_id: int, delivery_cost: float, topup: float,
+                          lsd_total_basket_cost: float, min_order_amount: float):
+        """Строка basket_delivery_costs (доставка и топап ЛСД в корзине)."""
+        self._write('basket_delivery_costs', (
+            self.order_id, basket_id, lsd_config_id, delivery_cost, topup,
+            lsd_total_basket_cost, min_order_amount
+        ))
+
+    def add_analysis(self, basket_id: int, total_loss: float, total_goods_cost: float,
+                     delivery_cost: Dict[str, float], delivery_topup: Dict[str, float],
+                     total_delivery_cost: float, total_cost: float, total_loss_and_delivery: float,
+                     basket_rank: int, is_mono_basket: bool = False):
+        """Строка basket_analyses (delivery_cost / delivery_topup - словари по имени ЛСД)."""
+        self._write('basket_analyses', (
+            self.order_id, basket_id, total_loss, total_goods_cost,
+            delivery_cost, delivery_topup, total_delivery_cost,
+            total_cost, total_loss_and_delivery, basket_rank, is_mono_basket
+        ))
+
+    def add_rows(self, table: str, rows: Iterable[Sequence[Any]]):
+        """Готовые строки в порядке колонок BASKET_TABLES[table] (снимок кэша результатов)."""
+        for row in rows:
+            self._write(table, row)
+
+    def write(self) -> Dict[str, int]:
+        """
+        Удаляет старые строки заказа и загружает буферы (одна транзакция).
+
+        Returns:
+            Количество записанных строк по таблицам
+        """
+        start_time = time.time()
+        try:
+            with self.conn.cursor() as cur:
+                deleted = {}
+                for table in DELETE_ORDER:
+                    cur.execute(f"DELETE FROM {table} WHERE order_id = %s", (self.order_id,))
+                    deleted[table] = cur.rowcount
+
+                for table, columns in BASKET_TABLES.items():
+                    if self._counts[table]:
+                        copy_buffer(cur, table, columns, self._buffers[table])
+
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+        logger.info("Удалено старых записей: " + ", ".join(f"{table}={count}" for table, count in deleted.items()))
+        logger.info(f"COPY basket_* за {time.time() - start_time:.2f} сек: " +
+                    ", ".join(f"{table}={count}" for table, count in self._counts.items()))
+        return dict(self._counts)
+
+
+class BatchResultWriter:
+    """Строки basket_* нескольких заказов - одной транзакцией (пакетная оптимизация)"""
+
+    def __init__(self, conn):
+        """
+        Args:
+            conn: psycopg2-соединение
+        """
+        self.conn = conn
+        self._writers: Dict[int, BasketResultWriter] = {}
+
+    def writer(self, order_id: int) -> BasketResultWriter:
+        """Буфер заказа; его write() не вызывается - строки пишет write() пакета."""
+        writer = BasketResultWriter(self.conn, order_id)
+        self._writers[order_id] = writer
+        return writer
+
+    def discard(self, order_id: int):
+        """Убирает строки заказа из пакета (оптимизация заказа не удалась)."""
+        self._writers.pop(order_id, None)
+
+    @property
+    def order_ids(self) -> List[int]:
+        return list(self._writers)
+
+    def write(self) -> Dict[int, Dict[str, int]]:
+        """
+        Удаляет старые строки всех заказов пакета и загружает их корзины
+        тремя COPY (одна транзакция).
+
+        Returns:
+            Количество записанных строк по заказам и таблицам
+        """
+        if not self._writers:
+            return {}
+
+        start_time = time.time()
+        order_ids = list(self._writers)
+        try:
+            with self.conn.cursor() as cur:
+                for table in DELETE_ORDER:
+                    cur.execute(f"DELETE FROM {table} WHERE order_id = ANY(%s)", (order_ids,))
+
+                for table, columns in BASKET_TABLES.items():
+                    buffer = io.StringIO()
+                    for writer in self._writers.values():
+                        if writer._counts[table]:
+                            buffer.write(writer._buffers[table].getvalue())
+                    if buffer.tell():
+                        copy_buffer(cur, table, columns, buffer)
+
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+        counts = {order_id: dict(writer._counts) for order_id, writer in self._writers.items()}
+        logger.info(f"COPY basket_* пакета из {len(order_ids)} заказов за {time.time() - start_time:.2f} сек: " +
+                    ", ".join(f"{table}={sum(c[table] for c in counts.values())}" for table in BASKET_TABLES))
+        return counts
+
+
+def write_baskets(conn, order_id: int, snapshot: Dict[str, Sequence[Sequence[Any]]]) -> Dict[str, int]:
+    """Заменяет строки basket_* заказа готовыми строками (по таблицам BASKET_TABLES)."""
+    writer = BasketResultWriter(conn, order_id)
+    for table in BASKET_TABLES:
+        writer.add_rows(table, snapshot.get(table) or [])
+    return writer.write()
@@ -0,0 +1,101 @@
+"""
+Поэтапные метрики оптимизатора.
+
+Раньше время этапов было только в тексте logs/optimizer_numpy.log.
+StageMetrics замеряет каждый этап optimize_order (load, metrics, delivery,
+select, save): длительность, пик выделенной за этап памяти (tracemalloc -
+NumPy регистрирует в нём свои буферы) и число обработанных комбинаций.
+Сводка по заказу (stage_metrics в результате движка) уходит в order-service:
+там этапы попадают в гистограммы Prometheus (/metrics) и в
+orders.analysis_result.
+"""
+
+import os
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+# Пик памяти через tracemalloc: заметно замедляет только Python-код, не NumPy
+TRACE_MEMORY = os.getenv('OPTIMIZER_TRACE_MEMORY', '1') == '1'
+
+
+class StageMetrics:
+    """Замеры этапов одной оптимизации"""
+
+    def __init__(self, engine: str, trace_memory: Optional[bool] = None):
+        """
+        Args:
+            engine: Движок (метка в Prometheus)
+            trace_memory: Замерять пик памяти (по умолчанию OPTIMIZER_TRACE_MEMORY)
+        """
+        self.engine = engine
+        self.trace_memory = TRACE_MEMORY if trace_memory is None else trace_memory
+        self.order: Dict[str, int] = {}
+        self.stages: Dict[str, Dict[str, Any]] = {}
+        self._started_tracing = False
+        self._start_time = time.perf_counter()
+
+    def set_order(self, data: Dict[str, Any]):
+        """Размеры заказа из словаря load_fprice_data_to_numpy."""
+        self.order = {
+            'n_items': int(data['n_items']),
+            'n_variants': int(sum(data['n_variants'])),
+            'n_lsds': len(set(data['lsd_config_ids'].tolist())),
+            'n_combinations': int(data['n_combinations'])
+        }
+
+    @contextmanager
+    def stage(self, name: str, combinations: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Замер этапа.
+
+        Yields:
+            Запись этапа: в неё можно дописать combinations, когда число
+            комбинаций становится известно внутри этапа
+        """
+        record: Dict[str, Any] = {}
+        if combinations is not None:
+            record['combinations'] = int(combinations)
+
+        base_memory = 0
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracing = True
+            tracemalloc.reset_peak()
+            base_memory = tracemalloc.get_traced_memory()[0]
+
+        start_time = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['duration_sec'] = round(time.perf_counter() - start_time, 6)
+            if self.trace_memory and tracemalloc.is_tracing():
+                record['peak_alloc_bytes'] = max(tracemalloc.get_traced_memory()[1] - base_memory, 0)
+            self.stages[name] = record
+
+    def close(self):
+        """Останавливает tracemalloc, если его запустил этот замер."""
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def summary(self) -> Dict[str, Any]:
+        """Сводка для результата движка и orders.analysis_result."""
+        return {
+            'engine': self.engine,
+            'total_sec': round(time.perf_counter() - self._start_time, 6),
+            **self.order,
+            'stages': {name: dict(record) for name, record in self.stages.items()}
+        }
+
+    def log_line(self) -> str:
+        """Этапы одной строкой: load 0.02с/1.2MB, metrics ..."""
+        parts = []
+        for name, record in self.stages.items():
+            part = f"{name} {record['duration_sec']:.3f}с"
+            if 'peak_alloc_bytes' in record:
+                part += f"/{record['peak_alloc_bytes'] / (1024 * 1024):.1f}MB"
+            parts.append(part)
+        return ", ".join(parts)
@@ -5,13 +5,16 @@ import os
 # Добавляем корневую папку проекта в путь
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
 
-from fastapi import FastAPI, HTTPException, Depends, BackgroundTasks
+from fastapi import FastAPI, HTTPException, Depends, BackgroundTasks, Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from sqlalchemy.ext.asyncio import AsyncSession
 from config.settings import settings
 from shared.utils.unified_logging import setup_service_logging
 from shared.utils.text_normalizer import normalize_product_name
 from shared.utils.egg_categories import get_egg_category_coefficient
 from shared.utils.alternatives_parser import parse_alternatives, normalize_alternatives_for_search
+from shared.utils.fprice_snapshot import refresh_fprice_snapshot, clear_fprice_snapshot
+from shared.utils.http_client import http_clients
 from shared.database import get_async_session
 from shared.database.models import (
     Order as DBOrder, 
@@ -23,17 +26,26 @@ from shared.database.models import (
 )
 from shared.models.base import OrderStatus, APIResponse, NormalizedOrder
 from pydantic import BaseModel
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Callable, Awaitable
 import uvicorn
 from sqlalchemy import select, and_
 from sqlalchemy import text
 from datetime import datetime
+import json
 import logging
+import uuid
 import httpx
 import asyncio
 from decimal import Decimal
 from datetime import timedelta
-from order_optimizer_handler import handle_analysis_complete, format_optimization_results
+from order_optimizer_handler import (
+    handle_analysis_complete, handle_analysis_complete_batch,
+    claim_analysis_complete_orders, format_optimization_results
+)
+from optimizer_pool import optimizer_pool
+from provisional_optimization import ProvisionalOptimization
+import search_job_queue
+from order_events import OrderEventDispatcher, OrderStatusListener
 from basket_formatter import format_basket_results_message, _get_basket_data, _format_single_basket
 
 setup_service_logging('order-service', level=logging.INFO)
@@ -42,6 +54,19 @@ logger = logging.getLogger(__name__)
 # Глобальный набор заказов в обработке (защита от дублирования)
 processing_order_ids: set[int] = set()
 
+# Заказы, оптимизация которых уже запущена (защита от повторного запуска)
+optimizing_order_ids: set[int] = set()
+
+# Обработчики статусов заказа: по событиям NOTIFY order_status и в сверочном цикле
+order_events = OrderEventDispatcher()
+order_listener: OrderStatusListener | None = None
+
+# Интервал мониторинга без слушателя order_status (сек)
+POLL_INTERVAL_SEC = 10
+
+# Попыток пересчёта снимка fprice перед ANALYSIS_COMPLETE
+SNAPSHOT_REFRESH_ATTEMPTS = 3
+
 app = FastAPI(
     title="Korzinka Order Service",
     description="Сервис управления заказами",
@@ -384,12 +409,13 @@ async def force_retry_order(
                 detail=f"Нельзя перезапустить заказ в статусе {order.status.value}"
             )
         
-        # Очищаем старые результаты поиска по order_id
+        # Очищаем старые результаты поиска по order_id (и снимок fprice из них - той же транзакцией)
         from sqlalchemy import delete
         deleted_result = await db.execute(
             delete(DBLSDStock).where(DBLSDStock.order_id == order_id)
         )
         deleted_count = deleted_result.rowcount
+        await clear_fprice_snapshot(db, order_id)
         await db.commit()
         
         logger.info(f"🧹 Deleted {deleted_count} old lsd_stocks records for order {order_id}")
@@ -658,10 +684,71 @@ async def get_order_analysis(
         )
 
 
+@app.get("/orders/{order_id}/baskets/provisional")
+async def get_provisional_baskets(
+    order_id: int,
+    rank: int = 1,
+    db: AsyncSession = Depends(get_async_session)
+):
+    """
+    Предварительная корзина заказа, пока ЛСД ещё ищут (provisional_optimization.py).
+    После окончательной оптимизации - 404: корзины берутся из результата заказа.
+    """
+    order = await db.get(DBOrder, order_id)
+    if not order:
+        raise HTTPException(status_code=404, detail="Заказ не найден")
+    
+    analysis_result = order.analysis_result or {}
+    provisional = analysis_result.get('provisional_optimization')
+    # Сводка другой попытки анализа (force-retry, перезапуск) - корзины не этого поиска
+    if (order.status != OrderStatus.ANALYZING or not provisional
+            or provisional.get('attempt') != analysis_result.get('analysis_attempt')):
+        raise HTTPException(status_code=404, detail="Предварительных корзин нет")
+    
+    basket = await _get_basket_data(db, order_id, rank)
+    if not basket:
+        raise HTTPException(status_code=404, detail=f"Корзина #{rank} не найдена")
+    
+    return APIResponse(
+        success=True,
+        data={
+            "order_id": order_id,
+            "provisional": provisional,
+            "basket": basket
+        }
+    )
+
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
-    return {"status": "healthy", "service": "order-service", "version": "1.0.0"}
+    return {
+        "status": "healthy",
+        "service": "order-service",
+        "version": "1.0.0",
+        "order_events": {
+            "listening": order_listener is not None and order_listener.connected,
+            "events_received": order_listener.events_received if order_listener else 0
+        }
+    }
+
+
+@app.get("/optimizer/stats")
+async def optimizer_stats():
+    """Состояние пула оптимизации: глубина очереди, выполняемые задачи, время ожидания"""
+    return APIResponse(
+        success=True,
+        data={
+            **optimizer_pool.stats(),
+            "optimizing_order_ids": sorted(optimizing_order_ids)
+        }
+    )
+
+
+@app.get("/metrics")
+async def metrics():
+    """Метрики Prometheus: гистограммы этапов оптимизатора (optimizer_metrics.py)"""
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
 
 async def perform_order_analysis(order_id: int):
@@ -718,26 +805,48 @@ async def perform_order_analysis(order_id: int):
             
             logger.info(f"📊 Found {len(order_items)} items to search in {len(active_lsds)} LSDs")
             
-            # ПАРАЛЛЕЛЬНЫЙ ПОИСК В БАТЧАХ
-            total_stocks_found = await _search_products_in_batches(
-                order_items=order_items,
-                active_lsds=active_lsds,
-                user_telegram_id=user_telegram_id
+            # Новая попытка анализа: снимок fprice и предварительные корзины прошлой
+            # попытки не используются (снимок заполняется заново по мере поиска)
+            analysis_attempt = uuid.uuid4().hex
+            await clear_fprice_snapshot(db, order_id)
+            order.analysis_result = {"analysis_attempt": analysis_attempt}
+            await db.commit()
+            
+            # Предварительная оптимизация по мере готовности ЛСД (ANYTIME_OPTIMIZATION_LSD_FRACTION)
+            provisional = ProvisionalOptimization(
+                order_id, user_telegram_id, len(active_lsds),
+                settings.anytime_optimization_lsd_fraction,
+                attempt=analysis_attempt
             )
             
+            # ПАРАЛЛЕЛЬНЫЙ ПОИСК В БАТЧАХ
+            try:
+                total_stocks_found = await _search_products_in_batches(
+                    order_items=order_items,
+                    active_lsds=active_lsds,
+                    user_telegram_id=user_telegram_id,
+                    on_lsd_done=lambda lsd: provisional.lsd_done(lsd['name'])
+                )
+            finally:
+                # Корзины предварительного запуска не должны перезаписать окончательные
+                await provisional.finish()
+            
             logger.info(f"✅ Parallel search completed: {total_stocks_found} stocks found")
             
-            # Обновляем статус заказа
-            order.status = OrderStatus.ANALYSIS_COMPLETE
-            order.analysis_completed_at = datetime.now()
-            order.analysis_result = {
+            # Прогресс поиска по ЛСД писали воркеры в своих сессиях - перечитываем
+            await db.refresh(order, attribute_names=['analysis_result'])
+            search_progress = (order.analysis_result or {}).get('search_progress', {})
+            
+            # Полный пересчёт снимка fprice и ANALYSIS_COMPLETE - одной транзакцией:
+            # NOTIFY о статусе сразу запускает оптимизатор, он читает fprice_snapshot
+            await _complete_order_analysis(db, order, {
+                "analysis_attempt": analysis_attempt,
+                "search_progress": search_progress,
                 "total_stocks_found": total_stocks_found,
                 "lsds_searched": len(active_lsds),
                 "items_processed": len(order_items),
                 "analysis_completed_at": datetime.now().isoformat()
-            }
-            
-            await db.commit()
+            })
             
             logger.info(f"✅ Order {order_id} analysis completed: {total_stocks_found} stocks found")
             
@@ -778,16 +887,46 @@ async def perform_order_analysis(order_id: int):
         processing_order_ids.discard(order_id)
 
 
+async def _complete_order_analysis(db: AsyncSession, order: DBOrder, analysis_result: Dict[str, Any]):
+    """
+    Пересчитывает снимок fprice заказа и переводит заказ в ANALYSIS_COMPLETE
+    одним commit. Пересчёт повторяется SNAPSHOT_REFRESH_ATTEMPTS раз; если
+    не удался - исключение (заказ уходит в FAILED, а не к оптимизатору со
+    старым снимком).
+    """
+    for attempt in range(1, SNAPSHOT_REFRESH_ATTEMPTS + 1):
+        try:
+            await refresh_fprice_snapshot(db, order.id, commit=False)
+            order.status = OrderStatus.ANALYSIS_COMPLETE
+            order.analysis_completed_at = datetime.now()
+            order.analysis_result = analysis_result
+            await db.commit()
+            return
+        except Exception as e:
+            await db.rollback()
+            if attempt == SNAPSHOT_REFRESH_ATTEMPTS:
+                raise RuntimeError(f"Не удалось пересчитать снимок fprice заказа: {e}") from e
+            logger.warning(f"⚠️ Order {order.id}: fprice snapshot refresh failed "
+                           f"(attempt {attempt}/{SNAPSHOT_REFRESH_ATTEMPTS}): {e}")
+            await asyncio.sleep(attempt)
+            await db.refresh(order)
+
+
 async def _search_products_in_batches(
     order_items: List[DBOrderItem],
     active_lsds: List[Dict[str, Any]],
-    user_telegram_id: int
+    user_telegram_id: int,
+    on_lsd_done: Optional[Callable[[Dict[str, Any]], None]] = None
 ) -> int:
     """
     Параллельный поиск товаров через пул (semaphore-based pool)
     Возвращает общее количество найденных stocks
+    on_lsd_done(lsd) вызывается, как только ЛСД закончил (в том числе с ошибкой)
     """
     max_concurrent = settings.max_concurrent_browsers
+    if settings.rpa_job_queue_enabled:
+        # Браузеры ограничивают воркеры очереди на своих хостах
+        max_concurrent = max(len(active_lsds), 1)
     
     logger.info(f"🚀 Starting pool-based parallel search: {len(active_lsds)} LSDs, pool size={max_concurrent}")
     logger.info(f"💡 Using semaphore pool: slots will be reused as they become available")
@@ -795,18 +934,24 @@ async def _search_products_in_batches(
     # Создаем семафор для управления пулом браузеров
     semaphore = asyncio.Semaphore(max_concurrent)
     
+    async def run_worker(lsd_num: int, lsd: Dict[str, Any]) -> int:
+        try:
+            return await _lsd_worker(
+                semaphore=semaphore,
+                lsd=lsd,
+                lsd_num=lsd_num,
+                total_lsds=len(active_lsds),
+                order_items=order_items,
+                user_telegram_id=user_telegram_id
+            )
+        finally:
+            if on_lsd_done is not None:
+                on_lsd_done(lsd)
+    
     # Создаем задачи для всех ЛСД сразу
     tasks = []
     for lsd_num, lsd in enumerate(active_lsds, 1):
-        task = _lsd_worker(
-            semaphore=semaphore,
-            lsd=lsd,
-            lsd_num=lsd_num,
-            total_lsds=len(active_lsds),
-            order_items=order_items,
-            user_telegram_id=user_telegram_id
-        )
-        tasks.append(task)
+        tasks.append(run_worker(lsd_num, lsd))
     
     logger.info(f"📋 Created {len(tasks)} worker tasks, starting parallel execution...")
     
@@ -988,60 +1133,211 @@ async def _search_products_in_lsd(
             }
             products_to_search.append(product_data)
         
-        # Вызываем RPA Service для поиска
+        order_id = order_items[0].order_id if order_items else None
+        saved_by_item: Dict[int, int] = {}
+        
+        async def on_item(event: Dict[str, Any]):
+            # Товар найден и уже сохранён RPA-сервисом - обновляем прогресс заказа
+            saved_by_item[event['order_item_id']] = event.get('results_saved', 0)
+            await _update_search_progress(order_id, lsd, {
+                "status": "searching",
+                "items_done": len(saved_by_item),
+                "items_total": len(products_to_search),
+                "results_saved": sum(saved_by_item.values())
+            })
+        
+        # Вызываем RPA Service для поиска (потоково: товары приходят по мере готовности)
         # RPA-сервис сам сохраняет результаты в БД в lsd_stocks
-        rpa_response = await _call_rpa_search(
-            telegram_id=telegram_id,
-            lsd_name=lsd['name'],
-            products=products_to_search
-        )
+        if settings.rpa_job_queue_enabled:
+            # Задания очереди для RPA-воркеров на нескольких хостах (search_job_queue.py)
+            rpa_response = await search_job_queue.search_via_job_queue(
+                order_id=order_id,
+                telegram_id=telegram_id,
+                lsd_name=lsd['name'],
+                products=products_to_search,
+                on_item=on_item
+            )
+        else:
+            rpa_response = await _call_rpa_search_stream(
+                telegram_id=telegram_id,
+                lsd_name=lsd['name'],
+                products=products_to_search,
+                on_item=on_item
+            )
         
-        # RPA-сервис уже сохранил результаты в БД
+        # RPA-сервис уже сохранил результаты в БД (при обрыве - уже готовые товары)
         if rpa_response:
             stocks_found = rpa_response.get('results_saved', 0)
             
             if stocks_found > 0:
-                logger.info(f"✅ RPA Service saved {stocks_found} search results for {lsd['display_name']}")
+                logger.info(f"✅ RPA Service saved {stocks_found} search results for {lsd['display_name']}"
+                            + (" (partial)" if rpa_response.get('partial') else ""))
             else:
                 logger.warning(f"⚠️ No stocks found in {lsd['display_name']}")
         else:
             logger.warning(f"⚠️ No response from RPA for {lsd['display_name']}")
         
+        await _update_search_progress(order_id, lsd, {
+            "status": ("partial" if rpa_response.get('partial') else "done") if rpa_response else "failed",
+            "items_done": len(saved_by_item),
+            "items_total": len(products_to_search),
+            "results_saved": stocks_found
+        })
+        
     except Exception as e:
         logger.error(f"❌ Error searching products in {lsd['display_name']}: {e}")
     
     return stocks_found
 
 
+async def _update_search_progress(order_id: Optional[int], lsd: Dict[str, Any], progress: Dict[str, Any]):
+    """
+    Прогресс поиска ЛСД в orders.analysis_result['search_progress'][<ЛСД>].
+    Одним UPDATE с jsonb-слиянием: воркеры разных ЛСД пишут в одну строку параллельно.
+    """
+    if order_id is None:
+        return
+    try:
+        async for db in get_async_session():
+            await db.execute(
+                text("""
+                    UPDATE orders
+                    SET analysis_result = (
+                        COALESCE(analysis_result::jsonb, '{}'::jsonb)
+                        || jsonb_build_object(
+                            'search_progress',
+                            COALESCE(analysis_result::jsonb -> 'search_progress', '{}'::jsonb)
+                            || jsonb_build_object(CAST(:lsd_name AS text), CAST(:progress AS jsonb))
+                        )
+                    )::json
+                    WHERE id = :order_id
+                """),
+                {
+                    "order_id": order_id,
+                    "lsd_name": lsd['name'],
+                    "progress": json.dumps({
+                        "display_name": lsd.get('display_name'),
+                        **progress,
+                        "updated_at": datetime.now().isoformat()
+                    })
+                }
+            )
+            await db.commit()
+            break
+    except Exception as e:
+        logger.warning(f"⚠️ Failed to update search progress of order {order_id} for {lsd.get('display_name')}: {e}")
+
+
+async def _call_rpa_search_stream(
+    telegram_id: int,
+    lsd_name: str,
+    products: List[Dict[str, Any]],
+    on_item: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None
+) -> Dict[str, Any]:
+    """
+    Потоковый вызов RPA Service (/search/products/stream, NDJSON).
+
+    Товары приходят по мере готовности (уже сохранёнными в lsd_stocks), для
+    каждого вызывается on_item(event). Если поиск оборвался (таймаут, ошибка),
+    возвращается итог по уже готовым товарам с partial=True - они тоже идут
+    в оптимизацию.
+    """
+    items: Dict[int, Dict[str, Any]] = {}
+    try:
+        logger.info(f"🤖 Calling RPA Service for {lsd_name} streaming search with {len(products)} products")
+        
+        client = http_clients.service('rpa')
+        async with client.stream(
+            "POST",
+            "/search/products/stream",
+            json={
+                "telegram_id": telegram_id,
+                "lsd_name": lsd_name,
+                "products": products
+            },
+            timeout=300.0  # 5 минут без новых товаров
+        ) as response:
+            if response.status_code != 200:
+                body = await response.aread()
+                if response.status_code == 404:
+                    # RPA Service без потокового эндпоинта - обычный поиск
+                    # (404 самого поиска - нет конфигурации ЛСД - /search/products вернёт так же)
+                    logger.info(f"↩️ RPA Service has no streaming search, falling back to /search/products")
+                    return await _call_rpa_search(telegram_id, lsd_name, products)
+                logger.error(f"❌ RPA Service request failed: {response.status_code} - {body.decode(errors='replace')}")
+                return {}
+            
+            async for line in response.aiter_lines():
+                if not line.strip():
+                    continue
+                event = json.loads(line)
+                kind = event.get('event')
+                
+                if kind == 'item':
+                    items[event['order_item_id']] = event
+                    logger.info(f"📦 {lsd_name}: item {event['order_item_id']} ready "
+                                f"({event.get('items_done')}/{event.get('items_total')}, "
+                                f"{event.get('results_saved', 0)} saved)")
+                    if on_item is not None:
+                        await on_item(event)
+                elif kind == 'done':
+                    logger.info(f"✅ RPA Service completed: {event.get('results_saved', 0)} results saved")
+                    return event
+                elif kind == 'error':
+                    logger.error(f"❌ RPA Service returned error: {event.get('message')}")
+                    break
+                
+    except httpx.TimeoutException:
+        logger.error(f"⏰ RPA Service search timeout for {lsd_name}")
+    except Exception as e:
+        logger.error(f"❌ Error calling RPA Service for {lsd_name}: {e}")
+    
+    if not items:
+        return {}
+    
+    # Поиск оборвался - готовые товары уже в lsd_stocks
+    found_item_ids = {item_id for item_id, event in items.items() if event.get('results_found')}
+    logger.warning(f"⚠️ RPA search in {lsd_name} ended early: {len(items)}/{len(products)} items finished")
+    return {
+        "lsd_name": lsd_name,
+        "products_searched": len(products),
+        "results_found": sum(event.get('results_found', 0) for event in items.values()),
+        "results_saved": sum(event.get('results_saved', 0) for event in items.values()),
+        "failed_products": [product['order_item_id'] for product in products
+                            if product['order_item_id'] not in found_item_ids],
+        "partial": True
+    }
+
+
 async def _call_rpa_search(telegram_id: int, lsd_name: str, products: List[Dict[str, Any]]) -> Dict[str, Any]:
     """Вызов RPA Service для поиска товаров (возвращает полный ответ)"""
     try:
         logger.info(f"🤖 Calling RPA Service for {lsd_name} search with {len(products)} products")
         
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"http://localhost:{settings.rpa_service_port}/search/products",
-                json={
-                    "telegram_id": telegram_id,
-                    "lsd_name": lsd_name,
-                    "products": products
-                },
-                timeout=300.0  # 5 минут на поиск
-            )
-            
-            if response.status_code == 200:
-                rpa_response = response.json()
-                if rpa_response.get('success'):
-                    data = rpa_response.get('data', {})
-                    logger.info(f"✅ RPA Service completed: {data.get('results_saved', 0)} results saved")
-                    return data  # Возвращаем data с results_saved, results_found и др.
-                else:
-                    logger.error(f"❌ RPA Service returned error: {rpa_response}")
-                    return {}
+        client = http_clients.service('rpa')
+        response = await client.post(
+            "/search/products",
+            json={
+                "telegram_id": telegram_id,
+                "lsd_name": lsd_name,
+                "products": products
+            },
+            timeout=300.0  # 5 минут на поиск
+        )
+        
+        if response.status_code == 200:
+            rpa_response = response.json()
+            if rpa_response.get('success'):
+                data = rpa_response.get('data', {})
+                logger.info(f"✅ RPA Service completed: {data.get('results_saved', 0)} results saved")
+                return data  # Возвращаем data с results_saved, results_found и др.
             else:
-                logger.error(f"❌ RPA Service request failed: {response.status_code} - {response.text}")
+                logger.error(f"❌ RPA Service returned error: {rpa_response}")
                 return {}
-                
+        else:
+            logger.error(f"❌ RPA Service request failed: {response.status_code} - {response.text}")
+            return {}
+            
     except httpx.TimeoutException:
         logger.error(f"⏰ RPA Service search timeout for {lsd_name}")
         return {}
@@ -1177,86 +1473,99 @@ async def _notify_user_analysis_complete(telegram_id: int, order_id: int, stocks
 
 async def monitor_analyzing_orders():
     """
-    Мониторинг заказов в ANALYZING и ANALYSIS_COMPLETE каждые 10 секунд
-    Двойная защита: in-memory set + DB lock
+    Сверочный цикл по статусам заказов (ANALYSIS_COMPLETE, OPTIMIZED, FAILED,
+    таймауты ANALYZING). Пока слушатель order_status подключен, переходы
+    обрабатываются сразу по событиям, а цикл - страховка раз в
+    ORDER_RECONCILE_INTERVAL_SEC; без слушателя - каждые 10 секунд.
+    Двойная защита ANALYZING: in-memory set + DB lock
     """
-    logger.info("🔄 Starting order monitoring loop (every 10 seconds)...")
+    logger.info("🔄 Starting order monitoring loop...")
     
     while True:
         try:
-            await asyncio.sleep(10)
+            if order_listener is not None and order_listener.connected:
+                await asyncio.sleep(settings.order_reconcile_interval_sec)
+            else:
+                await asyncio.sleep(POLL_INTERVAL_SEC)
             
-            # 1. Обрабатываем завершенные анализы (ANALYSIS_COMPLETE → OPTIMIZING → OPTIMIZED)
-            await process_analysis_complete_orders()
+            # 1. Обрабатываем завершенные анализы (ANALYSIS_COMPLETE → OPTIMIZING → OPTIMIZED);
+            #    пакетная оптимизация выполняется в обработчике - цикл её не ждёт
+            order_events.trigger(OrderStatus.ANALYSIS_COMPLETE)
             
             # 2. Обрабатываем оптимизированные заказы (OPTIMIZED → RESULTS_SENT)
-            await process_optimized_orders()
+            await order_events.run(OrderStatus.OPTIMIZED)
             
             # 3. Обрабатываем FAILED заказы (отправка уведомлений)
-            await process_failed_orders()
+            await order_events.run(OrderStatus.FAILED)
             
-            async for db in get_async_session():
-                # Быстрый SELECT только нужных полей
-                result = await db.execute(
-                    select(DBOrder.id, DBOrder.analysis_started_at, DBOrder.retry_count)
-                    .where(DBOrder.status == OrderStatus.ANALYZING)
-                )
-                orders_data = result.all()
-                
-                if not orders_data:
-                    break  # Нет заказов в ANALYZING
-                
-                for order_id, started_at, retry_count in orders_data:
-                    # Первая защита - in-memory
-                    if order_id in processing_order_ids:
-                        continue
-                    
-                    # Проверяем timeout
-                    if started_at:
-                        from datetime import timezone
-                        now = datetime.now(timezone.utc)
-                        elapsed = (now - started_at).total_seconds()
-                        if elapsed < 1800:  # Меньше 30 минут - все ок
-                            continue
-                    
-                    # Вторая защита - проверяем в БД с блокировкой
-                    order_result = await db.execute(
-                        select(DBOrder)
-                        .where(DBOrder.id == order_id)
-                        .with_for_update(skip_locked=True)
-                    )
-                    order = order_result.scalar_one_or_none()
-                    
-                    if not order or order.status != OrderStatus.ANALYZING:
-                        continue  # Уже обработан другим процессом
-                    
-                    # Обновляем и перезапускаем
-                    retry_count = (retry_count or 0) + 1
-                    
-                    if retry_count > 3:
-                        order.status = OrderStatus.FAILED
-                        order.error_details = {
-                            "error_message": "Analysis timeout - max retries exceeded",
-                            "failed_at": datetime.now().isoformat()
-                        }
-                        await db.commit()
-                        logger.error(f"❌ Order {order_id} failed after {retry_count} retries")
-                    else:
-                        order.analysis_started_at = datetime.now()
-                        order.retry_count = retry_count
-                        order.last_retry_reason = "timeout_recovery"
-                        await db.commit()
-                        
-                        logger.warning(f"🔄 Restarting order {order_id} analysis (retry {retry_count}/3)")
-                        asyncio.create_task(restart_order_analysis(order_id))
-                
-                break
+            # 4. Перезапускаем анализ, зависший в ANALYZING
+            await check_analyzing_timeouts()
                 
         except Exception as e:
             logger.error(f"❌ Error in monitor_analyzing_orders: {e}")
             await asyncio.sleep(30)  # Пауза при ошибке
 
 
+async def check_analyzing_timeouts():
+    """Заказы в ANALYZING дольше 30 минут: перезапуск анализа (до 3 раз) или FAILED"""
+    async for db in get_async_session():
+        # Быстрый SELECT только нужных полей
+        result = await db.execute(
+            select(DBOrder.id, DBOrder.analysis_started_at, DBOrder.retry_count)
+            .where(DBOrder.status == OrderStatus.ANALYZING)
+        )
+        orders_data = result.all()
+        
+        if not orders_data:
+            break  # Нет заказов в ANALYZING
+        
+        for order_id, started_at, retry_count in orders_data:
+            # Первая защита - in-memory
+            if order_id in processing_order_ids:
+                continue
+            
+            # Проверяем timeout
+            if started_at:
+                from datetime import timezone
+                now = datetime.now(timezone.utc)
+                elapsed = (now - started_at).total_seconds()
+                if elapsed < 1800:  # Меньше 30 минут - все ок
+                    continue
+            
+            # Вторая защита - проверяем в БД с блокировкой
+            order_result = await db.execute(
+                select(DBOrder)
+                .where(DBOrder.id == order_id)
+                .with_for_update(skip_locked=True)
+            )
+            order = order_result.scalar_one_or_none()
+            
+            if not order or order.status != OrderStatus.ANALYZING:
+                continue  # Уже обработан другим процессом
+            
+            # Обновляем и перезапускаем
+            retry_count = (retry_count or 0) + 1
+            
+            if retry_count > 3:
+                order.status = OrderStatus.FAILED
+                order.error_details = {
+                    "error_message": "Analysis timeout - max retries exceeded",
+                    "failed_at": datetime.now().isoformat()
+                }
+                await db.commit()
+                logger.error(f"❌ Order {order_id} failed after {retry_count} retries")
+            else:
+                order.analysis_started_at = datetime.now()
+                order.retry_count = retry_count
+                order.last_retry_reason = "timeout_recovery"
+                await db.commit()
+                
+                logger.warning(f"🔄 Restarting order {order_id} analysis (retry {retry_count}/3)")
+                asyncio.create_task(restart_order_analysis(order_id))
+        
+        break
+
+
 async def restart_order_analysis(order_id: int):
     """Перезапуск анализа с защитой от дублирования и очисткой старых результатов"""
     if order_id in processing_order_ids:
@@ -1278,6 +1587,8 @@ async def restart_order_analysis(order_id: int):
                     )
                 )
             )
+            # Снимок прошлой попытки - тоже (его читают предварительные оптимизации)
+            await clear_fprice_snapshot(db, order_id)
             await db.commit()
             logger.info(f"✅ Cleaned old search results for order {order_id}")
             break
@@ -1305,38 +1616,38 @@ async def send_telegram_message(
     try:
         logger.info(f"📤 Sending message via telegram-bot API to {chat_id}, length: {len(text)} chars")
 
-        async with httpx.AsyncClient() as client:
-            # Формируем payload, исключая None значения
-            payload = {
-                "chat_id": chat_id,
-                "text": text,
-                "parse_mode": parse_mode,
-                "disable_web_page_preview": disable_web_page_preview
-            }
+        client = http_clients.service('telegram-bot')
+        # Формируем payload, исключая None значения
+        payload = {
+            "chat_id": chat_id,
+            "text": text,
+            "parse_mode": parse_mode,
+            "disable_web_page_preview": disable_web_page_preview
+        }
 
-            # Добавляем необязательные параметры только если они не None
-            if order_id is not None:
-                payload["order_id"] = order_id
-            if reply_to_message_id is not None:
-                payload["reply_to_message_id"] = reply_to_message_id
+        # Добавляем необязательные параметры только если они не None
+        if order_id is not None:
+            payload["order_id"] = order_id
+        if reply_to_message_id is not None:
+            payload["reply_to_message_id"] = reply_to_message_id
 
-            response = await client.post(
-                "http://localhost:8001/api/send-message",
-                json=payload,
-                timeout=60.0  # Увеличен до 60 секунд для telegram-bot API
-            )
+        response = await client.post(
+            "/api/send-message",
+            json=payload,
+            timeout=60.0  # Увеличен до 60 секунд для telegram-bot API
+        )
 
-            if response.status_code == 200:
-                result = response.json()
-                if result.get("success"):
-                    logger.info(f"✅ Message sent successfully to {chat_id} (telegram_message_id={result.get('telegram_message_id')})")
-                    return True
-                else:
-                    logger.error(f"❌ telegram-bot API returned error: {result.get('error')}")
-                    return False
+        if response.status_code == 200:
+            result = response.json()
+            if result.get("success"):
+                logger.info(f"✅ Message sent successfully to {chat_id} (telegram_message_id={result.get('telegram_message_id')})")
+                return True
             else:
-                logger.error(f"❌ telegram-bot API request failed: {response.status_code} - {response.text}")
+                logger.error(f"❌ telegram-bot API returned error: {result.get('error')}")
                 return False
+        else:
+            logger.error(f"❌ telegram-bot API request failed: {response.status_code} - {response.text}")
+            return False
 
     except httpx.TimeoutException as e:
         logger.error(f"❌ Timeout calling telegram-bot API for {chat_id}: {e}")
@@ -1351,51 +1662,36 @@ async def send_telegram_message(
 async def process_analysis_complete_orders():
     """
     Обработка заказов в статусе ANALYSIS_COMPLETE.
-    Переводит в OPTIMIZING и запускает оптимизатор.
+    Каждый заказ оптимизируется в отдельной задаче (пул процессов optimizer_pool),
+    поэтому цикл мониторинга не ждёт окончания оптимизации. При
+    OPTIMIZER_BATCH_SIZE > 1 заказы забираются пачками (_optimize_batch_task)
+    и пачки выполняются здесь же, одна за другой, пока есть заказы: события,
+    пришедшие во время оптимизации, диспетчер схлопывает в один повторный
+    запуск, и следующая пачка забирает все накопившиеся заказы, а не по
+    заказу на событие.
     """
+    if settings.optimizer_batch_size > 1:
+        while await _optimize_batch_task() >= settings.optimizer_batch_size:
+            pass
+        return
+
     try:
         async for db in get_async_session():
             # Получаем заказы в ANALYSIS_COMPLETE
             result = await db.execute(
-                select(DBOrder).where(DBOrder.status == OrderStatus.ANALYSIS_COMPLETE)
+                select(DBOrder.id).where(DBOrder.status == OrderStatus.ANALYSIS_COMPLETE)
             )
-            orders = result.scalars().all()
+            order_ids = [order_id for order_id in result.scalars().all()
+                         if order_id not in optimizing_order_ids]
             
-            if not orders:
+            if not order_ids:
                 break
             
-            logger.info(f"📋 Found {len(orders)} orders in ANALYSIS_COMPLETE status")
+            logger.info(f"📋 Found {len(order_ids)} orders in ANALYSIS_COMPLETE status")
             
-            for order in orders:
-                # ===================================================================
-                # ЗАПУСК ОПТИМИЗАЦИИ: ANALYSIS_COMPLETE → OPTIMIZING → OPTIMIZED
-                # ===================================================================
-                logger.info(f"🎯 Starting optimization for order {order.id}...")
-                
-                optimization_result = await handle_analysis_complete(order.id, db)
-                
-                if not optimization_result.get('success'):
-                    logger.error(f"❌ Optimization failed for order {order.id}")
-                    logger.error(f"   Error: {optimization_result.get('error')}")
-                    # Статус уже установлен в FAILED внутри handle_analysis_complete
-                    
-                    # Если есть сообщение для пользователя - отправляем
-                    user_message = optimization_result.get('user_message')
-                    if user_message and order.tg_group:
-                        logger.info(f"📤 Sending failure notification to user for order {order.id}")
-                        await send_telegram_message(
-                            chat_id=order.tg_group,
-                            text=user_message,
-                            reply_to_message_id=order.telegram_message_id,
-                            parse_mode="HTML",
-                            disable_web_page_preview=True,
-                            order_id=order.id
-                        )
-                    
-                    continue
-                
-                # Логируем успешную оптимизацию
-                logger.info(format_optimization_results(order.id, optimization_result))
+            for order_id in order_ids:
+                optimizing_order_ids.add(order_id)
+                asyncio.create_task(_optimize_order_task(order_id))
             
             break
             
@@ -1405,6 +1701,115 @@ async def process_analysis_complete_orders():
         logger.error(traceback.format_exc())
 
 
+async def _optimize_order_task(order_id: int):
+    """Оптимизация одного заказа: ANALYSIS_COMPLETE → OPTIMIZING → OPTIMIZED / FAILED"""
+    try:
+        async for db in get_async_session():
+            order = await db.get(DBOrder, order_id)
+            if not order or order.status != OrderStatus.ANALYSIS_COMPLETE:
+                break
+            
+            # ===================================================================
+            # ЗАПУСК ОПТИМИЗАЦИИ: ANALYSIS_COMPLETE → OPTIMIZING → OPTIMIZED
+            # ===================================================================
+            logger.info(f"🎯 Starting optimization for order {order_id}...")
+            
+            optimization_result = await handle_analysis_complete(order_id, db)
+            await _report_optimization_result(
+                order_id, optimization_result, order.tg_group, order.telegram_message_id
+            )
+            break
+            
+    except Exception as e:
+        logger.error(f"❌ Error optimizing order {order_id}: {e}")
+        import traceback
+        logger.error(traceback.format_exc())
+    finally:
+        optimizing_order_ids.discard(order_id)
+
+
+async def _optimize_batch_task() -> int:
+    """
+    Пакетная оптимизация: до OPTIMIZER_BATCH_SIZE заказов ANALYSIS_COMPLETE
+    забираются FOR UPDATE SKIP LOCKED и оптимизируются общими задачами пула.
+
+    Returns:
+        Сколько заказов оптимизировано (0 - заказов нет, очередь полна или ошибка)
+    """
+    if optimizer_pool.is_full():
+        logger.warning(f"⏸️ Optimizer queue is full, postponing batch "
+                       f"({optimizer_pool.stats()['queue_depth']} queued)")
+        return 0
+
+    order_ids: list[int] = []
+    try:
+        async for db in get_async_session():
+            orders = await claim_analysis_complete_orders(
+                db, settings.optimizer_batch_size, exclude_ids=optimizing_order_ids
+            )
+            if not orders:
+                break
+            
+            order_ids = [order.id for order in orders]
+            optimizing_order_ids.update(order_ids)
+            # Чат и сообщение - до оптимизации: при ошибке сессия откатывается
+            # и атрибуты заказов истекают
+            reply_targets = {order.id: (order.tg_group, order.telegram_message_id) for order in orders}
+            
+            logger.info(f"🎯 Starting batch optimization for orders {order_ids}...")
+            results = await handle_analysis_complete_batch(orders, db)
+            
+            for order_id in order_ids:
+                tg_group, telegram_message_id = reply_targets[order_id]
+                await _report_optimization_result(
+                    order_id,
+                    results.get(order_id, {"success": False, "error": "No batch result"}),
+                    tg_group,
+                    telegram_message_id
+                )
+            break
+            
+    except Exception as e:
+        logger.error(f"❌ Error in batch optimization of orders {order_ids}: {e}")
+        import traceback
+        logger.error(traceback.format_exc())
+        return 0
+    finally:
+        optimizing_order_ids.difference_update(order_ids)
+
+    return len(order_ids)
+
+
+async def _report_optimization_result(order_id: int, optimization_result: dict,
+                                      tg_group, telegram_message_id):
+    """Лог результата оптимизации и уведомление пользователя о неудаче"""
+    if optimization_result.get('retry'):
+        # Очередь оптимизатора заполнена - заказ остался в ANALYSIS_COMPLETE
+        return
+    
+    if not optimization_result.get('success'):
+        logger.error(f"❌ Optimization failed for order {order_id}")
+        logger.error(f"   Error: {optimization_result.get('error')}")
+        # Статус уже установлен в FAILED обработчиком оптимизации
+        
+        # Если есть сообщение для пользователя - отправляем
+        user_message = optimization_result.get('user_message')
+        if user_message and tg_group:
+            logger.info(f"📤 Sending failure notification to user for order {order_id}")
+            await send_telegram_message(
+                chat_id=tg_group,
+                text=user_message,
+                reply_to_message_id=telegram_message_id,
+                parse_mode="HTML",
+                disable_web_page_preview=True,
+                order_id=order_id
+            )
+        return
+    
+    # Логируем успешную оптимизацию
+    logger.info(format_optimization_results(order_id, optimization_result))
+
+
 async def process_optimized_orders():
     """
     Обработка заказов в статусе OPTIMIZED.
@@ -1712,6 +2117,16 @@ async def run_service():
     # Проверяем зависшие заказы при старте
     await check_stuck_orders_on_startup()
     
+    # Обработчики статусов: по событиям NOTIFY order_status и в сверочном цикле
+    global order_listener
+    order_events.register(OrderStatus.ANALYSIS_COMPLETE, process_analysis_complete_orders)
+    order_events.register(OrderStatus.OPTIMIZED, process_optimized_orders)
+    order_events.register(OrderStatus.FAILED, process_failed_orders)
+    
+    if settings.order_events_enabled:
+        order_listener = OrderStatusListener(settings.database_url, order_events)
+        asyncio.create_task(order_listener.run())
+    
     # Запускаем мониторинг в фоне
     asyncio.create_task(monitor_analyzing_orders())
     
@@ -1724,7 +2139,12 @@ async def run_service():
     )
     
     server = uvicorn.Server(config)
-    await server.serve()
+    try:
+        await server.serve()
+    finally:
+        optimizer_pool.shutdown()
+        await http_clients.aclose()
+        await search_job_queue.close()
 
 
 if __name__ == "__main__":
@@ -210,8 +210,9 @@ class BasketOptimizer:
                 f"total={basket['total_with_delivery']:.2f}"
             )
         
-        # TODO: Шаг 3 (будущее улучшение) - пересмотр распределения
-        # Если добавление товара в другую корзину уменьшает общую стоимость доставки
+        # Шаг 3 - пересмотр распределения (перенос товаров, консолидация ЛСД, обмены
+        # с учётом диапазонов доставки и топапа) делает движок heuristic оптимизатора:
+        # services/optimizer/order_optimizer_heuristic.py
         
         return baskets
     
@@ -0,0 +1,92 @@
+"""
+Prometheus-метрики оптимизации заказов.
+
+Движки numpy и chunked возвращают stage_metrics - сводку по этапам optimize_order
+(services/optimizer/utils/stage_metrics.py): длительность, пик выделенной
+памяти и число комбинаций каждого этапа, размеры заказа. Оптимизация идёт в
+процессах optimizer_pool, поэтому сводка приходит сюда вместе с результатом
+и раскладывается в гистограммы с метками engine и stage; order-service
+отдаёт их на /metrics.
+"""
+
+import logging
+from typing import Any, Dict, Optional
+
+from prometheus_client import Histogram
+
+logger = logging.getLogger(__name__)
+
+STAGE_DURATION = Histogram(
+    'optimizer_stage_duration_seconds',
+    'Длительность этапа оптимизации заказа',
+    ['engine', 'stage'],
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+)
+
+STAGE_PEAK_ALLOC = Histogram(
+    'optimizer_stage_peak_alloc_bytes',
+    'Пик памяти, выделенной за этап оптимизации (tracemalloc)',
+    ['engine', 'stage'],
+    buckets=tuple(2 ** power for power in range(20, 34, 2))  # 1 MB .. 8 GB
+)
+
+STAGE_COMBINATIONS = Histogram(
+    'optimizer_stage_combinations',
+    'Комбинаций, обработанных этапом оптимизации',
+    ['engine', 'stage'],
+    buckets=(1e3, 1e4, 1e5, 1e6, 5e6, 1e7, 5e7, 1e8, 1e9)
+)
+
+ORDER_ITEMS = Histogram(
+    'optimizer_order_items',
+    'Товаров в оптимизируемом заказе',
+    ['engine'],
+    buckets=(1, 2, 4, 6, 8, 10, 15, 20, 30, 50)
+)
+
+ORDER_VARIANTS = Histogram(
+    'optimizer_order_variants',
+    'Вариантов (после исключений и отсечения) в оптимизируемом заказе',
+    ['engine'],
+    buckets=(5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+)
+
+ORDER_LSDS = Histogram(
+    'optimizer_order_lsds',
+    'ЛСД в оптимизируемом заказе',
+    ['engine'],
+    buckets=(1, 2, 3, 4, 6, 8, 12, 16, 24)
+)
+
+
+def observe_stage_metrics(stage_metrics: Optional[Dict[str, Any]]) -> bool:
+    """
+    Записывает сводку по этапам в гистограммы.
+
+    Args:
+        stage_metrics: result['stage_metrics'] движка (None - движок этапы не замерял)
+
+    Returns:
+        True, если сводка записана
+    """
+    if not stage_metrics:
+        return False
+
+    try:
+        engine = stage_metrics.get('engine', 'unknown')
+        for stage, record in stage_metrics.get('stages', {}).items():
+            STAGE_DURATION.labels(engine, stage).observe(record['duration_sec'])
+            if 'peak_alloc_bytes' in record:
+                STAGE_PEAK_ALLOC.labels(engine, stage).observe(record['peak_alloc_bytes'])
+            if 'combinations' in record:
+                STAGE_COMBINATIONS.labels(engine, stage).observe(record['combinations'])
+
+        if 'n_items' in stage_metrics:
+            ORDER_ITEMS.labels(engine).observe(stage_metrics['n_items'])
+            ORDER_VARIANTS.labels(engine).observe(stage_metrics['n_variants'])
+            ORDER_LSDS.labels(engine).observe(stage_metrics['n_lsds'])
+    except Exception as e:
+        logger.warning(f"⚠️ Failed to record optimizer stage metrics: {e}")
+        return False
+
+    return True
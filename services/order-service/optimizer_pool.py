@@ -0,0 +1,235 @@
+"""
+Пул процессов для оптимизации заказов.
+
+optimize_order_unified синхронный: держит psycopg2-соединение и считает
+секунды-минуты. Вызванный прямо из корутины, он останавливает весь event loop
+order-service (HTTP, monitor_analyzing_orders, отправку в Telegram). Здесь
+оптимизация уходит в отдельные процессы, а корутина только ждёт результата.
+
+- Не больше max_workers оптимизаций одновременно на хосте (Semaphore + пул того же размера)
+- Ограниченная очередь: при max_queue ожидающих задачах новая отклоняется
+  (OptimizerQueueFull) - заказ остаётся в ANALYSIS_COMPLETE до следующего цикла
+- По завершении вызывается on_success(result) или on_error(exc) - в них
+  обработчик переводит заказ в OPTIMIZED / FAILED
+- run_batch(): несколько заказов одной задачей (optimize_orders_batch) - общая
+  загрузка, общие lookup-таблицы доставки и одна транзакция записи корзин
+- has_idle_worker(): предварительная оптимизация (provisional_optimization.py)
+  запускается, только если не отнимает процесс у обычных задач
+- stats(): глубина очереди, число выполняемых задач, время ожидания и расчёта
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from config.settings import settings
+
+logger = logging.getLogger(__name__)
+
+
+class OptimizerQueueFull(Exception):
+    """Очередь оптимизации заполнена"""
+
+
+def _run_optimization(order_id: int, db_url: str, exclusions: Optional[Dict[str, Any]],
+                      engine: str, top_n: int) -> Dict[str, Any]:
+    """Выполняется в процессе пула."""
+    from services.optimizer.optimize import optimize_order_unified
+
+    return optimize_order_unified(
+        order_id=order_id,
+        db_connection_string=db_url,
+        engine=engine,
+        top_n=top_n,
+        exclusions=exclusions
+    )
+
+
+def _run_batch_optimization(order_ids: List[int], db_url: str,
+                            exclusions_by_order: Dict[int, Optional[Dict[str, Any]]],
+                            engine: str, top_n: int) -> Dict[int, Dict[str, Any]]:
+    """Выполняется в процессе пула: пакет заказов с общей загрузкой и записью."""
+    from services.optimizer.optimize_batch import optimize_orders_batch
+
+    return optimize_orders_batch(
+        order_ids,
+        db_url,
+        exclusions_by_order=exclusions_by_order,
+        engine=engine,
+        top_n=top_n
+    )
+
+
+class OptimizerPool:
+    """Пул процессов оптимизации с ограниченной очередью"""
+
+    def __init__(self, max_workers: int = 2, max_queue: int = 20):
+        """
+        Args:
+            max_workers: Одновременных оптимизаций на хосте
+            max_queue: Максимум задач, ожидающих свободный процесс
+        """
+        self.max_workers = max(1, max_workers)
+        self.max_queue = max(0, max_queue)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.last_wait_time = 0.0
+        self.total_run_time = 0.0
+
+    def _create_executor(self) -> ProcessPoolExecutor:
+        # spawn: процесс сервиса многопоточный (uvicorn, httpx), fork небезопасен
+        return ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def _ensure_started(self):
+        if self._executor is None:
+            self._executor = self._create_executor()
+            self._semaphore = asyncio.Semaphore(self.max_workers)
+            logger.info(f"🧮 Optimizer pool started: {self.max_workers} workers, queue limit {self.max_queue}")
+
+    def is_full(self) -> bool:
+        """Новая задача будет отклонена (все процессы заняты и очередь заполнена)."""
+        return self.running >= self.max_workers and self.queued >= self.max_queue
+
+    def has_idle_worker(self) -> bool:
+        """Есть свободный процесс и нет очереди - задача начнётся сразу."""
+        return self.running + self.queued < self.max_workers
+
+    async def run(self, order_id: int, db_url: str, exclusions: Optional[Dict[str, Any]] = None,
+                  engine: str = "auto", top_n: int = 10,
+                  on_success: Callable[[Dict[str, Any]], Awaitable[Any]] = None,
+                  on_error: Callable[[BaseException], Awaitable[Any]] = None) -> Any:
+        """
+        Ставит оптимизацию заказа в очередь и ждёт завершения.
+
+        Returns:
+            Результат on_success / on_error (или результат оптимизатора, если колбэков нет)
+
+        Raises:
+            OptimizerQueueFull: очередь заполнена, задача не принята
+        """
+        return await self._submit(
+            f"Order {order_id}", _run_optimization, (order_id, db_url, exclusions, engine, top_n),
+            on_success, on_error
+        )
+
+    async def run_batch(self, order_ids: List[int], db_url: str,
+                        exclusions_by_order: Optional[Dict[int, Optional[Dict[str, Any]]]] = None,
+                        engine: str = "auto", top_n: int = 10,
+                        on_success: Callable[[Dict[int, Dict[str, Any]]], Awaitable[Any]] = None,
+                        on_error: Callable[[BaseException], Awaitable[Any]] = None) -> Any:
+        """
+        Ставит пакет заказов в очередь одной задачей (services/optimizer/optimize_batch.py)
+        и ждёт завершения.
+
+        Returns:
+            Результат on_success / on_error (или {order_id: результат}, если колбэков нет)
+
+        Raises:
+            OptimizerQueueFull: очередь заполнена, задача не принята
+        """
+        return await self._submit(
+            f"Batch {order_ids}", _run_batch_optimization,
+            (list(order_ids), db_url, exclusions_by_order or {}, engine, top_n),
+            on_success, on_error
+        )
+
+    async def _submit(self, label: str, func: Callable[..., Any], args: tuple,
+                      on_success: Callable[[Any], Awaitable[Any]] = None,
+                      on_error: Callable[[BaseException], Awaitable[Any]] = None) -> Any:
+        """Очередь, слот пула и колбэки одной задачи (заказа или пакета)."""
+        self._ensure_started()
+
+        if self.is_full():
+            self.rejected += 1
+            raise OptimizerQueueFull(
+                f"Optimizer queue is full ({self.queued} queued, {self.running} running)"
+            )
+
+        self.queued += 1
+        enqueued_at = time.monotonic()
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.queued -= 1
+
+        wait_time = time.monotonic() - enqueued_at
+        self.last_wait_time = wait_time
+        self.total_wait_time += wait_time
+        self.max_wait_time = max(self.max_wait_time, wait_time)
+        if wait_time >= 1:
+            logger.info(f"⏳ {label}: waited {wait_time:.1f}s for optimizer worker")
+
+        self.running += 1
+        started_at = time.monotonic()
+        error = None
+        try:
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(self._executor, func, *args)
+        except BrokenProcessPool as e:
+            # Процесс пула убит (например, OOM) - пересоздаём пул для следующих задач
+            logger.error(f"❌ Optimizer pool is broken, restarting: {e}")
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = self._create_executor()
+            error = e
+        except Exception as e:
+            error = e
+        finally:
+            self.running -= 1
+            self.total_run_time += time.monotonic() - started_at
+            self._semaphore.release()
+
+        # Колбэки - после освобождения процесса: запись статуса не держит слот пула
+        if error is not None:
+            self.failed += 1
+            if on_error is None:
+                raise error
+            return await on_error(error)
+
+        self.completed += 1
+        if on_success is None:
+            return result
+        return await on_success(result)
+
+    def stats(self) -> Dict[str, Any]:
+        """Состояние очереди и времена ожидания."""
+        finished = self.completed + self.failed
+        started = finished + self.running
+        return {
+            'max_workers': self.max_workers,
+            'max_queue': self.max_queue,
+            'queue_depth': self.queued,
+            'running': self.running,
+            'completed': self.completed,
+            'failed': self.failed,
+            'rejected': self.rejected,
+            'avg_wait_sec': round(self.total_wait_time / started, 3) if started else 0.0,
+            'max_wait_sec': round(self.max_wait_time, 3),
+            'last_wait_sec': round(self.last_wait_time, 3),
+            'avg_run_sec': round(self.total_run_time / finished, 3) if finished else 0.0
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+            logger.info("🧮 Optimizer pool stopped")
+
+
+# Пул процесса order-service (процессы запускаются при первой задаче)
+optimizer_pool = OptimizerPool(
+    max_workers=settings.optimizer_max_workers or min(2, os.cpu_count() or 1),
+    max_queue=settings.optimizer_max_queue
+)
@@ -0,0 +1,153 @@
+"""
+События смены статуса заказа через PostgreSQL LISTEN/NOTIFY.
+
+Триггер на orders (миграция d4e5f6g7h8i9) при смене статуса делает
+pg_notify('order_status', {"order_id", "status", "old_status"}). Отдельное
+asyncpg-соединение слушает канал и сразу запускает обработчик статуса
+(ANALYSIS_COMPLETE → оптимизация, OPTIMIZED → отправка результатов, FAILED →
+уведомление), вместо ожидания следующего 10-секундного цикла мониторинга.
+
+- OrderEventDispatcher: обработчик статуса не выполняется параллельно сам с
+  собой; события, пришедшие во время выполнения, схлопываются в один повторный
+  запуск. Через него же идёт сверочный цикл monitor_analyzing_orders
+- OrderStatusListener: соединение LISTEN с переподключением; после
+  (пере)подключения запускает все обработчики - события, пришедшие без
+  слушателя, потеряны
+"""
+
+import asyncio
+import json
+import logging
+from typing import Awaitable, Callable, Dict, Optional, Set
+
+import asyncpg
+
+from shared.models.base import OrderStatus
+
+logger = logging.getLogger(__name__)
+
+ORDER_STATUS_CHANNEL = 'order_status'
+
+Handler = Callable[[], Awaitable[None]]
+
+
+class OrderEventDispatcher:
+    """Обработчики статусов заказа: один выполняющийся и не больше одного ожидающего запуска."""
+
+    def __init__(self):
+        self._handlers: Dict[OrderStatus, Handler] = {}
+        self._locks: Dict[OrderStatus, asyncio.Lock] = {}
+        self._pending: Set[OrderStatus] = set()
+        # Ссылки на запущенные задачи: цикл событий держит только слабые
+        self._tasks: Set[asyncio.Task] = set()
+
+    def register(self, status: OrderStatus, handler: Handler):
+        """Обработчик заказов в статусе status (обрабатывает все такие заказы)."""
+        self._handlers[status] = handler
+        self._locks[status] = asyncio.Lock()
+
+    @property
+    def statuses(self):
+        return list(self._handlers)
+
+    def trigger(self, status: OrderStatus):
+        """Запланировать запуск обработчика статуса, не дожидаясь его."""
+        if status not in self._handlers or status in self._pending:
+            return
+        self._pending.add(status)
+        task = asyncio.create_task(self._run_pending(status))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def trigger_all(self):
+        for status in self._handlers:
+            self.trigger(status)
+
+    async def _run_pending(self, status: OrderStatus):
+        async with self._locks[status]:
+            # Снимаем отметку до запуска: событие во время выполнения - ещё один запуск
+            self._pending.discard(status)
+            await self._call(status)
+
+    async def run(self, status: OrderStatus):
+        """Выполнить обработчик статуса (после уже выполняющегося запуска)."""
+        if status not in self._handlers:
+            return
+        async with self._locks[status]:
+            await self._call(status)
+
+    async def _call(self, status: OrderStatus):
+        try:
+            await self._handlers[status]()
+        except Exception as e:
+            logger.error(f"❌ Error in {status.value} handler: {e}")
+            import traceback
+            logger.error(traceback.format_exc())
+
+
+class OrderStatusListener:
+    """
+    Слушатель канала order_status на отдельном asyncpg-соединении.
+
+    Args:
+        dsn: PostgreSQL connection string (postgresql://...)
+        dispatcher: Обработчики статусов
+        reconnect_delay: Пауза перед переподключением, сек
+    """
+
+    def __init__(self, dsn: str, dispatcher: OrderEventDispatcher, reconnect_delay: float = 5.0):
+        self.dsn = dsn
+        self.dispatcher = dispatcher
+        self.reconnect_delay = reconnect_delay
+        self._conn: Optional[asyncpg.Connection] = None
+        self.events_received = 0
+
+    @property
+    def connected(self) -> bool:
+        return self._conn is not None and not self._conn.is_closed()
+
+    async def run(self):
+        """Слушать канал до отмены задачи; при обрыве - переподключаться."""
+        while True:
+            closed = asyncio.Event()
+            try:
+                self._conn = await asyncpg.connect(
+                    self.dsn, server_settings={'application_name': 'korzinka-order-events'}
+                )
+                self._conn.add_termination_listener(lambda conn: closed.set())
+                await self._conn.add_listener(ORDER_STATUS_CHANNEL, self._on_notify)
+                logger.info(f"📡 Listening for order status events on '{ORDER_STATUS_CHANNEL}'")
+
+                # События, пришедшие без слушателя, потеряны - сверяем все статусы
+                self.dispatcher.trigger_all()
+
+                await closed.wait()
+                logger.warning("⚠️ Order events connection closed, reconnecting...")
+            except Exception as e:
+                logger.error(f"❌ Order events listener error: {e}")
+            finally:
+                # Оборванное или сломанное соединение тоже закрываем - не оставляем сокет
+                await self.close()
+
+            await asyncio.sleep(self.reconnect_delay)
+
+    async def close(self):
+        conn, self._conn = self._conn, None
+        if conn is not None and not conn.is_closed():
+            try:
+                await conn.close()
+            except Exception as e:
+                logger.warning(f"⚠️ Failed to close order events connection gracefully: {e}")
+                conn.terminate()
+
+    def _on_notify(self, connection, pid: int, channel: str, payload: str):
+        try:
+            event = json.loads(payload)
+            status = OrderStatus(event['status'])
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f"⚠️ Bad order status event {payload!r}: {e}")
+            return
+
+        self.events_received += 1
+        logger.debug(f"📨 Order {event.get('order_id')}: {event.get('old_status')} → {status.value}")
+        self.dispatcher.trigger(status)
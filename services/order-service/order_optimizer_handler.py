@@ -3,8 +3,9 @@
 Интегрирует order_optimizer с жизненным циклом заказа.
 """
 
+import asyncio
 import logging
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional, Sequence
 import sys
 import os
 from datetime import datetime
@@ -13,8 +14,10 @@ import httpx
 # Добавляем путь к services для импорта оптимизатора
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 
-from services.optimizer.optimize import optimize_order_unified
 from config.settings import settings
+from shared.utils.http_client import http_clients
+from optimizer_pool import optimizer_pool, OptimizerQueueFull
+from optimizer_metrics import observe_stage_metrics
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from shared.database.models import Order as DBOrder, User as DBUser
@@ -31,37 +34,40 @@ async def get_user_exclusions(telegram_id: int) -> Optional[Dict[str, Any]]:
         telegram_id: Telegram ID пользователя
 
     Returns:
-        Dict с keywords и products для фильтрации, или None при ошибке
+        Dict с keywords и products для фильтрации (плюс user_id и version -
+        ключ кэша скомпилированных исключений в оптимизаторе), или None при ошибке
     """
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"http://localhost:{settings.user_service_port}/users/{telegram_id}/exclusions/keywords",
-                timeout=10.0
-            )
+        client = http_clients.service('user')
+        response = await client.get(
+            f"/users/{telegram_id}/exclusions/keywords",
+            timeout=10.0
+        )
 
-            if response.status_code == 200:
-                data = response.json()
-                if data.get('success'):
-                    exclusions = data.get('data', {})
-                    keywords = exclusions.get('keywords', [])
-                    products = exclusions.get('products', [])
-
-                    if keywords or products:
-                        logger.info(f"🚫 User {telegram_id} exclusions: {len(keywords)} keywords, {len(products)} products")
-                        return {
-                            'keywords': keywords,
-                            'products': products
-                        }
-                    else:
-                        logger.debug(f"User {telegram_id} has no exclusions")
-                        return None
-            elif response.status_code == 404:
-                logger.debug(f"No exclusions found for user {telegram_id}")
-                return None
-            else:
-                logger.warning(f"⚠️ Failed to get exclusions for user {telegram_id}: {response.status_code}")
-                return None
+        if response.status_code == 200:
+            data = response.json()
+            if data.get('success'):
+                exclusions = data.get('data', {})
+                keywords = exclusions.get('keywords', [])
+                products = exclusions.get('products', [])
+
+                if keywords or products:
+                    logger.info(f"🚫 User {telegram_id} exclusions: {len(keywords)} keywords, {len(products)} products")
+                    return {
+                        'keywords': keywords,
+                        'products': products,
+                        'user_id': telegram_id,
+                        'version': exclusions.get('version')
+                    }
+                else:
+                    logger.debug(f"User {telegram_id} has no exclusions")
+                    return None
+        elif response.status_code == 404:
+            logger.debug(f"No exclusions found for user {telegram_id}")
+            return None
+        else:
+            logger.warning(f"⚠️ Failed to get exclusions for user {telegram_id}: {response.status_code}")
+            return None
 
     except httpx.TimeoutException:
         logger.warning(f"⚠️ Timeout getting exclusions for user {telegram_id}")
@@ -75,15 +81,27 @@ async def handle_analysis_complete(order_id: int, db: AsyncSession) -> Dict[str,
     """
     Обработка заказа после завершения анализа (поиска товаров).
     
-    Переводит заказ: ANALYSIS_COMPLETE → OPTIMIZING → OPTIMIZED
+    Переводит заказ: ANALYSIS_COMPLETE → OPTIMIZING → OPTIMIZED / FAILED
+    
+    Оптимизация выполняется в пуле процессов (optimizer_pool), корутина только
+    ждёт результата - event loop сервиса не блокируется. Переходы
+    OPTIMIZING → OPTIMIZED / FAILED делают колбэки задачи
+    (_on_optimization_done / _on_optimization_error).
     
     Args:
         order_id: ID заказа
         db: AsyncSession для работы с БД
         
     Returns:
-        Dict с результатами оптимизации
+        Dict с результатами оптимизации; retry=True - очередь пула заполнена,
+        заказ остался в ANALYSIS_COMPLETE
     """
+    # Очередь заполнена - не трогаем статус, заказ возьмём в следующем цикле
+    if optimizer_pool.is_full():
+        logger.warning(f"⏸️ Order {order_id}: optimizer queue is full, postponing "
+                       f"({optimizer_pool.stats()['queue_depth']} queued)")
+        return {"success": False, "error": "optimizer_queue_full", "retry": True}
+
     try:
         # Загружаем заказ
         order = await db.get(DBOrder, order_id)
@@ -127,22 +145,214 @@ async def handle_analysis_complete(order_id: int, db: AsyncSession) -> Dict[str,
         # Получаем исключения пользователя (diet_type, категории, черный список)
         exclusions = await get_user_exclusions(telegram_id)
 
-        # Запускаем оптимизатор (топ-10 корзин)
+        # Запускаем оптимизатор (топ-10 корзин) в пуле процессов
         # Используем unified интерфейс с автовыбором движка (NumPy если доступен)
-        result = optimize_order_unified(
-            order_id=order_id,
-            db_connection_string=db_url,
-            engine="auto",  # Автоматический выбор: NumPy если доступен, иначе Legacy
-            top_n=10,
-            exclusions=exclusions  # Передаём исключения пользователя
+        try:
+            return await optimizer_pool.run(
+                order_id,
+                db_url,
+                exclusions=exclusions,  # Передаём исключения пользователя
+                engine="auto",  # Автоматический выбор: NumPy если доступен, иначе Legacy
+                top_n=10,
+                on_success=lambda result: _on_optimization_done(order_id, db, result),
+                on_error=lambda error: _on_optimization_error(order_id, db, error)
+            )
+        except OptimizerQueueFull:
+            # Очередь заполнилась, пока получали исключения - возвращаем заказ в очередь на оптимизацию
+            order.status = OrderStatus.ANALYSIS_COMPLETE
+            order.optimization_started_at = None
+            await db.commit()
+            logger.warning(f"⏸️ Order {order_id}: optimizer queue is full, OPTIMIZING → ANALYSIS_COMPLETE")
+            return {"success": False, "error": "optimizer_queue_full", "retry": True}
+        
+    except Exception as e:
+        logger.error(f"❌ Error optimizing order {order_id}: {e}")
+        import traceback
+        logger.error(traceback.format_exc())
+        
+        # Откат при неожиданной ошибке
+        try:
+            order = await db.get(DBOrder, order_id)
+            if order:
+                order.status = OrderStatus.FAILED
+                order.error_details = {
+                    "error_type": "unexpected_error",
+                    "message": str(e),
+                    "failed_at": datetime.now().isoformat()
+                }
+                await db.commit()
+        except Exception as rollback_error:
+            logger.error(f"❌ Error during rollback: {rollback_error}")
+        
+        return {
+            "success": False,
+            "error": str(e)
+        }
+
+
+async def claim_analysis_complete_orders(db: AsyncSession, limit: int,
+                                         exclude_ids: Sequence[int] = ()) -> List[DBOrder]:
+    """
+    Забирает до limit заказов ANALYSIS_COMPLETE на пакетную оптимизацию.
+    
+    SELECT ... FOR UPDATE SKIP LOCKED: заказы, которые в этот момент забирает
+    другой цикл или экземпляр order-service, пропускаются, а не ждут его транзакции.
+    Забранные заказы переводятся ANALYSIS_COMPLETE → OPTIMIZING одним commit.
+    
+    Args:
+        db: AsyncSession для работы с БД
+        limit: Максимум заказов в пакете
+        exclude_ids: Заказы, оптимизация которых уже запущена
+        
+    Returns:
+        Заказы в статусе OPTIMIZING
+    """
+    stmt = (
+        select(DBOrder)
+        .where(DBOrder.status == OrderStatus.ANALYSIS_COMPLETE)
+        .order_by(DBOrder.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    if exclude_ids:
+        stmt = stmt.where(DBOrder.id.notin_(list(exclude_ids)))
+
+    result = await db.execute(stmt)
+    orders = list(result.scalars().all())
+    if not orders:
+        await db.rollback()
+        return []
+
+    started_at = datetime.now()
+    for order in orders:
+        order.status = OrderStatus.OPTIMIZING
+        order.optimization_started_at = started_at
+    await db.commit()
+
+    logger.info(f"🎯 Orders {[order.id for order in orders]}: ANALYSIS_COMPLETE → OPTIMIZING (batch)")
+    return orders
+
+
+async def handle_analysis_complete_batch(orders: List[DBOrder], db: AsyncSession) -> Dict[int, Dict[str, Any]]:
+    """
+    Пакетная оптимизация заказов, забранных claim_analysis_complete_orders.
+    
+    Пакет делится на части по числу процессов optimizer_pool; каждая часть
+    оптимизируется одной задачей пула (services/optimizer/optimize_batch.py):
+    входные данные - одним запросом, lookup-таблицы доставки - общие, корзины -
+    одной транзакцией. Переходы OPTIMIZING → OPTIMIZED / FAILED выполняются
+    последовательно в этой сессии теми же _on_optimization_done / _on_optimization_error.
+    
+    Args:
+        orders: Заказы в статусе OPTIMIZING
+        db: AsyncSession для работы с БД
+        
+    Returns:
+        {order_id: результат как у handle_analysis_complete}
+    """
+    results: Dict[int, Dict[str, Any]] = {}
+
+    db_url = settings.database_url
+    if not db_url:
+        logger.error("❌ DATABASE_URL not configured")
+        for order in orders:
+            results[order.id] = await _on_optimization_error(
+                order.id, db, RuntimeError("DATABASE_URL not configured"))
+        return results
+
+    # Исключения пользователей (diet_type, категории, черный список) - параллельно
+    user_ids = {order.user_id for order in orders}
+    users = {
+        user.id: user
+        for user in (await db.execute(select(DBUser).where(DBUser.id.in_(user_ids)))).scalars().all()
+    }
+
+    order_ids = []
+    for order in orders:
+        if order.user_id in users:
+            order_ids.append(order.id)
+        else:
+            logger.error(f"❌ User not found for order {order.id}")
+            results[order.id] = await _on_optimization_error(order.id, db, RuntimeError("User not found"))
+
+    user_id_by_order = {order.id: order.user_id for order in orders}
+    exclusions = await asyncio.gather(*(
+        get_user_exclusions(users[user_id_by_order[order_id]].telegram_id) for order_id in order_ids
+    ))
+    exclusions_by_order = dict(zip(order_ids, exclusions))
+
+    # Части пакета - по одной на процесс пула
+    n_chunks = max(1, min(optimizer_pool.max_workers, len(order_ids)))
+    chunks = [order_ids[i::n_chunks] for i in range(n_chunks)]
+    chunks = [chunk for chunk in chunks if chunk]
+
+    outcomes = await asyncio.gather(*(
+        optimizer_pool.run_batch(
+            chunk,
+            db_url,
+            exclusions_by_order={order_id: exclusions_by_order[order_id] for order_id in chunk},
+            engine="auto",
+            top_n=10
         )
+        for chunk in chunks
+    ), return_exceptions=True)
+
+    for chunk, outcome in zip(chunks, outcomes):
+        if isinstance(outcome, OptimizerQueueFull):
+            # Очередь заполнилась - возвращаем заказы части в очередь на оптимизацию
+            for order_id in chunk:
+                order = await db.get(DBOrder, order_id)
+                if order:
+                    order.status = OrderStatus.ANALYSIS_COMPLETE
+                    order.optimization_started_at = None
+                results[order_id] = {"success": False, "error": "optimizer_queue_full", "retry": True}
+            await db.commit()
+            logger.warning(f"⏸️ Orders {chunk}: optimizer queue is full, OPTIMIZING → ANALYSIS_COMPLETE")
+            continue
+
+        if isinstance(outcome, BaseException):
+            for order_id in chunk:
+                results[order_id] = await _on_optimization_error(order_id, db, outcome)
+            continue
+
+        for order_id in chunk:
+            result = outcome.get(order_id)
+            if result is None:
+                results[order_id] = await _on_optimization_error(
+                    order_id, db, RuntimeError("Batch optimization returned no result"))
+            elif result.get('status') == 'error':
+                results[order_id] = await _on_optimization_error(
+                    order_id, db, RuntimeError(result.get('error', 'Batch optimization failed')))
+            else:
+                results[order_id] = await _on_optimization_done(order_id, db, result)
+
+    return results
+
+
+async def _on_optimization_done(order_id: int, db: AsyncSession, result: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Колбэк завершения задачи оптимизации: OPTIMIZING → OPTIMIZED / FAILED.
+    
+    Args:
+        order_id: ID заказа
+        db: AsyncSession для работы с БД
+        result: Результат optimize_order_unified
+        
+    Returns:
+        Dict с результатами оптимизации
+    """
+    try:
+        order = await db.get(DBOrder, order_id)
+        if not order:
+            logger.error(f"❌ Order {order_id} not found after optimization")
+            return {"success": False, "error": "Order not found"}
         
         # Проверяем статус оптимизации
         opt_status = result.get('status')
         
         if opt_status == 'no_data':
-            # Нет данных в fprice_optimizer - товары не найдены
-            logger.warning(f"⚠️ Order {order_id}: No products found in fprice_optimizer")
+            # Нет данных в fprice_snapshot - товары не найдены
+            logger.warning(f"⚠️ Order {order_id}: No products found in fprice_snapshot")
             
             order.status = OrderStatus.FAILED
             order.error_details = {
@@ -166,11 +376,25 @@ async def handle_analysis_complete(order_id: int, db: AsyncSession) -> Dict[str,
             order.status = OrderStatus.OPTIMIZED
             order.optimization_completed_at = datetime.now()
             
-            # Сохраняем missing_mono_lsds в analysis_result (если есть)
+            # Этапы движка - в гистограммы Prometheus (/metrics); при попадании
+            # в кэш результатов движок не запускался, сводка - от прошлого прогона
+            stage_metrics = result.get('stage_metrics') if result.get('cache') != 'hit' else None
+            observe_stage_metrics(stage_metrics)
+
+            # Сохраняем missing_mono_lsds, статистику кэша и этапы движка в analysis_result.
+            # Присваиваем новый dict: изменения внутри JSON-колонки SQLAlchemy не отслеживает
+            analysis_result = dict(order.analysis_result or {})
             if result.get('missing_mono_lsds'):
-                if not order.analysis_result:
-                    order.analysis_result = {}
-                order.analysis_result['missing_mono_lsds'] = result['missing_mono_lsds']
+                analysis_result['missing_mono_lsds'] = result['missing_mono_lsds']
+            if result.get('cache'):
+                analysis_result['optimizer_cache'] = {
+                    'status': result['cache'],
+                    'key': result.get('cache_key'),
+                    **result.get('cache_stats', {})
+                }
+            if stage_metrics:
+                analysis_result['optimizer_stages'] = stage_metrics
+            order.analysis_result = analysis_result
             
             await db.commit()
             
@@ -183,6 +407,8 @@ async def handle_analysis_complete(order_id: int, db: AsyncSession) -> Dict[str,
             logger.info(f"   Best basket: #{result['best_basket_id']}")
             logger.info(f"   Best cost: {result['best_total_cost']:.2f}₽")
             logger.info(f"   Execution time: {result['elapsed_time']:.2f}s")
+            if result.get('cache'):
+                logger.info(f"   Result cache: {result['cache']}")
             if result.get('performance_comb_per_sec'):
                 logger.info(f"   Performance: {result['performance_comb_per_sec']:,} comb/sec")
             if result.get('missing_mono_lsds'):
@@ -213,28 +439,33 @@ async def handle_analysis_complete(order_id: int, db: AsyncSession) -> Dict[str,
             }
         
     except Exception as e:
-        logger.error(f"❌ Error optimizing order {order_id}: {e}")
-        import traceback
-        logger.error(traceback.format_exc())
-        
-        # Откат при неожиданной ошибке
-        try:
-            order = await db.get(DBOrder, order_id)
-            if order:
-                order.status = OrderStatus.FAILED
-                order.error_details = {
-                    "error_type": "unexpected_error",
-                    "message": str(e),
-                    "failed_at": datetime.now().isoformat()
-                }
-                await db.commit()
-        except Exception as rollback_error:
-            logger.error(f"❌ Error during rollback: {rollback_error}")
-        
-        return {
-            "success": False,
-            "error": str(e)
-        }
+        return await _on_optimization_error(order_id, db, e)
+
+
+async def _on_optimization_error(order_id: int, db: AsyncSession, error: BaseException) -> Dict[str, Any]:
+    """Колбэк ошибки задачи оптимизации: OPTIMIZING → FAILED."""
+    logger.error(f"❌ Error optimizing order {order_id}: {error}")
+    import traceback
+    logger.error(''.join(traceback.format_exception(type(error), error, error.__traceback__)))
+    
+    try:
+        await db.rollback()
+        order = await db.get(DBOrder, order_id)
+        if order:
+            order.status = OrderStatus.FAILED
+            order.error_details = {
+                "error_type": "unexpected_error",
+                "message": str(error),
+                "failed_at": datetime.now().isoformat()
+            }
+            await db.commit()
+    except Exception as rollback_error:
+        logger.error(f"❌ Error during rollback: {rollback_error}")
+    
+    return {
+        "success": False,
+        "error": str(error)
+    }
 
 
 def format_optimization_results(order_id: int, result: Dict[str, Any]) -> str:
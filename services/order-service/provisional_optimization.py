@@ -0,0 +1,193 @@
+"""
+Предварительная оптимизация заказа, пока ЛСД ещё ищут.
+
+perform_order_analysis ждёт все ЛСД, прежде чем перевести заказ в
+ANALYSIS_COMPLETE, и один медленный магазин задерживает весь заказ. Когда
+отчиталась доля ЛСД ANYTIME_OPTIMIZATION_LSD_FRACTION, оптимизатор
+запускается на том, что уже лежит в fprice_snapshot (RPA-сервис обновляет
+снимок по мере сохранения товаров), и повторно - после каждого следующего ЛСД.
+Движок читает заказ и пишет корзины в одной транзакции REPEATABLE READ
+(columnar_loader.use_consistent_snapshot) - перезапись снимка во время
+запуска не смешивает строки разных версий.
+
+- Корзины пишутся в basket_* как обычно, сводка - в
+  orders.analysis_result['provisional_optimization']; бот берёт их через
+  GET /orders/{order_id}/baskets/provisional
+- Один запуск на заказ за раз; ЛСД, отчитавшиеся во время запуска,
+  схлопываются в один повторный запуск
+- Только при свободном процессе optimizer_pool - обычные оптимизации не ждут
+- Повтор на неизменившемся снимке (ЛСД ничего не нашёл) отдаётся из кэша
+  результатов оптимизатора (services/optimizer/utils/result_cache.py), если
+  попал на тот же процесс optimizer_pool: кэш живёт в памяти процесса
+- finish() перед ANALYSIS_COMPLETE дожидается текущего запуска: его корзины
+  не перезапишут результат окончательной оптимизации
+- Сводка помечена попыткой анализа (analysis_result['analysis_attempt']):
+  после force-retry / перезапуска запуски старой попытки не пишут сводку,
+  а эндпоинт не отдаёт сводку чужой попытки
+"""
+
+import asyncio
+import json
+import logging
+from datetime import datetime
+from typing import Any, Dict, Optional, Set
+
+from sqlalchemy import text
+
+from config.settings import settings
+from optimizer_pool import optimizer_pool, OptimizerQueueFull
+from order_optimizer_handler import get_user_exclusions
+from shared.database import get_async_session
+
+logger = logging.getLogger(__name__)
+
+
+class ProvisionalOptimization:
+    """
+    Предварительные оптимизации одного заказа по мере готовности ЛСД.
+
+    Args:
+        order_id: ID заказа
+        telegram_id: Telegram ID пользователя (исключения)
+        total_lsds: Сколько ЛСД ищут товары заказа
+        lsd_fraction: Доля отчитавшихся ЛСД для первого запуска (0 - выключено)
+        attempt: Метка попытки анализа (analysis_result['analysis_attempt'])
+    """
+
+    def __init__(self, order_id: int, telegram_id: int, total_lsds: int, lsd_fraction: float,
+                 attempt: Optional[str] = None):
+        self.order_id = order_id
+        self.attempt = attempt
+        self.telegram_id = telegram_id
+        self.total_lsds = total_lsds
+        self.lsd_fraction = lsd_fraction
+        self.reported: Set[str] = set()
+        self.runs = 0
+        self._task: Optional[asyncio.Task] = None
+        self._dirty = False
+        self._finished = False
+        self._exclusions: Optional[Dict[str, Any]] = None
+        self._exclusions_loaded = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.lsd_fraction > 0 and self.total_lsds > 1
+
+    def lsd_done(self, lsd_name: str):
+        """ЛСД закончил поиск (успешно, частично или с ошибкой)."""
+        self.reported.add(lsd_name)
+        if not self.enabled or self._finished:
+            return
+        # Все ЛСД отчитались - дальше окончательная оптимизация
+        if len(self.reported) >= self.total_lsds:
+            return
+        if len(self.reported) < self.lsd_fraction * self.total_lsds:
+            return
+
+        self._dirty = True
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def finish(self):
+        """Больше не запускать; дождаться текущего запуска."""
+        self._finished = True
+        if self._task is not None and not self._task.done():
+            logger.info(f"⏳ Order {self.order_id}: waiting for provisional optimization to finish")
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _run(self):
+        while self._dirty and not self._finished:
+            self._dirty = False
+            lsds = sorted(self.reported)
+
+            if not optimizer_pool.has_idle_worker():
+                logger.info(f"⏭️ Order {self.order_id}: optimizer busy, skipping provisional run "
+                            f"({len(lsds)}/{self.total_lsds} LSDs)")
+                return
+
+            if not await self._attempt_is_current():
+                logger.info(f"⏭️ Order {self.order_id}: analysis attempt {self.attempt} was superseded, "
+                            f"stopping provisional runs")
+                self._finished = True
+                return
+
+            if not self._exclusions_loaded:
+                self._exclusions = await get_user_exclusions(self.telegram_id)
+                self._exclusions_loaded = True
+
+            logger.info(f"🔮 Order {self.order_id}: provisional optimization on "
+                        f"{len(lsds)}/{self.total_lsds} LSDs ({', '.join(lsds)})")
+            try:
+                result = await optimizer_pool.run(
+                    self.order_id,
+                    settings.database_url,
+                    exclusions=self._exclusions,
+                    engine="auto",
+                    top_n=10
+                )
+            except OptimizerQueueFull:
+                logger.info(f"⏭️ Order {self.order_id}: optimizer queue is full, skipping provisional run")
+                return
+            except Exception as e:
+                logger.warning(f"⚠️ Order {self.order_id}: provisional optimization failed: {e}")
+                continue
+
+            self.runs += 1
+            if result.get('status') != 'success':
+                logger.info(f"🔮 Order {self.order_id}: provisional optimization returned {result.get('status')}")
+                continue
+
+            await self._store_summary(lsds, result)
+            logger.info(f"🔮 Order {self.order_id}: provisional best basket #{result.get('best_basket_id')} "
+                        f"{result.get('best_total_cost') or 0:.2f}₽ ({len(lsds)}/{self.total_lsds} LSDs"
+                        + (f", cache {result['cache']}" if result.get('cache') else "") + ")")
+
+    async def _attempt_is_current(self) -> bool:
+        """Попытка анализа не сменилась (нет force-retry / перезапуска)."""
+        current = None
+        try:
+            async for db in get_async_session():
+                result = await db.execute(
+                    text("SELECT analysis_result::jsonb ->> 'analysis_attempt' FROM orders WHERE id = :order_id"),
+                    {"order_id": self.order_id}
+                )
+                current = result.scalar()
+                break
+        except Exception as e:
+            logger.warning(f"⚠️ Failed to check analysis attempt of order {self.order_id}: {e}")
+            return False
+        return current == self.attempt
+
+    async def _store_summary(self, lsds, result: Dict[str, Any]):
+        """Сводка в orders.analysis_result['provisional_optimization'] (jsonb-слияние одним UPDATE)."""
+        summary = {
+            "lsds_reported": lsds,
+            "lsds_total": self.total_lsds,
+            "engine": result.get('engine'),
+            "best_basket_id": result.get('best_basket_id'),
+            "best_total_cost": result.get('best_total_cost'),
+            "saved_baskets": result.get('saved_baskets'),
+            "cache": result.get('cache'),
+            "run": self.runs,
+            "attempt": self.attempt,
+            "computed_at": datetime.now().isoformat()
+        }
+        try:
+            async for db in get_async_session():
+                await db.execute(
+                    text("""
+                        UPDATE orders
+                        SET analysis_result = (
+                            COALESCE(analysis_result::jsonb, '{}'::jsonb)
+                            || jsonb_build_object('provisional_optimization', CAST(:summary AS jsonb))
+                        )::json
+                        WHERE id = :order_id
+                          AND analysis_result::jsonb ->> 'analysis_attempt' IS NOT DISTINCT FROM CAST(:attempt AS text)
+                    """),
+                    {"order_id": self.order_id, "summary": json.dumps(summary, default=str),
+                     "attempt": self.attempt}
+                )
+                await db.commit()
+                break
+        except Exception as e:
+            logger.warning(f"⚠️ Failed to store provisional optimization of order {self.order_id}: {e}")
@@ -0,0 +1,202 @@
+"""
+Поиск товаров ЛСД через распределённую очередь заданий (RPA_JOB_QUEUE_ENABLED).
+
+Вместо вызова /search/products/stream одного RPA-сервиса товары ЛСД делятся на
+пачки по RPA_JOB_BATCH_SIZE, и каждая пачка - задание Celery в очереди
+rpa_search (shared/utils/search_jobs.py). Задания забирают воркеры
+services/rpa-service/search_worker.py на любых хостах; результаты они сохраняют
+через save_search_results_to_db, сюда приходят те же события item / done / error.
+
+- Пока воркер держит аренду (heartbeat каждые RPA_JOB_LEASE_SEC / 3), задание
+  ждёт сколько угодно; аренда истекла без done - старая доставка отменяется,
+  ещё не готовые товары пачки уходят новым заданием (до MAX_LSD_RETRIES раз)
+- Задание, которое никто не взял за RPA_JOB_QUEUE_TIMEOUT_SEC, снимается;
+  доставка, от которой воркер отказался (событие skipped), доставляется заново
+- Итог как у _call_rpa_search_stream: partial=True, если часть товаров не готова
+"""
+
+import asyncio
+import json
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import redis.asyncio as aioredis
+
+from config.settings import settings
+from shared.utils.search_jobs import (
+    celery_app,
+    SEARCH_TASK,
+    JOB_KEY_TTL_SEC,
+    make_job,
+    events_key,
+    lease_key,
+    cancel_key,
+)
+
+logger = logging.getLogger(__name__)
+
+_redis: Optional[aioredis.Redis] = None
+
+
+def _get_redis() -> aioredis.Redis:
+    global _redis
+    if _redis is None:
+        _redis = aioredis.Redis.from_url(settings.redis_url)
+    return _redis
+
+
+async def close():
+    """Закрыть соединения с Redis (при остановке сервиса)."""
+    global _redis
+    if _redis is not None:
+        await _redis.close()
+        _redis = None
+
+
+def _batches(products: List[Dict[str, Any]], batch_size: int) -> List[List[Dict[str, Any]]]:
+    if batch_size <= 0:
+        return [products]
+    return [products[i:i + batch_size] for i in range(0, len(products), batch_size)]
+
+
+async def search_via_job_queue(
+    order_id: int,
+    telegram_id: int,
+    lsd_name: str,
+    products: List[Dict[str, Any]],
+    on_item: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None
+) -> Dict[str, Any]:
+    """
+    Поиск товаров в ЛСД заданиями очереди; для каждого готового товара (уже
+    сохранённого воркером) вызывается on_item(event).
+
+    Returns:
+        Итог как у /search/products (results_found, results_saved, failed_products);
+        partial=True, если не все пачки завершились; {} - если не готово ничего
+    """
+    batches = _batches(products, settings.rpa_job_batch_size)
+    logger.info(f"📨 Queueing {len(batches)} search job(s) for {lsd_name}: {len(products)} products")
+
+    # order_item_id -> событие item
+    items: Dict[int, Dict[str, Any]] = {}
+    completed = await asyncio.gather(*(
+        _run_batch(order_id, telegram_id, lsd_name, batch_num, batch, items, on_item)
+        for batch_num, batch in enumerate(batches, 1)
+    ))
+
+    if not all(completed) and not items:
+        return {}
+
+    found_item_ids = {item_id for item_id, event in items.items() if event.get('results_found')}
+    summary = {
+        "lsd_name": lsd_name,
+        "products_searched": len(products),
+        "results_found": sum(event.get('results_found', 0) for event in items.values()),
+        "results_saved": sum(event.get('results_saved', 0) for event in items.values()),
+        "failed_products": [product['order_item_id'] for product in products
+                            if product['order_item_id'] not in found_item_ids]
+    }
+    if not all(completed):
+        logger.warning(f"⚠️ Job queue search in {lsd_name} ended early: {len(items)}/{len(products)} items finished")
+        summary["partial"] = True
+    return summary
+
+
+async def _run_batch(
+    order_id: int,
+    telegram_id: int,
+    lsd_name: str,
+    batch_num: int,
+    products: List[Dict[str, Any]],
+    items: Dict[int, Dict[str, Any]],
+    on_item: Optional[Callable[[Dict[str, Any]], Awaitable[None]]]
+) -> bool:
+    """Пачка товаров с повторной доставкой при потере аренды. True - пачка завершена."""
+    r = _get_redis()
+    remaining = products
+
+    for attempt in range(settings.max_lsd_retries + 1):
+        job = make_job(order_id, telegram_id, lsd_name, batch_num, attempt, remaining)
+        job_id = job['job_id']
+        await asyncio.to_thread(celery_app.send_task, SEARCH_TASK, args=[job])
+
+        outcome = await _wait_job(r, job_id, items, on_item)
+        if outcome == 'done':
+            return True
+        if outcome == 'error':
+            return False
+
+        # Доставка потеряна или не взята - воркер, если он ещё жив, её бросит
+        await r.set(cancel_key(job_id), 1, ex=JOB_KEY_TTL_SEC)
+        if outcome == 'queue_timeout':
+            logger.error(f"⏰ Job {job_id}: no RPA worker took it in {settings.rpa_job_queue_timeout_sec}s")
+            return False
+
+        remaining = [product for product in remaining if product['order_item_id'] not in items]
+        if not remaining:
+            return True
+        reason = "skipped by worker" if outcome == 'skipped' else "lease expired"
+        logger.warning(f"🔁 Job {job_id}: {reason}, re-delivering {len(remaining)} unfinished products "
+                       f"({attempt + 1}/{settings.max_lsd_retries})")
+
+    logger.error(f"❌ {lsd_name} batch {batch_num}: max re-deliveries ({settings.max_lsd_retries}) reached")
+    return False
+
+
+async def _wait_job(
+    r: aioredis.Redis,
+    job_id: str,
+    items: Dict[int, Dict[str, Any]],
+    on_item: Optional[Callable[[Dict[str, Any]], Awaitable[None]]]
+) -> str:
+    """События доставки до конца: 'done', 'error', 'lost' (аренда истекла),
+    'skipped' (воркер отказался от доставки) или 'queue_timeout'."""
+    check_interval = max(1, settings.rpa_job_lease_sec // 3)
+    enqueued_at = time.monotonic()
+    worker = None
+
+    try:
+        while True:
+            popped = await r.blpop([events_key(job_id)], timeout=check_interval)
+            if popped is None:
+                if worker is None:
+                    if time.monotonic() - enqueued_at > settings.rpa_job_queue_timeout_sec:
+                        return 'queue_timeout'
+                elif not await r.exists(lease_key(job_id)):
+                    logger.warning(f"💔 Job {job_id}: worker {worker} stopped renewing its lease")
+                    return 'lost'
+                continue
+
+            event = json.loads(popped[1])
+            kind = event.get('event')
+
+            if kind == 'started':
+                worker = event.get('worker')
+                logger.info(f"🖥️ Job {job_id} taken by {worker} after {time.monotonic() - enqueued_at:.1f}s")
+            elif kind == 'item':
+                worker = worker or 'unknown'
+                items[event['order_item_id']] = event
+                logger.info(f"📦 Job {job_id}: item {event['order_item_id']} ready "
+                            f"({event.get('items_done')}/{event.get('items_total')}, "
+                            f"{event.get('results_saved', 0)} saved)")
+                if on_item is not None:
+                    await on_item(event)
+            elif kind == 'done':
+                logger.info(f"✅ Job {job_id} completed on {event.get('worker')}: "
+                            f"{event.get('results_saved', 0)} results saved")
+                return 'done'
+            elif kind == 'error':
+                logger.error(f"❌ Job {job_id} failed on {event.get('worker')}: {event.get('message')}")
+                return 'error'
+            elif kind == 'skipped':
+                if event.get('reason') == 'leased':
+                    # Повторная доставка сообщения, задание уже выполняет другой процесс - ждём его аренду
+                    worker = worker or event.get('leased_by') or 'unknown'
+                    logger.info(f"⏭️ Job {job_id}: duplicate delivery skipped by {event.get('worker')}, "
+                                f"running on {worker}")
+                else:
+                    logger.warning(f"⏭️ Job {job_id} skipped by {event.get('worker')}: {event.get('reason')}")
+                    return 'skipped'
+    finally:
+        await r.delete(events_key(job_id))
@@ -6,6 +6,8 @@ import httpx
 import base64
 from typing import Optional
 
+from shared.utils.http_client import http_clients
+
 logger = logging.getLogger(__name__)
 
 
@@ -42,39 +44,39 @@ async def send_telegram_document(
         # Кодируем документ в base64
         document_base64 = base64.b64encode(document).decode('utf-8')
 
-        async with httpx.AsyncClient() as client:
-            # Формируем payload, исключая None значения
-            payload = {
-                "chat_id": chat_id,
-                "document_base64": document_base64,
-                "filename": filename
-            }
+        client = http_clients.service('telegram-bot')
+        # Формируем payload, исключая None значения
+        payload = {
+            "chat_id": chat_id,
+            "document_base64": document_base64,
+            "filename": filename
+        }
 
-            # Добавляем необязательные параметры только если они не None
-            if caption is not None:
-                payload["caption"] = caption
-            if order_id is not None:
-                payload["order_id"] = order_id
-            if reply_to_message_id is not None:
-                payload["reply_to_message_id"] = reply_to_message_id
+        # Добавляем необязательные параметры только если они не None
+        if caption is not None:
+            payload["caption"] = caption
+        if order_id is not None:
+            payload["order_id"] = order_id
+        if reply_to_message_id is not None:
+            payload["reply_to_message_id"] = reply_to_message_id
 
-            response = await client.post(
-                "http://localhost:8001/api/send-document",
-                json=payload,
-                timeout=60.0  # Увеличенный таймаут для загрузки файла
-            )
+        response = await client.post(
+            "/api/send-document",
+            json=payload,
+            timeout=60.0  # Увеличенный таймаут для загрузки файла
+        )
 
-            if response.status_code == 200:
-                result = response.json()
-                if result.get("success"):
-                    logger.info(f"✅ Document sent successfully to {chat_id} (telegram_message_id={result.get('telegram_message_id')})")
-                    return True
-                else:
-                    logger.error(f"❌ telegram-bot API returned error: {result.get('error')}")
-                    return False
+        if response.status_code == 200:
+            result = response.json()
+            if result.get("success"):
+                logger.info(f"✅ Document sent successfully to {chat_id} (telegram_message_id={result.get('telegram_message_id')})")
+                return True
             else:
-                logger.error(f"❌ telegram-bot API request failed: {response.status_code} - {response.text}")
+                logger.error(f"❌ telegram-bot API returned error: {result.get('error')}")
                 return False
+        else:
+            logger.error(f"❌ telegram-bot API request failed: {response.status_code} - {response.text}")
+            return False
 
     except httpx.TimeoutException as e:
         logger.error(f"❌ Timeout calling telegram-bot API for {chat_id}: {e}")
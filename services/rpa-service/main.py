@@ -18,8 +18,9 @@ setup_service_logging('rpa-service', level=logging.INFO)
 import re
 import json
 import asyncio
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Callable, Awaitable
 from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 import uvicorn
 import urllib.parse as urlparse
@@ -31,6 +32,7 @@ import time
 from shared.database import get_async_session
 from shared.database.models import LSDConfig, User, Order, OrderItem, LSDStock, UserSession
 from shared.utils.text_normalizer import normalize_product_name
+from shared.utils.http_client import http_clients
 from order_quantity_calculator import calculate_order_quantity
 from shared.utils.text_processing import (
     get_word_synonyms, 
@@ -75,6 +77,7 @@ from contextlib import asynccontextmanager
 
 from shared.models.base import OrderStatus
 from shared.utils.units import get_base_unit, convert_to_base_unit
+from shared.utils.fprice_snapshot import refresh_fprice_snapshot, clear_fprice_snapshot
 from shared.utils.egg_categories import get_egg_category_coefficient, extract_egg_category, extract_egg_count_from_name
 from sqlalchemy import select, update
 from config.settings import settings
@@ -574,6 +577,9 @@ async def lifespan(app: FastAPI):
         except asyncio.CancelledError:
             pass
 
+    # Пулы HTTP-соединений к telegram-bot
+    await http_clients.aclose()
+
 # Хранилище для SMS кодов больше не нужно - используем БД
 
 app = FastAPI(
@@ -688,134 +694,232 @@ async def check_user_profiles(telegram_id: int):
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.post("/search/products")
-async def search_products(request: ProductSearchRequest):
-    """Поиск товаров в ЛСД через Selenium RPA"""
-    logger.info(f"🔍 Starting Selenium product search for {request.lsd_name} (user: {request.telegram_id})")
-    logger.info(f"📦 Products to search: {len(request.products)}")
+async def _load_search_context(request: ProductSearchRequest):
+    """Куки пользователя, конфигурация ЛСД и конфигурация поиска (HTTPException, если чего-то нет)"""
+    # Проверяем наличие кук пользователя для данного ЛСД
+    cookies_data = await get_user_cookies(request.telegram_id, request.lsd_name)
+    if not cookies_data:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Куки для {request.lsd_name} не найдены. Сначала выполните авторизацию."
+        )
     
-    try:
-        # Проверяем наличие кук пользователя для данного ЛСД
-        cookies_data = await get_user_cookies(request.telegram_id, request.lsd_name)
-        if not cookies_data:
-            raise HTTPException(
-                status_code=400,
-                detail=f"Куки для {request.lsd_name} не найдены. Сначала выполните авторизацию."
-            )
-        
-        # Получаем конфигурацию ЛСД
-        lsd_config = await get_lsd_config(request.lsd_name)
-        if not lsd_config:
-            raise HTTPException(
-                status_code=404,
-                detail=f"Конфигурация для {request.lsd_name} не найдена."
-            )
-        
-        # Получаем конфигурацию поиска для ЛСД
-        search_config = lsd_config.search_config_rpa
-        if not search_config:
-            raise HTTPException(
-                status_code=400,
-                detail=f"Конфигурация поиска отсутствует для {request.lsd_name}"
-            )
-        
-        logger.info(f"📋 Using enhanced search config for {lsd_config.display_name}")
+    # Получаем конфигурацию ЛСД
+    lsd_config = await get_lsd_config(request.lsd_name)
+    if not lsd_config:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Конфигурация для {request.lsd_name} не найдена."
+        )
+    
+    # Получаем конфигурацию поиска для ЛСД
+    search_config = lsd_config.search_config_rpa
+    if not search_config:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Конфигурация поиска отсутствует для {request.lsd_name}"
+        )
+    
+    logger.info(f"📋 Using enhanced search config for {lsd_config.display_name}")
 
-        # КРИТИЧНО: Retry logic с MAX_LSD_RETRIES из .env
-        max_retries = settings.max_lsd_retries
-        search_timeout_seconds = settings.rpa_search_timeout_sec
-        retry_count = 0
-        search_results = []
+    return cookies_data, lsd_config, search_config
 
-        while retry_count <= max_retries:
-            # Захватываем слот в браузерном семафоре для ограничения параллелизма
-            logger.info(f"🔒 [{lsd_config.display_name}] Waiting for browser slot (limit: {settings.max_concurrent_browsers})...")
 
-            try:
-                async with browser_semaphore:
-                    acquired_slots = browser_semaphore._value
-                    logger.info(f"✅ [{lsd_config.display_name}] Browser slot acquired (free slots: {acquired_slots}/{settings.max_concurrent_browsers})")
+async def _run_search_with_retries(
+    request: ProductSearchRequest,
+    lsd_config,
+    search_config: dict,
+    cookies_data: dict,
+    on_item_done: Optional[Callable[[Dict[str, Any], List[ProductSearchResult]], Awaitable[None]]] = None
+) -> List[ProductSearchResult]:
+    """
+    Поиск в ЛСД в слоте браузерного семафора с таймаутом RPA_SEARCH_TIMEOUT_SEC
+    и повторами MAX_LSD_RETRIES. on_item_done вызывается по мере готовности товаров.
+    """
+    # КРИТИЧНО: Retry logic с MAX_LSD_RETRIES из .env
+    max_retries = settings.max_lsd_retries
+    search_timeout_seconds = settings.rpa_search_timeout_sec
+    retry_count = 0
+    search_results = []
 
-                    if retry_count > 0:
-                        logger.warning(f"🔄 [{lsd_config.display_name}] Retry attempt {retry_count}/{max_retries} after timeout")
+    while retry_count <= max_retries:
+        # Захватываем слот в браузерном семафоре для ограничения параллелизма
+        logger.info(f"🔒 [{lsd_config.display_name}] Waiting for browser slot (limit: {settings.max_concurrent_browsers})...")
 
-                    logger.info(f"⏱️ [{lsd_config.display_name}] Search timeout set to {search_timeout_seconds}s")
+        try:
+            async with browser_semaphore:
+                acquired_slots = browser_semaphore._value
+                logger.info(f"✅ [{lsd_config.display_name}] Browser slot acquired (free slots: {acquired_slots}/{settings.max_concurrent_browsers})")
 
-                    try:
-                        # ВЫПОЛНЯЕМ SELENIUM ПОИСК С CDP ПРЕДЗАГРУЗКОЙ КУК + localStorage + sessionStorage
-                        search_results = await asyncio.wait_for(
-                            perform_product_search_with_cdp_cookies(
-                                lsd_config=lsd_config,
-                                search_config=search_config,
-                                cookies=cookies_data['cookies'],
-                                local_storage=cookies_data.get('localStorage', {}),
-                                session_storage=cookies_data.get('sessionStorage', {}),
-                                products=request.products,
-                                telegram_id=request.telegram_id
-                            ),
-                            timeout=search_timeout_seconds
-                        )
+                if retry_count > 0:
+                    logger.warning(f"🔄 [{lsd_config.display_name}] Retry attempt {retry_count}/{max_retries} after timeout")
 
-                        # Успех - выходим из retry loop
-                        logger.info(f"✅ [{lsd_config.display_name}] Search completed successfully")
-                        break
+                logger.info(f"⏱️ [{lsd_config.display_name}] Search timeout set to {search_timeout_seconds}s")
 
-                    except asyncio.TimeoutError:
-                        retry_count += 1
-                        logger.error(f"⏰ [{lsd_config.display_name}] TIMEOUT! Search exceeded {search_timeout_seconds}s")
-                        logger.error(f"🔪 Browser was force-closed by finally block in perform_product_search_with_cdp_cookies()")
+                try:
+                    # ВЫПОЛНЯЕМ SELENIUM ПОИСК С CDP ПРЕДЗАГРУЗКОЙ КУК + localStorage + sessionStorage
+                    search_results = await asyncio.wait_for(
+                        perform_product_search_with_cdp_cookies(
+                            lsd_config=lsd_config,
+                            search_config=search_config,
+                            cookies=cookies_data['cookies'],
+                            local_storage=cookies_data.get('localStorage', {}),
+                            session_storage=cookies_data.get('sessionStorage', {}),
+                            products=request.products,
+                            telegram_id=request.telegram_id,
+                            on_item_done=on_item_done
+                        ),
+                        timeout=search_timeout_seconds
+                    )
 
-                        if retry_count <= max_retries:
-                            logger.warning(f"🔄 [{lsd_config.display_name}] Will retry ({retry_count}/{max_retries})")
-                            # Слот освобождается при выходе из async with - следующая итерация возьмёт его снова
-                            continue
-                        else:
-                            logger.error(f"❌ [{lsd_config.display_name}] Max retries ({max_retries}) reached - returning empty results")
-                            search_results = []
-                            break
+                    # Успех - выходим из retry loop
+                    logger.info(f"✅ [{lsd_config.display_name}] Search completed successfully")
+                    break
+
+                except asyncio.TimeoutError:
+                    retry_count += 1
+                    logger.error(f"⏰ [{lsd_config.display_name}] TIMEOUT! Search exceeded {search_timeout_seconds}s")
+                    logger.error(f"🔪 Browser was force-closed by finally block in perform_product_search_with_cdp_cookies()")
 
-                    except asyncio.CancelledError:
-                        logger.error(f"🚫 [{lsd_config.display_name}] Search was CANCELLED externally")
-                        logger.error(f"💾 Partial results should have been saved in CancelledError handler")
+                    if retry_count <= max_retries:
+                        logger.warning(f"🔄 [{lsd_config.display_name}] Will retry ({retry_count}/{max_retries})")
+                        # Слот освобождается при выходе из async with - следующая итерация возьмёт его снова
+                        continue
+                    else:
+                        logger.error(f"❌ [{lsd_config.display_name}] Max retries ({max_retries}) reached - returning empty results")
                         search_results = []
                         break
 
-                    logger.info(f"🔓 [{lsd_config.display_name}] Browser slot released")
-
-            except Exception as e:
-                retry_count += 1
-                logger.error(f"❌ [{lsd_config.display_name}] Unexpected error during search: {e}")
-
-                if retry_count <= max_retries:
-                    logger.warning(f"🔄 [{lsd_config.display_name}] Will retry after error ({retry_count}/{max_retries})")
-                    continue
-                else:
-                    logger.error(f"❌ [{lsd_config.display_name}] Max retries reached after error")
+                except asyncio.CancelledError:
+                    logger.error(f"🚫 [{lsd_config.display_name}] Search was CANCELLED externally")
+                    logger.error(f"💾 Partial results should have been saved in CancelledError handler")
                     search_results = []
                     break
+
+                logger.info(f"🔓 [{lsd_config.display_name}] Browser slot released")
+
+        except Exception as e:
+            retry_count += 1
+            logger.error(f"❌ [{lsd_config.display_name}] Unexpected error during search: {e}")
+
+            if retry_count <= max_retries:
+                logger.warning(f"🔄 [{lsd_config.display_name}] Will retry after error ({retry_count}/{max_retries})")
+                continue
+            else:
+                logger.error(f"❌ [{lsd_config.display_name}] Max retries reached after error")
+                search_results = []
+                break
+
+    return search_results
+
+
+def _flatten_search_results(search_results: List[ProductSearchResult], lsd_name: str) -> List[ProductSearchResult]:
+    """
+    Результаты поиска (found_items по вариантам) -> строка на каждый найденный товар для lsd_stocks.
+
+    search_position - позиция внутри своего товара (order_item_id, все его варианты
+    по порядку), поэтому она одна и та же в /search/products, в потоковом поиске и
+    в заданиях очереди, где товар сохраняется отдельно от остальных.
+    """
+    product_search_results = []
+    positions: Dict[int, int] = {}
+    for result in search_results:
+        if result.found_items:
+            for item in result.found_items:
+                positions[result.order_item_id] = positions.get(result.order_item_id, 0) + 1
+                # Создаем ProductSearchResult из найденного элемента
+                psr = ProductSearchResult(
+                    order_item_id=result.order_item_id,
+                    product_name=result.product_name,
+                    found_name=item.get('name', result.product_name),
+                    price=item.get('price', 0.0),
+                    unit=item.get('unit', 'шт'),
+                    quantity=item.get('quantity', 1.0),  # Используем распарсенное значение
+                    available_stock=1 if item.get('available', True) else 0,
+                    product_url=item.get('url'),
+                    lsd_name=lsd_name,
+                    search_position=positions[result.order_item_id],
+                    min_order_amount=item.get('min_order_amount', 0.0),
+                    delivery_cost=item.get('delivery_cost', 0.0),
+                    delivery_cost_model=item.get('delivery_cost_model')  # Новая модель
+                )
+                product_search_results.append(psr)
+    return product_search_results
+
+
+def _search_result_summary(result: ProductSearchResult) -> Dict[str, Any]:
+    return {
+        "order_item_id": result.order_item_id,
+        "product_name": result.product_name,
+        "found_name": result.found_name,
+        "price": result.price,
+        "unit": result.unit,
+        "product_url": result.product_url,
+        "search_position": result.search_position
+    }
+
+
+async def _save_item_results(
+    request: ProductSearchRequest,
+    lsd_config,
+    product: Dict[str, Any],
+    item_results: List[ProductSearchResult],
+    item_counts: Dict[int, tuple]
+) -> Dict[str, Any]:
+    """
+    Сохраняет в lsd_stocks результаты готового товара и возвращает событие item.
+    item_counts: order_item_id -> (найдено, сохранено), обновляется здесь.
+    """
+    product_search_results = _flatten_search_results(item_results, request.lsd_name)
+    saved_count = 0
+    if product_search_results:
+        saved_count = await save_search_results_to_db(
+            search_results=product_search_results,
+            lsd_config_id=lsd_config.id,
+            telegram_id=request.telegram_id
+        )
+    item_counts[product['order_item_id']] = (len(product_search_results), saved_count)
+    return {
+        "event": "item",
+        "order_item_id": product['order_item_id'],
+        "product_name": product.get('product_name'),
+        "results_found": len(product_search_results),
+        "results_saved": saved_count,
+        "items_done": len(item_counts),
+        "items_total": len(request.products),
+        "results": [_search_result_summary(result) for result in product_search_results[:5]]
+    }
+
+
+def _search_done_event(request: ProductSearchRequest, lsd_config, item_counts: Dict[int, tuple]) -> Dict[str, Any]:
+    """Итоговое событие done по сохранённым товарам (как ответ /search/products)"""
+    found_item_ids = {item_id for item_id, (found, _) in item_counts.items() if found}
+    return {
+        "event": "done",
+        "method": "selenium",
+        "lsd_name": request.lsd_name,
+        "display_name": lsd_config.display_name,
+        "products_searched": len(request.products),
+        "results_found": sum(found for found, _ in item_counts.values()),
+        "results_saved": sum(saved for _, saved in item_counts.values()),
+        "failed_products": [product['order_item_id'] for product in request.products
+                            if product['order_item_id'] not in found_item_ids]
+    }
+
+
+@app.post("/search/products")
+async def search_products(request: ProductSearchRequest):
+    """Поиск товаров в ЛСД через Selenium RPA"""
+    logger.info(f"🔍 Starting Selenium product search for {request.lsd_name} (user: {request.telegram_id})")
+    logger.info(f"📦 Products to search: {len(request.products)}")
+    
+    try:
+        cookies_data, lsd_config, search_config = await _load_search_context(request)
+        
+        search_results = await _run_search_with_retries(request, lsd_config, search_config, cookies_data)
         
         # Преобразуем результаты в нужный формат
-        product_search_results = []
-        for result in search_results:
-            if result.found_items:
-                for item in result.found_items:
-                    # Создаем ProductSearchResult из найденного элемента
-                    psr = ProductSearchResult(
-                        order_item_id=result.order_item_id,
-                        product_name=result.product_name,
-                        found_name=item.get('name', result.product_name),
-                        price=item.get('price', 0.0),
-                        unit=item.get('unit', 'шт'),
-                        quantity=item.get('quantity', 1.0),  # Используем распарсенное значение
-                        available_stock=1 if item.get('available', True) else 0,
-                        product_url=item.get('url'),
-                        lsd_name=request.lsd_name,
-                        search_position=len(product_search_results) + 1,
-                        min_order_amount=item.get('min_order_amount', 0.0),
-                        delivery_cost=item.get('delivery_cost', 0.0),
-                        delivery_cost_model=item.get('delivery_cost_model')  # Новая модель
-                    )
-                    product_search_results.append(psr)
+        product_search_results = _flatten_search_results(search_results, request.lsd_name)
         
         # Сохраняем результаты в lsd_stocks
         saved_count = await save_search_results_to_db(
@@ -844,15 +948,7 @@ async def search_products(request: ProductSearchRequest):
                 "results_saved": saved_count,
                 "failed_products": failed_products,  # NEW: список order_item_id без результатов
                 "results": [
-                    {
-                        "order_item_id": result.order_item_id,
-                        "product_name": result.product_name,
-                        "found_name": result.found_name,
-                        "price": result.price,
-                        "unit": result.unit,
-                        "product_url": result.product_url,
-                        "search_position": result.search_position
-                    }
+                    _search_result_summary(result)
                     for result in product_search_results[:20]  # Показываем первые 20
                 ]
             }
@@ -866,6 +962,59 @@ async def search_products(request: ProductSearchRequest):
         logger.error(traceback.format_exc())
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/search/products/stream")
+async def search_products_stream(request: ProductSearchRequest):
+    """
+    Потоковый поиск товаров в ЛСД (NDJSON, строка на событие).
+
+    Каждый товар сохраняется в lsd_stocks (и fprice_snapshot), как только найдены
+    все его варианты, и сразу отдаётся событием {"event": "item", ...} - при
+    таймауте ЛСД уже найденное остаётся в БД и известно order-service.
+    Последняя строка - {"event": "done", ...} с итогом как у /search/products
+    или {"event": "error", "message": ...}.
+    """
+    logger.info(f"🔍 Starting streaming product search for {request.lsd_name} (user: {request.telegram_id})")
+    logger.info(f"📦 Products to search: {len(request.products)}")
+
+    cookies_data, lsd_config, search_config = await _load_search_context(request)
+
+    events: asyncio.Queue = asyncio.Queue()
+    # order_item_id -> (найдено, сохранено) по последнему сохранению товара
+    item_counts: Dict[int, tuple] = {}
+
+    async def on_item_done(product: Dict[str, Any], item_results: List[ProductSearchResult]):
+        await events.put(await _save_item_results(request, lsd_config, product, item_results, item_counts))
+
+    async def run_search():
+        try:
+            await _run_search_with_retries(request, lsd_config, search_config, cookies_data, on_item_done=on_item_done)
+
+            done_event = _search_done_event(request, lsd_config, item_counts)
+            logger.info(f"✅ Streaming product search completed: {done_event['results_found']} results, "
+                        f"{done_event['results_saved']} saved to DB")
+            await events.put(done_event)
+        except Exception as e:
+            logger.error(f"❌ Error in streaming product search: {e}")
+            import traceback
+            logger.error(traceback.format_exc())
+            await events.put({"event": "error", "message": str(e)})
+
+    async def stream():
+        search_task = asyncio.create_task(run_search())
+        try:
+            while True:
+                event = await events.get()
+                yield json.dumps(event, ensure_ascii=False, default=str) + "\n"
+                if event["event"] in ("done", "error"):
+                    break
+        finally:
+            # Клиент отключился - останавливаем поиск (найденное уже сохранено)
+            if not search_task.done():
+                search_task.cancel()
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
 async def perform_product_search_with_cdp_cookies(
     lsd_config,
     search_config: dict,
@@ -873,7 +1022,8 @@ async def perform_product_search_with_cdp_cookies(
     local_storage: dict,
     session_storage: dict,
     products: List[Dict[str, Any]],
-    telegram_id: int
+    telegram_id: int,
+    on_item_done: Optional[Callable[[Dict[str, Any], List[ProductSearchResult]], Awaitable[None]]] = None
 ) -> List[ProductSearchResult]:
     """
     Выполнение поиска товаров с поддержкой двух режимов:
@@ -883,6 +1033,9 @@ async def perform_product_search_with_cdp_cookies(
     После поиска cookies автоматически сохраняются:
     - CDP: в JSON файл через _save_cookies_before_return
     - Persistent: в SQLite при закрытии браузера
+
+    on_item_done(product, results) вызывается, когда товар найден во всех
+    вариантах (и повторно - после успешного retry), с результатами всех его вариантов.
     """
 
     logger.info(f"🔍 Starting product search for {len(products)} products on {lsd_config.display_name}")
@@ -1319,6 +1472,9 @@ async def perform_product_search_with_cdp_cookies(
             
             logger.info(f"{'='*60}\n")
 
+            # Товар со всеми вариантами готов - отдаём его результаты (потоковый поиск)
+            await _notify_item_done(on_item_done, product, results)
+
             # ПРИМЕЧАНИЕ: Проверка авторизации НЕ НУЖНА в persistent profile режиме
             # Куки уже находятся в SQLite базе Chrome и загружаются автоматически
             # Нет CDP менеджера в этой функции - она использует SimpleUndetectedBrowser 
@@ -1374,6 +1530,7 @@ async def perform_product_search_with_cdp_cookies(
                             found_count = len(result.found_items)
                             logger.info(f"✅ Retry SUCCESS for '{variant_name}' - found {found_count} items")
                             # Результат уже обновлен в result, который уже в results
+                            await _notify_item_done(on_item_done, product, results)
                         else:
                             logger.warning(f"⚠️ Retry FAILED for '{variant_name}'")
                             still_failed.append(item_data)
@@ -1422,10 +1579,13 @@ async def perform_product_search_with_cdp_cookies(
 
         # Преобразуем results в формат для сохранения
         product_search_results = []
+        positions: Dict[int, int] = {}
         for result in results:
             if result.found_items:
                 for item in result.found_items:
                     from models.product_search import ProductSearchResult as PSR
+                    # Позиция внутри товара, как в _flatten_search_results
+                    positions[result.order_item_id] = positions.get(result.order_item_id, 0) + 1
                     psr = PSR(
                         order_item_id=result.order_item_id,
                         product_name=result.product_name,
@@ -1436,7 +1596,7 @@ async def perform_product_search_with_cdp_cookies(
                         available_stock=1 if item.get('available', True) else 0,
                         product_url=item.get('url'),
                         lsd_name=lsd_config.name,
-                        search_position=len(product_search_results) + 1,
+                        search_position=positions[result.order_item_id],
                         min_order_amount=item.get('min_order_amount', 0.0),
                         delivery_cost=item.get('delivery_cost', 0.0),
                         delivery_cost_model=item.get('delivery_cost_model')
@@ -1539,6 +1699,21 @@ async def perform_product_search_with_cdp_cookies(
         else:
             logger.debug(f"ℹ️ No browser to cleanup (not initialized or already cleaned)")
 
+async def _notify_item_done(
+    on_item_done: Optional[Callable[[Dict[str, Any], List[ProductSearchResult]], Awaitable[None]]],
+    product: Dict[str, Any],
+    results: List[ProductSearchResult]
+):
+    """Вызов on_item_done с результатами всех вариантов товара; ошибка колбэка не прерывает поиск"""
+    if on_item_done is None:
+        return
+    try:
+        item_results = [result for result in results if result.order_item_id == product['order_item_id']]
+        await on_item_done(product, item_results)
+    except Exception as e:
+        logger.error(f"❌ Error handling finished item {product.get('order_item_id')}: {e}")
+
+
 async def handle_search_results_with_modals(driver, search_config: dict, lsd_config):
     """
     Умное ожидание: одновременно ждём либо появления контейнера с товарами,
@@ -2679,6 +2854,17 @@ async def save_search_results_to_db(
                     import traceback
                     logger.error(traceback.format_exc())
             
+            # Снимок fprice товаров этого поиска (fprice_min зависит от всех ЛСД товара) -
+            # в той же транзакции, что и замена lsd_stocks: старые строки снимка не переживают удалённые stocks
+            if order_id and search_results:
+                try:
+                    async with db.begin_nested():
+                        await refresh_fprice_snapshot(db, order_id, order_item_ids, commit=False)
+                except Exception as e:
+                    # Без снимка этих товаров; полный пересчёт перед ANALYSIS_COMPLETE построит его заново
+                    logger.warning(f"⚠️ Failed to refresh fprice snapshot for order {order_id}: {e}")
+                    await clear_fprice_snapshot(db, order_id, order_item_ids)
+            
             await db.commit()
             logger.info(f"💾 Successfully saved {saved_count}/{len(search_results)} results to lsd_stocks")
             
@@ -2882,35 +3068,33 @@ async def send_telegram_message(chat_id: str, text: str, reply_to_message_id: in
     который автоматически логирует их в user_messages таблицу.
     """
     try:
-        import httpx
-
         logger.info(f"📤 Sending message via telegram-bot API to {chat_id}, length: {len(text)} chars")
 
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                "http://localhost:8001/api/send-message",
-                json={
-                    "chat_id": chat_id,
-                    "text": text,
-                    "order_id": None,  # RPA-service не связан с заказами напрямую
-                    "reply_to_message_id": reply_to_message_id,
-                    "parse_mode": parse_mode or "HTML",
-                    "disable_web_page_preview": disable_web_page_preview
-                },
-                timeout=30.0
-            )
+        client = http_clients.service('telegram-bot')
+        response = await client.post(
+            "/api/send-message",
+            json={
+                "chat_id": chat_id,
+                "text": text,
+                "order_id": None,  # RPA-service не связан с заказами напрямую
+                "reply_to_message_id": reply_to_message_id,
+                "parse_mode": parse_mode or "HTML",
+                "disable_web_page_preview": disable_web_page_preview
+            },
+            timeout=30.0
+        )
 
-            if response.status_code == 200:
-                result = response.json()
-                if result.get("success"):
-                    logger.info(f"✅ Message sent successfully to {chat_id} (telegram_message_id={result.get('telegram_message_id')})")
-                    return True
-                else:
-                    logger.error(f"❌ telegram-bot API returned error: {result.get('error')}")
-                    return False
+        if response.status_code == 200:
+            result = response.json()
+            if result.get("success"):
+                logger.info(f"✅ Message sent successfully to {chat_id} (telegram_message_id={result.get('telegram_message_id')})")
+                return True
             else:
-                logger.error(f"❌ telegram-bot API request failed: {response.status_code} - {response.text}")
+                logger.error(f"❌ telegram-bot API returned error: {result.get('error')}")
                 return False
+        else:
+            logger.error(f"❌ telegram-bot API request failed: {response.status_code} - {response.text}")
+            return False
 
     except Exception as e:
         logger.error(f"❌ Error calling telegram-bot API for {chat_id}: {e}")
@@ -3987,39 +4171,37 @@ async def execute_selenium_auth_flow(telegram_id: int, lsd_config: LSDConfig, au
 async def notify_user_about_auth_start(telegram_id: int, display_name: str, base_url: str):
     """Уведомление о начале авторизации"""
     try:
-        import httpx
-        async with httpx.AsyncClient() as client:
-            await client.post(
-                "http://localhost:8001/rpa/qr-code-extracted",
-                json={
-                    "telegram_id": telegram_id,
-                    "qr_link": base_url,
-                    "action": "auth_start",
-                    "message": f"🔐 Открыт браузер для авторизации в {display_name}. Пройдите авторизацию в открывшемся окне браузера."
-                },
-                timeout=5.0
-            )
+        client = http_clients.service('telegram-bot')
+        await client.post(
+            "/rpa/qr-code-extracted",
+            json={
+                "telegram_id": telegram_id,
+                "qr_link": base_url,
+                "action": "auth_start",
+                "message": f"🔐 Открыт браузер для авторизации в {display_name}. Пройдите авторизацию в открывшемся окне браузера."
+            },
+            timeout=5.0
+        )
     except Exception as e:
         logger.error(f"❌ Error notifying user about auth start: {e}")
 
 async def notify_user_auth_progress(telegram_id: int, elapsed: int, total: int):
     """Уведомление о прогрессе авторизации"""
     try:
-        import httpx
         minutes_elapsed = elapsed // 60
         minutes_total = total // 60
         
-        async with httpx.AsyncClient() as client:
-            await client.post(
-                "http://localhost:8001/rpa/qr-code-extracted",
-                json={
-                    "telegram_id": telegram_id,
-                    "qr_link": f"⏳ Прошло {minutes_elapsed}/{minutes_total} мин. Ожидаю авторизации...",
-                    "action": "auth_progress",
-                    "message": ""
-                },
-                timeout=5.0
-            )
+        client = http_clients.service('telegram-bot')
+        await client.post(
+            "/rpa/qr-code-extracted",
+            json={
+                "telegram_id": telegram_id,
+                "qr_link": f"⏳ Прошло {minutes_elapsed}/{minutes_total} мин. Ожидаю авторизации...",
+                "action": "auth_progress",
+                "message": ""
+            },
+            timeout=5.0
+        )
     except Exception as e:
         logger.error(f"❌ Error notifying user about auth progress: {e}")
 
@@ -4073,7 +4255,6 @@ async def get_qr_message_id(telegram_id: int) -> int | None:
 async def notify_user_auth_success(telegram_id: int, display_name: str, cookies_count: int):
     """Уведомление об успешной авторизации"""
     try:
-        import httpx
         
         # Получаем message_id сообщения с QR ссылкой
         qr_message_id = await get_qr_message_id(telegram_id)
@@ -4093,15 +4274,15 @@ async def notify_user_auth_success(telegram_id: int, display_name: str, cookies_
         
         logger.info(f"📤 Sending auth success to telegram-bot: {payload}")
         
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                "http://localhost:8001/rpa/auth-success",
-                json=payload,
-                timeout=5.0
-            )
-            
-            logger.info(f"✅ Auth success notification sent, response: {response.status_code}")
-            
+        client = http_clients.service('telegram-bot')
+        response = await client.post(
+            "/rpa/auth-success",
+            json=payload,
+            timeout=5.0
+        )
+        
+        logger.info(f"✅ Auth success notification sent, response: {response.status_code}")
+        
     except Exception as e:
         logger.error(f"❌ Error notifying user about auth success: {e}")
         import traceback
@@ -4110,36 +4291,34 @@ async def notify_user_auth_success(telegram_id: int, display_name: str, cookies_
 async def notify_user_auth_timeout(telegram_id: int, display_name: str):
     """Уведомление о таймауте авторизации"""
     try:
-        import httpx
-        async with httpx.AsyncClient() as client:
-            await client.post(
-                "http://localhost:8001/rpa/qr-code-extracted",
-                json={
-                    "telegram_id": telegram_id,
-                    "qr_link": f"❌ Таймаут авторизации в {display_name}. Попробуйте снова.",
-                    "action": "auth_timeout",
-                    "message": ""
-                },
-                timeout=5.0
-            )
+        client = http_clients.service('telegram-bot')
+        await client.post(
+            "/rpa/qr-code-extracted",
+            json={
+                "telegram_id": telegram_id,
+                "qr_link": f"❌ Таймаут авторизации в {display_name}. Попробуйте снова.",
+                "action": "auth_timeout",
+                "message": ""
+            },
+            timeout=5.0
+        )
     except Exception as e:
         logger.error(f"❌ Error notifying user about auth timeout: {e}")
 
 async def notify_user_auth_error(telegram_id: int, display_name: str, error_message: str):
     """Уведомление об ошибке авторизации"""
     try:
-        import httpx
-        async with httpx.AsyncClient() as client:
-            await client.post(
-                "http://localhost:8001/rpa/qr-code-extracted",
-                json={
-                    "telegram_id": telegram_id,
-                    "qr_link": f"❌ Ошибка авторизации в {display_name}: {error_message}",
-                    "action": "auth_error",
-                    "message": ""
-                },
-                timeout=5.0
-            )
+        client = http_clients.service('telegram-bot')
+        await client.post(
+            "/rpa/qr-code-extracted",
+            json={
+                "telegram_id": telegram_id,
+                "qr_link": f"❌ Ошибка авторизации в {display_name}: {error_message}",
+                "action": "auth_error",
+                "message": ""
+            },
+            timeout=5.0
+        )
     except Exception as e:
         logger.error(f"❌ Error notifying user about auth error: {e}")
 
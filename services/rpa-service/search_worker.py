@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Celery-воркер распределённого поиска товаров в ЛСД (shared/utils/search_jobs.py).
+
+Запускается на каждом хосте с браузерами (из services/rpa-service):
+
+    celery -A search_worker worker -Q rpa_search -n rpa@%h
+
+- Процессов воркера RPA_WORKER_BROWSERS (0 - MAX_CONCURRENT_BROWSERS), в каждом
+  один поиск = один браузер: задание берётся, только когда браузер свободен,
+  и ёмкость растёт добавлением хостов
+- Поиск тот же, что у /search/products/stream: _run_search_with_retries, товары
+  сохраняются через save_search_results_to_db по мере готовности, события
+  item / done / error пишутся в rpa:search:events:{job_id}; пропущенная
+  доставка (отменена или уже в работе у другого процесса) - событие skipped
+- Аренду задания продлевает поток-heartbeat (selenium блокирует цикл событий);
+  отменённая доставка (rpa:search:cancel) останавливает поиск
+"""
+
+import asyncio
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+from typing import Any, Dict, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+import redis
+
+import main as rpa
+from config.settings import settings
+from shared.utils.search_jobs import (
+    celery_app,
+    SEARCH_TASK,
+    JOB_KEY_TTL_SEC,
+    events_key,
+    lease_key,
+    cancel_key,
+)
+
+logger = logging.getLogger(__name__)
+
+# Свои на каждый процесс воркера (создаются после fork): пул соединений БД
+# и HTTP-клиенты привязаны к циклу событий и живут между заданиями
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_redis: Optional[redis.Redis] = None
+
+
+def _process_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    if _loop is None:
+        _loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(_loop)
+    return _loop
+
+
+def _process_redis() -> redis.Redis:
+    global _redis
+    if _redis is None:
+        _redis = redis.Redis.from_url(settings.redis_url)
+    return _redis
+
+
+def _worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _push_event(r: redis.Redis, job_id: str, event: Dict[str, Any]):
+    key = events_key(job_id)
+    pipe = r.pipeline()
+    pipe.rpush(key, json.dumps(event, ensure_ascii=False, default=str))
+    pipe.expire(key, JOB_KEY_TTL_SEC)
+    pipe.execute()
+
+
+class _LeaseHeartbeat(threading.Thread):
+    """Продлевает аренду задания; при отмене доставки отменяет задачу поиска."""
+
+    def __init__(self, r: redis.Redis, job_id: str, loop: asyncio.AbstractEventLoop, task: asyncio.Task):
+        super().__init__(name=f"lease-{job_id}", daemon=True)
+        self.r = r
+        self.job_id = job_id
+        self.loop = loop
+        self.task = task
+        self._stopped = threading.Event()
+
+    def run(self):
+        interval = max(1.0, settings.rpa_job_lease_sec / 3)
+        while not self._stopped.wait(interval):
+            try:
+                if self.r.exists(cancel_key(self.job_id)):
+                    logger.warning(f"🚫 Job {self.job_id} was cancelled by order-service, stopping search")
+                    self.loop.call_soon_threadsafe(self.task.cancel)
+                    return
+                self.r.set(lease_key(self.job_id), _worker_id(), ex=settings.rpa_job_lease_sec)
+            except redis.RedisError as e:
+                logger.warning(f"⚠️ Failed to renew lease of job {self.job_id}: {e}")
+
+    def stop(self):
+        self._stopped.set()
+        self.join(timeout=5)
+
+
+async def _run_job(r: redis.Redis, job: Dict[str, Any]):
+    job_id = job['job_id']
+    request = rpa.ProductSearchRequest(
+        telegram_id=job['telegram_id'],
+        lsd_name=job['lsd_name'],
+        products=job['products']
+    )
+    _push_event(r, job_id, {"event": "started", "worker": _worker_id()})
+
+    try:
+        cookies_data, lsd_config, search_config = await rpa._load_search_context(request)
+
+        # order_item_id -> (найдено, сохранено)
+        item_counts: Dict[int, tuple] = {}
+
+        async def on_item_done(product, item_results):
+            _push_event(r, job_id, await rpa._save_item_results(request, lsd_config, product, item_results, item_counts))
+
+        await rpa._run_search_with_retries(request, lsd_config, search_config, cookies_data, on_item_done=on_item_done)
+
+        done_event = rpa._search_done_event(request, lsd_config, item_counts)
+        done_event["worker"] = _worker_id()
+        logger.info(f"✅ Job {job_id}: {done_event['results_found']} results, {done_event['results_saved']} saved to DB")
+        _push_event(r, job_id, done_event)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        # HTTPException из _load_search_context (нет кук, конфигурации) - в detail
+        message = getattr(e, 'detail', None) or str(e)
+        logger.error(f"❌ Job {job_id} failed: {message}")
+        _push_event(r, job_id, {"event": "error", "message": message, "worker": _worker_id()})
+
+
+@celery_app.task(name=SEARCH_TASK)
+def search_products_job(job: Dict[str, Any]):
+    """Задание поиска (заказ, ЛСД, пачка товаров) - см. shared.utils.search_jobs.make_job"""
+    r = _process_redis()
+    job_id = job['job_id']
+
+    # Пропуск доставки - тоже событие: order-service не должен ждать его молча
+    if r.exists(cancel_key(job_id)):
+        logger.info(f"⏭️ Job {job_id} was re-delivered elsewhere, skipping")
+        _push_event(r, job_id, {"event": "skipped", "reason": "cancelled", "worker": _worker_id()})
+        return
+    # Повторная доставка того же сообщения Celery не запускает второй браузер, пока аренда жива
+    if not r.set(lease_key(job_id), _worker_id(), nx=True, ex=settings.rpa_job_lease_sec):
+        holder = r.get(lease_key(job_id))
+        holder = holder.decode() if isinstance(holder, bytes) else holder
+        logger.info(f"⏭️ Job {job_id} is leased by {holder}, skipping")
+        _push_event(r, job_id, {"event": "skipped", "reason": "leased", "leased_by": holder,
+                                "worker": _worker_id()})
+        return
+
+    logger.info(f"🔍 Job {job_id}: {len(job['products'])} products in {job['lsd_name']} (attempt {job['attempt']})")
+
+    loop = _process_loop()
+    task = loop.create_task(_run_job(r, job))
+    heartbeat = _LeaseHeartbeat(r, job_id, loop, task)
+    heartbeat.start()
+    try:
+        loop.run_until_complete(task)
+    except asyncio.CancelledError:
+        logger.warning(f"🚫 Job {job_id} cancelled")
+    finally:
+        heartbeat.stop()
+        # Последнее событие уже записано - order-service не примет снятую аренду за потерю
+        r.delete(lease_key(job_id))
@@ -64,6 +64,8 @@ import asyncio
 # HTTP client with retries
 from shared.utils.http_client import (
     RetryableHTTPClient,
+    http_clients,
+    http2_available,
     get_user_service_client,
     get_order_service_client,
     get_rpa_service_client
@@ -2162,6 +2164,11 @@ class KorzinkaTelegramBot:
                         SELECT id FROM orders WHERE user_id = {user_db_id}
                     )
                 """))
+                await db.execute(text(f"""
+                    DELETE FROM fprice_snapshot WHERE order_id IN (
+                        SELECT id FROM orders WHERE user_id = {user_db_id}
+                    )
+                """))
                 await db.execute(text(f"""
                     DELETE FROM lsd_stocks WHERE order_id IN (
                         SELECT id FROM orders WHERE user_id = {user_db_id}
@@ -2241,13 +2248,25 @@ class KorzinkaTelegramBot:
             )
             server = uvicorn.Server(config)
             
+            async def serve():
+                try:
+                    await server.serve()
+                finally:
+                    # Пулы HTTP-соединений event loop'а этого потока
+                    await http_clients.aclose()
+            
             # Создаем новый event loop для этого потока
             import asyncio
-            asyncio.run(server.serve())
+            asyncio.run(serve())
         except Exception as e:
             logger.error(f"Error starting API server: {e}")
 
 
+async def _close_http_clients(application: Application) -> None:
+    """Закрытие пулов HTTP-соединений к сервисам (event loop бота)"""
+    await http_clients.aclose()
+
+
 def main() -> None:
     """Точка входа для запуска бота"""
     # Защита от повторного логирования при перезагрузке
@@ -2259,8 +2278,20 @@ def main() -> None:
     
     bot = KorzinkaTelegramBot()
 
-    # Создаем приложение
-    bot.application = Application.builder().token(settings.telegram_bot_token).build()
+    # Создаем приложение: пул соединений к Telegram Bot API и закрытие
+    # пулов HTTP-соединений к сервисам при остановке
+    builder = (
+        Application.builder()
+        .token(settings.telegram_bot_token)
+        .connection_pool_size(settings.telegram_api_pool_size)
+        .post_shutdown(_close_http_clients)
+    )
+    if settings.telegram_api_http2:
+        if http2_available():
+            builder = builder.http_version("2")
+        else:
+            logger.warning("⚠️ TELEGRAM_API_HTTP2=1, but h2 is not installed - using HTTP/1.1")
+    bot.application = builder.build()
 
     # Инициализируем фабрику сессий БД в bot_data
     from shared.database import AsyncSessionLocal
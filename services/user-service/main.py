@@ -1,4 +1,6 @@
 import asyncio
+import hashlib
+import json
 import sys
 import os
 import logging
@@ -851,11 +853,20 @@ async def get_user_exclusion_keywords(telegram_id: int, db: AsyncSession = Depen
                 )
                 keywords = {kw.keyword.lower() for kw in keywords_result.scalars().all()}
 
+        keywords = sorted(keywords)
+        products = sorted({p.lower() for p in (exclusion.excluded_products or [])})
+
+        # Штамп версии: оптимизатор кэширует скомпилированные исключения по (telegram_id, version)
+        version = hashlib.sha1(
+            json.dumps([keywords, products], ensure_ascii=False).encode('utf-8')
+        ).hexdigest()[:16]
+
         return APIResponse(
             success=True,
             data={
-                "keywords": list(keywords),
-                "products": [p.lower() for p in (exclusion.excluded_products or [])]
+                "keywords": keywords,
+                "products": products,
+                "version": version
             }
         )
 
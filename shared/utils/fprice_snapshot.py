@@ -0,0 +1,88 @@
+"""
+Refresh of the per-order fprice snapshot (fprice_snapshot table).
+
+The optimizers read fprice_snapshot instead of the fprice_optimizer view;
+rows are recalculated by the SQL function refresh_fprice_snapshot
+(services/optimizer/fprice_snapshot.sql).
+"""
+from typing import Iterable, Optional
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from shared.utils.unified_logging import get_logger
+
+logger = get_logger(__name__)
+
+
+async def refresh_fprice_snapshot(
+    db: AsyncSession,
+    order_id: int,
+    order_item_ids: Optional[Iterable[int]] = None,
+    commit: bool = True
+) -> Optional[int]:
+    """
+    Пересчитывает снимок fprice заказа
+
+    Args:
+        db: Сессия БД
+        order_id: ID заказа
+        order_item_ids: Только эти товары (None - весь заказ)
+        commit: True - зафиксировать транзакцию, ошибку только залогировать;
+            False - пересчёт в транзакции вызывающего (изменения lsd_stocks /
+            статус заказа фиксируются вместе со снимком), ошибка пробрасывается
+
+    Returns:
+        Количество строк снимка или None, если пересчитать не удалось
+    """
+    item_ids = None if order_item_ids is None else sorted({int(item_id) for item_id in order_item_ids})
+    scope = "all items" if item_ids is None else f"{len(item_ids)} items"
+
+    if not commit:
+        # Несохранённые ORM-изменения (новые lsd_stocks) должны попасть в снимок
+        await db.flush()
+        result = await db.execute(
+            text("SELECT refresh_fprice_snapshot(:order_id, CAST(:order_item_ids AS bigint[]))"),
+            {"order_id": order_id, "order_item_ids": item_ids}
+        )
+        rows = result.scalar()
+        logger.info(f"📸 fprice snapshot refreshed for order {order_id} ({scope}, pending commit): {rows} rows")
+        return rows
+
+    try:
+        result = await db.execute(
+            text("SELECT refresh_fprice_snapshot(:order_id, CAST(:order_item_ids AS bigint[]))"),
+            {"order_id": order_id, "order_item_ids": item_ids}
+        )
+        rows = result.scalar()
+        await db.commit()
+    except Exception as e:
+        await db.rollback()
+        logger.warning(f"⚠️ Failed to refresh fprice snapshot for order {order_id}: {e}")
+        return None
+
+    logger.info(f"📸 fprice snapshot refreshed for order {order_id} ({scope}): {rows} rows")
+    return rows
+
+
+async def clear_fprice_snapshot(
+    db: AsyncSession,
+    order_id: int,
+    order_item_ids: Optional[Iterable[int]] = None
+) -> int:
+    """
+    Удаляет строки снимка заказа в транзакции вызывающего (без commit).
+
+    Вызывается везде, где удаляются lsd_stocks заказа: снимок не должен
+    переживать строки, из которых он построен.
+    """
+    item_ids = None if order_item_ids is None else sorted({int(item_id) for item_id in order_item_ids})
+    result = await db.execute(
+        text("""
+            DELETE FROM fprice_snapshot
+            WHERE order_id = :order_id
+              AND (CAST(:order_item_ids AS bigint[]) IS NULL OR order_item_id = ANY(CAST(:order_item_ids AS bigint[])))
+        """),
+        {"order_id": order_id, "order_item_ids": item_ids}
+    )
+    return result.rowcount
@@ -1,14 +1,104 @@
-"""HTTP client with exponential backoff retry logic."""
+"""HTTP clients for inter-service calls: pooled keep-alive clients and exponential backoff retry logic."""
 
 import asyncio
+import importlib.util
 import logging
-from typing import Optional, Any
+import weakref
+from typing import Dict, Optional, Any
 from functools import wraps
 
 import httpx
 
 logger = logging.getLogger(__name__)
 
+# Target services: name -> settings attribute with the port
+SERVICE_PORTS = {
+    'telegram-bot': 'telegram_bot_port',
+    'user': 'user_service_port',
+    'order': 'order_service_port',
+    'rpa': 'rpa_service_port',
+    'promotion': 'promotion_service_port',
+}
+
+
+def http2_available() -> bool:
+    """HTTP/2 needs the optional h2 package (httpx[http2])."""
+    return importlib.util.find_spec('h2') is not None
+
+
+def pool_limits() -> httpx.Limits:
+    """Connection pool limits from settings (HTTP_POOL_*)."""
+    from config.settings import settings
+    return httpx.Limits(
+        max_connections=settings.http_pool_max_connections,
+        max_keepalive_connections=settings.http_pool_max_keepalive,
+        keepalive_expiry=settings.http_pool_keepalive_expiry
+    )
+
+
+class HTTPClientRegistry:
+    """
+    Process-wide httpx.AsyncClient per target base URL with keep-alive pools.
+
+    Connections are reused between requests instead of a new client (TCP
+    handshake and pool setup) per call. An httpx pool belongs to the event loop
+    it was created in, so clients are kept per running loop (telegram-bot runs
+    its API server in a separate thread with its own loop).
+    """
+
+    def __init__(self):
+        self._clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, httpx.AsyncClient]]" = \
+            weakref.WeakKeyDictionary()
+
+    def get(self, base_url: str, http2: bool = False, timeout: float = 30.0) -> httpx.AsyncClient:
+        """
+        Pooled client for base_url in the running event loop.
+
+        Args:
+            base_url: Target base URL (requests may use paths relative to it)
+            http2: Negotiate HTTP/2 (HTTPS targets only, requires h2)
+            timeout: Default request timeout in seconds (per-request timeout overrides it)
+        """
+        base_url = base_url.rstrip('/')
+        clients = self._clients.setdefault(asyncio.get_running_loop(), {})
+        client = clients.get(base_url)
+        if client is None or client.is_closed:
+            if http2 and not http2_available():
+                logger.warning(f"HTTP/2 requested for {base_url} but h2 is not installed, using HTTP/1.1")
+                http2 = False
+            client = httpx.AsyncClient(
+                base_url=base_url,
+                limits=pool_limits(),
+                http2=http2,
+                timeout=timeout
+            )
+            clients[base_url] = client
+        return client
+
+    def service(self, name: str) -> httpx.AsyncClient:
+        """
+        Pooled client for a project service (see SERVICE_PORTS).
+
+        Services are plain-HTTP uvicorn on localhost, which does not speak
+        HTTP/2 without TLS, so these clients use HTTP/1.1 keep-alive.
+        """
+        from config.settings import settings
+        return self.get(f"http://localhost:{getattr(settings, SERVICE_PORTS[name])}")
+
+    async def aclose(self):
+        """Close clients of the running event loop (service shutdown)."""
+        clients = self._clients.pop(asyncio.get_running_loop(), {})
+        for base_url, client in clients.items():
+            try:
+                await client.aclose()
+            except Exception as e:
+                logger.warning(f"Failed to close HTTP client for {base_url}: {e}")
+        if clients:
+            logger.info(f"Closed {len(clients)} pooled HTTP clients")
+
+
+http_clients = HTTPClientRegistry()
+
 
 class RetryableHTTPClient:
     """HTTP client wrapper with exponential backoff retries."""
@@ -59,9 +149,8 @@ class RetryableHTTPClient:
 
         for attempt in range(self.max_retries):
             try:
-                async with httpx.AsyncClient(timeout=self.timeout) as client:
-                    response = await getattr(client, method.lower())(url, **kwargs)
-                    return response
+                client = http_clients.get(self.base_url)
+                return await client.request(method, url, **{'timeout': self.timeout, **kwargs})
 
             except (httpx.ConnectError, httpx.TimeoutException, httpx.NetworkError) as e:
                 last_exception = e
@@ -0,0 +1,74 @@
+"""
+Distributed LSD search jobs: Celery app and Redis keys shared by the
+order-service (producer) and RPA workers (services/rpa-service/search_worker.py).
+
+A job is one (order, LSD, product batch). Workers on any host pull jobs from
+the rpa_search queue, one job per worker process (= one browser). The job
+protocol lives in Redis next to the Celery broker:
+
+- rpa:search:events:{job_id} - list of NDJSON-like events from the worker
+  (started / item / done / error), same events as /search/products/stream,
+  plus skipped when a worker drops a delivery it must not run
+- rpa:search:lease:{job_id} - lease held by the worker, renewed by heartbeat;
+  when it expires the producer re-delivers the unfinished products
+- rpa:search:cancel:{job_id} - the producer gave up on this delivery
+
+job_id ends with a random nonce: the keys outlive the job by JOB_KEY_TTL_SEC,
+and a restarted analysis of the same order must not inherit the cancel mark
+or the events of an earlier run.
+"""
+import uuid
+from typing import Any, Dict, List
+
+from celery import Celery
+
+from config.settings import settings
+
+SEARCH_QUEUE = 'rpa_search'
+SEARCH_TASK = 'rpa.search_products'
+
+# События и отметки живут не дольше часа после последней записи
+JOB_KEY_TTL_SEC = 3600
+
+celery_app = Celery('korzinka_rpa', broker=settings.redis_url)
+celery_app.conf.update(
+    task_default_queue=SEARCH_QUEUE,
+    task_routes={SEARCH_TASK: {'queue': SEARCH_QUEUE}},
+    task_serializer='json',
+    accept_content=['json'],
+    task_ignore_result=True,
+    # Ёмкость воркера - число браузеров; задание берётся, только когда браузер свободен
+    worker_concurrency=settings.rpa_worker_browsers or settings.max_concurrent_browsers,
+    worker_prefetch_multiplier=1,
+    # Упавший процесс воркера возвращает задание в очередь
+    task_acks_late=True,
+    task_reject_on_worker_lost=True,
+    broker_transport_options={'visibility_timeout': settings.rpa_search_timeout_sec * (settings.max_lsd_retries + 1) + 600},
+)
+
+
+def events_key(job_id: str) -> str:
+    return f"rpa:search:events:{job_id}"
+
+
+def lease_key(job_id: str) -> str:
+    return f"rpa:search:lease:{job_id}"
+
+
+def cancel_key(job_id: str) -> str:
+    return f"rpa:search:cancel:{job_id}"
+
+
+def make_job(order_id: int, telegram_id: int, lsd_name: str, batch: int, attempt: int,
+             products: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Задание поиска; у каждой доставки свой job_id и свои события, в том числе
+    у доставок повторного анализа того же заказа (случайный суффикс)"""
+    return {
+        "job_id": f"{order_id}:{lsd_name}:{batch}:{attempt}:{uuid.uuid4().hex[:12]}",
+        "order_id": order_id,
+        "telegram_id": telegram_id,
+        "lsd_name": lsd_name,
+        "batch": batch,
+        "attempt": attempt,
+        "products": products,
+    }